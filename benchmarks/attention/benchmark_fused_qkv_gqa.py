@@ -0,0 +1,87 @@
+"""
+CPU microbenchmark of the fused QKV projection and of grouped query attention without repeating the key/value
+heads, across different head configurations (MHA, GQA and MQA).
+
+For each configuration, the benchmark compares
+  - separate q/k/v projections (three GEMMs) vs. the fused qkv projection (single GEMM) and
+  - attention on physically repeated key/value heads vs. the grouped attention of
+    CausalSelfAttention.execute_attention (manual implementation).
+The memory metric is the number of bytes that autograd keeps alive for the backward pass.
+
+Example:
+    python benchmarks/attention/benchmark_fused_qkv_gqa.py --sequence_length 1024 --n_embd 1024
+"""
+import argparse
+import time
+from typing import Callable, Dict, Tuple
+
+import torch
+
+from modalities.models.gpt2.gpt2_model import AttentionImplementation, CausalSelfAttention
+
+
+def measure(forward_fun: Callable[[], torch.Tensor], num_repetitions: int) -> Tuple[float, int]:
+    saved_tensors: Dict[int, int] = {}
+
+    def pack_hook(t: torch.Tensor) -> torch.Tensor:
+        saved_tensors[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    forward_fun().sum().backward()  # warmup
+    start = time.perf_counter()
+    for _ in range(num_repetitions):
+        saved_tensors.clear()
+        with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda t: t):
+            out = forward_fun()
+        out.sum().backward()
+    return (time.perf_counter() - start) / num_repetitions, sum(saved_tensors.values())
+
+
+def main(batch_size: int, sequence_length: int, n_embd: int, head_dim: int, num_repetitions: int):
+    torch.manual_seed(0)
+    n_head_q = n_embd // head_dim
+    x = torch.randn(batch_size, sequence_length, n_embd, requires_grad=True)
+
+    for n_head_kv in [n_head_q, n_head_q // 4, n_head_q // 8, 1]:
+        kv_dim = n_embd * n_head_kv // n_head_q
+        q_proj = torch.nn.Linear(n_embd, n_embd, bias=False)
+        k_proj = torch.nn.Linear(n_embd, kv_dim, bias=False)
+        v_proj = torch.nn.Linear(n_embd, kv_dim, bias=False)
+        qkv_proj = torch.nn.Linear(n_embd, n_embd + 2 * kv_dim, bias=False)
+
+        q = torch.randn(batch_size, n_head_q, sequence_length, head_dim, requires_grad=True)
+        k = torch.randn(batch_size, n_head_kv, sequence_length, head_dim, requires_grad=True)
+        v = torch.randn(batch_size, n_head_kv, sequence_length, head_dim, requires_grad=True)
+
+        def repeated_kv_attention() -> torch.Tensor:
+            k_repeated, v_repeated = CausalSelfAttention.repeat_kv_heads(q, k, v)
+            return CausalSelfAttention.execute_attention(
+                q, k_repeated, v_repeated, dropout=0.0, attention_impl=AttentionImplementation.MANUAL
+            )
+
+        def grouped_attention() -> torch.Tensor:
+            return CausalSelfAttention.execute_attention(
+                q, k, v, dropout=0.0, attention_impl=AttentionImplementation.MANUAL
+            )
+
+        candidates = {
+            "separate q/k/v": lambda: torch.cat([q_proj(x), k_proj(x), v_proj(x)], dim=-1),
+            "fused qkv": lambda: qkv_proj(x),
+            "repeated kv attention": repeated_kv_attention,
+            "grouped attention": grouped_attention,
+        }
+        print(f"n_head_q={n_head_q}, n_head_kv={n_head_kv}")
+        for name, forward_fun in candidates.items():
+            duration, num_saved_bytes = measure(forward_fun, num_repetitions)
+            print(f"{name:>24}: {duration * 1000:8.1f} ms | saved for backward: {num_saved_bytes / 1024**2:8.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--sequence_length", type=int, default=512)
+    parser.add_argument("--n_embd", type=int, default=1024)
+    parser.add_argument("--head_dim", type=int, default=64)
+    parser.add_argument("--num_repetitions", type=int, default=5)
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,57 @@
+"""
+Benchmark of the index mapping construction of OpenGPTXMMapDataset, comparing the NumPy-vectorized
+build_sample_idx with the loop-based reference implementation.
+
+Example:
+    python benchmarks/dataloader/benchmark_build_sample_idx.py --num_documents 100000 --num_samples 200000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from modalities.dataloader.open_gptx_dataset.open_gptx_dataset import (
+    _build_sample_idx_loop,
+    build_doc_idx,
+    build_sample_idx,
+    get_num_epochs,
+    get_num_tokens_per_epoch,
+)
+
+
+def main(num_documents: int, mean_document_size: int, sequence_len: int, num_samples: int):
+    np_rng = np.random.RandomState(seed=0)
+    sizes = np_rng.geometric(1 / mean_document_size, size=num_documents).astype(np.int32)
+    documents = np.arange(num_documents)
+    tokens_per_epoch = get_num_tokens_per_epoch(documents=documents, sizes=sizes)
+    num_epochs = get_num_epochs(
+        num_tokens_per_epoch=tokens_per_epoch, sequence_len=sequence_len, num_samples=num_samples
+    )
+
+    start = time.perf_counter()
+    doc_idx = build_doc_idx(documents, num_epochs, np_rng, separate_last_epoch=False)
+    print(f"build_doc_idx ({len(doc_idx)} entries): {time.perf_counter() - start:.3f} s")
+
+    sample_idx_kwargs = dict(
+        sizes=sizes,
+        doc_idx=doc_idx,
+        seq_length=sequence_len,
+        num_epochs=num_epochs,
+        tokens_per_epoch=tokens_per_epoch,
+    )
+    results = {}
+    for name, fun in [("vectorized", build_sample_idx), ("loop", _build_sample_idx_loop)]:
+        start = time.perf_counter()
+        results[name] = fun(**sample_idx_kwargs)
+        print(f"build_sample_idx {name:>10} ({len(results[name])} entries): {time.perf_counter() - start:.3f} s")
+    assert np.array_equal(results["vectorized"], results["loop"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_documents", type=int, default=100_000)
+    parser.add_argument("--mean_document_size", type=int, default=500)
+    parser.add_argument("--sequence_len", type=int, default=2048)
+    parser.add_argument("--num_samples", type=int, default=200_000)
+    args = parser.parse_args()
+    main(**vars(args))
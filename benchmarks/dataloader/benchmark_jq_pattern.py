@@ -0,0 +1,68 @@
+"""
+Benchmark of the field extraction from jsonl lines, comparing the jq interpreter with the fast path
+for simple field paths (see modalities.dataloader.jq_pattern), on an openwebtext-style file.
+
+Example:
+    python benchmarks/dataloader/benchmark_jq_pattern.py --num_lines 20000
+    python benchmarks/dataloader/benchmark_jq_pattern.py --input_path <path-to-openwebtext.jsonl>
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import jq
+import numpy as np
+
+from modalities.dataloader.jq_pattern import compile_jq_pattern
+
+
+def create_openwebtext_style_lines(num_lines: int, mean_num_words: int) -> List[str]:
+    # openwebtext documents have a mean length of roughly 3-4k characters
+    rng = np.random.default_rng(0)
+    vocabulary = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "sed", "do"]
+    lines = []
+    for i in range(num_lines):
+        num_words = int(rng.geometric(1 / mean_num_words))
+        text = " ".join(rng.choice(vocabulary, size=num_words))
+        lines.append(json.dumps({"text": text, "meta": {"source": "openwebtext", "id": i}}))
+    return lines
+
+
+def main(input_path: Optional[Path], num_lines: int, mean_num_words: int, jq_patterns: List[str]):
+    if input_path is None:
+        lines = create_openwebtext_style_lines(num_lines, mean_num_words)
+    else:
+        with input_path.open() as f:
+            lines = [line for _, line in zip(range(num_lines), f)]
+    mean_num_chars = sum(map(len, lines)) / len(lines)
+    print(f"{len(lines)} lines with {mean_num_chars:.0f} characters on average")
+
+    for jq_pattern in jq_patterns:
+        jq_filter = jq.compile(jq_pattern)
+        compiled_pattern = compile_jq_pattern(jq_pattern)
+
+        start = time.perf_counter()
+        jq_results = [jq_filter.input_text(line).first() for line in lines]
+        jq_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        fast_path_results = [compiled_pattern.first(line) for line in lines]
+        fast_path_time = time.perf_counter() - start
+
+        assert fast_path_results == jq_results
+        print(
+            f"{jq_pattern}: jq {jq_time:.3f} s, {type(compiled_pattern).__name__} {fast_path_time:.3f} s "
+            f"(speedup {jq_time / fast_path_time:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_path", type=Path, default=None, help="jsonl file, synthetic data if not set")
+    parser.add_argument("--num_lines", type=int, default=20000)
+    parser.add_argument("--mean_num_words", type=int, default=600)
+    parser.add_argument("--jq_patterns", type=str, nargs="+", default=[".text", ".meta.source"])
+    args = parser.parse_args()
+    main(args.input_path, args.num_lines, args.mean_num_words, args.jq_patterns)
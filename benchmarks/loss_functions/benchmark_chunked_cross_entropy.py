@@ -0,0 +1,72 @@
+"""
+CPU benchmark comparing CLMCrossEntropyLoss on full logits with the chunked LM head + cross entropy
+implementation of CLMChunkedCrossEntropyLoss.
+
+The memory metric is the number of bytes that autograd keeps alive for the backward pass (i.e., the activation
+memory of the LM head and the loss), which is where the full (B, T, vocab_size) logits tensor dominates.
+
+Example:
+    python benchmarks/loss_functions/benchmark_chunked_cross_entropy.py --vocab_size 50304 --sequence_length 2048
+"""
+import argparse
+import time
+from typing import Callable, Dict, Tuple
+
+import torch
+
+from modalities.batch import InferenceResultBatch
+from modalities.loss_functions import CLMChunkedCrossEntropyLoss, CLMCrossEntropyLoss
+
+
+def measure(forward_fun: Callable[[], torch.Tensor]) -> Tuple[float, int]:
+    saved_tensors: Dict[int, int] = {}
+
+    def pack_hook(t: torch.Tensor) -> torch.Tensor:
+        saved_tensors[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    start = time.perf_counter()
+    with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda t: t):
+        loss = forward_fun()
+    loss.backward()
+    return time.perf_counter() - start, sum(saved_tensors.values())
+
+
+def main(batch_size: int, sequence_length: int, n_embd: int, vocab_size: int, chunk_size: int):
+    torch.manual_seed(0)
+    hidden_states = torch.randn(batch_size, sequence_length, n_embd, requires_grad=True)
+    lm_head = torch.nn.Linear(n_embd, vocab_size, bias=False)
+    labels = torch.randint(0, vocab_size, (batch_size, sequence_length))
+
+    full_loss_fun = CLMCrossEntropyLoss(target_key="target_ids", prediction_key="logits")
+    chunked_loss_fun = CLMChunkedCrossEntropyLoss(
+        target_key="target_ids",
+        prediction_key="hidden_states",
+        lm_head_weight_key="lm_head_weight",
+        chunk_size=chunk_size,
+    )
+
+    def full_forward() -> torch.Tensor:
+        predictions = {"logits": lm_head(hidden_states)}
+        return full_loss_fun(InferenceResultBatch(targets={"target_ids": labels}, predictions=predictions))
+
+    def chunked_forward() -> torch.Tensor:
+        predictions = {"hidden_states": hidden_states, "lm_head_weight": lm_head.weight}
+        return chunked_loss_fun(InferenceResultBatch(targets={"target_ids": labels}, predictions=predictions))
+
+    logits_size_in_mb = batch_size * sequence_length * vocab_size * 4 / 1024**2
+    print(f"full logits tensor: {logits_size_in_mb:.1f} MB")
+    for name, forward_fun in [("full logits", full_forward), (f"chunked ({chunk_size})", chunked_forward)]:
+        duration, num_saved_bytes = measure(forward_fun)
+        print(f"{name:>20}: {duration * 1000:8.1f} ms | saved for backward: {num_saved_bytes / 1024**2:8.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--sequence_length", type=int, default=1024)
+    parser.add_argument("--n_embd", type=int, default=256)
+    parser.add_argument("--vocab_size", type=int, default=50304)
+    parser.add_argument("--chunk_size", type=int, default=1024)
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,78 @@
+"""
+CPU benchmark comparing the sequential loop of selective_scan_ref with the chunked parallel scan
+selective_scan_chunked (the fallback of selective_scan_fn without the CUDA kernel).
+
+The memory metric is the number of bytes that autograd keeps alive for the backward pass.
+
+Example:
+    python benchmarks/mamba/benchmark_selective_scan.py --d_inner 128 --sequence_length 512 --chunk_sizes 16 32 64
+"""
+import argparse
+import time
+from functools import partial
+from typing import Callable, Dict, List, Tuple
+
+import torch
+
+from modalities.models.mamba.ops.selective_scan_interface import selective_scan_chunked, selective_scan_ref
+
+
+def measure(scan_fun: Callable[..., torch.Tensor], inputs: Dict[str, torch.Tensor]) -> Tuple[float, float, int]:
+    saved_tensors: Dict[int, int] = {}
+
+    def pack_hook(t: torch.Tensor) -> torch.Tensor:
+        saved_tensors[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    leaves = {key: value.detach().requires_grad_() for key, value in inputs.items()}
+    start = time.perf_counter()
+    with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda t: t):
+        out = scan_fun(**leaves, delta_softplus=True)
+    forward_time = time.perf_counter() - start
+    out.sum().backward()
+    backward_time = time.perf_counter() - start - forward_time
+    return forward_time, backward_time, sum(saved_tensors.values())
+
+
+def main(batch_size: int, d_inner: int, d_state: int, sequence_length: int, chunk_sizes: List[int], num_runs: int):
+    torch.manual_seed(0)
+    inputs = dict(
+        u=torch.randn(batch_size, d_inner, sequence_length),
+        delta=torch.randn(batch_size, d_inner, sequence_length),
+        A=-torch.arange(1, d_state + 1, dtype=torch.float32).repeat(d_inner, 1),
+        B=torch.randn(batch_size, d_state, sequence_length),
+        C=torch.randn(batch_size, d_state, sequence_length),
+        D=torch.ones(d_inner),
+        z=torch.randn(batch_size, d_inner, sequence_length),
+        delta_bias=torch.rand(d_inner),
+    )
+    implementations = {"selective_scan_ref (loop)": selective_scan_ref}
+    for chunk_size in chunk_sizes:
+        implementations[f"selective_scan_chunked ({chunk_size})"] = partial(
+            selective_scan_chunked, chunk_size=chunk_size
+        )
+
+    with torch.no_grad():
+        out_ref = selective_scan_ref(**inputs, delta_softplus=True)
+    for name, scan_fun in implementations.items():
+        with torch.no_grad():
+            torch.testing.assert_close(scan_fun(**inputs, delta_softplus=True), out_ref, rtol=1e-3, atol=1e-3)
+        results = [measure(scan_fun, inputs) for _ in range(num_runs)]
+        forward_time = min(result[0] for result in results)
+        backward_time = min(result[1] for result in results)
+        print(
+            f"{name}: forward {forward_time * 1000:.0f} ms, backward {backward_time * 1000:.0f} ms, "
+            f"saved for backward {results[0][2] / 2**20:.1f} MB"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--d_inner", type=int, default=128)
+    parser.add_argument("--d_state", type=int, default=16)
+    parser.add_argument("--sequence_length", type=int, default=512)
+    parser.add_argument("--chunk_sizes", type=int, nargs="+", default=[16, 32, 64])
+    parser.add_argument("--num_runs", type=int, default=3)
+    args = parser.parse_args()
+    main(args.batch_size, args.d_inner, args.d_state, args.sequence_length, args.chunk_sizes, args.num_runs)
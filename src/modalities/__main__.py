@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import glob
 import logging
 import os
 import shutil
@@ -9,20 +10,31 @@ from typing import Tuple, Type
 
 import click
 import click_pathlib
+import torch
 from pydantic import BaseModel, FilePath
 
 from modalities.activation_checkpointing import apply_activation_checkpointing_inplace
+from modalities.activation_offloading import apply_activation_offloading_inplace
 from modalities.batch import EvaluationResultBatch
 from modalities.checkpointing.checkpoint_conversion import CheckpointConversion
 from modalities.config.component_factory import ComponentFactory
 from modalities.config.config import ProcessGroupBackendType, load_app_config_dict
 from modalities.config.instantiation_models import (
     PackedDatasetComponentsInstantiationModel,
+    ShardedPackedDatasetComponentsInstantiationModel,
     TrainingComponentsInstantiationModel,
 )
 from modalities.dataloader.create_index import IndexGenerator
-from modalities.dataloader.create_packed_data import EmbeddedStreamData, PackedDataGenerator, join_embedded_stream_data
+from modalities.dataloader.create_packed_data import (
+    EmbeddedStreamData,
+    PackedDataGenerator,
+    create_virtual_pbin,
+    join_embedded_stream_data,
+)
+from modalities.dataloader.document_filter import DocumentFilter
 from modalities.dataloader.large_file_lines_reader import LargeFileLinesReader
+from modalities.dataloader.open_gptx_dataset.open_gptx_dataset import prebuild_index_mappings
+from modalities.dataloader.sharded_packing import ShardedPackedDataGenerator
 from modalities.evaluator import Evaluator
 from modalities.gym import Gym
 from modalities.inference.inference import generate_text
@@ -34,6 +46,7 @@ from modalities.models.huggingface_adapters.hf_adapter import HFModelAdapter
 from modalities.registry.components import COMPONENTS
 from modalities.registry.registry import Registry
 from modalities.running_env.cuda_env import CudaEnv
+from modalities.running_env.pipeline_parallel import PipelineSchedule1F1B
 from modalities.trainer import Trainer
 from modalities.util import get_total_number_of_trainable_parameters, print_rank_0
 
@@ -138,6 +151,8 @@ def entry_point_pack_encoded_data(config_path: FilePath):
     (see also `create_index` for more information)
     Returns .pbin-file, which can be inserted into a training process directly
     and does not require its original jsonl-file or the respective index file anymore.
+    Alternatively, `settings.src_glob` selects multiple (possibly .gz or .zst compressed) jsonl shards,
+    which are streamed in sorted order without index files and packed into the single file `settings.dst_path`.
     """
     # TODO: if we want to use alternative entrypoints together with the ResolverRegistry,
     #  we can currently not rely on the existing class resolver.
@@ -152,8 +167,16 @@ def entry_point_pack_encoded_data(config_path: FilePath):
         config_dict=config, components_model_type=PackedDatasetComponentsInstantiationModel
     )
 
+    document_filter = None
+    if components.settings.document_filter is not None:
+        document_filter = DocumentFilter(**components.settings.document_filter.model_dump())
+    src_path = components.settings.src_path
+    if components.settings.src_glob is not None:
+        src_path = sorted(Path(p) for p in glob.glob(components.settings.src_glob, recursive=True))
+        if len(src_path) == 0:
+            raise FileNotFoundError(f"No files match {components.settings.src_glob}.")
     generator = PackedDataGenerator(
-        components.settings.src_path,
+        src_path,
         index_path=components.settings.index_path,
         tokenizer=components.tokenizer,
         eod_token=components.settings.eod_token,
@@ -162,14 +185,61 @@ def entry_point_pack_encoded_data(config_path: FilePath):
         processing_batch_size=components.settings.processing_batch_size,
         raw_samples_queue_size=components.settings.raw_samples_queue_size,
         processed_samples_queue_size=components.settings.processed_samples_queue_size,
+        document_filter=document_filter,
+        num_decompression_threads=components.settings.num_decompression_threads,
     )
     generator.run(components.settings.dst_path)
 
 
+@data.command(name="pack_encoded_data_sharded")
+@click.argument("config_path", type=FilePath)
+def entry_point_pack_encoded_data_sharded(config_path: FilePath):
+    """
+    Utility to pack many (possibly .gz or .zst compressed) jsonl-files in parallel.
+
+    Each file matching `settings.src_glob` is streamed without an index file and packed into its own pbin-file in
+    `settings.dst_dir`. Up to `settings.num_parallel_shards` files are packed at the same time, sharing the
+    `settings.num_cpus` tokenization workers. A manifest.json with the document and token counts per shard is
+    written to `settings.dst_dir`. With `settings.merge_type` (virtual or physical), the shards are merged afterwards.
+    """
+    config = load_app_config_dict(config_path)
+    registry = Registry(COMPONENTS)
+    component_factory = ComponentFactory(registry=registry)
+    components: ShardedPackedDatasetComponentsInstantiationModel = component_factory.build_components(
+        config_dict=config, components_model_type=ShardedPackedDatasetComponentsInstantiationModel
+    )
+    settings = components.settings
+    src_paths = sorted(Path(p) for p in glob.glob(settings.src_glob, recursive=True))
+    if len(src_paths) == 0:
+        raise FileNotFoundError(f"No files match {settings.src_glob}.")
+
+    generator = ShardedPackedDataGenerator(
+        src_paths=src_paths,
+        dst_dir=settings.dst_dir,
+        tokenizer=components.tokenizer,
+        eod_token=settings.eod_token,
+        jq_pattern=settings.jq_pattern,
+        processing_batch_size=settings.processing_batch_size,
+        raw_samples_queue_size=settings.raw_samples_queue_size,
+        processed_samples_queue_size=settings.processed_samples_queue_size,
+        num_cpus=settings.num_cpus,
+        num_parallel_shards=settings.num_parallel_shards,
+        document_filter_kwargs=None if settings.document_filter is None else settings.document_filter.model_dump(),
+    )
+    manifest_path = generator.run(merge_type=settings.merge_type)
+    print(f"Wrote manifest to {manifest_path}")
+
+
 @data.command(name="merge_packed_data")
 @click.argument("src_paths", type=click.types.Path(exists=True, path_type=Path), nargs=-1, required=True)
 @click.argument("target_path", type=click.types.Path(file_okay=False, dir_okay=False, path_type=Path))
-def entry_point_merge_packed_data(src_paths, target_path):
+@click.option(
+    "--virtual",
+    is_flag=True,
+    default=False,
+    help="Write a manifest (.vpbin) referencing the input files instead of copying their data.",
+)
+def entry_point_merge_packed_data(src_paths, target_path, virtual: bool):
     """
     Utility for merging different pbin-files into one.
     This is especially useful, if different datasets were at different points in time or if one encoding takes so long,
@@ -177,6 +247,8 @@ def entry_point_merge_packed_data(src_paths, target_path):
     It is important that the same tokenizer got used for all chunks.
 
     Specify an arbitrary amount of pbin-files and/or directory containing such as input.
+    With --virtual, the pbin-files are merged without copying by writing a small manifest file, which can be used
+    as raw_data_path of the packed datasets. The manifest references the input files by their relative paths.
     """
     input_files = []
     for p in src_paths:
@@ -185,8 +257,28 @@ def entry_point_merge_packed_data(src_paths, target_path):
             input_files.extend(p.glob("**/*.pbin"))
         else:
             input_files.append(p)
-    embedded_datasets = list(map(EmbeddedStreamData, input_files))
-    join_embedded_stream_data(embedded_datasets, target_path)
+    if virtual:
+        create_virtual_pbin(input_files, target_path)
+    else:
+        embedded_datasets = list(map(EmbeddedStreamData, input_files))
+        join_embedded_stream_data(embedded_datasets, target_path)
+
+
+@data.command(name="prebuild_open_gptx_index_mappings")
+@click.argument("path", type=click.types.Path(exists=True, dir_okay=False, path_type=Path))
+@click.option("--sequence_len", type=int, required=True, help="sequence length of the dataset config.")
+@click.option("--num_samples", type=int, required=True, help="number of samples of the dataset config.")
+@click.option("--seed", type=int, default=47, show_default=True, help="seed of the dataset config.")
+def entry_point_prebuild_open_gptx_index_mappings(path: Path, sequence_len: int, num_samples: int, seed: int):
+    """
+    Utility for building the cached index mappings (doc-idx, sample-idx and shuffle-idx) of an
+    open_gptx_mmap_dataset in advance, so that the training ranks only need to memory-map them.
+    """
+    index_mapping_filenames = prebuild_index_mappings(
+        path=path, sequence_len=sequence_len, num_samples=num_samples, seed=seed
+    )
+    for filename in index_mapping_filenames:
+        print(f"index mapping available at {filename}")
 
 
 class Main:
@@ -232,7 +324,29 @@ class Main:
             * components.settings.training.sequence_length
             * components.settings.training.gradient_acc_steps
             * components.settings.cuda_env.world_size
+            # the ranks of a context, tensor or pipeline parallel group process the same samples
+            // components.settings.training.num_ranks_per_data_parallel_replica
         )
+        wrapped_model = components.wrapped_model
+        if len(components.settings.training.activation_offloading_modules) > 0:
+            activation_offloader = apply_activation_offloading_inplace(
+                model=wrapped_model,
+                activation_offloading_modules=components.settings.training.activation_offloading_modules,
+                min_offloaded_tensor_size_in_bytes=(
+                    components.settings.training.activation_offloading.min_offloaded_tensor_size_in_bytes
+                ),
+                pin_memory=components.settings.training.activation_offloading.pin_memory,
+            )
+        else:
+            activation_offloader = None
+        pipeline_parallelism = components.settings.training.pipeline_parallelism
+        if pipeline_parallelism.pipeline_parallel_degree > 1:
+            pipeline_schedule = PipelineSchedule1F1B(
+                pipeline_parallel_degree=pipeline_parallelism.pipeline_parallel_degree,
+                num_micro_batches=pipeline_parallelism.num_micro_batches,
+            )
+        else:
+            pipeline_schedule = None
         trainer = Trainer(
             global_rank=components.settings.cuda_env.global_rank,
             batch_progress_publisher=batch_processed_publisher,
@@ -240,12 +354,19 @@ class Main:
             gradient_acc_steps=components.settings.training.gradient_acc_steps,
             gradient_clipper=components.gradient_clipper,
             global_num_tokens_per_train_step=global_num_tokens_per_train_step,
+            activation_offloader=activation_offloader,
+            pipeline_schedule=pipeline_schedule,
+            use_no_sync_for_gradient_accumulation=components.settings.training.use_no_sync_for_gradient_accumulation,
         )
 
         # Evaluator
         evaluator = Evaluator(
             batch_progress_publisher=batch_processed_publisher,
             evaluation_result_publisher=evaluation_result_publisher,
+            max_num_eval_batches=components.settings.evaluation.max_num_batches,
+            max_num_eval_tokens=components.settings.evaluation.max_num_tokens,
+            use_inference_mode=components.settings.evaluation.use_inference_mode,
+            pipeline_schedule=pipeline_schedule,
         )
 
         # Gym
@@ -255,15 +376,31 @@ class Main:
             loss_fun=components.loss_fn,
             num_ranks=components.settings.cuda_env.world_size,
         )
-        wrapped_model = components.wrapped_model
         num_params = get_total_number_of_trainable_parameters(wrapped_model)
         components.evaluation_subscriber.consume_dict({"No. Parameters": num_params})
         logging.info(f"Training model with {num_params} parameters.")
 
         if len(components.settings.training.activation_checkpointing_modules) > 0:
+            activation_checkpointing = components.settings.training.activation_checkpointing
+            # the activation memory of the memory budget is measured on a single sample
+            sample_inputs = {
+                components.settings.referencing_keys["sample_key"]: torch.zeros(
+                    1,
+                    components.settings.training.sequence_length,
+                    dtype=torch.long,
+                    device=next(wrapped_model.parameters()).device,
+                )
+            }
             apply_activation_checkpointing_inplace(
                 model=wrapped_model,
                 activation_checkpointing_modules=components.settings.training.activation_checkpointing_modules,
+                variant=activation_checkpointing.variant,
+                every_k_blocks=activation_checkpointing.every_k_blocks,
+                submodule_names=activation_checkpointing.submodule_names,
+                saved_ops=activation_checkpointing.saved_ops,
+                memory_budget_in_bytes=activation_checkpointing.memory_budget_in_bytes,
+                sample_inputs=sample_inputs,
+                activation_memory_scale=components.settings.training.local_train_micro_batch_size,
             )
         print_rank_0(f"Model initialized at {datetime.now()}.")
 
@@ -1,5 +1,8 @@
+import logging
+from dataclasses import dataclass
+from enum import Enum
 from functools import partial
-from typing import List
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 import torch
 from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import (
@@ -7,9 +10,43 @@ from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import (
     apply_activation_checkpointing,
     checkpoint_wrapper,
 )
-from torch.distributed.fsdp.fully_sharded_data_parallel import FullyShardedDataParallel as FSDP
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten, tree_map
 
-from modalities.util import get_module_class_from_name
+from modalities.util import get_module_class_from_name, print_rank_0
+
+# matmuls and attention kernels, whose outputs are kept by selective activation checkpointing,
+# while cheap ops (e.g., norms, activations and elementwise ops) are recomputed in the backward pass
+DEFAULT_SAVED_OPS = [
+    "mm",
+    "bmm",
+    "addmm",
+    "_scaled_dot_product_flash_attention",
+    "_scaled_dot_product_efficient_attention",
+    "_scaled_dot_product_flash_attention_for_cpu",
+]
+
+
+class ActivationCheckpointingVariants(str, Enum):
+    # checkpoints all blocks
+    FULL_BLOCK = "full_block"
+    # checkpoints every k-th block
+    EVERY_KTH_BLOCK = "every_kth_block"
+    # checkpoints the given submodules of all blocks, e.g., only the attention or only the MLP
+    SUBMODULES = "submodules"
+    # checkpoints all blocks, but keeps the outputs of the saved ops instead of recomputing them
+    SELECTIVE_OPS = "selective_ops"
+    # chooses per block between no, selective and full checkpointing based on the measured activation memory
+    MEMORY_BUDGET = "memory_budget"
+
+
+@dataclass
+class BlockActivationMemory:
+    """Activation memory in bytes that a block keeps for the backward pass."""
+
+    no_checkpointing: int
+    selective_ops: int
+    full_block: int
 
 
 def is_module_to_apply_activation_checkpointing(
@@ -18,18 +55,210 @@ def is_module_to_apply_activation_checkpointing(
     return isinstance(submodule, tuple(activation_checkpointing_modules))
 
 
-def apply_activation_checkpointing_inplace(model: torch.nn.Module, activation_checkpointing_modules: List[str]):
-    activation_checkpointing_module_types = [
-        get_module_class_from_name(model, m) for m in activation_checkpointing_modules
-    ]
-    if not isinstance(model, FSDP):
-        raise ValueError("activation checkpointing can only be applied to FSDP wrapped models!")
-    non_reentrant_wrapper = partial(checkpoint_wrapper, checkpoint_impl=CheckpointImpl.NO_REENTRANT, debug=False)
+def apply_activation_checkpointing_inplace(
+    model: torch.nn.Module,
+    activation_checkpointing_modules: List[str],
+    variant: ActivationCheckpointingVariants = ActivationCheckpointingVariants.FULL_BLOCK,
+    every_k_blocks: int = 1,
+    submodule_names: Optional[List[str]] = None,
+    saved_ops: Optional[List[str]] = None,
+    memory_budget_in_bytes: Optional[int] = None,
+    sample_inputs: Optional[Dict[str, torch.Tensor]] = None,
+    activation_memory_scale: float = 1.0,
+):
+    """Applies activation checkpointing to the blocks of a (optionally FSDP wrapped) model.
 
-    apply_activation_checkpointing(
-        model,
-        checkpoint_wrapper_fn=non_reentrant_wrapper,
-        check_fn=lambda submodule: is_module_to_apply_activation_checkpointing(
-            submodule, activation_checkpointing_module_types
-        ),
+    Args:
+        model (torch.nn.Module): The model, which is modified in place.
+        activation_checkpointing_modules (List[str]): Class names of the blocks, e.g., ["GPT2Block"].
+        variant (ActivationCheckpointingVariants): The checkpointing policy.
+        every_k_blocks (int): For EVERY_KTH_BLOCK, the blocks 0, k, 2k, ... are checkpointed.
+        submodule_names (Optional[List[str]]): For SUBMODULES, the attribute names of the block's submodules
+            to checkpoint, e.g., ["attn"] or ["mlp"].
+        saved_ops (Optional[List[str]]): For SELECTIVE_OPS and MEMORY_BUDGET, the aten ops whose outputs are kept.
+            Defaults to DEFAULT_SAVED_OPS.
+        memory_budget_in_bytes (Optional[int]): For MEMORY_BUDGET, the activation memory of all blocks.
+        sample_inputs (Optional[Dict[str, torch.Tensor]]): For MEMORY_BUDGET, the inputs of a forward pass
+            to measure the activation memory of each block.
+        activation_memory_scale (float): For MEMORY_BUDGET, the factor from the measured activation memory to
+            the one of the training, e.g., the micro batch size if the sample inputs are a single sample.
+    """
+    block_types = []
+    for block_name in activation_checkpointing_modules:
+        block_type = get_module_class_from_name(model, block_name)
+        if block_type is None:
+            raise ValueError(f"Could not find block with name {block_name} in model")
+        block_types.append(block_type)
+    blocks = [m for m in model.modules() if is_module_to_apply_activation_checkpointing(m, block_types)]
+    saved_op_packets = _get_op_overload_packets(DEFAULT_SAVED_OPS if saved_ops is None else saved_ops)
+    non_reentrant_wrapper = partial(checkpoint_wrapper, checkpoint_impl=CheckpointImpl.NO_REENTRANT, debug=False)
+    selective_wrapper = partial(
+        non_reentrant_wrapper, context_fn=partial(_get_selective_checkpointing_contexts, saved_op_packets)
     )
+
+    if variant == ActivationCheckpointingVariants.FULL_BLOCK:
+        _apply_wrapper(model, non_reentrant_wrapper, blocks)
+    elif variant == ActivationCheckpointingVariants.EVERY_KTH_BLOCK:
+        _apply_wrapper(model, non_reentrant_wrapper, blocks[::every_k_blocks])
+    elif variant == ActivationCheckpointingVariants.SUBMODULES:
+        if not submodule_names:
+            raise ValueError("submodule_names must be given for checkpointing submodules.")
+        _apply_wrapper(model, non_reentrant_wrapper, [getattr(b, name) for b in blocks for name in submodule_names])
+    elif variant == ActivationCheckpointingVariants.SELECTIVE_OPS:
+        _apply_wrapper(model, selective_wrapper, blocks)
+    elif variant == ActivationCheckpointingVariants.MEMORY_BUDGET:
+        if memory_budget_in_bytes is None or sample_inputs is None:
+            raise ValueError("memory_budget_in_bytes and sample_inputs must be given for the memory budget.")
+        activation_memories = measure_block_activation_memory(model, blocks, sample_inputs, saved_op_packets)
+        activation_memories = [
+            BlockActivationMemory(*(int(getattr(m, f) * activation_memory_scale) for f in vars(m)))
+            for m in activation_memories
+        ]
+        block_variants = get_block_variants_for_memory_budget(activation_memories, memory_budget_in_bytes)
+        print_rank_0(f"Activation checkpointing of the blocks for the memory budget: {block_variants}")
+        for block_variant, wrapper in [
+            (ActivationCheckpointingVariants.SELECTIVE_OPS, selective_wrapper),
+            (ActivationCheckpointingVariants.FULL_BLOCK, non_reentrant_wrapper),
+        ]:
+            _apply_wrapper(model, wrapper, [b for b, v in zip(blocks, block_variants) if v == block_variant])
+    else:
+        raise NotImplementedError(f"Activation checkpointing variant {variant} is not supported.")
+
+
+def measure_block_activation_memory(
+    model: torch.nn.Module,
+    blocks: List[torch.nn.Module],
+    sample_inputs: Dict[str, torch.Tensor],
+    saved_op_packets: Set,
+) -> List[BlockActivationMemory]:
+    """Measures the activation memory of each block for a forward pass without activation checkpointing.
+    Without checkpointing, a block keeps all tensors that autograd saves for the backward pass, with full
+    checkpointing only its inputs and with selective checkpointing its inputs and the outputs of the saved ops."""
+    saved_storages: List[Dict[int, int]] = [{} for _ in blocks]
+    input_bytes = [0] * len(blocks)
+    saved_op_output_bytes = [0] * len(blocks)
+    current_block_ids = []
+    # the weights saved by the matmuls are no activations
+    parameter_storage_ptrs = {p.untyped_storage().data_ptr() for p in model.parameters()}
+
+    def pre_hook(block_id: int, module: torch.nn.Module, args: Tuple):
+        current_block_ids.append(block_id)
+        input_bytes[block_id] += sum(arg.nbytes for arg in args if isinstance(arg, torch.Tensor))
+
+    def post_hook(block_id: int, module: torch.nn.Module, args: Tuple, output):
+        current_block_ids.pop()
+
+    def pack_hook(tensor: torch.Tensor) -> torch.Tensor:
+        storage = tensor.untyped_storage()
+        if len(current_block_ids) > 0 and storage.data_ptr() not in parameter_storage_ptrs:
+            saved_storages[current_block_ids[-1]][storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    def count_saved_op_output(nbytes: int):
+        if len(current_block_ids) > 0:
+            saved_op_output_bytes[current_block_ids[-1]] += nbytes
+
+    handles = []
+    for block_id, block in enumerate(blocks):
+        handles.append(block.register_forward_pre_hook(partial(pre_hook, block_id)))
+        handles.append(block.register_forward_hook(partial(post_hook, block_id)))
+    try:
+        with torch.enable_grad(), torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda tensor: tensor):
+            with _SavedOpsOutputCounter(saved_op_packets, count_saved_op_output):
+                outputs = model(sample_inputs)
+        # the backward pass completes the iteration, e.g., for the hooks of FSDP
+        loss = sum(t.float().sum() for t in tree_flatten(outputs)[0] if isinstance(t, torch.Tensor) and t.requires_grad)
+        if isinstance(loss, torch.Tensor):
+            loss.backward()
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.zero_grad(set_to_none=True)
+    return [
+        BlockActivationMemory(
+            no_checkpointing=sum(saved_storages[i].values()),
+            selective_ops=input_bytes[i] + saved_op_output_bytes[i],
+            full_block=input_bytes[i],
+        )
+        for i in range(len(blocks))
+    ]
+
+
+def get_block_variants_for_memory_budget(
+    activation_memories: List[BlockActivationMemory], memory_budget_in_bytes: int
+) -> List[Optional[ActivationCheckpointingVariants]]:
+    """Greedily chooses per block between no (None), selective and full checkpointing, such that the activation
+    memory fits into the budget with as little recomputation as possible. First, the blocks are switched to
+    selective checkpointing in the order of the largest savings, then to full checkpointing."""
+    block_variants: List[Optional[ActivationCheckpointingVariants]] = [None] * len(activation_memories)
+    block_memories = [m.no_checkpointing for m in activation_memories]
+    for block_variant, field_name in [
+        (ActivationCheckpointingVariants.SELECTIVE_OPS, "selective_ops"),
+        (ActivationCheckpointingVariants.FULL_BLOCK, "full_block"),
+    ]:
+        savings = [block_memories[i] - getattr(m, field_name) for i, m in enumerate(activation_memories)]
+        for block_id in sorted(range(len(savings)), key=lambda i: savings[i], reverse=True):
+            if sum(block_memories) <= memory_budget_in_bytes or savings[block_id] <= 0:
+                break
+            block_memories[block_id] -= savings[block_id]
+            block_variants[block_id] = block_variant
+    if sum(block_memories) > memory_budget_in_bytes:
+        logging.warning(
+            f"The activation memory of {sum(block_memories)} bytes exceeds the budget of {memory_budget_in_bytes} "
+            "bytes even with full activation checkpointing."
+        )
+    return block_variants
+
+
+def _apply_wrapper(model: torch.nn.Module, wrapper: Callable, modules: List[torch.nn.Module]):
+    module_ids = {id(module) for module in modules}
+    apply_activation_checkpointing(model, checkpoint_wrapper_fn=wrapper, check_fn=lambda m: id(m) in module_ids)
+
+
+def _get_op_overload_packets(op_names: List[str]) -> Set:
+    return {getattr(torch.ops.aten, op_name) for op_name in op_names if hasattr(torch.ops.aten, op_name)}
+
+
+class _SavedOpsOutputCounter(TorchDispatchMode):
+    def __init__(self, saved_op_packets: Set, count_fun: Callable[[int], None]):
+        super().__init__()
+        self.saved_op_packets = saved_op_packets
+        self.count_fun = count_fun
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        if func.overloadpacket in self.saved_op_packets:
+            tree_map(lambda x: self.count_fun(x.nbytes) if isinstance(x, torch.Tensor) else None, out)
+        return out
+
+
+class _CachingMode(TorchDispatchMode):
+    # keeps the outputs of the saved ops during the forward pass
+    def __init__(self, saved_op_packets: Set, cache: List):
+        super().__init__()
+        self.saved_op_packets = saved_op_packets
+        self.cache = cache
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        if func.overloadpacket in self.saved_op_packets:
+            self.cache.append(tree_map(lambda x: x.detach() if isinstance(x, torch.Tensor) else x, out))
+        return out
+
+
+class _CachedMode(TorchDispatchMode):
+    # returns the kept outputs of the saved ops instead of recomputing them in the backward pass
+    def __init__(self, saved_op_packets: Set, cache: List):
+        super().__init__()
+        self.saved_op_packets = saved_op_packets
+        self.cache = cache
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        if func.overloadpacket in self.saved_op_packets:
+            return self.cache.pop(0)
+        return func(*args, **(kwargs or {}))
+
+
+def _get_selective_checkpointing_contexts(saved_op_packets: Set) -> Tuple[TorchDispatchMode, TorchDispatchMode]:
+    cache = []
+    return _CachingMode(saved_op_packets, cache), _CachedMode(saved_op_packets, cache)
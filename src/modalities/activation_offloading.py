@@ -0,0 +1,209 @@
+import weakref
+from functools import partial
+from typing import Dict, List, Optional, Sequence, Set, Tuple, Union
+
+import torch
+from torch.utils._pytree import tree_flatten
+
+from modalities.activation_checkpointing import is_module_to_apply_activation_checkpointing
+from modalities.util import get_module_class_from_name
+
+
+class _CudaCopyStreams:
+    # copies tensors between a CUDA device and the host on separate streams,
+    # such that the copies overlap with the computation on the current stream
+    def __init__(self, device: torch.device):
+        self.device = device
+        self.offload_stream = torch.cuda.Stream(device)
+        self.prefetch_stream = torch.cuda.Stream(device)
+
+    def offload(self, tensor: torch.Tensor, host_tensor: torch.Tensor) -> torch.cuda.Event:
+        self.offload_stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.offload_stream):
+            host_tensor.copy_(tensor, non_blocking=True)
+            offload_event = self.offload_stream.record_event()
+        # prevents the caching allocator from reusing the device memory before the copy is done
+        tensor.record_stream(self.offload_stream)
+        return offload_event
+
+    def prefetch(
+        self, host_tensor: torch.Tensor, offload_event: torch.cuda.Event
+    ) -> Tuple[torch.Tensor, torch.cuda.Event]:
+        with torch.cuda.stream(self.prefetch_stream):
+            self.prefetch_stream.wait_event(offload_event)
+            device_tensor = torch.empty_like(host_tensor, device=self.device)
+            device_tensor.copy_(host_tensor, non_blocking=True)
+            return device_tensor, self.prefetch_stream.record_event()
+
+    def wait(self, device_tensor: torch.Tensor, prefetch_event: torch.cuda.Event):
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_event(prefetch_event)
+        # the tensor was allocated on the prefetch stream, but is used on the current stream
+        device_tensor.record_stream(current_stream)
+
+
+class _SynchronousCopyStreams:
+    # copies tensors synchronously on devices without streams, e.g., tensors on the host to separate host memory
+    def __init__(self, device: torch.device):
+        self.device = device
+
+    def offload(self, tensor: torch.Tensor, host_tensor: torch.Tensor) -> None:
+        host_tensor.copy_(tensor)
+
+    def prefetch(self, host_tensor: torch.Tensor, offload_event: None) -> Tuple[torch.Tensor, None]:
+        return host_tensor.to(self.device, copy=True), None
+
+    def wait(self, device_tensor: torch.Tensor, prefetch_event: None):
+        pass
+
+
+_CopyStreams = Union[_CudaCopyStreams, _SynchronousCopyStreams]
+
+
+class _OffloadedTensor:
+    # a tensor saved for the backward pass, which is copied to host memory in the forward pass
+    # and prefetched to its device before it is needed in the backward pass
+    def __init__(self, tensor: torch.Tensor, copy_streams: _CopyStreams, pin_memory: bool):
+        self.device = tensor.device
+        self.copy_streams = copy_streams
+        self.host_tensor = torch.empty_like(tensor, device="cpu", pin_memory=pin_memory)
+        self.offload_event = copy_streams.offload(tensor, self.host_tensor)
+        self.device_tensor: Optional[torch.Tensor] = None
+        self.prefetch_event: Optional[torch.cuda.Event] = None
+
+    def prefetch(self):
+        if self.device_tensor is not None:
+            return
+        self.device_tensor, self.prefetch_event = self.copy_streams.prefetch(self.host_tensor, self.offload_event)
+
+    def get(self) -> torch.Tensor:
+        self.prefetch()
+        device_tensor = self.device_tensor
+        self.copy_streams.wait(device_tensor, self.prefetch_event)
+        self.device_tensor = None
+        return device_tensor
+
+
+class ActivationOffloader:
+    def __init__(
+        self,
+        min_offloaded_tensor_size_in_bytes: int = 1024,
+        pin_memory: bool = True,
+        offloaded_device_types: Sequence[str] = ("cuda",),
+    ):
+        """
+        Offloads the tensors that the given blocks save for the backward pass to host memory during the forward
+        pass. When the backward pass of a block starts, its tensors and the ones of the preceding block are
+        prefetched on a separate stream, such that the copies overlap with the computation of the backward pass.
+        Only tensors on the offloaded device types are offloaded, parameters and tensors smaller than
+        min_offloaded_tensor_size_in_bytes stay on the device.
+
+        :param min_offloaded_tensor_size_in_bytes: Size of the smallest tensor that is offloaded.
+        :param pin_memory: Whether the host memory is pinned, which is required for asynchronous copies.
+        :param offloaded_device_types: Types of the devices whose tensors are offloaded. Tensors on other devices
+                                       than CUDA devices (e.g., "cpu" to test the offloading without a GPU) are
+                                       copied synchronously.
+        """
+        self.min_offloaded_tensor_size_in_bytes = min_offloaded_tensor_size_in_bytes
+        self.pin_memory = pin_memory
+        self.offloaded_device_types = set(offloaded_device_types)
+        self.num_offloaded_bytes = 0
+        # weak references to the offloaded tensors of each forward call of a block, in the order of the calls
+        self._groups: Dict[int, List[weakref.ref]] = {}
+        self._next_group_id = 0
+        self._copy_streams: Dict[torch.device, _CopyStreams] = {}
+        self._hooks_stack: List[Tuple[torch.autograd.graph.saved_tensors_hooks, int]] = []
+
+    def register_block(self, block: torch.nn.Module):
+        block.register_forward_pre_hook(self._forward_pre_hook)
+        block.register_forward_hook(self._forward_hook)
+
+    def pop_num_offloaded_bytes(self) -> int:
+        """Returns the number of bytes offloaded since the last call."""
+        num_offloaded_bytes, self.num_offloaded_bytes = self.num_offloaded_bytes, 0
+        return num_offloaded_bytes
+
+    def _forward_pre_hook(self, block: torch.nn.Module, args: Tuple):
+        if not torch.is_grad_enabled():
+            return
+        group_id = self._next_group_id
+        self._next_group_id += 1
+        self._groups = {i: group for i, group in self._groups.items() if any(ref() is not None for ref in group)}
+        self._groups[group_id] = []
+        parameter_storage_ptrs = {p.untyped_storage().data_ptr() for p in block.parameters()}
+        hooks = torch.autograd.graph.saved_tensors_hooks(
+            partial(self._pack, group_id, parameter_storage_ptrs), self._unpack
+        )
+        hooks.__enter__()
+        self._hooks_stack.append((hooks, group_id))
+
+    def _forward_hook(self, block: torch.nn.Module, args: Tuple, output):
+        if not torch.is_grad_enabled():
+            return
+        hooks, group_id = self._hooks_stack.pop()
+        hooks.__exit__(None, None, None)
+        output_tensors = [t for t in tree_flatten(output)[0] if isinstance(t, torch.Tensor) and t.requires_grad]
+        if len(output_tensors) > 0:
+            # called before the gradients are propagated through the block
+            output_tensors[0].register_hook(partial(self._on_block_backward, group_id))
+
+    def _pack(self, group_id: int, parameter_storage_ptrs: Set[int], tensor: torch.Tensor):
+        if (
+            tensor.device.type not in self.offloaded_device_types
+            or isinstance(tensor, torch.nn.Parameter)
+            or tensor.untyped_storage().data_ptr() in parameter_storage_ptrs
+            or tensor.nbytes < self.min_offloaded_tensor_size_in_bytes
+        ):
+            return tensor
+        offloaded_tensor = _OffloadedTensor(tensor, self._get_copy_streams(tensor.device), self.pin_memory)
+        self._groups[group_id].append(weakref.ref(offloaded_tensor))
+        self.num_offloaded_bytes += tensor.nbytes
+        return offloaded_tensor
+
+    def _unpack(self, packed) -> torch.Tensor:
+        if isinstance(packed, _OffloadedTensor):
+            return packed.get()
+        return packed
+
+    def _on_block_backward(self, group_id: int, grad: torch.Tensor):
+        self._prefetch(group_id)
+        self._prefetch(group_id - 1)
+        self._groups.pop(group_id, None)
+
+    def _prefetch(self, group_id: int):
+        for ref in self._groups.get(group_id, []):
+            offloaded_tensor = ref()
+            if offloaded_tensor is not None:
+                offloaded_tensor.prefetch()
+
+    def _get_copy_streams(self, device: torch.device) -> _CopyStreams:
+        if device not in self._copy_streams:
+            copy_streams_type = _CudaCopyStreams if device.type == "cuda" else _SynchronousCopyStreams
+            self._copy_streams[device] = copy_streams_type(device)
+        return self._copy_streams[device]
+
+
+def apply_activation_offloading_inplace(
+    model: torch.nn.Module,
+    activation_offloading_modules: List[str],
+    min_offloaded_tensor_size_in_bytes: int = 1024,
+    pin_memory: bool = True,
+    offloaded_device_types: Sequence[str] = ("cuda",),
+) -> ActivationOffloader:
+    """Offloads the activations of the blocks with the given class names (e.g., ["GPT2Block"]) to host memory.
+    The blocks are not wrapped, such that the module hierarchy and the parameter names stay the same."""
+    block_types = []
+    for block_name in activation_offloading_modules:
+        block_type = get_module_class_from_name(model, block_name)
+        if block_type is None:
+            raise ValueError(f"Could not find block with name {block_name} in model")
+        block_types.append(block_type)
+    activation_offloader = ActivationOffloader(
+        min_offloaded_tensor_size_in_bytes=min_offloaded_tensor_size_in_bytes,
+        pin_memory=pin_memory,
+        offloaded_device_types=offloaded_device_types,
+    )
+    for module in model.modules():
+        if is_module_to_apply_activation_checkpointing(module, block_types):
+            activation_offloader.register_block(module)
+    return activation_offloader
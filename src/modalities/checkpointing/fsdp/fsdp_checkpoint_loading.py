@@ -8,6 +8,7 @@ from torch.distributed.fsdp import ShardingStrategy
 from torch.optim import Optimizer
 
 from modalities.checkpointing.checkpoint_loading import CheckpointLoadingIF
+from modalities.models.gpt2.gpt2_model import fuse_qkv_optimizer_state_dict_keys
 from modalities.running_env.env_utils import MixedPrecisionSettings
 
 
@@ -54,6 +55,8 @@ class FSDPCheckpointLoading(CheckpointLoadingIF):
         if self.global_rank == 0:
             # load full optimizer state dict to rank 0 (CPU RAM)
             full_optimizer_state_dict = torch.load(file_path)
+            # optimizer states of checkpoints with separate query, key and value projections
+            full_optimizer_state_dict = fuse_qkv_optimizer_state_dict_keys(full_optimizer_state_dict)
 
         # distribute the optimizer state dict from rank 0 to all the other ranks
         sharded_optimizer_state_dict = FSDP.scatter_full_optim_state_dict(
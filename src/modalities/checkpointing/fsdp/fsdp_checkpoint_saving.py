@@ -1,6 +1,6 @@
 from enum import Enum
 from pathlib import Path
-from typing import Callable, List
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import torch
 import torch.distributed as dist
@@ -12,6 +12,7 @@ from torch.optim import Optimizer
 from modalities.checkpointing.checkpoint_saving import CheckpointEntityType
 from modalities.checkpointing.checkpoint_saving_execution import CheckpointSavingExecutionABC
 from modalities.exceptions import CheckpointingError
+from modalities.running_env.tensor_parallel import gather_tensor_parallel_state_dict, get_tensor_parallel_shards
 
 
 class CheckpointingEntityType(Enum):
@@ -61,9 +62,16 @@ class FSDPCheckpointSaving(CheckpointSavingExecutionABC):
         full_path = Path(self.checkpoint_path, experiment_id, entity_file_name)
         return full_path
 
-    def _save_checkpoint(self, model: FSDP, optimizer: Optimizer, num_train_steps_done: int):
+    def _get_full_state_dicts(
+        self, model: FSDP, optimizer: Optimizer
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        # returns the full model and optimizer state dicts on rank 0
+        if not isinstance(model, FSDP):
+            raise CheckpointingError(
+                f"FSDP checkpoint saving requires an FSDP wrapped model, but got {type(model).__name__}. "
+                "Use the pipeline checkpoint saving for the stages of a pipeline."
+            )
         # saving the model via FULL_STATE_DICT and checkpoint via FULL_OPTIM_STATE_DICT
-        # TODO Need to check if LR schedulers also need checkpointing
         model_save_policy = FullStateDictConfig(offload_to_cpu=True, rank0_only=True)
         optim_save_policy = FullOptimStateDictConfig(offload_to_cpu=True, rank0_only=True)
         with FSDP.state_dict_type(
@@ -75,9 +83,27 @@ class FSDPCheckpointSaving(CheckpointSavingExecutionABC):
             model_state = model.state_dict()
             optimizer_state = optimizer.state_dict()  # this gets the optimizer state dict object for each rank
             optim_state_dict = FSDP.optim_state_dict(
-                model=model, optim=optimizer, optim_state_dict=optimizer_state
+                model=model, optim=optimizer, optim_state_dict=optimizer_state, group=model.process_group
             )  # all the state dicts of the different ranks are synchronized
 
+        tensor_parallel_shards = get_tensor_parallel_shards(model)
+        if len(tensor_parallel_shards) > 0:
+            # 2D parallelism: the first rank of each data parallel group holds the full state of its tensor parallel
+            # shards. These ranks form the tensor parallel group of rank 0, which merges the shards.
+            tensor_parallel_group = next(iter(tensor_parallel_shards.values())).group
+            if dist.get_rank() < dist.get_world_size(tensor_parallel_group):
+                model_state = gather_tensor_parallel_state_dict(
+                    model_state, tensor_parallel_shards, tensor_parallel_group
+                )
+                optim_state_dict["state"] = gather_tensor_parallel_state_dict(
+                    optim_state_dict["state"], tensor_parallel_shards, tensor_parallel_group
+                )
+        return model_state, optim_state_dict
+
+    def _save_checkpoint(self, model: FSDP, optimizer: Optimizer, num_train_steps_done: int):
+        # TODO Need to check if LR schedulers also need checkpointing
+        model_state, optim_state_dict = self._get_full_state_dicts(model, optimizer)
+
         if self.global_rank == 0:
             # save model
             model_checkpoint_path = self._get_checkpointing_path(
@@ -0,0 +1,89 @@
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch.optim import Optimizer
+
+from modalities.checkpointing.fsdp.fsdp_checkpoint_saving import FSDPCheckpointSaving
+from modalities.running_env.pipeline_parallel import get_pipeline_parallel_group
+
+
+class PipelineCheckpointSaving(FSDPCheckpointSaving):
+    def __init__(
+        self,
+        checkpoint_path: Path,
+        experiment_id: str,
+        global_rank: int,
+        get_num_tokens_from_num_steps_callable: Callable[[int], int],
+        pipeline_parallel_degree: int,
+    ):
+        """
+        Implementation of checkpointing the stage models of a pipeline (see ModelFactory.get_pipeline_stage_model)
+        to disc. The state dicts of the stages are merged on rank 0 into the same full checkpoints as saved by
+        FSDPCheckpointSaving, i.e., the state dict of the full model and the optimizer state dict, whose parameters
+        are referenced by their names. Thus, the checkpoints can be loaded with FSDPCheckpointLoading.
+
+        Args:
+            checkpoint_path (Path): folder path to the checkpoint
+            experiment_id (str): ID of the experiment
+            global_rank (int): global rank within the current process group
+            get_num_tokens_from_num_steps_callable (Callable[[int], int]): callable to get the number
+                of tokens for a given number of train steps
+            pipeline_parallel_degree (int): number of pipeline stages
+        """
+        super().__init__(
+            checkpoint_path=checkpoint_path,
+            experiment_id=experiment_id,
+            global_rank=global_rank,
+            get_num_tokens_from_num_steps_callable=get_num_tokens_from_num_steps_callable,
+        )
+        self.group = get_pipeline_parallel_group(pipeline_parallel_degree)
+
+    def _get_full_state_dicts(
+        self, model: nn.Module, optimizer: Optimizer
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        model_state = {name: tensor.cpu() for name, tensor in model.state_dict().items()}
+        optim_state_dict = _get_named_optimizer_state_dict(model, optimizer)
+        stage_state_dicts = [None] * dist.get_world_size(self.group) if self.global_rank == 0 else None
+        dist.gather_object((model_state, optim_state_dict), stage_state_dicts, dst=0, group=self.group)
+        if self.global_rank != 0:
+            return None, None
+
+        # the stages hold disjoint parameters, whose names are the same as in the full model
+        model_state, optim_state_dict = {}, {"state": {}, "param_groups": None}
+        for stage_model_state, stage_optim_state_dict in stage_state_dicts:
+            model_state.update(stage_model_state)
+            optim_state_dict["state"].update(stage_optim_state_dict["state"])
+            if optim_state_dict["param_groups"] is None:
+                optim_state_dict["param_groups"] = stage_optim_state_dict["param_groups"]
+            else:
+                for param_group, stage_param_group in zip(
+                    optim_state_dict["param_groups"], stage_optim_state_dict["param_groups"]
+                ):
+                    param_group["params"].extend(stage_param_group["params"])
+        return model_state, optim_state_dict
+
+
+def _get_named_optimizer_state_dict(model: nn.Module, optimizer: Optimizer) -> Dict[str, Any]:
+    # the optimizer state dict of the stage, whose parameters are referenced by their names instead of their ids
+    names = {id(parameter): name for name, parameter in model.named_parameters()}
+    # the tied weight of the last stage is the same parameter of the full model as the one of the first stage
+    tied_parameters = [] if model.is_first_pipeline_stage else model.get_pipeline_tied_parameters()
+    skipped_parameters = {id(parameter) for parameter in tied_parameters}
+    optimizer_state = optimizer.state_dict()
+    state, param_groups = {}, []
+    for param_group, param_group_state in zip(optimizer.param_groups, optimizer_state["param_groups"]):
+        param_names = []
+        for parameter, param_id in zip(param_group["params"], param_group_state["params"]):
+            if id(parameter) in skipped_parameters:
+                continue
+            param_names.append(names[id(parameter)])
+            if param_id in optimizer_state["state"]:
+                state[names[id(parameter)]] = {
+                    key: value.cpu() if torch.is_tensor(value) else value
+                    for key, value in optimizer_state["state"][param_id].items()
+                }
+        param_groups.append({**param_group_state, "params": param_names})
+    return {"state": state, "param_groups": param_groups}
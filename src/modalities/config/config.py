@@ -4,7 +4,7 @@ from pathlib import Path
 from typing import Annotated, Callable, Dict, List, Literal, Optional, Tuple
 
 import torch
-from omegaconf import OmegaConf
+from omegaconf import DictConfig, OmegaConf
 from pydantic import BaseModel, ConfigDict, Field, FilePath, PositiveInt, field_validator, model_validator
 from torch.distributed.fsdp import ShardingStrategy
 from transformers import GPT2TokenizerFast
@@ -64,6 +64,15 @@ class ReferenceConfig(BaseModel):
 class CLMCrossEntropyLossConfig(BaseModel):
     target_key: str
     prediction_key: str
+    context_parallel_degree: Annotated[int, Field(strict=True, ge=1)] = 1
+
+
+class CLMChunkedCrossEntropyLossConfig(BaseModel):
+    target_key: str
+    prediction_key: str
+    lm_head_weight_key: str
+    chunk_size: Annotated[int, Field(strict=True, ge=1)]
+    context_parallel_degree: Annotated[int, Field(strict=True, ge=1)] = 1
 
 
 # Checkpointing
@@ -114,6 +123,10 @@ class FSDPCheckpointSavingConfig(BaseModel):
     get_num_tokens_from_num_steps_callable: Callable[[int], int]
 
 
+class PipelineCheckpointSavingConfig(FSDPCheckpointSavingConfig):
+    pipeline_parallel_degree: Annotated[int, Field(strict=True, ge=1)]
+
+
 class CheckpointSavingConfig(BaseModel):
     checkpoint_saving_strategy: PydanticCheckpointSavingStrategyIFType
     checkpoint_saving_execution: PydanticCheckpointSavingExecutionIFType
@@ -212,6 +225,7 @@ class FSDPWrappedModelConfig(BaseModel):
     mixed_precision_settings: MixedPrecisionSettings
     sharding_strategy: ShardingStrategy
     block_names: List[str]
+    tensor_parallel_degree: Annotated[int, Field(strict=True, ge=1)] = 1
 
     @field_validator("mixed_precision_settings", mode="before")
     def parse_mixed_precision_setting_by_name(cls, name):
@@ -230,6 +244,26 @@ class FSDPWrappedModelConfig(BaseModel):
         return parse_enum_by_name(name=name, enum_type=ShardingStrategy)
 
 
+class CompiledModelConfig(BaseModel):
+    model: PydanticPytorchModuleType
+    block_names: List[str]
+    mode: Optional[Literal["default", "reduce-overhead", "max-autotune", "max-autotune-no-cudagraphs"]] = None
+    dynamic: Optional[bool] = None
+    fullgraph: bool = False
+    backend: str = "inductor"
+    cache_dir: Optional[Path] = None
+
+
+class TensorParallelModelConfig(BaseModel):
+    model: PydanticPytorchModuleType
+    tensor_parallel_degree: Annotated[int, Field(strict=True, ge=1)]
+
+
+class PipelineStageModelConfig(BaseModel):
+    model: PydanticPytorchModuleType
+    pipeline_parallel_degree: Annotated[int, Field(strict=True, ge=1)]
+
+
 class WeightInitializedModelConfig(BaseModel):
     model: PydanticPytorchModuleType
     model_initializer: PydanticModelInitializationIFType
@@ -267,12 +301,14 @@ class MemMapDatasetConfig(BaseModel):
     tokenizer: PydanticTokenizerIFType
     jq_pattern: str
     sample_key: str
+    token_cache_dir: Optional[Path] = None
 
 
 class PackedMemMapDatasetContinuousConfig(BaseModel):
     raw_data_path: Path
     sequence_length: Annotated[int, Field(strict=True, gt=1)]
     sample_key: str
+    document_id_key: Optional[str] = None
 
 
 class PackedMemMapDatasetMegatronConfig(BaseModel):
@@ -293,6 +329,20 @@ class OpenGPTXMMapDatasetConfig(BaseModel):
     sequence_len: PositiveInt
 
 
+class BlendedPackedDatasetConfig(BaseModel):
+    datasets: List[PydanticDatasetIFType]
+    weights: List[Annotated[float, Field(ge=0)]]
+    seed: int = 0
+    num_samples: Optional[Annotated[int, Field(strict=True, ge=1)]] = None
+    blend_index_dir: Optional[Path] = None
+
+    @model_validator(mode="after")
+    def check_weights_match_datasets(self) -> "BlendedPackedDatasetConfig":
+        if len(self.weights) != len(self.datasets):
+            raise ValueError("The number of weights must match the number of datasets.")
+        return self
+
+
 class BatchSamplerConfig(BaseModel):
     sampler: PydanticSamplerIFType
     batch_size: Annotated[int, Field(strict=True, gt=0)]
@@ -307,6 +357,7 @@ class ResumableBatchSamplerConfig(BaseModel):
 class GPT2LLMCollateFnConfig(BaseModel):
     sample_key: str
     target_key: str
+    document_id_key: Optional[str] = None
 
 
 class LLMDataLoaderConfig(BaseModel):
@@ -374,11 +425,27 @@ def load_app_config_dict(config_file_path: Path) -> Dict:
         if var_name == "num_cpus":
             return os.cpu_count()
 
+    def data_parallel_env_resolver_fun(var_name: str, _root_: DictConfig) -> int:
+        # the consecutive ranks of a context, tensor or pipeline parallel group form a single data parallel
+        # replica, such that the samplers of its ranks return the same samples
+        num_ranks_per_data_parallel_replica = (
+            OmegaConf.select(_root_, "settings.training.context_parallel_degree", default=1)
+            * OmegaConf.select(_root_, "settings.training.tensor_parallel_degree", default=1)
+            * OmegaConf.select(_root_, "settings.training.pipeline_parallelism.pipeline_parallel_degree", default=1)
+        )
+        if var_name == "rank":
+            return int(os.getenv("RANK")) // num_ranks_per_data_parallel_replica
+        elif var_name == "world_size":
+            return int(os.getenv("WORLD_SIZE")) // num_ranks_per_data_parallel_replica
+        else:
+            raise ValueError(f"Unknown data_parallel_env variable: {var_name}.")
+
     OmegaConf.register_new_resolver("cuda_env", cuda_env_resolver_fun, replace=True)
     OmegaConf.register_new_resolver(
         "modalities_env", partial(modalities_env_resolver_fun, config_file_path=config_file_path), replace=True
     )
     OmegaConf.register_new_resolver("node_env", node_env_resolver_fun, replace=True)
+    OmegaConf.register_new_resolver("data_parallel_env", data_parallel_env_resolver_fun, replace=True)
 
     cfg = OmegaConf.load(config_file_path)
     config_dict = OmegaConf.to_container(cfg, resolve=True)
@@ -2,8 +2,9 @@ import os
 from pathlib import Path
 from typing import Annotated, Dict, List, Optional
 
-from pydantic import BaseModel, ConfigDict, Field, FilePath, field_validator
+from pydantic import BaseModel, ConfigDict, Field, FilePath, field_validator, model_validator
 
+from modalities.activation_checkpointing import ActivationCheckpointingVariants
 from modalities.config.pydanctic_if_types import (
     PydanticCheckpointSavingIFType,
     PydanticGradientClipperIFType,
@@ -18,6 +19,7 @@ from modalities.config.pydanctic_if_types import (
     PydanticTokenizerIFType,
 )
 from modalities.config.utils import parse_torch_device
+from modalities.dataloader.sharded_packing import ShardMergeType
 
 
 class CudaEnvSettings(BaseModel):
@@ -29,23 +31,121 @@ class CudaEnvSettings(BaseModel):
 class TrainingComponentsInstantiationModel(BaseModel):
     class TrainingSettings(BaseModel):
         class Training(BaseModel):
+            class ActivationCheckpointing(BaseModel):
+                variant: ActivationCheckpointingVariants = ActivationCheckpointingVariants.FULL_BLOCK
+                every_k_blocks: Annotated[int, Field(strict=True, ge=1)] = 1
+                submodule_names: Optional[List[str]] = None
+                saved_ops: Optional[List[str]] = None
+                memory_budget_in_bytes: Optional[Annotated[int, Field(strict=True, ge=0)]] = None
+
+                @model_validator(mode="after")
+                def check_variant_settings(
+                    self,
+                ) -> "TrainingComponentsInstantiationModel.TrainingSettings.Training.ActivationCheckpointing":
+                    if self.variant == ActivationCheckpointingVariants.SUBMODULES and not self.submodule_names:
+                        raise ValueError("submodule_names must be set for checkpointing submodules.")
+                    if self.variant == ActivationCheckpointingVariants.MEMORY_BUDGET and (
+                        self.memory_budget_in_bytes is None
+                    ):
+                        raise ValueError("memory_budget_in_bytes must be set for the memory budget.")
+                    return self
+
+            class ActivationOffloading(BaseModel):
+                min_offloaded_tensor_size_in_bytes: Annotated[int, Field(strict=True, ge=0)] = 1024
+                pin_memory: bool = True
+
+            class PipelineParallelism(BaseModel):
+                # has to match the degree of the pipeline_stage model component
+                pipeline_parallel_degree: Annotated[int, Field(strict=True, ge=1)] = 1
+                num_micro_batches: Annotated[int, Field(strict=True, ge=1)] = 1
+
             training_log_interval_in_steps: Annotated[int, Field(strict=True, ge=1)]
             checkpointing_interval_in_steps: Annotated[int, Field(strict=True, ge=1)]
             evaluation_interval_in_steps: Annotated[int, Field(strict=True, ge=1)]
             activation_checkpointing_modules: Optional[List[str]] = Field(default_factory=list)
+            activation_checkpointing: ActivationCheckpointing = Field(default_factory=ActivationCheckpointing)
+            activation_offloading_modules: Optional[List[str]] = Field(default_factory=list)
+            activation_offloading: ActivationOffloading = Field(default_factory=ActivationOffloading)
+            pipeline_parallelism: PipelineParallelism = Field(default_factory=PipelineParallelism)
+            # have to match the degrees of the model components and the loss
+            context_parallel_degree: Annotated[int, Field(strict=True, ge=1)] = 1
+            tensor_parallel_degree: Annotated[int, Field(strict=True, ge=1)] = 1
             gradient_acc_steps: Annotated[int, Field(strict=True, ge=1)]
+            # reduces the gradients once per step instead of per micro-batch, but keeps them unsharded in between
+            use_no_sync_for_gradient_accumulation: bool = False
             local_train_micro_batch_size: Annotated[int, Field(strict=True, ge=1)]
             sequence_length: Annotated[int, Field(strict=True, ge=1)]
 
+            @model_validator(mode="after")
+            def check_activation_offloading_modules(
+                self,
+            ) -> "TrainingComponentsInstantiationModel.TrainingSettings.Training":
+                # the activations of checkpointed blocks are recomputed instead of saved
+                overlapping_modules = set(self.activation_offloading_modules) & set(
+                    self.activation_checkpointing_modules
+                )
+                if len(overlapping_modules) > 0:
+                    raise ValueError(f"Modules {overlapping_modules} cannot be both checkpointed and offloaded.")
+                return self
+
+            @model_validator(mode="after")
+            def check_pipeline_micro_batches(
+                self,
+            ) -> "TrainingComponentsInstantiationModel.TrainingSettings.Training":
+                if self.local_train_micro_batch_size % self.pipeline_parallelism.num_micro_batches != 0:
+                    raise ValueError(
+                        f"local_train_micro_batch_size {self.local_train_micro_batch_size} must be divisible by "
+                        f"the number of pipeline micro-batches {self.pipeline_parallelism.num_micro_batches}."
+                    )
+                return self
+
+            @property
+            def num_ranks_per_data_parallel_replica(self) -> int:
+                # the consecutive ranks of a context, tensor or pipeline parallel group process the same samples
+                return (
+                    self.context_parallel_degree
+                    * self.tensor_parallel_degree
+                    * self.pipeline_parallelism.pipeline_parallel_degree
+                )
+
+        class Evaluation(BaseModel):
+            max_num_batches: Optional[Annotated[int, Field(strict=True, ge=1)]] = None
+            max_num_tokens: Optional[Annotated[int, Field(strict=True, ge=1)]] = None
+            use_inference_mode: bool = False
+
         class Paths(BaseModel):
             checkpointing_path: Path
 
         experiment_id: str
         referencing_keys: Dict[str, str]
         training: Training
+        evaluation: Evaluation = Field(default_factory=Evaluation)
         cuda_env: CudaEnvSettings
         paths: Paths
 
+        @model_validator(mode="after")
+        def check_num_ranks_per_data_parallel_replica(
+            self,
+        ) -> "TrainingComponentsInstantiationModel.TrainingSettings":
+            num_ranks_per_data_parallel_replica = self.training.num_ranks_per_data_parallel_replica
+            if self.cuda_env.world_size % num_ranks_per_data_parallel_replica != 0:
+                raise ValueError(
+                    f"The world size {self.cuda_env.world_size} must be divisible by the product of the context, "
+                    f"tensor and pipeline parallel degrees {num_ranks_per_data_parallel_replica}."
+                )
+            return self
+
+        @model_validator(mode="after")
+        def check_pipeline_parallel_degree(self) -> "TrainingComponentsInstantiationModel.TrainingSettings":
+            # the gradients of the stages are not averaged across several pipelines, i.e., data parallel replicas
+            pipeline_parallel_degree = self.training.pipeline_parallelism.pipeline_parallel_degree
+            if pipeline_parallel_degree > 1 and self.cuda_env.world_size != pipeline_parallel_degree:
+                raise ValueError(
+                    f"The world size {self.cuda_env.world_size} must equal the pipeline parallel degree "
+                    f"{pipeline_parallel_degree}, since pipeline parallelism is not combined with data parallelism."
+                )
+            return self
+
     wrapped_model: PydanticPytorchModuleType
     optimizer: PydanticOptimizerIFType
     scheduler: PydanticLRSchedulerIFType
@@ -60,8 +160,28 @@ class TrainingComponentsInstantiationModel(BaseModel):
 
 
 class PackedDatasetComponentsInstantiationModel(BaseModel):
+    class DocumentFilterSettings(BaseModel):
+        min_num_tokens: Optional[Annotated[int, Field(strict=True, ge=1)]] = None
+        max_num_tokens: Optional[Annotated[int, Field(strict=True, ge=1)]] = None
+        exact_deduplication: bool = False
+        near_deduplication: bool = False
+        minhash_num_permutations: Annotated[int, Field(strict=True, ge=1)] = 128
+        minhash_num_bands: Annotated[int, Field(strict=True, ge=1)] = 16
+        shingle_size: Annotated[int, Field(strict=True, ge=1)] = 5
+        max_index_entries: Annotated[int, Field(strict=True, ge=1)] = 10_000_000
+        seed: int = 0
+
+        @model_validator(mode="after")
+        def check_minhash_num_bands(self) -> "PackedDatasetComponentsInstantiationModel.DocumentFilterSettings":
+            if self.minhash_num_permutations % self.minhash_num_bands != 0:
+                raise ValueError("minhash_num_permutations must be divisible by minhash_num_bands.")
+            return self
+
     class PackedDatasetSettings(BaseModel):
-        src_path: FilePath
+        src_path: Optional[FilePath] = None
+        # glob of (possibly gzip or zstandard compressed) jsonl shards, which are streamed without index files
+        src_glob: Optional[str] = None
+        num_decompression_threads: Annotated[int, Field(strict=True, ge=1)] = 4
         dst_path: Optional[Path] = None
         index_path: Optional[FilePath] = None
         jq_pattern: str
@@ -70,11 +190,39 @@ class PackedDatasetComponentsInstantiationModel(BaseModel):
         processing_batch_size: Annotated[int, Field(strict=True, ge=1)]
         raw_samples_queue_size: Annotated[int, Field(strict=True, ge=1)]
         processed_samples_queue_size: Annotated[int, Field(strict=True, ge=1)]
+        document_filter: Optional["PackedDatasetComponentsInstantiationModel.DocumentFilterSettings"] = None
+
+        @model_validator(mode="after")
+        def check_src(self) -> "PackedDatasetComponentsInstantiationModel.PackedDatasetSettings":
+            if (self.src_path is None) == (self.src_glob is None):
+                raise ValueError("Exactly one of src_path and src_glob must be set.")
+            if self.src_glob is not None and self.dst_path is None:
+                raise ValueError("dst_path must be set when packing the files of src_glob.")
+            return self
 
     tokenizer: PydanticTokenizerIFType
     settings: PackedDatasetSettings
 
 
+class ShardedPackedDatasetComponentsInstantiationModel(BaseModel):
+    class ShardedPackedDatasetSettings(BaseModel):
+        # glob of (possibly gzip or zstandard compressed) jsonl files, each of which is packed as a shard
+        src_glob: str
+        dst_dir: Path
+        jq_pattern: str
+        num_cpus: Annotated[int, Field(strict=True, ge=1)] = os.cpu_count()
+        num_parallel_shards: Annotated[int, Field(strict=True, ge=1)] = 1
+        eod_token: str
+        processing_batch_size: Annotated[int, Field(strict=True, ge=1)]
+        raw_samples_queue_size: Annotated[int, Field(strict=True, ge=1)]
+        processed_samples_queue_size: Annotated[int, Field(strict=True, ge=1)]
+        document_filter: Optional[PackedDatasetComponentsInstantiationModel.DocumentFilterSettings] = None
+        merge_type: Optional[ShardMergeType] = None
+
+    tokenizer: PydanticTokenizerIFType
+    settings: ShardedPackedDatasetSettings
+
+
 class TextGenerationInstantiationModel(BaseModel):
     class TextGenerationSettings(BaseModel):
         model_path: FilePath
@@ -1,3 +1,4 @@
+import json
 import logging
 import math
 import multiprocessing
@@ -6,18 +7,22 @@ import pickle
 import warnings
 from io import BufferedWriter
 from pathlib import Path
-from typing import Callable, Iterator, List, Optional, Tuple
+from typing import Callable, Iterator, List, Optional, Tuple, Union
 
-import jq
 import numpy as np
 from pydantic import FilePath
 from tqdm import tqdm
 
-from modalities.dataloader.large_file_lines_reader import LargeFileLinesReader
+from modalities.dataloader.document_filter import DocumentFilter, DocumentFingerprint
+from modalities.dataloader.jq_pattern import compile_jq_pattern
+from modalities.dataloader.large_file_lines_reader import LargeFileLinesReader, StreamingLinesReader
+from modalities.dataloader.packed_data_stats import PackedDataStatsCollector
 from modalities.tokenization.tokenizer_wrapper import TokenizerWrapper
 
 logger = logging.getLogger(__name__)
 
+VIRTUAL_PBIN_SUFFIX = ".vpbin"
+
 
 class EmptySampleError(RuntimeError):
     pass
@@ -26,7 +31,7 @@ class EmptySampleError(RuntimeError):
 class PackedDataGenerator:
     def __init__(
         self,
-        src_path: FilePath,
+        src_path: Union[FilePath, List[FilePath]],
         tokenizer: TokenizerWrapper,
         eod_token: str,
         number_of_processes: int,
@@ -35,10 +40,14 @@ class PackedDataGenerator:
         raw_samples_queue_size: int,
         processed_samples_queue_size: int,
         index_path: Optional[FilePath] = None,
+        document_filter: Optional[DocumentFilter] = None,
+        num_decompression_threads: int = 4,
     ):
         """
         Reads in a jsonl file and the corresponding index file and packs dataset file for LLM training.
-        :param src_path: Path to a jsonl file, which holds text data
+        :param src_path: Path to a jsonl file, which holds text data. Alternatively, a list of (possibly gzip or
+                         zstandard compressed) jsonl shards or a single compressed file, which are streamed
+                         sequentially without an index file and without decompressing them to disk.
         :param index_path: Path to an index file, which indicates the start character position
                            and length of samples given in `src_path`.
                            If not defined, an index file next to `src_path` is picked,
@@ -48,6 +57,14 @@ class PackedDataGenerator:
         :param tokenizer: PretrainedTokenizer object, which is used to pre-tokenize the provided data in `src_path`.
                           Tokenization is necessary to work on final lengths of token sequences.
         :param jq_pattern: jq-pattern applied on every jsonl-entry. Results are afterwards tokenized and packed
+        :param document_filter: Optional length filter and deduplication of the tokenized documents.
+                                If set, the number of dropped documents per reason is written to a sidecar file
+                                next to the destination file (suffix ".filter_stats.json").
+        :param num_decompression_threads: Number of shards that are decompressed in parallel when streaming.
+
+        Besides the pbin file, statistics of the packed documents (number of documents and tokens, document length
+        histogram and token frequencies) are written to sidecar files with the suffixes ".stats.json" and
+        ".token_frequencies.npy", see `modalities.dataloader.packed_data_stats`.
         """
         self.src_path = src_path
         self.tokenizer = tokenizer
@@ -55,14 +72,20 @@ class PackedDataGenerator:
         self._token_size_in_bytes = self._get_required_num_of_bytes_to_repr(self.tokenizer.vocab_size)
         encoded_eod_token = self.tokenizer.get_token_id(self.eod_token)
         self._encoded_eos_token_as_bytes = self._encoded_token_to_bytes(encoded_eod_token)
-        self.jq_filter = jq.compile(jq_pattern)
+        self.jq_filter = compile_jq_pattern(jq_pattern)
         self._number_of_processes = number_of_processes
-        self._reader = LargeFileLinesReader(src_path, index_path=index_path)
+        self._reader: Union[LargeFileLinesReader, StreamingLinesReader]
+        if isinstance(src_path, list) or StreamingLinesReader.is_compressed(src_path):
+            src_paths = src_path if isinstance(src_path, list) else [src_path]
+            self._reader = StreamingLinesReader(src_paths, num_decompression_threads=num_decompression_threads)
+        else:
+            self._reader = LargeFileLinesReader(src_path, index_path=index_path)
         self._total_num_of_tokens = 0
         self._raw_samples_queue = multiprocessing.Queue(maxsize=raw_samples_queue_size)
         self.processed_samples_queue = multiprocessing.Queue(maxsize=processed_samples_queue_size)
         self._exception_buffer = []
         self.processing_batch_size = processing_batch_size
+        self._document_filter = document_filter
 
     @staticmethod
     def _get_required_num_of_bytes_to_repr(int_to_get_repr: int) -> int:
@@ -73,7 +96,13 @@ class PackedDataGenerator:
 
     def _default_destination_path(self, destination_path: Optional[Path] = None) -> Path:
         if destination_path is None:
-            default_destination_path = Path(self.src_path.parent, f"{self.src_path.stem}.pbin")
+            if isinstance(self.src_path, list):
+                raise ValueError("A destination path is required when packing multiple source files.")
+            stem = self.src_path.stem
+            if StreamingLinesReader.is_compressed(self.src_path):
+                # e.g., data.jsonl.zst -> data
+                stem = Path(stem).stem
+            default_destination_path = Path(self.src_path.parent, f"{stem}.pbin")
             print(
                 f"No specific Destination Path provided. "
                 f"Pointing to destination next to input data at: {default_destination_path}"
@@ -116,6 +145,13 @@ class PackedDataGenerator:
             p.join()
         self._stop_processing()
         writer.join()
+        reader.join()
+        # exceptions in the reader and writer processes can only be detected via their exit codes
+        for process_name, process in [("reader", reader), ("writer", writer)]:
+            if process.exitcode != 0:
+                self._exception_buffer.append(
+                    RuntimeError(f"The {process_name} process failed with exit code {process.exitcode}.")
+                )
 
     def _stop_processing(self):
         self.processed_samples_queue.put(None)
@@ -136,22 +172,32 @@ class PackedDataGenerator:
         def writer():
             # writes a batch received from the processed_samples_queue to the destination file
             def _write_batch(
-                batch: List[Tuple[int, bytes]], prev_line_id: int, curr_offset: int, index_list: List, f: BufferedWriter
+                batch: List[Tuple[int, Optional[bytes], Optional[DocumentFingerprint]]],
+                prev_line_id: int,
+                curr_offset: int,
+                index_list: List,
+                f: BufferedWriter,
+                stats_collector: PackedDataStatsCollector,
             ) -> Tuple[int, int]:
                 # write the tokens for each document
-                for line_id, tokens_as_bytes in batch:
+                for line_id, tokens_as_bytes, fingerprint in batch:
                     if prev_line_id + 1 != line_id:
                         raise ValueError(
                             f"Line IDs are not consecutive. Expected {prev_line_id + 1}, but got {line_id}"
                         )
+                    prev_line_id = line_id
+                    # the documents are filtered here, since the writer sees all documents in order
+                    if self._document_filter is not None and not self._document_filter.keep(fingerprint):
+                        continue
                     f.write(tokens_as_bytes)
+                    stats_collector.add_document(tokens_as_bytes)
                     segment_length = len(tokens_as_bytes)
                     index_list.append((curr_offset, segment_length))
                     curr_offset += segment_length
-                    prev_line_id = line_id
                 return prev_line_id, curr_offset
 
             index_list = []
+            stats_collector = PackedDataStatsCollector(self._token_size_in_bytes, vocab_size=self.tokenizer.vocab_size)
             with dst_path.open("wb") as f:
                 # allocate first self.header_size_in_bytes bytes for header (encodes length of data section)
                 # not possible to prepend header after determining size of data section
@@ -166,7 +212,9 @@ class PackedDataGenerator:
                 curr_offset = 0
 
                 # write data section (tokens)
-                pbar = tqdm(total=len(self._reader), desc="Processed batches")
+                # the number of lines is unknown when streaming
+                num_lines = len(self._reader) if isinstance(self._reader, LargeFileLinesReader) else None
+                pbar = tqdm(total=num_lines, desc="Processed batches")
                 prev_line_id = -1
                 batch_dict = {}
                 for batch in self._generator_for_tokens_to_get_written():
@@ -175,31 +223,38 @@ class PackedDataGenerator:
 
                     while prev_line_id + 1 in batch_dict:
                         batch = batch_dict.pop(prev_line_id + 1)
-                        prev_line_id, curr_offset = _write_batch(batch, prev_line_id, curr_offset, index_list, f)
+                        prev_line_id, curr_offset = _write_batch(
+                            batch, prev_line_id, curr_offset, index_list, f, stats_collector
+                        )
                         pbar.update(len(batch))
                 # write index
                 f.write(pickle.dumps(index_list))
 
             self._update_data_length_in_pre_allocated_header(dst_path, index_list)
+            stats_collector.save(dst_path)
+            if self._document_filter is not None:
+                self._document_filter.save_stats(dst_path.with_suffix(".filter_stats.json"))
 
         return writer
 
     def _reader_thread(self) -> Callable:
         def reader():
-            batch = []
-            for line_id, line in tqdm(enumerate(self._reader), desc="Reading jsonl", disable=True):
-                # line = self._reader[line_id]
-                batch.append((line_id, line))
-                if len(batch) % self.processing_batch_size == 0:
+            try:
+                batch = []
+                for line_id, line in tqdm(enumerate(self._reader), desc="Reading jsonl", disable=True):
+                    # line = self._reader[line_id]
+                    batch.append((line_id, line))
+                    if len(batch) % self.processing_batch_size == 0:
+                        self._raw_samples_queue.put(batch)
+                        batch = []
+
+                # add the remaining samples
+                if len(batch) > 0:
                     self._raw_samples_queue.put(batch)
-                    batch = []
-
-            # add the remaining samples
-            if len(batch) > 0:
-                self._raw_samples_queue.put(batch)
-
-            for _ in range(self._number_of_processes):
-                self._raw_samples_queue.put(None)
+            finally:
+                # the workers are stopped also if reading fails, e.g., due to a corrupt compressed file
+                for _ in range(self._number_of_processes):
+                    self._raw_samples_queue.put(None)
 
         return reader
 
@@ -217,8 +272,8 @@ class PackedDataGenerator:
             try:
                 batch_processed = []
                 for line_id, line in batch:
-                    processed_line = self._process_line(line, process_id)
-                    batch_processed.append((line_id, processed_line))
+                    processed_line, fingerprint = self._process_line(line, process_id)
+                    batch_processed.append((line_id, processed_line, fingerprint))
                 self.processed_samples_queue.put(batch_processed)
             except EmptySampleError:
                 warnings.warn(
@@ -231,7 +286,8 @@ class PackedDataGenerator:
                 )
 
     def _update_data_length_in_pre_allocated_header(self, dst_path: Path, index_list: List[Tuple[int, int]]):
-        length_of_byte_encoded_data_section = index_list[-1][0] + index_list[-1][1]
+        # the index is empty, if all documents were filtered out
+        length_of_byte_encoded_data_section = index_list[-1][0] + index_list[-1][1] if index_list else 0
         data_section_length_in_bytes = length_of_byte_encoded_data_section.to_bytes(
             EmbeddedStreamData.DATA_SECTION_LENGTH_IN_BYTES, byteorder="little"
         )
@@ -239,14 +295,20 @@ class PackedDataGenerator:
             fout.seek(0)
             fout.write(data_section_length_in_bytes)
 
-    def _process_line(self, line: str, process_id: int) -> bytes:
-        jq_retrieved_text = self.jq_filter.input_text(line).first()
+    def _process_line(self, line: str, process_id: int) -> Tuple[Optional[bytes], Optional[DocumentFingerprint]]:
+        jq_retrieved_text = self.jq_filter.first(line)
         if jq_retrieved_text is None:
             raise ValueError(f"jq was not able to find anything using the expression: {self.jq_filter}")
         tokens = self.tokenizer.tokenize(jq_retrieved_text)
         if len(tokens) == 0:
             raise EmptySampleError("Received empty sample...")
-        return b"".join(map(self._encoded_token_to_bytes, tokens)) + self._encoded_eos_token_as_bytes
+        fingerprint = None
+        if self._document_filter is not None:
+            # the fingerprint is computed in the worker processes, the writer only looks it up in the index
+            fingerprint = self._document_filter.compute_fingerprint(tokens)
+            if fingerprint.drop_reason is not None:
+                return None, fingerprint
+        return b"".join(map(self._encoded_token_to_bytes, tokens)) + self._encoded_eos_token_as_bytes, fingerprint
 
 
 class EmbeddedStreamData:
@@ -285,41 +347,185 @@ class EmbeddedStreamData:
             # initialize memmapped data section
             self.data = np.memmap(self._data_path, mode="r", offset=self.HEADER_SIZE_IN_BYTES, shape=(self.data_len,))
 
+    @property
+    def data_path(self) -> Path:
+        return self._data_path
 
-def join_embedded_stream_data(stream_data: List[EmbeddedStreamData], target_file: Path, chunk_size: int = 2048):
-    if target_file.exists():
-        raise FileExistsError(f'Target File at "{target_file}" exists!')
-    data_len = sum(d.data_len for d in stream_data)
+    def get_data_slice(self, offset_in_bytes: int, length_in_bytes: int) -> np.ndarray:
+        # zero-copy view on the memmapped data section
+        return self.data[offset_in_bytes : offset_in_bytes + length_in_bytes]
+
+
+def _check_token_sizes(stream_data: List[EmbeddedStreamData]) -> int:
     assert len({d.token_size_in_bytes for d in stream_data}) == 1, (
         "Found different token representation sizes. This could indicate the usage of different tokenizers. "
         "Not supported!"
     )
-    token_size_in_bytes = stream_data[0].token_size_in_bytes
+    return stream_data[0].token_size_in_bytes
+
+
+def _copy_file_range(src_path: Path, src_offset: int, count: int, fout: BufferedWriter, chunk_size: int):
+    # appends the bytes [src_offset, src_offset + count) of the source file at the current position of fout.
+    # os.copy_file_range and os.sendfile copy within the kernel (copy_file_range even allows reflinks on
+    # file systems like XFS or btrfs). A copy in large blocks through user space is the fallback.
+    fout.flush()
+    out_fd = fout.fileno()
+    dst_offset = os.lseek(out_fd, 0, os.SEEK_CUR)
+    num_copied_bytes = 0
+    with src_path.open("rb") as fin:
+        in_fd = fin.fileno()
 
-    num_data_chunks = sum(math.ceil(d.data_len / chunk_size) for d in stream_data)
-    data_stream_generator = (d.data[i : i + chunk_size] for d in stream_data for i in range(0, d.data_len, chunk_size))
+        def copy_file_range(n: int) -> int:
+            return os.copy_file_range(in_fd, out_fd, n, src_offset + num_copied_bytes, dst_offset + num_copied_bytes)
+
+        def sendfile(n: int) -> int:
+            os.lseek(out_fd, dst_offset + num_copied_bytes, os.SEEK_SET)
+            return os.sendfile(out_fd, in_fd, src_offset + num_copied_bytes, n)
+
+        def read_write(n: int) -> int:
+            fin.seek(src_offset + num_copied_bytes)
+            os.lseek(out_fd, dst_offset + num_copied_bytes, os.SEEK_SET)
+            return os.write(out_fd, fin.read(n))
+
+        for copy_fun in [copy_file_range, sendfile, read_write]:
+            try:
+                while num_copied_bytes < count:
+                    n = copy_fun(min(chunk_size, count - num_copied_bytes))
+                    if n == 0:
+                        raise EOFError(f"Unexpected end of file {src_path}.")
+                    num_copied_bytes += n
+                break
+            except (AttributeError, OSError):
+                # not supported by the platform or file system, continue with the next copy function
+                if copy_fun is read_write:
+                    raise
+    # copy_file_range does not move the file position of fout
+    os.lseek(out_fd, dst_offset + count, os.SEEK_SET)
+
+
+def join_embedded_stream_data(
+    stream_data: List[EmbeddedStreamData], target_file: Path, chunk_size: int = 64 * 1024**2
+):
+    """Physically merges pbin files into a single pbin file. The data sections are copied in blocks of
+    `chunk_size` bytes via `os.copy_file_range` (or `os.sendfile`), i.e., without passing through Python.
+    Consider `create_virtual_pbin` to merge pbin files without copying any data."""
+    if target_file.exists():
+        raise FileExistsError(f'Target File at "{target_file}" exists!')
+    data_len = sum(d.data_len for d in stream_data)
+    token_size_in_bytes = _check_token_sizes(stream_data)
 
     num_entries = sum(len(d.index_base) for d in stream_data)
 
     def index_stream_generator() -> Iterator[Tuple[int, int]]:
+        # the offsets in the index are relative to the data section
         curr_offset = 0
         for embedded_stream_data in stream_data:
             for entry_offset, segment_length in embedded_stream_data.index_base:
                 yield entry_offset + curr_offset, segment_length
             curr_offset += embedded_stream_data.data_len
-            curr_offset -= embedded_stream_data.HEADER_SIZE_IN_BYTES
 
     with target_file.open("wb") as fout:
         fout.write(data_len.to_bytes(EmbeddedStreamData.DATA_SECTION_LENGTH_IN_BYTES, byteorder="little"))
         fout.write(
             token_size_in_bytes.to_bytes(EmbeddedStreamData.TOKEN_SIZE_DESCRIPTOR_LENGTH_IN_BYTES, byteorder="little")
         )
-        for data_chunk in tqdm(data_stream_generator, total=num_data_chunks, desc="Writing Data Chunks..."):
-            fout.write(data_chunk)
+        for d in tqdm(stream_data, desc="Copying Data Sections..."):
+            _copy_file_range(
+                d.data_path,
+                src_offset=EmbeddedStreamData.HEADER_SIZE_IN_BYTES,
+                count=d.data_len,
+                fout=fout,
+                chunk_size=chunk_size,
+            )
 
         joint_index = [entry for entry in tqdm(index_stream_generator(), total=num_entries, desc="Concatenating Index")]
-        pickled_index = pickle.dumps(joint_index)
-        pickled_index_as_chunks = (pickled_index[i : i + chunk_size] for i in range(0, len(pickled_index), chunk_size))
-        num_index_chunks = math.ceil(len(pickled_index) / chunk_size)
-        for index_chunk in tqdm(pickled_index_as_chunks, total=num_index_chunks, desc="Writing Index Chunks..."):
-            fout.write(index_chunk)
+        fout.write(pickle.dumps(joint_index))
+
+
+class VirtualEmbeddedStreamData:
+    """Read-only view on multiple pbin files as one contiguous pbin file, based on a small manifest file
+    (see `create_virtual_pbin`). It provides the same attributes as `EmbeddedStreamData`, whereby the offsets
+    in `index_base` are relative to the concatenated data sections of all member files."""
+
+    MANIFEST_FORMAT = "virtual_pbin"
+    MANIFEST_VERSION = 1
+
+    def __init__(self, manifest_path: Path):
+        self._data_path = manifest_path
+        with manifest_path.open("r") as f:
+            manifest = json.load(f)
+        if manifest.get("format") != self.MANIFEST_FORMAT or manifest.get("version") != self.MANIFEST_VERSION:
+            raise ValueError(f"{manifest_path} is not a virtual pbin manifest of version {self.MANIFEST_VERSION}.")
+
+        self.members: List[EmbeddedStreamData] = []
+        for member in manifest["members"]:
+            member_data = EmbeddedStreamData(manifest_path.parent / member["path"])
+            if member_data.data_len != member["data_len"] or len(member_data.index_base) != member["num_documents"]:
+                raise ValueError(f"{member_data.data_path} changed after creating the manifest {manifest_path}.")
+            self.members.append(member_data)
+        self.token_size_in_bytes = manifest["token_size_in_bytes"]
+        if {d.token_size_in_bytes for d in self.members} != {self.token_size_in_bytes}:
+            raise ValueError(f"The members of {manifest_path} have different token sizes.")
+        # start offset of each member within the concatenated data sections
+        self.member_offsets = np.cumsum([0] + [d.data_len for d in self.members], dtype=np.int64)
+        self.data_len = int(self.member_offsets[-1])
+        self.index_base: List[Tuple[int, int]] = [
+            (entry_offset + int(member_offset), segment_length)
+            for member_data, member_offset in zip(self.members, self.member_offsets)
+            for entry_offset, segment_length in member_data.index_base
+        ]
+
+    @property
+    def data_path(self) -> Path:
+        return self._data_path
+
+    def get_data_slice(self, offset_in_bytes: int, length_in_bytes: int) -> np.ndarray:
+        # zero-copy view if the slice lies within a single member, otherwise the parts are concatenated
+        if length_in_bytes == 0:
+            return np.empty(0, dtype=np.uint8)
+        first_member_id = int(np.searchsorted(self.member_offsets, offset_in_bytes, side="right")) - 1
+        parts = []
+        end_in_bytes = offset_in_bytes + length_in_bytes
+        for member_id in range(first_member_id, len(self.members)):
+            member_offset = int(self.member_offsets[member_id])
+            if member_offset >= end_in_bytes:
+                break
+            member_start = max(offset_in_bytes - member_offset, 0)
+            parts.append(
+                self.members[member_id].get_data_slice(
+                    member_start, min(end_in_bytes - member_offset, self.members[member_id].data_len) - member_start
+                )
+            )
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+def create_virtual_pbin(src_paths: List[Path], target_path: Path):
+    """Merges pbin files without copying any data by writing a manifest file, which lists the member pbin files
+    (relative to the manifest's directory) together with their sizes. The manifest can be used as `raw_data_path`
+    of the packed datasets like a regular pbin file."""
+    if target_path.exists():
+        raise FileExistsError(f'Target File at "{target_path}" exists!')
+    stream_data = [EmbeddedStreamData(p) for p in src_paths]
+    token_size_in_bytes = _check_token_sizes(stream_data)
+    manifest = {
+        "format": VirtualEmbeddedStreamData.MANIFEST_FORMAT,
+        "version": VirtualEmbeddedStreamData.MANIFEST_VERSION,
+        "token_size_in_bytes": token_size_in_bytes,
+        "members": [
+            {
+                "path": os.path.relpath(d.data_path.absolute(), target_path.absolute().parent),
+                "data_len": d.data_len,
+                "num_documents": len(d.index_base),
+            }
+            for d in stream_data
+        ],
+    }
+    with target_path.open("w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def load_embedded_stream_data(data_path: Path) -> Union[EmbeddedStreamData, VirtualEmbeddedStreamData]:
+    """Loads a pbin file or, if the path has the suffix `.vpbin`, a virtual pbin manifest."""
+    if data_path.suffix == VIRTUAL_PBIN_SUFFIX:
+        return VirtualEmbeddedStreamData(data_path)
+    return EmbeddedStreamData(data_path)
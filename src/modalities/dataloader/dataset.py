@@ -1,10 +1,10 @@
 from __future__ import annotations
 
+import hashlib
 from enum import Enum
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 
-import jq
 import numpy as np
 from pydantic import BaseModel
 from torch.utils.data.dataset import Dataset as TorchdataSet
@@ -12,9 +12,12 @@ from tqdm import tqdm
 from transformers import BatchEncoding
 
 from modalities.tokenization.tokenizer_wrapper import TokenizerWrapper
+from modalities.util import file_lock, save_array_atomically
 
 from ..dataloader.large_file_lines_reader import LargeFileLinesReader
-from .create_packed_data import EmbeddedStreamData
+from .create_packed_data import EmbeddedStreamData, load_embedded_stream_data
+from .jq_pattern import compile_jq_pattern
+from .token_cache import TokenCache
 
 
 class Dataset(TorchdataSet):
@@ -81,6 +84,7 @@ class MemMapDataset(Dataset):
         sample_key: str,
         index_path: Optional[Path] = None,
         jq_pattern: str = ".text",
+        token_cache_dir: Optional[Path] = None,
     ):
         """
         Pytorch Dataset with mmap support.
@@ -95,19 +99,42 @@ class MemMapDataset(Dataset):
         :param sample_key: model-specific parameter to indicate where in the BatchEncoding the input_token_ids are.
                            TODO: If this setting should support multi-modal features using separately encoded inputs,
                             this needs to get replaced with a list of sample keys!
+        :param token_cache_dir: If set, the token ids of each sample are cached persistently in a subdirectory
+                                specific to the raw data, jq pattern and tokenizer (see `TokenCache`).
+                                Each sample is tokenized once by any dataloader worker or rank and afterwards read
+                                zero-copy from the cache.
+                                With and without the cache, the token ids of a sample are returned as numpy array
+                                of dtype `TokenCache.TOKEN_DTYPE` (int32).
         """
         super().__init__(raw_data_path=raw_data_path, sample_key=sample_key)
 
         self.reader = LargeFileLinesReader(self.raw_data_path, index_path=index_path)
-        self.jq_filter = jq.compile(jq_pattern)
+        self.jq_filter = compile_jq_pattern(jq_pattern)
         self.tokenizer = tokenizer
+        self.token_cache = None
+        if token_cache_dir is not None:
+            cache_dir = TokenCache.get_cache_dir(
+                token_cache_dir,
+                raw_data_path=self.raw_data_path,
+                num_samples=len(self.reader),
+                jq_pattern=jq_pattern,
+                tokenizer=tokenizer,
+            )
+            self.token_cache = TokenCache(cache_dir, num_samples=len(self.reader))
 
     def __len__(self) -> int:
         return len(self.reader)
 
-    def __getitem__(self, idx: int) -> BatchEncoding:
+    def __getitem__(self, idx: int) -> np.ndarray:
         self._check_if_inbounds(idx)
-        return self.tokenizer.tokenize(text=self.jq_filter.input_text(self.reader[idx]).first())
+        if self.token_cache is not None:
+            tokens = self.token_cache.get(idx)
+            if tokens is not None:
+                return tokens
+        tokens = self.tokenizer.tokenize(text=self.jq_filter.first(self.reader[idx]))
+        if self.token_cache is not None:
+            return self.token_cache.put(idx, tokens)
+        return np.asarray(tokens, dtype=TokenCache.TOKEN_DTYPE)
 
 
 class PackedMemMapDatasetBase(Dataset):
@@ -131,12 +158,14 @@ class PackedMemMapDatasetBase(Dataset):
 
         :param raw_data_path: Path to a packed binary file (*.pbin).
                               Use `modalities data pack_encoded_data` to create one based on a jsonl-file.
+                              Alternatively, a virtual pbin manifest (*.vpbin) spanning multiple pbin files,
+                              see `modalities data merge_packed_data --virtual`.
         :param sample_key: model-specific parameter to indicate where in the BatchEncoding the input_token_ids are.
                            TODO: If this setting should support multi-modal features using separately encoded inputs,
                             this needs to get replaced with a list of sample keys!
         """
         super().__init__(raw_data_path=raw_data_path, sample_key=sample_key)
-        self._embedded_stream_data = EmbeddedStreamData(raw_data_path)
+        self._embedded_stream_data = load_embedded_stream_data(raw_data_path)
         self._token_size_in_bytes = self._embedded_stream_data.token_size_in_bytes
         try:
             self._token_dtype_on_disk = self.np_dtype_of_tokens_on_disk_from_bytes[self._token_size_in_bytes]
@@ -164,15 +193,11 @@ class PackedMemMapDatasetBase(Dataset):
                 f"Length of the sample in bytes is not a multiple of {self._token_size_in_bytes}."
                 f"Offset in bytes: {offset_in_bytes}, Length in bytes: {length_in_bytes}"
             )
-        # numpy frombuffer takes the memmap object as the buffer
-        # and indices the data section with the given offset (in bytes)
-        # and length in indices of type self._token_dtype_on_disk
-        num_tokens = length_in_bytes // self._token_size_in_bytes
+        # numpy frombuffer takes the (memmapped) slice of the data section as the buffer
+        # and interprets it as indices of type self._token_dtype_on_disk
         tokens = np.frombuffer(
-            buffer=self._embedded_stream_data.data,
+            buffer=self._embedded_stream_data.get_data_slice(offset_in_bytes, length_in_bytes),
             dtype=self._token_dtype_on_disk,
-            count=num_tokens,
-            offset=offset_in_bytes,
         )
         # torch can't convert most uint-formats, therefore we infer regular int types
         tokens = tokens.astype(self._token_dtype_in_ram)
@@ -180,9 +205,40 @@ class PackedMemMapDatasetBase(Dataset):
 
 
 class PackedMemMapDatasetContinuous(PackedMemMapDatasetBase):
-    def __init__(self, raw_data_path: Path, sample_key: str, block_size: int):
+    def __init__(self, raw_data_path: Path, sample_key: str, block_size: int, document_id_key: Optional[str] = None):
+        """
+        Packed memmapped dataset that concatenates all documents and cuts the resulting token stream into
+        blocks of `block_size` tokens, whereby the last token of a block is reused as the first token of the
+        subsequent block.
+
+        :param raw_data_path: Path to a packed binary file (*.pbin).
+        :param sample_key: model-specific parameter to indicate where in the BatchEncoding the input_token_ids are.
+        :param block_size: Number of tokens per sample.
+        :param document_id_key: If set, each sample additionally contains the ids of the documents that the
+                                individual tokens belong to under this key. The ids are relative to the sample,
+                                i.e., the first token of each sample has document id 0. This allows the model to
+                                restrict the attention to the tokens of the same document.
+        """
         self.block_size = block_size
+        self.document_id_key = document_id_key
         super().__init__(raw_data_path=raw_data_path, sample_key=sample_key)
+        if self.document_id_key is not None:
+            self._document_start_token_ids = np.array(
+                [offset // self._token_size_in_bytes for offset, _ in self._embedded_stream_data.index_base],
+                dtype=np.int64,
+            )
+
+    def __getitem__(self, idx: int) -> BatchEncoding:
+        sample = super().__getitem__(idx)
+        if self.document_id_key is not None:
+            sample[self.document_id_key] = self._get_document_ids(idx)
+        return sample
+
+    def _get_document_ids(self, idx: int) -> np.ndarray:
+        first_token_id = idx * (self.block_size - 1)
+        token_ids = np.arange(first_token_id, first_token_id + self.block_size, dtype=np.int64)
+        document_ids = np.searchsorted(self._document_start_token_ids, token_ids, side="right")
+        return document_ids - document_ids[0]
 
     def _generate_packing_index(self) -> List[Tuple[int, int]]:
         # get number of total tokens in file
@@ -241,3 +297,96 @@ class PackedMemMapDatasetMegatron(PackedMemMapDatasetBase):
                     curr_offset = segment_offset
                     curr_len = segment_len
         return index
+
+
+class BlendedPackedDataset(TorchdataSet):
+    def __init__(
+        self,
+        datasets: Sequence[TorchdataSet],
+        weights: Sequence[float],
+        seed: int = 0,
+        num_samples: Optional[int] = None,
+        blend_index_dir: Optional[Path] = None,
+    ):
+        """
+        Blends multiple (packed) datasets according to sampling weights without copying their data.
+
+        Sample i of the blend maps to (dataset index, sample index) via a precomputed blend index.
+        The k-th sample of dataset d is placed at the position (k + u_d) / w_d of a common timeline, where w_d is
+        the normalized weight and u_d a random phase in [0, 1) drawn with the given seed. Sorting by this position
+        interleaves the datasets deterministically and matches the weights exactly in every prefix (up to one
+        sample per dataset), which keeps the blend consistent when resuming via `ResumableBatchSampler`.
+        Datasets that are sampled more often than they contain samples are repeated from the start.
+        Changing the weights only requires a new blend index, the underlying data is not touched.
+
+        :param datasets: Datasets to blend, e.g., PackedMemMapDatasetContinuous instances of different corpora.
+        :param weights: Non-negative sampling weight per dataset, normalized internally.
+        :param seed: Seed for the phases of the datasets within the blend.
+        :param num_samples: Number of samples of the blend. Defaults to the sum of the lengths of all datasets.
+        :param blend_index_dir: If set, the blend index is cached as memory-mapped .npy file in this directory,
+                                addressed by the dataset lengths, weights, seed and number of samples.
+        """
+        if len(datasets) == 0 or len(datasets) != len(weights):
+            raise ValueError(
+                f"Expected one weight per dataset, got {len(weights)} weights for {len(datasets)} datasets."
+            )
+        weights = np.asarray(weights, dtype=np.float64)
+        if np.any(weights < 0) or weights.sum() <= 0:
+            raise ValueError(f"Weights must be non-negative with a positive sum, got {weights.tolist()}.")
+        self.datasets = list(datasets)
+        self.weights = weights / weights.sum()
+        self.seed = seed
+        self.dataset_lengths = np.array([len(dataset) for dataset in self.datasets], dtype=np.int64)
+        if np.any((self.dataset_lengths == 0) & (self.weights > 0)):
+            raise ValueError("Datasets with a positive weight must not be empty.")
+        self.num_samples = int(self.dataset_lengths.sum()) if num_samples is None else num_samples
+
+        if blend_index_dir is None:
+            self.blend_index = self._build_blend_index()
+        else:
+            self.blend_index = self._load_or_build_blend_index(Path(blend_index_dir))
+
+    def _load_or_build_blend_index(self, blend_index_dir: Path) -> np.ndarray:
+        content_hash = hashlib.sha256(
+            str((self.dataset_lengths.tolist(), self.weights.tolist(), self.seed, self.num_samples)).encode()
+        ).hexdigest()[:16]
+        blend_index_path = blend_index_dir / f"blend_index_{self.num_samples}ns_{self.seed}s_{content_hash}.npy"
+        if not blend_index_path.is_file():
+            blend_index_dir.mkdir(parents=True, exist_ok=True)
+            with file_lock(f"{blend_index_path}.lock"):
+                # another process might have built the blend index while we were waiting for the lock
+                if not blend_index_path.is_file():
+                    save_array_atomically(str(blend_index_path), self._build_blend_index())
+        return np.load(blend_index_path, mmap_mode="r")
+
+    def _build_blend_index(self) -> np.ndarray:
+        np_rng = np.random.RandomState(seed=self.seed)
+        phases = np_rng.uniform(size=len(self.datasets))
+        dataset_ids, positions = [], []
+        for dataset_id, (weight, phase) in enumerate(zip(self.weights, phases)):
+            if weight == 0:
+                continue
+            # enough samples of this dataset to cover the first num_samples positions of the blend
+            num_dataset_samples = int(np.ceil(self.num_samples * weight)) + 1
+            positions.append((np.arange(num_dataset_samples) + phase) / weight)
+            dataset_ids.append(np.full(num_dataset_samples, dataset_id, dtype=np.int64))
+        dataset_ids = np.concatenate(dataset_ids)
+        order = np.argsort(np.concatenate(positions), kind="stable")[: self.num_samples]
+        dataset_ids = dataset_ids[order]
+
+        # the k-th occurrence of a dataset in the blend refers to its (k mod len(dataset))-th sample
+        blend_index = np.empty((self.num_samples, 2), dtype=np.int64)
+        blend_index[:, 0] = dataset_ids
+        for dataset_id in np.unique(dataset_ids):
+            is_dataset = dataset_ids == dataset_id
+            blend_index[is_dataset, 1] = np.arange(is_dataset.sum()) % self.dataset_lengths[dataset_id]
+        return blend_index
+
+    def __len__(self) -> int:
+        return self.num_samples
+
+    def __getitem__(self, idx: int) -> BatchEncoding:
+        if not 0 <= idx < len(self):
+            raise IndexError
+        dataset_id, sample_id = self.blend_index[idx]
+        return self.datasets[dataset_id][int(sample_id)]
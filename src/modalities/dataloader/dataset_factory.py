@@ -1,11 +1,12 @@
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
 from pydantic import FilePath
 from torch.utils.data.dataset import Dataset
 from transformers import PreTrainedTokenizer
 
 from modalities.dataloader.dataset import (
+    BlendedPackedDataset,
     DummyDataset,
     DummySampleConfig,
     MemMapDataset,
@@ -45,23 +46,28 @@ class DatasetFactory:
         sample_key: str,
         index_path: Optional[Path] = None,
         jq_pattern: str = ".text",
+        token_cache_dir: Optional[Path] = None,
     ) -> MemMapDataset:
+        # the samples are not cut into blocks, i.e., sequence_length is not used by the MemMapDataset
         dataset = MemMapDataset(
             raw_data_path=raw_data_path,
-            block_size=sequence_length + 1,
             tokenizer=tokenizer,
             sample_key=sample_key,
             index_path=index_path,
             jq_pattern=jq_pattern,
+            token_cache_dir=token_cache_dir,
         )
         return dataset
 
     @staticmethod
     def get_packed_mem_map_dataset_continuous(
-        raw_data_path: Path, sequence_length: int, sample_key: str
+        raw_data_path: Path, sequence_length: int, sample_key: str, document_id_key: Optional[str] = None
     ) -> PackedMemMapDatasetContinuous:
         dataset = PackedMemMapDatasetContinuous(
-            raw_data_path=raw_data_path, block_size=sequence_length + 1, sample_key=sample_key
+            raw_data_path=raw_data_path,
+            block_size=sequence_length + 1,
+            sample_key=sample_key,
+            document_id_key=document_id_key,
         )
         return dataset
 
@@ -92,3 +98,16 @@ class DatasetFactory:
         # TODO: Fix the OpenGPTX implementation and get rid of this hack.
         dataset_wrapped = OpenGPTXDatasetWrapper(open_gptx_dataset=dataset, num_samples=num_samples)
         return dataset_wrapped
+
+    @staticmethod
+    def get_blended_packed_dataset(
+        datasets: List[Dataset],
+        weights: List[float],
+        seed: int = 0,
+        num_samples: Optional[int] = None,
+        blend_index_dir: Optional[Path] = None,
+    ) -> BlendedPackedDataset:
+        dataset = BlendedPackedDataset(
+            datasets=datasets, weights=weights, seed=seed, num_samples=num_samples, blend_index_dir=blend_index_dir
+        )
+        return dataset
@@ -0,0 +1,190 @@
+import hashlib
+import json
+from collections import Counter, deque
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+from typing import Deque, List, Optional, Sequence, Set
+
+import numpy as np
+
+
+class DropReason(str, Enum):
+    TOO_SHORT = "too_short"
+    TOO_LONG = "too_long"
+    EXACT_DUPLICATE = "exact_duplicate"
+    NEAR_DUPLICATE = "near_duplicate"
+
+
+@dataclass
+class DocumentFingerprint:
+    num_tokens: int
+    drop_reason: Optional[DropReason] = None
+    exact_hash: Optional[int] = None
+    band_hashes: Optional[List[int]] = None
+
+
+class DocumentFilter:
+    # Mersenne prime used for the universal hash functions of MinHash
+    _MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+    _MAX_HASH_32 = np.uint64((1 << 32) - 1)
+
+    def __init__(
+        self,
+        min_num_tokens: Optional[int] = None,
+        max_num_tokens: Optional[int] = None,
+        exact_deduplication: bool = False,
+        near_deduplication: bool = False,
+        minhash_num_permutations: int = 128,
+        minhash_num_bands: int = 16,
+        shingle_size: int = 5,
+        max_index_entries: int = 10_000_000,
+        seed: int = 0,
+    ):
+        """
+        Filters tokenized documents during packing. Documents can be dropped based on their number of tokens
+        (without the eod token), if they are exact duplicates (same token sequence) of a previous document or
+        if they are near duplicates of a previous document, which is determined by locality sensitive hashing
+        (LSH) of the MinHash signatures over the token shingles.
+
+        The filtering is split into two steps, so that the expensive part runs in the tokenization workers
+        and the deduplication index only exists once:
+        `compute_fingerprint` is called by the workers for each tokenized document.
+        `keep` is called by the single writer process in the order of the documents, which checks and
+        updates the deduplication index. The index is bounded by `max_index_entries`, whereby the oldest entries
+        are evicted first. Thus, duplicates are only found within a window of the most recent documents.
+
+        :param min_num_tokens: Documents with fewer tokens are dropped.
+        :param max_num_tokens: Documents with more tokens are dropped.
+        :param exact_deduplication: If True, exact duplicates are dropped.
+        :param near_deduplication: If True, near duplicates are dropped.
+        :param minhash_num_permutations: Number of hash functions of the MinHash signature.
+        :param minhash_num_bands: Number of LSH bands. Two documents are considered near duplicates, if the
+                                  signatures agree in all rows of at least one band. More bands (with fewer rows)
+                                  lower the Jaccard similarity threshold, which is approx.
+                                  (1 / num_bands) ** (num_bands / num_permutations).
+        :param shingle_size: Number of consecutive tokens per shingle.
+        :param max_index_entries: Maximum number of hashes kept in the deduplication index.
+                                  Each document adds one entry for exact and `minhash_num_bands` entries
+                                  for near deduplication.
+        :param seed: Seed of the MinHash hash functions.
+        """
+        if minhash_num_permutations % minhash_num_bands != 0:
+            raise ValueError("minhash_num_permutations must be divisible by minhash_num_bands.")
+        self.min_num_tokens = min_num_tokens
+        self.max_num_tokens = max_num_tokens
+        self.exact_deduplication = exact_deduplication
+        self.near_deduplication = near_deduplication
+        self.minhash_num_permutations = minhash_num_permutations
+        self.minhash_num_bands = minhash_num_bands
+        self.shingle_size = shingle_size
+        self.max_index_entries = max_index_entries
+        self.seed = seed
+
+        rng = np.random.default_rng(seed)
+        # parameters of the hash functions h(x) = (a * x + b) mod p with 32 bit shingle hashes x
+        self._hash_a = rng.integers(1, 1 << 32, size=minhash_num_permutations, dtype=np.uint64)
+        self._hash_b = rng.integers(0, 1 << 32, size=minhash_num_permutations, dtype=np.uint64)
+
+        self._index: Set[int] = set()
+        self._index_insertion_order: Deque[int] = deque()
+        self._num_evicted_index_entries = 0
+        self._num_documents = 0
+        self._num_dropped_documents: Counter = Counter()
+
+    def compute_fingerprint(self, tokens: Sequence[int]) -> DocumentFingerprint:
+        num_tokens = len(tokens)
+        if self.min_num_tokens is not None and num_tokens < self.min_num_tokens:
+            return DocumentFingerprint(num_tokens=num_tokens, drop_reason=DropReason.TOO_SHORT)
+        if self.max_num_tokens is not None and num_tokens > self.max_num_tokens:
+            return DocumentFingerprint(num_tokens=num_tokens, drop_reason=DropReason.TOO_LONG)
+
+        token_ids = np.asarray(tokens, dtype=np.int64)
+        fingerprint = DocumentFingerprint(num_tokens=num_tokens)
+        if self.exact_deduplication:
+            fingerprint.exact_hash = self._hash_bytes(b"exact", token_ids.tobytes())
+        if self.near_deduplication:
+            signature = self._compute_minhash_signature(token_ids)
+            fingerprint.band_hashes = [
+                self._hash_bytes(band_id.to_bytes(4, byteorder="little"), band.tobytes())
+                for band_id, band in enumerate(signature.reshape(self.minhash_num_bands, -1))
+            ]
+        return fingerprint
+
+    def keep(self, fingerprint: DocumentFingerprint) -> bool:
+        """Returns whether the document should be written and adds it to the deduplication index.
+        Must be called in the order of the documents by a single process."""
+        self._num_documents += 1
+        drop_reason = fingerprint.drop_reason
+        if drop_reason is None and fingerprint.exact_hash is not None and fingerprint.exact_hash in self._index:
+            drop_reason = DropReason.EXACT_DUPLICATE
+        if drop_reason is None and fingerprint.band_hashes is not None:
+            if any(band_hash in self._index for band_hash in fingerprint.band_hashes):
+                drop_reason = DropReason.NEAR_DUPLICATE
+
+        if drop_reason is not None:
+            self._num_dropped_documents[drop_reason.value] += 1
+            return False
+        if fingerprint.exact_hash is not None:
+            self._add_to_index(fingerprint.exact_hash)
+        for band_hash in fingerprint.band_hashes or []:
+            self._add_to_index(band_hash)
+        return True
+
+    def get_stats(self) -> dict:
+        num_dropped_documents = {reason.value: self._num_dropped_documents[reason.value] for reason in DropReason}
+        return {
+            "num_documents": self._num_documents,
+            "num_kept_documents": self._num_documents - sum(num_dropped_documents.values()),
+            "num_dropped_documents": num_dropped_documents,
+            "num_index_entries": len(self._index),
+            "num_evicted_index_entries": self._num_evicted_index_entries,
+            "settings": {
+                "min_num_tokens": self.min_num_tokens,
+                "max_num_tokens": self.max_num_tokens,
+                "exact_deduplication": self.exact_deduplication,
+                "near_deduplication": self.near_deduplication,
+                "minhash_num_permutations": self.minhash_num_permutations,
+                "minhash_num_bands": self.minhash_num_bands,
+                "shingle_size": self.shingle_size,
+                "max_index_entries": self.max_index_entries,
+                "seed": self.seed,
+            },
+        }
+
+    def save_stats(self, stats_path: Path):
+        with stats_path.open("w") as f:
+            json.dump(self.get_stats(), f, indent=2)
+
+    def _add_to_index(self, entry: int):
+        if entry in self._index:
+            return
+        if len(self._index) >= self.max_index_entries:
+            self._index.remove(self._index_insertion_order.popleft())
+            self._num_evicted_index_entries += 1
+        self._index.add(entry)
+        self._index_insertion_order.append(entry)
+
+    def _compute_minhash_signature(self, token_ids: np.ndarray, chunk_size: int = 4096) -> np.ndarray:
+        shingle_size = min(self.shingle_size, len(token_ids))
+        if shingle_size == 0:
+            return np.full(self.minhash_num_permutations, self._MERSENNE_PRIME, dtype=np.uint64)
+        shingles = np.lib.stride_tricks.sliding_window_view(token_ids.astype(np.uint64), shingle_size)
+        # polynomial hash of each shingle, truncated to 32 bits so that a * x + b does not overflow
+        shingle_hashes = np.zeros(len(shingles), dtype=np.uint64)
+        for i in range(shingle_size):
+            shingle_hashes = shingle_hashes * np.uint64(1_000_003) + shingles[:, i]
+        shingle_hashes = np.unique(shingle_hashes & self._MAX_HASH_32)
+
+        signature = np.full(self.minhash_num_permutations, self._MERSENNE_PRIME, dtype=np.uint64)
+        # the shingles are processed in chunks to bound the size of the (num_shingles x num_permutations) matrix
+        for start in range(0, len(shingle_hashes), chunk_size):
+            x = shingle_hashes[start : start + chunk_size, None]
+            permuted_hashes = (self._hash_a[None, :] * x + self._hash_b[None, :]) % self._MERSENNE_PRIME
+            signature = np.minimum(signature, permuted_hashes.min(axis=0))
+        return signature
+
+    @staticmethod
+    def _hash_bytes(prefix: bytes, data: bytes) -> int:
+        # python's builtin hash is salted per interpreter and is thus not used
+        return int.from_bytes(hashlib.blake2b(prefix + data, digest_size=8).digest(), byteorder="little")
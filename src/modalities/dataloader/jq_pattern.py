@@ -0,0 +1,102 @@
+import json
+import re
+from typing import Any, List, Optional, Tuple, Union
+
+import jq
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# a path segment of a simple jq field path: .key, ."key", .["key"], ["key"], .[0] or [0]
+_JSON_STRING = r'"(?:[^"\\]|\\.)*"'
+_PATH_SEGMENT_REGEX = re.compile(
+    rf"\.(?P<key>[A-Za-z_][A-Za-z0-9_]*)"
+    rf"|\.?\[(?P<index>-?\d+)\]"
+    rf"|\.(?P<quoted_key>{_JSON_STRING})"
+    rf"|\.?\[(?P<bracket_key>{_JSON_STRING})\]"
+)
+
+
+def _parse_simple_path(jq_pattern: str) -> Optional[List[Union[str, int]]]:
+    # returns the path segments if the pattern is a simple field path, otherwise None
+    pattern = jq_pattern.strip()
+    if pattern == ".":
+        return []
+    if not pattern.startswith("."):
+        # e.g., [0] constructs an array in jq
+        return None
+    segments, position = [], 0
+    while position < len(pattern):
+        match = _PATH_SEGMENT_REGEX.match(pattern, position)
+        if match is None:
+            return None
+        if match.group("key") is not None:
+            segments.append(match.group("key"))
+        elif match.group("index") is not None:
+            segments.append(int(match.group("index")))
+        else:
+            segments.append(json.loads(match.group("quoted_key") or match.group("bracket_key")))
+        position = match.end()
+    return segments
+
+
+class SimplePathPattern:
+    def __init__(self, jq_pattern: str, path: List[Union[str, int]]):
+        """Extracts a simple field path (e.g., `.text`, `.meta.source` or `.texts[0]`) with a fast JSON parser
+        (orjson, if installed) instead of the jq interpreter. The semantics follow jq: missing keys, indices out of
+        range and accessing `null` yield None, while accessing a key of a non-object or an index of a non-array
+        raises a ValueError."""
+        self.jq_pattern = jq_pattern
+        self.path = path
+        self._loads = json.loads if orjson is None else orjson.loads
+
+    def first(self, line: Union[str, bytes]) -> Any:
+        value = self._loads(line)
+        for segment in self.path:
+            if value is None:
+                return None
+            if isinstance(segment, str):
+                if not isinstance(value, dict):
+                    raise ValueError(f"Cannot index {type(value).__name__} with {segment!r} ({self.jq_pattern}).")
+                value = value.get(segment)
+            else:
+                if not isinstance(value, list):
+                    raise ValueError(f"Cannot index {type(value).__name__} with number ({self.jq_pattern}).")
+                value = value[segment] if -len(value) <= segment < len(value) else None
+        return value
+
+    def __repr__(self) -> str:
+        return self.jq_pattern
+
+
+class JqPattern:
+    def __init__(self, jq_pattern: str):
+        """Applies an arbitrary jq pattern via the jq interpreter."""
+        self.jq_pattern = jq_pattern
+        self._jq_filter = jq.compile(jq_pattern)
+
+    def first(self, line: Union[str, bytes]) -> Any:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        return self._jq_filter.input_text(line).first()
+
+    def __getstate__(self) -> Tuple[str]:
+        # compiled jq programs cannot be pickled
+        return (self.jq_pattern,)
+
+    def __setstate__(self, state: Tuple[str]):
+        self.__init__(*state)
+
+    def __repr__(self) -> str:
+        return self.jq_pattern
+
+
+def compile_jq_pattern(jq_pattern: str) -> Union[SimplePathPattern, JqPattern]:
+    """Compiles a jq pattern, whose method `first(line)` returns the first result for a JSON line.
+    Simple field paths are extracted with a fast JSON parser, all other patterns fall back to jq."""
+    path = _parse_simple_path(jq_pattern)
+    if path is None:
+        return JqPattern(jq_pattern)
+    return SimplePathPattern(jq_pattern, path)
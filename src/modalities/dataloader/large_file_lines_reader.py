@@ -1,7 +1,18 @@
+import gzip
+import io
 import pickle
+import queue
+import threading
 from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional
+from typing import BinaryIO, Deque, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 class BaseReader(ABC):
@@ -55,3 +66,108 @@ class LargeFileLinesReader(BaseReader):
         f = self.raw_data_path.open()
         f.seek(offset)
         return f.read(sample_length_in_bytes)
+
+
+class StreamingLinesReader:
+    COMPRESSED_SUFFIXES = (".gz", ".zst")
+
+    def __init__(
+        self,
+        raw_data_paths: List[Path],
+        num_decompression_threads: int = 4,
+        lines_per_chunk: int = 1024,
+        max_buffered_chunks_per_file: int = 16,
+    ):
+        """
+        Sequentially reads the lines of (possibly compressed) jsonl files without requiring an index,
+        i.e., the files are never decompressed to disk. Supported are gzip (".gz"), zstandard (".zst",
+        requires the `zstandard` package) and uncompressed files.
+
+        The files are decompressed by a pool of threads (zlib and zstandard release the GIL), so that up to
+        `num_decompression_threads` files are decompressed ahead in parallel. The lines are nevertheless
+        yielded in the order of `raw_data_paths` and of the lines within each file.
+
+        :param raw_data_paths: Paths to the jsonl files.
+        :param num_decompression_threads: Number of files that are decompressed in parallel.
+        :param lines_per_chunk: Number of lines that are passed from a decompression thread to the consumer at once.
+        :param max_buffered_chunks_per_file: Bounds the memory of files that are decompressed ahead.
+        """
+        self.raw_data_paths = raw_data_paths
+        self.num_decompression_threads = num_decompression_threads
+        self.lines_per_chunk = lines_per_chunk
+        self.max_buffered_chunks_per_file = max_buffered_chunks_per_file
+        for raw_data_path in self.raw_data_paths:
+            if not raw_data_path.is_file():
+                raise FileNotFoundError(f"Raw data file {raw_data_path} does not exist")
+            if raw_data_path.suffix == ".zst" and zstandard is None:
+                raise ImportError(f"Reading {raw_data_path} requires the zstandard package.")
+
+    @staticmethod
+    def is_compressed(raw_data_path: Path) -> bool:
+        return raw_data_path.suffix in StreamingLinesReader.COMPRESSED_SUFFIXES
+
+    @staticmethod
+    def _open_binary(raw_data_path: Path) -> BinaryIO:
+        if raw_data_path.suffix == ".gz":
+            return gzip.open(raw_data_path, "rb")
+        if raw_data_path.suffix == ".zst":
+            # read_across_frames supports files that were written by multi-threaded zstd compressors
+            stream_reader = zstandard.ZstdDecompressor().stream_reader(
+                raw_data_path.open("rb"), read_across_frames=True
+            )
+            return io.BufferedReader(stream_reader, buffer_size=2**22)
+        return raw_data_path.open("rb")
+
+    def _decompression_thread(self, raw_data_path: Path, chunk_queue: queue.Queue, stop_event: threading.Event):
+        def put(item) -> bool:
+            # returns False if the consumer stopped, so that the thread does not block forever
+            while not stop_event.is_set():
+                try:
+                    chunk_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            with self._open_binary(raw_data_path) as f:
+                chunk = []
+                for line in f:
+                    line = line.decode("utf-8").rstrip("\r\n")
+                    if len(line.strip()) == 0:
+                        continue
+                    chunk.append(line)
+                    if len(chunk) == self.lines_per_chunk:
+                        if not put(chunk):
+                            return
+                        chunk = []
+                if len(chunk) > 0 and not put(chunk):
+                    return
+        finally:
+            # signals the end of the file (also in case of an exception, which is raised by the future)
+            put(None)
+
+    def __iter__(self) -> Iterator[str]:
+        stop_event = threading.Event()
+        raw_data_paths = iter(self.raw_data_paths)
+        pending_files: Deque[Tuple[queue.Queue, Future]] = deque()
+        with ThreadPoolExecutor(max_workers=self.num_decompression_threads) as executor:
+
+            def submit_next_file():
+                raw_data_path = next(raw_data_paths, None)
+                if raw_data_path is not None:
+                    chunk_queue = queue.Queue(maxsize=self.max_buffered_chunks_per_file)
+                    future = executor.submit(self._decompression_thread, raw_data_path, chunk_queue, stop_event)
+                    pending_files.append((chunk_queue, future))
+
+            try:
+                for _ in range(self.num_decompression_threads):
+                    submit_next_file()
+                while pending_files:
+                    chunk_queue, future = pending_files.popleft()
+                    while (chunk := chunk_queue.get()) is not None:
+                        yield from chunk
+                    future.result()
+                    submit_next_file()
+            finally:
+                stop_event.set()
@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import os
 import time
@@ -5,12 +6,13 @@ from pathlib import Path
 from typing import Tuple
 
 import numpy as np
-import torch
+import torch.distributed as dist
 from numpy._typing import NDArray
 from pydantic import FilePath
 from torch.utils.data.dataset import Dataset
 
 from modalities.dataloader.open_gptx_dataset.mmap_dataset import make_dataset, print_rank_0
+from modalities.util import file_lock, save_array_atomically
 
 
 def get_num_tokens_per_epoch(documents: NDArray, sizes: NDArray) -> NDArray:
@@ -36,10 +38,7 @@ def build_doc_idx(documents, num_epochs, np_rng, separate_last_epoch):
     """Build an array with length = number-of-epochs * number-of-documents.
     Each index is mapped to a corresponding document."""
     if not separate_last_epoch or num_epochs == 1:
-        doc_idx = np.mgrid[0:num_epochs, 0 : len(documents)][1]
-        doc_idx[:] = documents
-        doc_idx = doc_idx.reshape(-1)
-        doc_idx = doc_idx.astype(np.int32)
+        doc_idx = np.tile(np.asarray(documents, dtype=np.int32), num_epochs)
         np_rng.shuffle(doc_idx)
 
         return doc_idx
@@ -82,7 +81,38 @@ def build_sample_idx(
     """Sample index mapping is a 2D array with sizes
     [number-of-samples + 1, 2] where [..., 0] contains
     the index into `doc_idx` and [..., 1] is the
-    starting offset in that document."""
+    starting offset in that document.
+
+    Vectorized version of `_build_sample_idx_loop`: sample i spans the tokens
+    [i * seq_length, (i + 1) * seq_length] of the concatenation of all documents in `doc_idx`,
+    i.e., the i-th entry of the mapping locates the token i * seq_length via the cumulative document sizes."""
+
+    # Total number of samples. For -1 see comments in `_num_epochs`.
+    num_samples = (num_epochs * tokens_per_epoch - 1) // seq_length
+    doc_sizes = sizes[doc_idx].astype(np.int64)
+    doc_end_offsets = np.cumsum(doc_sizes)
+    token_offsets = np.arange(num_samples + 1, dtype=np.int64) * seq_length
+    # The document containing the token, skipping documents of size 0.
+    doc_idx_indices = np.searchsorted(doc_end_offsets, token_offsets, side="right")
+    doc_offsets = token_offsets - (doc_end_offsets[doc_idx_indices] - doc_sizes[doc_idx_indices])
+
+    sample_idx = np.empty([num_samples + 1, 2], dtype=np.int32)
+    sample_idx[:, 0] = doc_idx_indices
+    sample_idx[:, 1] = doc_offsets
+    # Start with first document and no offset (even if it is empty).
+    sample_idx[0] = 0
+    return sample_idx
+
+
+def _build_sample_idx_loop(
+    sizes: NDArray,
+    doc_idx: NDArray,
+    seq_length: int,
+    num_epochs: int,
+    tokens_per_epoch: int,
+):
+    """Loop-based reference implementation of `build_sample_idx` (as in Megatron-LM's helpers),
+    kept for parity tests and benchmarking."""
 
     # Total number of samples. For -1 see comments in `_num_epochs`.
     num_samples = (num_epochs * tokens_per_epoch - 1) // seq_length
@@ -126,6 +156,137 @@ def build_sample_idx(
     return sample_idx
 
 
+def get_index_mappings_cache_prefix(
+    name: str,
+    data_prefix: str,
+    documents: NDArray,
+    sizes: NDArray,
+    num_samples: int,
+    sequence_len: int,
+    seed: int,
+    cutoff_ratio_last_epoch: float,
+) -> str:
+    """Returns the content-addressed file prefix of the index mappings.
+    Besides the parameters, the prefix contains a hash of the documents and their sizes,
+    so that changed data never matches a stale cache."""
+    content_hash = hashlib.sha256()
+    for array in [documents, sizes]:
+        content_hash.update(str(np.asarray(array).dtype).encode())
+        content_hash.update(np.ascontiguousarray(array).data)
+    content_hash.update(f"{cutoff_ratio_last_epoch}".encode())
+    return f"{data_prefix}_{name}_indexmap_{num_samples}ns_{sequence_len}sl_{seed}s_{content_hash.hexdigest()[:16]}"
+
+
+def _build_index_mappings_arrays(
+    documents: NDArray,
+    sizes: NDArray,
+    num_samples: int,
+    sequence_len: int,
+    seed: int,
+    cutoff_ratio_last_epoch: float,
+) -> Tuple[NDArray, NDArray, NDArray]:
+    # Number of tokens in each epoch and number of required epochs.
+    tokens_per_epoch = get_num_tokens_per_epoch(sizes=sizes, documents=documents)
+    num_epochs = get_num_epochs(
+        num_tokens_per_epoch=tokens_per_epoch,
+        sequence_len=sequence_len,
+        num_samples=num_samples,
+    )
+
+    # rng state
+    np_rng = np.random.RandomState(seed=seed)
+
+    # For the last epoch, decide whether include the entire epoch
+    # in the global shuffle or not.
+
+    # If we need only one epoch, then separating last epoch  does
+    # not mean anything.
+    if num_epochs == 1:
+        separate_last_epoch = False
+        print(
+            " > only one epoch required, setting " "separate_last_epoch to False",
+            flush=True,
+        )
+
+    else:
+        # Get the number of samples for the last epoch
+        num_samples_from_epochs_minus_one = ((num_epochs - 1) * tokens_per_epoch - 1) // sequence_len
+        last_epoch_num_samples = num_samples - num_samples_from_epochs_minus_one
+
+        assert (
+            last_epoch_num_samples >= 0
+        ), f"last epoch number of samples {last_epoch_num_samples} should be non-negative."
+        num_samples_per_epoch = (tokens_per_epoch - 1) // sequence_len
+        assert (
+            last_epoch_num_samples <= num_samples_per_epoch
+        ), f"last epoch number of samples {last_epoch_num_samples} exceeded max value {num_samples_per_epoch}."
+        # If we have less than cutoff_last_epoch * samples_per_epoch of the samples for the last epoch,
+        # seperate out the epoch and treat it differently.
+        separate_last_epoch = last_epoch_num_samples < int(cutoff_ratio_last_epoch * num_samples_per_epoch)
+        if separate_last_epoch:
+            string = (
+                " > last epoch number of samples ({}) is smaller "
+                "than {}% of number of samples per epoch ({}), "
+                "setting separate_last_epoch to True"
+            )
+        else:
+            string = (
+                " > last epoch number of samples ({}) is larger "
+                "than {}% of number of samples per epoch ({}), "
+                "setting separate_last_epoch to False"
+            )
+        print(
+            string.format(last_epoch_num_samples, cutoff_ratio_last_epoch * 100, num_samples_per_epoch),
+            flush=True,
+        )
+
+    # doc-idx.
+    start_time = time.time()
+    doc_idx = build_doc_idx(
+        documents,
+        num_epochs,
+        np_rng,
+        separate_last_epoch,
+    )
+    print_rank_0(" > elasped time to build doc-idx mapping " "(seconds): {:4f}".format(time.time() - start_time))
+    # sample-idx.
+    start_time = time.time()
+    # Vectorized with NumPy instead of Megatron-LM's C++ helpers.
+    assert doc_idx.dtype == np.int32
+    assert sizes.dtype == np.int32
+    sample_idx = build_sample_idx(
+        sizes=sizes,
+        doc_idx=doc_idx,
+        seq_length=sequence_len,
+        num_epochs=num_epochs,
+        tokens_per_epoch=tokens_per_epoch,
+    )
+    print_rank_0(" > elasped time to build sample-idx mapping " "(seconds): {:4f}".format(time.time() - start_time))
+    # shuffle-idx.
+    start_time = time.time()
+    # -1 is due to data structure used to retieve the index:
+    #    sample i --> [sample_idx[i], sample_idx[i+1])
+    if separate_last_epoch:
+        num_samples_ = num_samples_from_epochs_minus_one
+    else:
+        num_samples_ = sample_idx.shape[0] - 1
+    shuffle_idx = _build_shuffle_idx(
+        num_samples_,
+        sample_idx.shape[0] - 1,
+        np_rng,
+    )
+    print_rank_0(" > elasped time to build shuffle-idx mapping" " (seconds): {:4f}".format(time.time() - start_time))
+    return doc_idx, sample_idx, shuffle_idx
+
+
+def load_index_mappings(index_mapping_filenames: Tuple[str, str, str]) -> Tuple[NDArray, NDArray, NDArray]:
+    """Memory-maps the doc-idx, sample-idx and shuffle-idx files read-only."""
+    start_time = time.time()
+    doc_idx, sample_idx, shuffle_idx = (np.load(filename, mmap_mode="r") for filename in index_mapping_filenames)
+    print_rank_0("    loaded indexed file in {:3.3f} seconds".format(time.time() - start_time))
+    return doc_idx, sample_idx, shuffle_idx
+
+
 def build_index_mappings(
     name: str,
     data_prefix: str,
@@ -135,12 +296,18 @@ def build_index_mappings(
     sequence_len: int,
     seed: int,
     cutoff_ratio_last_epoch: float = 0.95,
-    is_distributed: bool = True,
-) -> Tuple[NDArray, NDArray, NDArray]:
+) -> Tuple[Tuple[str, str, str], Tuple[NDArray, NDArray, NDArray]]:
     """Build doc-idx, sample-idx, and shuffle-idx.
     doc-idx: is an array (ordered) of documents to be used in training.
     sample-idx: is the start document index and document offset for each training sample.
     shuffle-idx: maps the sample index into a random index into sample-idx.
+
+    The mappings are cached as .npy files next to the data, addressed by the parameters and a hash of the
+    documents and their sizes. The first process that acquires the file lock builds the missing files,
+    each written atomically, while all others wait for the lock and then memory-map the files.
+    Hence, the cache can be built by all ranks concurrently as well as offline, see `prebuild_index_mappings`.
+    If torch.distributed is initialized, all ranks additionally meet at a barrier after the build.
+
     :param name: 'train', 'validation' or 'test'
     :type name:
     :param data_prefix:
@@ -151,168 +318,61 @@ def build_index_mappings(
     :type seed:
     :param cutoff_ratio_last_epoch:
     :type cutoff_ratio_last_epoch:
-    :return:
+    :return: the filenames and the memory-mapped arrays of doc-idx, sample-idx and shuffle-idx
     :rtype:
     """
-    # Number of tokens in each epoch and number of required epochs.
-    tokens_per_epoch = get_num_tokens_per_epoch(sizes=sizes, documents=documents)
-    num_epochs = get_num_epochs(
-        num_tokens_per_epoch=tokens_per_epoch,
-        sequence_len=sequence_len,
+    _filename = get_index_mappings_cache_prefix(
+        name=name,
+        data_prefix=data_prefix,
+        documents=documents,
+        sizes=sizes,
         num_samples=num_samples,
+        sequence_len=sequence_len,
+        seed=seed,
+        cutoff_ratio_last_epoch=cutoff_ratio_last_epoch,
+    )
+    index_mapping_filenames = (
+        f"{_filename}_doc_idx.npy",
+        f"{_filename}_sample_idx.npy",
+        f"{_filename}_shuffle_idx.npy",
     )
-
-    # rng state
-    np_rng = np.random.RandomState(seed=seed)
-
-    # Filename of the index mappings.
-    _filename = data_prefix
-    _filename += "_{}_indexmap".format(name)
-    _filename += "_{}ns".format(num_samples)
-    _filename += "_{}sl".format(sequence_len)
-    _filename += "_{}s".format(seed)
-    doc_idx_filename = f"{_filename}_doc_idx.npy"
-    sample_idx_filename = f"{_filename}_sample_idx.npy"
-    shuffle_idx_filename = f"{_filename}_shuffle_idx.npy"
 
     # Build the indexed mapping if not exist.
-    if not is_distributed or torch.distributed.get_rank() == 0:
-        if (
-            (not os.path.isfile(doc_idx_filename))
-            or (not os.path.isfile(sample_idx_filename))
-            or (not os.path.isfile(shuffle_idx_filename))
-        ):
-            print_rank_0(" > WARNING: could not find index map files, building the indices on rank 0 ...")
-
-            # For the last epoch, decide whether include the entire epoch
-            # in the global shuffle or not.
-
-            # If we need only one epoch, then separating last epoch  does
-            # not mean anything.
-            if num_epochs == 1:
-                separate_last_epoch = False
-                print(
-                    " > only one epoch required, setting " "separate_last_epoch to False",
-                    flush=True,
+    if not all(os.path.isfile(filename) for filename in index_mapping_filenames):
+        with file_lock(f"{_filename}.lock"):
+            # another process might have built the files while we were waiting for the lock
+            if not all(os.path.isfile(filename) for filename in index_mapping_filenames):
+                print_rank_0(" > WARNING: could not find index map files, building the indices ...")
+                index_mappings = _build_index_mappings_arrays(
+                    documents=documents,
+                    sizes=sizes,
+                    num_samples=num_samples,
+                    sequence_len=sequence_len,
+                    seed=seed,
+                    cutoff_ratio_last_epoch=cutoff_ratio_last_epoch,
                 )
-
-            else:
-                # Get the number of samples for the last epoch
-                num_samples_from_epochs_minus_one = ((num_epochs - 1) * tokens_per_epoch - 1) // sequence_len
-                last_epoch_num_samples = num_samples - num_samples_from_epochs_minus_one
-
-                assert (
-                    last_epoch_num_samples >= 0
-                ), f"last epoch number of samples {last_epoch_num_samples} should be non-negative."
-                num_samples_per_epoch = (tokens_per_epoch - 1) // sequence_len
-                assert (
-                    last_epoch_num_samples <= num_samples_per_epoch
-                ), f"last epoch number of samples {last_epoch_num_samples} exceeded max value {num_samples_per_epoch}."
-                # If we have less than cutoff_last_epoch * samples_per_epoch of the samples for the last epoch,
-                # seperate out the epoch and treat it differently.
-                separate_last_epoch = last_epoch_num_samples < int(cutoff_ratio_last_epoch * num_samples_per_epoch)
-                if separate_last_epoch:
-                    string = (
-                        " > last epoch number of samples ({}) is smaller "
-                        "than {}% of number of samples per epoch ({}), "
-                        "setting separate_last_epoch to True"
-                    )
-                else:
-                    string = (
-                        " > last epoch number of samples ({}) is larger "
-                        "than {}% of number of samples per epoch ({}), "
-                        "setting separate_last_epoch to False"
-                    )
-                print(
-                    string.format(last_epoch_num_samples, cutoff_ratio_last_epoch * 100, num_samples_per_epoch),
-                    flush=True,
-                )
-
-            # doc-idx.
-            start_time = time.time()
-            doc_idx = build_doc_idx(
-                documents,
-                num_epochs,
-                np_rng,
-                separate_last_epoch,
-            )
-            np.save(doc_idx_filename, doc_idx, allow_pickle=True)
-            print_rank_0(
-                " > elasped time to build and save doc-idx mapping " "(seconds): {:4f}".format(time.time() - start_time)
-            )
-            # sample-idx.
-            start_time = time.time()
-            # Use C++ implementation for speed.
-            # First compile and then import.
-            # TODO: check import
-
-            assert doc_idx.dtype == np.int32
-            assert sizes.dtype == np.int32
-            # from rlm.util.helpers import helpers
-            sample_idx = build_sample_idx(
-                sizes=sizes,
-                doc_idx=doc_idx,
-                seq_length=sequence_len,
-                num_epochs=num_epochs,
-                tokens_per_epoch=tokens_per_epoch,
-            )
-
-            np.save(sample_idx_filename, sample_idx, allow_pickle=True)
-            print_rank_0(
-                " > elasped time to build and save sample-idx mapping "
-                "(seconds): {:4f}".format(time.time() - start_time)
-            )
-            # shuffle-idx.
-            start_time = time.time()
-            # -1 is due to data structure used to retieve the index:
-            #    sample i --> [sample_idx[i], sample_idx[i+1])
-            if separate_last_epoch:
-                num_samples_ = num_samples_from_epochs_minus_one
-            else:
-                num_samples_ = sample_idx.shape[0] - 1
-            shuffle_idx = _build_shuffle_idx(
-                num_samples_,
-                sample_idx.shape[0] - 1,
-                np_rng,
-            )
-            np.save(shuffle_idx_filename, shuffle_idx, allow_pickle=True)
-            print_rank_0(
-                " > elasped time to build and save shuffle-idx mapping"
-                " (seconds): {:4f}".format(time.time() - start_time)
-            )
-
-    # This should be a barrier but nccl barrier assumes
-    # device_index=rank which is not the case for model
-    # parallel case
-    # counts = torch.cuda.LongTensor([1])
-
-    # if is_distributed
-    #   torch.distributed.all_reduce(counts, group=mpu.get_data_parallel_group())
-    #   torch.distributed.all_reduce(counts, group=mpu.get_pipeline_model_parallel_group())
-
-    # TODO: check: in MegatronLM, an all_reduce() (see below) is called because of the different model parallel groups,
-    #  i.e., not all ranks are in the data parallel group
-    if is_distributed:
-        torch.distributed.barrier()
-
-    # if is_distributed
-    #   assert counts[0].item() == (
-    #   torch.distributed.get_world_size() //
-    #   torch.distributed.get_world_size(group=mpu.get_tensor_model_parallel_group()))
+                for filename, array in zip(index_mapping_filenames, index_mappings):
+                    save_array_atomically(filename, array)
+    # fcntl locks are unreliable on some multi-node network file systems (e.g., NFS or Lustre without -o flock),
+    # hence the ranks additionally wait for each other before loading the files
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
 
     # Load mappings.
-    start_time = time.time()
-    print_rank_0(" > loading doc-idx mapping from {}".format(doc_idx_filename))
-    doc_idx = np.load(doc_idx_filename, allow_pickle=True, mmap_mode="r")
-    print_rank_0(" > loading sample-idx mapping from {}".format(sample_idx_filename))
-    sample_idx = np.load(sample_idx_filename, allow_pickle=True, mmap_mode="r")
-    print_rank_0(" > loading shuffle-idx mapping from {}".format(shuffle_idx_filename))
-    shuffle_idx = np.load(shuffle_idx_filename, allow_pickle=True, mmap_mode="r")
-    print_rank_0("    loaded indexed file in {:3.3f} seconds".format(time.time() - start_time))
+    print_rank_0(" > loading index mappings from {}_*_idx.npy".format(_filename))
+    doc_idx, sample_idx, shuffle_idx = load_index_mappings(index_mapping_filenames)
     print_rank_0("    total number of samples: {}".format(sample_idx.shape[0]))
-    print_rank_0("    total number of epochs: {}".format(num_epochs))
 
-    return doc_idx, sample_idx, shuffle_idx
+    return index_mapping_filenames, (doc_idx, sample_idx, shuffle_idx)
+
+
+def prebuild_index_mappings(path: Path, sequence_len: int, num_samples: int, seed: int = 47) -> Tuple[str, str, str]:
+    """Builds the index mappings cache of an OpenGPTXMMapDataset offline, i.e., without torch.distributed.
+    Datasets with the same parameters load the cache afterwards instead of building it."""
+    dataset = OpenGPTXMMapDataset(
+        sample_key="", path=path, sequence_len=sequence_len, num_samples=num_samples, seed=seed
+    )
+    return dataset.index_mapping_filenames
 
 
 class OpenGPTXMMapDataset(Dataset):
@@ -362,11 +422,7 @@ class OpenGPTXMMapDataset(Dataset):
 
         logging.info("Compiling dataset index builder.")
 
-        (
-            self.doc_idx,
-            self.sample_idx,
-            self.shuffle_idx,
-        ) = build_index_mappings(
+        self.index_mapping_filenames, (self.doc_idx, self.sample_idx, self.shuffle_idx) = build_index_mappings(
             name=dataset_filename_prefix,
             sizes=text_dataset.sizes,
             num_samples=num_samples,
@@ -377,6 +433,17 @@ class OpenGPTXMMapDataset(Dataset):
             seed=seed,
         )
 
+    def __getstate__(self):
+        # the index mappings are memory-mapped again in each dataloader worker instead of being pickled
+        state = self.__dict__.copy()
+        for key in ["doc_idx", "sample_idx", "shuffle_idx"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.doc_idx, self.sample_idx, self.shuffle_idx = load_index_mappings(self.index_mapping_filenames)
+
     def __len__(self):
         # -1 is due to data structure used to retieve the index:
         #    sample i --> [sample_idx[i], sample_idx[i+1])
@@ -0,0 +1,108 @@
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+STATS_FORMAT_VERSION = 1
+
+
+def get_stats_paths(pbin_path: Path) -> Tuple[Path, Path]:
+    """Returns the paths of the statistics sidecar files of a pbin file, i.e.,
+    the JSON summary and the NumPy array of token frequencies."""
+    return pbin_path.with_suffix(".stats.json"), pbin_path.with_suffix(".token_frequencies.npy")
+
+
+def load_packed_data_stats(pbin_path: Path) -> Optional[Dict]:
+    """Loads the JSON summary of the statistics sidecar of a pbin file, if it exists."""
+    stats_path, _ = get_stats_paths(pbin_path)
+    if not stats_path.is_file():
+        return None
+    with stats_path.open("r") as f:
+        stats = json.load(f)
+    if stats.get("version") != STATS_FORMAT_VERSION:
+        return None
+    return stats
+
+
+def load_token_frequencies(pbin_path: Path) -> np.ndarray:
+    _, token_frequencies_path = get_stats_paths(pbin_path)
+    return np.load(token_frequencies_path)
+
+
+class PackedDataStatsCollector:
+    def __init__(self, token_size_in_bytes: int, vocab_size: int, token_buffer_size: int = 2**20):
+        """
+        Collects statistics of the tokenized documents while packing, i.e., the number of documents and tokens,
+        a histogram of the document lengths with power-of-two bins and the token frequencies.
+
+        :param token_size_in_bytes: Number of bytes per token in the data section.
+        :param vocab_size: Initial size of the token frequency array. It grows for larger token ids.
+        :param token_buffer_size: Number of tokens that are buffered before the token frequencies are updated.
+        """
+        self._token_dtype = np.dtype(f"<u{token_size_in_bytes}")
+        self.token_size_in_bytes = token_size_in_bytes
+        self.num_documents = 0
+        self.num_tokens = 0
+        self.min_document_length: Optional[int] = None
+        self.max_document_length: Optional[int] = None
+        # bin i counts the documents with a length (in tokens) in [2^i, 2^(i+1))
+        self.document_length_histogram: List[int] = []
+        self.token_frequencies = np.zeros(vocab_size, dtype=np.int64)
+        self._token_buffer: List[bytes] = []
+        self._num_buffered_tokens = 0
+        self._token_buffer_size = token_buffer_size
+
+    def add_document(self, tokens_as_bytes: bytes):
+        document_length = len(tokens_as_bytes) // self.token_size_in_bytes
+        self.num_documents += 1
+        self.num_tokens += document_length
+        if self.min_document_length is None or document_length < self.min_document_length:
+            self.min_document_length = document_length
+        if self.max_document_length is None or document_length > self.max_document_length:
+            self.max_document_length = document_length
+        histogram_bin = max(document_length, 1).bit_length() - 1
+        if histogram_bin >= len(self.document_length_histogram):
+            self.document_length_histogram.extend([0] * (histogram_bin + 1 - len(self.document_length_histogram)))
+        self.document_length_histogram[histogram_bin] += 1
+
+        # bincount has a cost linear in the vocabulary size, so it is computed for many documents at once
+        self._token_buffer.append(tokens_as_bytes)
+        self._num_buffered_tokens += document_length
+        if self._num_buffered_tokens >= self._token_buffer_size:
+            self._flush_token_buffer()
+
+    def save(self, pbin_path: Path):
+        self._flush_token_buffer()
+        stats_path, token_frequencies_path = get_stats_paths(pbin_path)
+        stats = {
+            "version": STATS_FORMAT_VERSION,
+            "num_documents": self.num_documents,
+            "num_tokens": self.num_tokens,
+            "token_size_in_bytes": self.token_size_in_bytes,
+            "data_len": self.num_tokens * self.token_size_in_bytes,
+            "min_document_length": self.min_document_length,
+            "max_document_length": self.max_document_length,
+            "mean_document_length": self.num_tokens / self.num_documents if self.num_documents > 0 else None,
+            "document_length_histogram": {
+                "bin_edges": [2**i for i in range(len(self.document_length_histogram) + 1)],
+                "counts": self.document_length_histogram,
+            },
+            "token_frequencies_file": token_frequencies_path.name,
+        }
+        np.save(token_frequencies_path, self.token_frequencies)
+        with stats_path.open("w") as f:
+            json.dump(stats, f, indent=2)
+
+    def _flush_token_buffer(self):
+        if not self._token_buffer:
+            return
+        token_ids = np.frombuffer(b"".join(self._token_buffer), dtype=self._token_dtype)
+        token_counts = np.bincount(token_ids, minlength=len(self.token_frequencies))
+        if len(token_counts) > len(self.token_frequencies):
+            self.token_frequencies = np.pad(
+                self.token_frequencies, (0, len(token_counts) - len(self.token_frequencies))
+            )
+        self.token_frequencies += token_counts
+        self._token_buffer = []
+        self._num_buffered_tokens = 0
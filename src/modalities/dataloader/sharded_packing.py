@@ -0,0 +1,166 @@
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+from enum import Enum
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from modalities.dataloader.create_packed_data import (
+    EmbeddedStreamData,
+    PackedDataGenerator,
+    create_virtual_pbin,
+    join_embedded_stream_data,
+)
+from modalities.dataloader.document_filter import DocumentFilter
+from modalities.dataloader.packed_data_stats import load_packed_data_stats
+from modalities.tokenization.tokenizer_wrapper import TokenizerWrapper
+
+
+class ShardMergeType(str, Enum):
+    VIRTUAL = "virtual"
+    PHYSICAL = "physical"
+
+
+class ShardedPackedDataGenerator:
+    MANIFEST_FORMAT = "packed_shards"
+    MANIFEST_VERSION = 1
+    MANIFEST_FILE_NAME = "manifest.json"
+
+    def __init__(
+        self,
+        src_paths: List[Path],
+        dst_dir: Path,
+        tokenizer: TokenizerWrapper,
+        eod_token: str,
+        jq_pattern: str,
+        processing_batch_size: int,
+        raw_samples_queue_size: int,
+        processed_samples_queue_size: int,
+        num_cpus: int = os.cpu_count(),
+        num_parallel_shards: int = 1,
+        document_filter_kwargs: Optional[Dict] = None,
+    ):
+        """
+        Packs many (possibly compressed) jsonl files into one pbin file per shard. Up to `num_parallel_shards`
+        shards are packed at the same time, each by its own `PackedDataGenerator` pipeline, which streams the
+        shard without an index file. The `num_cpus` tokenization workers are split evenly among them.
+
+        Besides the pbin files, a manifest ("manifest.json") with the number of documents and tokens
+        per shard is written to `dst_dir`. Optionally, the shards are merged afterwards (see `run`).
+
+        :param src_paths: Paths to the jsonl files (.jsonl, .jsonl.gz or .jsonl.zst), one shard each.
+        :param dst_dir: Directory of the pbin files and the manifest.
+        :param tokenizer: Tokenizer used for all shards.
+        :param eod_token: Token that is appended to each document.
+        :param jq_pattern: jq-pattern applied on every jsonl-entry.
+        :param processing_batch_size: The size of the batches that the workers process.
+        :param raw_samples_queue_size: Queue size of the raw samples per shard pipeline.
+        :param processed_samples_queue_size: Queue size of the processed samples per shard pipeline.
+        :param num_cpus: Total number of tokenization workers.
+        :param num_parallel_shards: Number of shards that are packed at the same time.
+        :param document_filter_kwargs: Optional arguments of a `DocumentFilter`. Note, that each shard is
+                                       deduplicated individually.
+        """
+        self.src_paths = src_paths
+        self.dst_dir = dst_dir
+        self.num_parallel_shards = min(num_parallel_shards, len(src_paths))
+        self.document_filter_kwargs = document_filter_kwargs
+        self._generator_kwargs = dict(
+            tokenizer=tokenizer,
+            eod_token=eod_token,
+            jq_pattern=jq_pattern,
+            processing_batch_size=processing_batch_size,
+            raw_samples_queue_size=raw_samples_queue_size,
+            processed_samples_queue_size=processed_samples_queue_size,
+            number_of_processes=max(1, num_cpus // self.num_parallel_shards),
+            # the parallelism is across shards, a single shard is read sequentially
+            num_decompression_threads=1,
+        )
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.dst_dir / self.MANIFEST_FILE_NAME
+
+    def get_shard_dst_path(self, shard_id: int) -> Path:
+        return self.dst_dir / f"shard_{shard_id:05d}.pbin"
+
+    def run(self, merge_type: Optional[ShardMergeType] = None, merged_file_name: str = "merged") -> Path:
+        """Packs all shards and writes the manifest, whose path is returned.
+
+        :param merge_type: If set, the shards are additionally merged into "<merged_file_name>.vpbin" (virtual,
+                           i.e., a manifest referencing the shards) or "<merged_file_name>.pbin" (physical copy).
+        :param merged_file_name: Name of the merged file in `dst_dir` without suffix.
+        """
+        self.dst_dir.mkdir(parents=True, exist_ok=True)
+        if self.manifest_path.exists():
+            raise FileExistsError(f"Manifest at {self.manifest_path} exists!")
+        self._pack_shards_in_parallel()
+
+        shard_dst_paths = [self.get_shard_dst_path(shard_id) for shard_id in range(len(self.src_paths))]
+        merged_path = None
+        if merge_type == ShardMergeType.VIRTUAL:
+            merged_path = self.dst_dir / f"{merged_file_name}.vpbin"
+            create_virtual_pbin(shard_dst_paths, merged_path)
+        elif merge_type == ShardMergeType.PHYSICAL:
+            merged_path = self.dst_dir / f"{merged_file_name}.pbin"
+            join_embedded_stream_data(list(map(EmbeddedStreamData, shard_dst_paths)), merged_path)
+
+        self._write_manifest(shard_dst_paths, merged_path)
+        return self.manifest_path
+
+    def _pack_shards_in_parallel(self):
+        pending_shard_ids = list(range(len(self.src_paths)))[::-1]
+        running_processes: Dict[int, multiprocessing.Process] = {}
+        failed_shard_ids = []
+        while pending_shard_ids or running_processes:
+            # no new shards are started after a failure
+            while pending_shard_ids and len(running_processes) < self.num_parallel_shards and not failed_shard_ids:
+                shard_id = pending_shard_ids.pop()
+                process = multiprocessing.Process(target=self._pack_shard, args=(shard_id,))
+                process.start()
+                running_processes[shard_id] = process
+            if not running_processes:
+                break
+            multiprocessing.connection.wait([p.sentinel for p in running_processes.values()])
+            for shard_id, process in list(running_processes.items()):
+                if not process.is_alive():
+                    process.join()
+                    if process.exitcode != 0:
+                        failed_shard_ids.append(shard_id)
+                    del running_processes[shard_id]
+        if failed_shard_ids:
+            failed_src_paths = [str(self.src_paths[shard_id]) for shard_id in sorted(failed_shard_ids)]
+            raise RuntimeError(f"Packing failed for the shards {failed_src_paths}.")
+
+    def _pack_shard(self, shard_id: int):
+        document_filter = None
+        if self.document_filter_kwargs is not None:
+            document_filter = DocumentFilter(**self.document_filter_kwargs)
+        generator = PackedDataGenerator(
+            src_path=[self.src_paths[shard_id]], document_filter=document_filter, **self._generator_kwargs
+        )
+        generator.run(self.get_shard_dst_path(shard_id))
+
+    def _write_manifest(self, shard_dst_paths: List[Path], merged_path: Optional[Path]):
+        shards = []
+        for src_path, shard_dst_path in zip(self.src_paths, shard_dst_paths):
+            stats = load_packed_data_stats(shard_dst_path)
+            shards.append(
+                {
+                    "src_path": str(src_path.absolute()),
+                    "pbin_path": shard_dst_path.name,
+                    "num_documents": stats["num_documents"],
+                    "num_tokens": stats["num_tokens"],
+                }
+            )
+        manifest = {
+            "format": self.MANIFEST_FORMAT,
+            "version": self.MANIFEST_VERSION,
+            "num_documents": sum(shard["num_documents"] for shard in shards),
+            "num_tokens": sum(shard["num_tokens"] for shard in shards),
+            "shards": shards,
+            "merged_path": None if merged_path is None else merged_path.name,
+        }
+        with self.manifest_path.open("w") as f:
+            json.dump(manifest, f, indent=2)
@@ -0,0 +1,113 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import Optional, Sequence
+
+import numpy as np
+
+from modalities.tokenization.tokenizer_wrapper import TokenizerWrapper
+from modalities.util import file_lock, save_array_atomically
+
+
+class TokenCache:
+    # int32 instead of uint32, since torch tensors of the token ids have to be int32 or int64 for the embedding
+    TOKEN_DTYPE = np.dtype("<i4")
+    # used to detect a change of the tokenizer
+    _PROBE_TEXT = "The quick brown fox jumps over the lazy dog. 0123456789 äöü ß !?"
+
+    def __init__(self, cache_dir: Path, num_samples: int):
+        """
+        Persistent cache of the token ids of tokenized samples, which is filled lazily.
+
+        The cache consists of an entry array (.npy) of shape (num_samples, 2) holding the offset and length
+        (in tokens) of each cached sample within an append-only token file. Both files are memory-mapped,
+        so that cached samples are read zero-copy. Missing samples are appended under an exclusive file lock,
+        such that any number of processes (dataloader workers, ranks) can fill the cache at the same time.
+        An entry is only set after its tokens were written and its offset last, so that readers without
+        the lock either see a complete entry or a cache miss.
+
+        :param cache_dir: Directory of the cache files. Use `get_cache_dir` to derive a directory that is
+                          specific to the raw data, the jq pattern and the tokenizer.
+        :param num_samples: Number of samples of the dataset.
+        """
+        self.cache_dir = cache_dir
+        self.num_samples = num_samples
+        self.entries_path = cache_dir / "entries.npy"
+        self.tokens_path = cache_dir / "tokens.bin"
+        self.lock_path = cache_dir / "cache.lock"
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with file_lock(self.lock_path):
+            if not self.entries_path.is_file():
+                self.tokens_path.write_bytes(b"")
+                save_array_atomically(str(self.entries_path), np.full((num_samples, 2), -1, dtype=np.int64))
+        self._entries: Optional[np.memmap] = None
+        self._tokens: Optional[np.memmap] = None
+
+    @staticmethod
+    def get_cache_dir(
+        token_cache_dir: Path, raw_data_path: Path, num_samples: int, jq_pattern: str, tokenizer: TokenizerWrapper
+    ) -> Path:
+        raw_data_stat = raw_data_path.stat()
+        key = repr(
+            (
+                str(raw_data_path.absolute()),
+                raw_data_stat.st_size,
+                raw_data_stat.st_mtime_ns,
+                num_samples,
+                jq_pattern,
+                type(tokenizer).__name__,
+                tokenizer.vocab_size,
+                tokenizer.tokenize(TokenCache._PROBE_TEXT),
+            )
+        )
+        key_hash = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+        return token_cache_dir / f"{raw_data_path.stem}_{key_hash}"
+
+    def get(self, idx: int) -> Optional[np.ndarray]:
+        entries = self._get_entries()
+        offset = int(entries[idx, 0])
+        if offset < 0:
+            return None
+        length = int(entries[idx, 1])
+        if length < 0:
+            # the entry is being written by another process
+            return None
+        return self._get_tokens(offset + length)[offset : offset + length]
+
+    def put(self, idx: int, tokens: Sequence[int]) -> np.ndarray:
+        """Adds the tokens of a sample to the cache, unless another process cached them already,
+        and returns the cached tokens."""
+        token_array = np.asarray(tokens, dtype=np.int64)
+        if len(token_array) > 0 and (token_array.min() < 0 or token_array.max() > np.iinfo(self.TOKEN_DTYPE).max):
+            raise ValueError("Token ids must fit into the token dtype of the cache.")
+        with file_lock(self.lock_path):
+            cached_tokens = self.get(idx)
+            if cached_tokens is not None:
+                return cached_tokens
+            with self.tokens_path.open("ab") as f:
+                offset = os.fstat(f.fileno()).st_size // self.TOKEN_DTYPE.itemsize
+                f.write(token_array.astype(self.TOKEN_DTYPE).tobytes())
+            entries = self._get_entries()
+            entries[idx, 1] = len(token_array)
+            entries[idx, 0] = offset
+        return self.get(idx)
+
+    def __getstate__(self):
+        # the memory maps are reopened lazily, e.g., after pickling the dataset to spawned dataloader workers
+        state = self.__dict__.copy()
+        state["_entries"] = None
+        state["_tokens"] = None
+        return state
+
+    def _get_entries(self) -> np.memmap:
+        if self._entries is None:
+            self._entries = np.load(self.entries_path, mmap_mode="r+")
+        return self._entries
+
+    def _get_tokens(self, min_num_tokens: int) -> np.ndarray:
+        # the token file grows, so it is remapped if it does not cover the requested tokens yet
+        if self._tokens is None or len(self._tokens) < min_num_tokens:
+            if min_num_tokens == 0:
+                return np.empty(0, dtype=self.TOKEN_DTYPE)
+            self._tokens = np.memmap(self.tokens_path, dtype=self.TOKEN_DTYPE, mode="r")
+        return self._tokens
@@ -1,4 +1,4 @@
-from typing import Callable, Dict, List
+from typing import Callable, Dict, List, Optional
 
 import torch
 import torch.distributed as dist
@@ -10,8 +10,8 @@ from modalities.logging_broker.messages import BatchProgressUpdate, ExperimentSt
 from modalities.logging_broker.publisher import MessagePublisher
 from modalities.models.model import model_predict_batch
 from modalities.running_env.fsdp.reducer import Reducer
-from modalities.trainer import ThroughputAggregationKeys
-from modalities.util import Aggregator, TimeRecorder
+from modalities.running_env.pipeline_parallel import PipelineSchedule1F1B
+from modalities.util import TimeRecorder
 
 
 class Evaluator:
@@ -19,9 +19,34 @@ class Evaluator:
         self,
         batch_progress_publisher: MessagePublisher[BatchProgressUpdate],
         evaluation_result_publisher: MessagePublisher[EvaluationResultBatch],
+        max_num_eval_batches: Optional[int] = None,
+        max_num_eval_tokens: Optional[int] = None,
+        use_inference_mode: bool = False,
+        pipeline_schedule: Optional[PipelineSchedule1F1B] = None,
     ) -> None:
+        """Evaluates a model on a list of dataloaders.
+
+        Args:
+            batch_progress_publisher (MessagePublisher[BatchProgressUpdate]): publisher for progress updates
+            evaluation_result_publisher (MessagePublisher[EvaluationResultBatch]): publisher for evaluation results
+            max_num_eval_batches (Optional[int], optional): Maximum number of batches that are evaluated per
+                dataloader and rank. The evaluation of a dataloader stops early once the cap is reached.
+                Defaults to None, i.e., all batches are evaluated.
+            max_num_eval_tokens (Optional[int], optional): Maximum number of tokens that are evaluated per
+                dataloader and rank. The token count is derived from the shape of the batch samples. The batch
+                that exceeds the cap is still evaluated. Defaults to None, i.e., no token cap.
+            use_inference_mode (bool, optional): If True, the forward pass runs under `torch.inference_mode`
+                instead of `torch.no_grad`, which additionally disables view tracking and version counters.
+                Defaults to False.
+            pipeline_schedule (Optional[PipelineSchedule1F1B], optional): If set, the model is a pipeline stage
+                and the batches are forwarded through the pipeline in micro-batches. Defaults to None.
+        """
         self.batch_progress_publisher = batch_progress_publisher
         self.evaluation_result_publisher = evaluation_result_publisher
+        self.max_num_eval_batches = max_num_eval_batches
+        self.max_num_eval_tokens = max_num_eval_tokens
+        self.use_inference_mode = use_inference_mode
+        self.pipeline_schedule = pipeline_schedule
 
     def evaluate_batch(
         self,
@@ -29,9 +54,12 @@ class Evaluator:
         model: nn.Module,
         loss_fun: Callable[[InferenceResultBatch], torch.Tensor],
     ):
-        with torch.no_grad():
+        grad_context = torch.inference_mode() if self.use_inference_mode else torch.no_grad()
+        with grad_context:
+            if self.pipeline_schedule is not None:
+                return self.pipeline_schedule.forward_only(model=model, batch=batch, loss_fun=loss_fun)
             result_batch = model_predict_batch(model=model, batch=batch)
-        loss = loss_fun(result_batch)
+            loss = loss_fun(result_batch)
         return loss
 
     def evaluate(
@@ -42,53 +70,54 @@ class Evaluator:
         num_train_steps_done: int,
     ) -> Dict[str, EvaluationResultBatch]:
         result_dict: Dict[str, EvaluationResultBatch] = {}
+        if len(data_loaders) == 0:
+            return result_dict
+
         model.eval()
 
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-        for data_loader in data_loaders:
-            cumulated_loss = torch.zeros(3).to(device)
+        # All dataloaders are evaluated in a single pass and the statistics are accumulated on the device.
+        # Per dataloader, we track: summed batch loss, number of batches, number of samples.
+        # The statistics are synced across ranks only once after the last dataloader.
+        cumulated_stats = torch.zeros(len(data_loaders), 3, device=device)
+        forward_times = torch.zeros(len(data_loaders), device=device)
 
+        for loader_id, data_loader in enumerate(data_loaders):
             Evaluator._publish_progress(
                 batch_progress_publisher=self.batch_progress_publisher,
                 num_eval_steps_done=0,  # Reset progress bar
                 dataloader_tag=data_loader.dataloader_tag,
             )
-            thoughput_aggregator = Aggregator[ThroughputAggregationKeys]()
-            with TimeRecorder() as forward_backward_timer_recorder:
+            num_tokens_done = 0
+            with TimeRecorder() as forward_timer_recorder:
                 for batch_id, batch in enumerate(data_loader):
                     batch_loss = self.evaluate_batch(
                         batch=batch,
                         model=model,
                         loss_fun=loss_fun,
                     )
-
-                    cumulated_loss[0] += batch_loss.item()  # sum up batch loss
-                    cumulated_loss[1] += 1
-                    batch_length_tensor = torch.tensor(len(batch)).to(device)
-                    thoughput_aggregator.add_value(key=ThroughputAggregationKeys.NUM_SAMPLES, value=batch_length_tensor)
+                    cumulated_stats[loader_id, 0] += batch_loss.detach().sum()  # sum up batch loss
+                    cumulated_stats[loader_id, 1] += 1
+                    cumulated_stats[loader_id, 2] += len(batch)
+                    num_tokens_done += Evaluator._get_num_tokens(batch)
 
                     Evaluator._publish_progress(
                         batch_progress_publisher=self.batch_progress_publisher,
                         num_eval_steps_done=batch_id + 1,
                         dataloader_tag=data_loader.dataloader_tag,
                     )
-            # TODO: insert reducer from outside so Evaluator is independent of FSDP
-            total_loss = Reducer.reduce(
-                tensor=cumulated_loss,
-                operation=dist.ReduceOp.SUM,
-                post_processing_fun=lambda t: t[0] / t[1],
-            )
+                    if self._is_cap_reached(num_batches_done=batch_id + 1, num_tokens_done=num_tokens_done):
+                        break
+            forward_times[loader_id] = forward_timer_recorder.delta_t
 
-            forward_backward_time = torch.tensor(forward_backward_timer_recorder.delta_t).to(device)
-            thoughput_aggregator.add_value(
-                key=ThroughputAggregationKeys.FORWARD_BACKWARD_TIME, value=forward_backward_time
-            )
-            synced_num_samples = thoughput_aggregator.get_all_reduced_value(ThroughputAggregationKeys.NUM_SAMPLES)
-            synced_forward_backward_time = thoughput_aggregator.get_all_reduced_value(
-                ThroughputAggregationKeys.FORWARD_BACKWARD_TIME, reduce_operation=dist.ReduceOp.MAX
-            )
-            num_samples_per_second = synced_num_samples / synced_forward_backward_time
+        # TODO: insert reducer from outside so Evaluator is independent of FSDP
+        synced_stats = Reducer.reduce(tensor=cumulated_stats, operation=dist.ReduceOp.SUM)
+        synced_forward_times = Reducer.reduce(tensor=forward_times, operation=dist.ReduceOp.MAX)
+
+        for loader_id, data_loader in enumerate(data_loaders):
+            total_loss = synced_stats[loader_id, 0] / synced_stats[loader_id, 1]
+            num_samples_per_second = synced_stats[loader_id, 2] / synced_forward_times[loader_id]
 
             evaluation_result = EvaluationResultBatch(
                 losses={loss_fun.tag: total_loss},
@@ -107,6 +136,18 @@ class Evaluator:
 
         return result_dict
 
+    def _is_cap_reached(self, num_batches_done: int, num_tokens_done: int) -> bool:
+        if self.max_num_eval_batches is not None and num_batches_done >= self.max_num_eval_batches:
+            return True
+        if self.max_num_eval_tokens is not None and num_tokens_done >= self.max_num_eval_tokens:
+            return True
+        return False
+
+    @staticmethod
+    def _get_num_tokens(batch: DatasetBatch) -> int:
+        key = list(batch.samples.keys())[0]
+        return batch.samples[key].numel()
+
     @staticmethod
     def _publish_progress(
         batch_progress_publisher: MessagePublisher[BatchProgressUpdate],
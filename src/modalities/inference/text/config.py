@@ -16,6 +16,10 @@ class TextInferenceComponentConfig(BaseModel):
     prompt_template: str
     sequence_length: int
     temperature: Optional[float] = 1.0
+    top_k: int = 0
+    top_p: float = 1.0
+    min_p: float = 0.0
+    repetition_penalty: float = 1.0
     eod_token: Optional[str] = "<eod>"
     device: PydanticPytorchDeviceType
 
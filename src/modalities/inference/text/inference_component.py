@@ -1,10 +1,12 @@
 import re
 import sys
+from typing import Any, Optional
 
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 
+from modalities.inference.text.sampling import TokenSampler
+from modalities.models.model import IncrementalDecodingMixin
 from modalities.tokenization.tokenizer_wrapper import TokenizerWrapper
 
 
@@ -18,6 +20,10 @@ class TextInferenceComponent:
         temperature: float,
         eod_token: str,
         device: torch.device,
+        top_k: int = 0,
+        top_p: float = 1.0,
+        min_p: float = 0.0,
+        repetition_penalty: float = 1.0,
     ) -> None:
         self.model = model
         self.model.eval()
@@ -27,7 +33,11 @@ class TextInferenceComponent:
         self.temperature = temperature
         self.sequence_length = sequence_length
         self.device = device
+        self.sampler = TokenSampler(
+            temperature=temperature, top_k=top_k, top_p=top_p, min_p=min_p, repetition_penalty=repetition_penalty
+        )
 
+    @torch.no_grad()
     def generate_tokens(
         self,
         context: str,
@@ -35,7 +45,11 @@ class TextInferenceComponent:
         token_ids_list = self.tokenizer.tokenize(context)
         max_new_tokens = self.sequence_length - len(token_ids_list)
         input_token_ids = torch.IntTensor(token_ids_list).to(self.device).unsqueeze(0)
-        input_dict = {"input_ids": input_token_ids}
+        # models with incremental decoding only process the new token in each step,
+        # all other models recompute the whole sequence
+        decoding_state = None
+        if isinstance(self.model, IncrementalDecodingMixin):
+            decoding_state = self.model.init_decoding_state(batch_size=1, max_seqlen=self.sequence_length)
 
         print("--------------------PROMPT--------------------")
         context_decoded = self.tokenizer.decode(token_ids_list)
@@ -45,16 +59,9 @@ class TextInferenceComponent:
         generated_token_ids = []
         generated_text_old = ""
         for _ in range(max_new_tokens):
-            logits = self.model.forward(input_dict)["logits"]
-            logits = logits[:, -1, :]
-            if self.temperature > 0:
-                logits = logits / self.temperature
-                probs = F.softmax(logits, dim=-1)
-                idx_next = torch.multinomial(probs, num_samples=1)
-                token_id: int = idx_next[0, 0].item()
-            else:
-                idx_next = torch.argmax(logits, dim=-1)
-                token_id: int = idx_next.item()
+            logits = self._get_next_token_logits(input_token_ids, decoding_state)
+            prev_token_ids = torch.tensor(token_ids_list, device=self.device).unsqueeze(0)
+            token_id: int = self.sampler(logits, prev_token_ids=prev_token_ids).item()
             generated_token_ids.append(token_id)
             idx_next_str = self.tokenizer.decode([token_id])
             generated_text_new = self.tokenizer.decode(generated_token_ids)
@@ -68,10 +75,15 @@ class TextInferenceComponent:
                 print(diff_text, end="")
                 sys.stdout.flush()
                 token_ids_list.append(token_id)
-                input_token_ids = torch.IntTensor(token_ids_list).to(self.device).unsqueeze(0)
-                input_dict = {"input_ids": input_token_ids}
+                next_token_ids = [token_id] if decoding_state is not None else token_ids_list
+                input_token_ids = torch.IntTensor(next_token_ids).to(self.device).unsqueeze(0)
         print("\n max tokens reached", end="")
 
+    def _get_next_token_logits(self, input_token_ids: torch.Tensor, decoding_state: Optional[Any]) -> torch.Tensor:
+        if decoding_state is not None:
+            return self.model.decode_step(input_token_ids, decoding_state)
+        return self.model.forward({"input_ids": input_token_ids})["logits"][:, -1, :]
+
     def run(self):
         prompt = TextInferenceComponent._get_prompt(self.prompt_template)
         try:
@@ -0,0 +1,125 @@
+from typing import Optional, Sequence, Tuple, Union
+
+import torch
+
+# a sampling parameter, either shared by all sequences or one value per sequence of the batch
+SamplingParameter = Union[float, Sequence[float], torch.Tensor]
+
+
+class TokenSampler:
+    def __init__(
+        self,
+        temperature: SamplingParameter = 1.0,
+        top_k: SamplingParameter = 0,
+        top_p: SamplingParameter = 1.0,
+        min_p: SamplingParameter = 0.0,
+        repetition_penalty: SamplingParameter = 1.0,
+        num_initial_candidates: int = 256,
+    ):
+        """
+        Vectorized sampling of the next tokens from logits of shape (batch_size, vocab_size), shared by
+        the text generation of all models. Each parameter is either a scalar or one value per sequence.
+
+        The filters are applied in the order repetition penalty, temperature, top-k, top-p and min-p.
+        Top-p is computed on the top-k tokens (renormalized), min-p keeps the tokens with a probability of at
+        least min_p times the probability of the most likely token. Instead of sorting the whole vocabulary,
+        the candidates are determined with a partial sort (torch.topk) over the num_initial_candidates most
+        likely tokens, which is only enlarged if the filters of a sequence keep all of them.
+
+        :param temperature: Softmax temperature, 0 selects the most likely token (greedy decoding).
+        :param top_k: Number of most likely tokens to sample from, 0 disables top-k filtering.
+        :param top_p: Smallest cumulative probability of the most likely tokens to sample from,
+                      values <= 0 or >= 1 disable top-p filtering.
+        :param min_p: Minimum probability relative to the most likely token, 0 disables min-p filtering.
+        :param repetition_penalty: Penalty of the tokens that occurred before (https://arxiv.org/abs/1909.05858),
+                                   1 disables the penalty.
+        :param num_initial_candidates: Number of candidates of the first partial sort.
+        """
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_p = min_p
+        self.repetition_penalty = repetition_penalty
+        self.num_initial_candidates = num_initial_candidates
+
+    @torch.no_grad()
+    def __call__(
+        self,
+        logits: torch.Tensor,
+        prev_token_ids: Optional[torch.Tensor] = None,
+        generator: Optional[torch.Generator] = None,
+    ) -> torch.Tensor:
+        """
+        :param logits: Logits of the next tokens of shape (batch_size, vocab_size).
+        :param prev_token_ids: Token ids of shape (batch_size, seq_len) for the repetition penalty.
+        :param generator: Optional random number generator of the multinomial sampling.
+        :return: The sampled token ids of shape (batch_size,).
+        """
+        batch_size, vocab_size = logits.shape
+        logits = logits.float()
+        temperature = self._to_column(self.temperature, batch_size, logits.device)
+        top_k = self._to_column(self.top_k, batch_size, logits.device).long()
+        top_p = self._to_column(self.top_p, batch_size, logits.device)
+        min_p = self._to_column(self.min_p, batch_size, logits.device)
+        repetition_penalty = self._to_column(self.repetition_penalty, batch_size, logits.device)
+
+        if prev_token_ids is not None and (repetition_penalty != 1.0).any():
+            score = torch.gather(logits, 1, prev_token_ids.long())
+            # if score < 0 then repetition penalty has to be multiplied to reduce the previous token probability
+            score = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
+            logits = logits.scatter(1, prev_token_ids.long(), score)
+        greedy_token_ids = logits.argmax(dim=-1)
+        is_greedy = temperature.squeeze(1) <= 0
+        if is_greedy.all():
+            return greedy_token_ids
+
+        logits = logits / torch.where(temperature > 0, temperature, 1.0)
+        # number of top-k tokens and top-p threshold, where disabled filters keep all tokens
+        top_k = torch.where((top_k > 0) & (top_k < vocab_size), top_k, vocab_size)
+        top_p = torch.where((top_p > 0) & (top_p < 1), top_p, float("inf"))
+        log_min_p = torch.log(min_p.clamp(min=0.0))
+        if (top_k == vocab_size).all() and torch.isinf(top_p).all() and torch.isinf(log_min_p).all():
+            candidate_ids = None
+            candidate_logits = logits
+        else:
+            candidate_ids, candidate_logits = self._get_candidates(logits, top_k, top_p, log_min_p)
+
+        probs = torch.softmax(candidate_logits, dim=-1)
+        sampled_token_ids = torch.multinomial(probs, num_samples=1, generator=generator)
+        if candidate_ids is not None:
+            sampled_token_ids = torch.gather(candidate_ids, 1, sampled_token_ids)
+        return torch.where(is_greedy, greedy_token_ids, sampled_token_ids.squeeze(1))
+
+    def _get_candidates(
+        self, logits: torch.Tensor, top_k: torch.Tensor, top_p: torch.Tensor, log_min_p: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # returns the candidate token ids of each sequence (sorted by logit) and their logits,
+        # which are -inf for the filtered candidates
+        vocab_size = logits.shape[1]
+        # the probabilities without top-k filtering are normalized over the whole vocabulary
+        log_normalizer = torch.logsumexp(logits, dim=-1, keepdim=True)
+        has_top_k = top_k < vocab_size
+        max_top_k = int(torch.where(has_top_k, top_k, 1).max())
+        num_candidates = max(min(self.num_initial_candidates, vocab_size), max_top_k)
+        while True:
+            candidate_logits, candidate_ids = torch.topk(logits, num_candidates, dim=-1)
+            ranks = torch.arange(num_candidates, device=logits.device)
+            keep = ranks < top_k
+            top_k_log_normalizer = torch.logsumexp(candidate_logits.masked_fill(~keep, float("-inf")), -1, True)
+            probs = torch.exp(candidate_logits - torch.where(has_top_k, top_k_log_normalizer, log_normalizer))
+            # keeps the tokens until the cumulative probability reaches top_p (at least the most likely token)
+            keep &= (torch.cumsum(probs, dim=-1) - probs) < top_p
+            keep &= candidate_logits >= candidate_logits[:, :1] + log_min_p
+            # the kept candidates are a prefix of the sorted tokens, which is complete if its last candidate
+            # was filtered out or if top-k is within the candidates
+            is_complete = ~keep[:, -1:] | (top_k <= num_candidates)
+            if num_candidates == vocab_size or is_complete.all():
+                return candidate_ids, candidate_logits.masked_fill(~keep, float("-inf"))
+            num_candidates = min(2 * num_candidates, vocab_size)
+
+    @staticmethod
+    def _to_column(value: SamplingParameter, batch_size: int, device: torch.device) -> torch.Tensor:
+        column = torch.as_tensor(value, dtype=torch.float32, device=device).reshape(-1, 1)
+        if column.shape[0] not in (1, batch_size):
+            raise ValueError(f"Expected a scalar or {batch_size} values per sampling parameter, got {column.shape[0]}.")
+        return column.expand(batch_size, 1)
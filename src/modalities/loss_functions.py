@@ -1,9 +1,11 @@
 from abc import ABC, abstractmethod
 
 import torch
+import torch.distributed as dist
 from torch.nn import CrossEntropyLoss
 
 from modalities.batch import InferenceResultBatch
+from modalities.running_env.context_parallel import get_context_parallel_group, get_sequence_shard
 
 
 class Loss(ABC):
@@ -24,12 +26,22 @@ class Loss(ABC):
 
 
 class CLMCrossEntropyLoss(Loss):
-    def __init__(self, target_key: str, prediction_key: str, tag: str = "CLMCrossEntropyLoss"):
+    def __init__(
+        self,
+        target_key: str,
+        prediction_key: str,
+        tag: str = "CLMCrossEntropyLoss",
+        context_parallel_degree: int = 1,
+    ):
         super().__init__(tag)
         self.target_key = target_key
         self.prediction_key = prediction_key
         # Mean over the tokens in the local-batch (batch per rank)
         self.loss_fun = CrossEntropyLoss(reduction="mean")
+        # with context parallelism, the predictions are the shards of the sequences (see GPT2LLM)
+        self.context_parallel_group = (
+            get_context_parallel_group(context_parallel_degree) if context_parallel_degree > 1 else None
+        )
 
     def __call__(self, forward_batch: InferenceResultBatch) -> torch.Tensor:
         labels = forward_batch.get_targets(self.target_key)
@@ -37,12 +49,188 @@ class CLMCrossEntropyLoss(Loss):
 
         # move labels to correct device to enable model parallelism
         labels = labels.to(lm_logits.device)
+        if self.context_parallel_group is not None:
+            return self._get_context_parallel_loss(lm_logits, labels)
         shift_logits = lm_logits.contiguous()
         shift_labels = labels.contiguous().long()
         # Flatten the tokens. We compute here, the loss per token.
         loss = self.loss_fun(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
         return loss
 
+    def _get_context_parallel_loss(self, lm_logits: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+        labels = get_sequence_shard(labels, self.context_parallel_group).long()
+        local_loss_sum = torch.nn.functional.cross_entropy(
+            lm_logits.reshape(-1, lm_logits.size(-1)), labels.reshape(-1), reduction="sum"
+        )
+        num_local_targets = (labels != self.loss_fun.ignore_index).sum()
+        return reduce_context_parallel_loss(local_loss_sum, num_local_targets, self.context_parallel_group)
+
+
+def reduce_context_parallel_loss(
+    local_loss_sum: torch.Tensor, num_local_targets: torch.Tensor, context_parallel_group: dist.ProcessGroup
+) -> torch.Tensor:
+    """Calculates the mean loss over the tokens of the full sequences from the losses of the sequence shards.
+
+    The sums of the losses and the numbers of targets of all shards are reduced within the context parallel group.
+    The gradient of the local loss sum is scaled by the context parallel degree, since the gradients are averaged
+    over all ranks (e.g., by FSDP), while the shards of a context parallel group contribute to the same samples.
+
+    Args:
+        local_loss_sum (torch.Tensor): sum of the losses of the targets of the local shard.
+        num_local_targets (torch.Tensor): number of (not ignored) targets of the local shard.
+        context_parallel_group (dist.ProcessGroup): the context parallel group.
+
+    Returns:
+        torch.Tensor: loss tensor.
+    """
+    loss_sum_and_num_targets = torch.stack([local_loss_sum.detach().float(), num_local_targets.float()])
+    dist.all_reduce(loss_sum_and_num_targets, group=context_parallel_group)
+    loss_sum, num_targets = loss_sum_and_num_targets
+    scaled_local_loss_sum = dist.get_world_size(context_parallel_group) * local_loss_sum
+    return (scaled_local_loss_sum - scaled_local_loss_sum.detach() + loss_sum) / num_targets
+
+
+class _ChunkedLinearCrossEntropyFunction(torch.autograd.Function):
+    """Fuses the LM head projection and the cross entropy loss.
+    The logits are computed for `chunk_size` tokens at a time and discarded right after the loss and the gradients
+    of the chunk have been calculated. Since the loss is a scalar, the gradients w.r.t. the hidden states and the
+    LM head weight are already computed in the forward pass and only rescaled by the incoming gradient in the
+    backward pass. Thereby, at most (chunk_size, vocab_size) logits are materialized at once.
+    """
+
+    @staticmethod
+    def forward(
+        ctx,
+        hidden_states: torch.Tensor,
+        weight: torch.Tensor,
+        labels: torch.Tensor,
+        chunk_size: int,
+        ignore_index: int,
+        compute_gradients: bool,
+    ) -> torch.Tensor:
+        # hidden_states: (N, n_embd), weight: (vocab_size, n_embd), labels: (N,)
+        num_tokens = hidden_states.shape[0]
+        is_target = labels != ignore_index
+        num_targets = is_target.sum().clamp(min=1)
+
+        loss = torch.zeros((), dtype=torch.float32, device=hidden_states.device)
+        if compute_gradients:
+            grad_hidden_states = torch.empty_like(hidden_states)
+            grad_weight = torch.zeros_like(weight, dtype=torch.float32)
+
+        for start in range(0, num_tokens, chunk_size):
+            end = min(start + chunk_size, num_tokens)
+            chunk_hidden_states = hidden_states[start:end]
+            chunk_is_target = is_target[start:end]
+            chunk_labels = labels[start:end].masked_fill(~chunk_is_target, 0)
+
+            logits = (chunk_hidden_states @ weight.t()).float()  # (chunk_size, vocab_size)
+            log_normalizer = torch.logsumexp(logits, dim=-1)
+            target_logits = logits.gather(dim=-1, index=chunk_labels.unsqueeze(-1)).squeeze(-1)
+            loss += ((log_normalizer - target_logits) * chunk_is_target).sum()
+
+            if compute_gradients:
+                # d loss / d logits = (softmax(logits) - one_hot(labels)) / num_targets for all target tokens
+                grad_logits = logits.sub_(log_normalizer.unsqueeze(-1)).exp_()
+                grad_logits[torch.arange(end - start, device=logits.device), chunk_labels] -= 1.0
+                grad_logits *= (chunk_is_target / num_targets).unsqueeze(-1)
+                grad_logits = grad_logits.to(hidden_states.dtype)
+                grad_hidden_states[start:end] = grad_logits @ weight
+                grad_weight += (grad_logits.t() @ chunk_hidden_states).float()
+
+        if compute_gradients:
+            ctx.save_for_backward(grad_hidden_states, grad_weight.to(weight.dtype))
+        return loss / num_targets
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        grad_hidden_states, grad_weight = ctx.saved_tensors
+        grad_output = grad_output.to(grad_hidden_states.dtype)
+        return grad_hidden_states * grad_output, grad_weight * grad_output, None, None, None, None
+
+
+def chunked_linear_cross_entropy(
+    hidden_states: torch.Tensor,
+    weight: torch.Tensor,
+    labels: torch.Tensor,
+    chunk_size: int,
+    ignore_index: int = -100,
+) -> torch.Tensor:
+    """
+    Calculates the mean cross entropy loss of `hidden_states @ weight.T` w.r.t. `labels`
+    without materializing the full logits tensor.
+
+    Args:
+        hidden_states (torch.Tensor): hidden states of shape (..., n_embd).
+        weight (torch.Tensor): LM head weight of shape (vocab_size, n_embd).
+        labels (torch.Tensor): target token ids of shape (...).
+        chunk_size (int): number of tokens for which the logits are materialized at once.
+        ignore_index (int, optional): target value that is ignored. Defaults to -100.
+
+    Returns:
+        torch.Tensor: loss tensor.
+    """
+    hidden_states = hidden_states.reshape(-1, hidden_states.size(-1))
+    labels = labels.reshape(-1).long()
+    compute_gradients = torch.is_grad_enabled() and (hidden_states.requires_grad or weight.requires_grad)
+    return _ChunkedLinearCrossEntropyFunction.apply(
+        hidden_states, weight, labels, chunk_size, ignore_index, compute_gradients
+    )
+
+
+class CLMChunkedCrossEntropyLoss(Loss):
+    def __init__(
+        self,
+        target_key: str,
+        prediction_key: str,
+        lm_head_weight_key: str,
+        chunk_size: int,
+        tag: str = "CLMCrossEntropyLoss",
+        context_parallel_degree: int = 1,
+    ):
+        """
+        Causal language modeling cross entropy loss that applies the LM head chunk-wise.
+        Requires a model that returns the final hidden states under `prediction_key`
+        and the LM head weight under `lm_head_weight_key` (see `GPT2LLMConfig.lm_head_weight_key`).
+        With context parallelism, the hidden states are the shards of the sequences (see `CLMCrossEntropyLoss`).
+
+        Args:
+            target_key (str): key to access the target token ids.
+            prediction_key (str): key to access the final hidden states.
+            lm_head_weight_key (str): key to access the LM head weight.
+            chunk_size (int): number of tokens for which the logits are materialized at once.
+            tag (str, optional): Defaults to "CLMCrossEntropyLoss".
+            context_parallel_degree (int, optional): context parallel degree of the model. Defaults to 1.
+        """
+        super().__init__(tag)
+        self.target_key = target_key
+        self.prediction_key = prediction_key
+        self.lm_head_weight_key = lm_head_weight_key
+        self.chunk_size = chunk_size
+        self.context_parallel_group = (
+            get_context_parallel_group(context_parallel_degree) if context_parallel_degree > 1 else None
+        )
+
+    def __call__(self, forward_batch: InferenceResultBatch) -> torch.Tensor:
+        labels = forward_batch.get_targets(self.target_key)
+        hidden_states = forward_batch.get_predictions(self.prediction_key)
+        lm_head_weight = forward_batch.get_predictions(self.lm_head_weight_key)
+
+        # move labels to correct device to enable model parallelism
+        labels = labels.to(hidden_states.device)
+        if self.context_parallel_group is not None:
+            labels = get_sequence_shard(labels, self.context_parallel_group)
+        loss = chunked_linear_cross_entropy(
+            hidden_states=hidden_states, weight=lm_head_weight, labels=labels, chunk_size=self.chunk_size
+        )
+        if self.context_parallel_group is not None:
+            # the chunked loss is the mean over the local targets, or 0 if there are none
+            num_local_targets = (labels != -100).sum()
+            return reduce_context_parallel_loss(
+                loss * num_local_targets.clamp(min=1), num_local_targets, self.context_parallel_group
+            )
+        return loss
+
 
 def nce_loss(
     embedding1: torch.Tensor, embedding2: torch.Tensor, device: torch.device, is_asymmetric: bool, temperature: float
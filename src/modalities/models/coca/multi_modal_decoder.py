@@ -1,12 +1,12 @@
 from functools import partial
-from typing import Dict
+from typing import Dict, Optional
 
 import torch
 from torch import nn
 
 from modalities.models.gpt2.gpt2_model import ActivationType
 from modalities.models.model import NNModel, SwiGLU
-from modalities.nn.attention import AttentionConfig, AttentionType, MultiHeadAttention
+from modalities.nn.attention import AttentionCache, AttentionConfig, AttentionType, MultiHeadAttention
 from modalities.nn.mlp import MLP
 
 
@@ -24,6 +24,7 @@ class TransformerBlock(nn.Module):
         attention_type: AttentionType,
         attention_config: AttentionConfig = None,
         add_extra_mlp: bool = False,
+        attention_cache: Optional[AttentionCache] = None,
     ):
         super().__init__()
         self.with_context = with_context
@@ -38,7 +39,12 @@ class TransformerBlock(nn.Module):
 
         self.ln_1 = nn.LayerNorm(normalized_shape=n_embd, bias=bias, eps=epsilon)
         self.attn = MultiHeadAttention(
-            n_embd=n_embd, n_head=n_head, bias=bias, attention_config=attention_config, attention_type=attention_type
+            n_embd=n_embd,
+            n_head=n_head,
+            bias=bias,
+            attention_config=attention_config,
+            attention_type=attention_type,
+            attention_cache=attention_cache,
         )
 
         if not self.with_context or self.add_extra_mlp:
@@ -88,6 +94,8 @@ class MultiModalTextDecoder(NNModel):
         self.sample_key = sample_key
         self.prediction_key = prediction_key
         self.block_size = block_size
+        # the causal mask is computed once and shared by all blocks
+        self.attention_cache = AttentionCache()
 
         self.transformer = nn.ModuleDict(
             dict(
@@ -104,6 +112,7 @@ class MultiModalTextDecoder(NNModel):
                             with_context=True,
                             attention_type=AttentionType.CAUSAL_SELF_ATTENTION,
                             attention_config=attention_config,
+                            attention_cache=self.attention_cache,
                             add_extra_mlp=False,
                         )
                         for _ in range(n_layer)
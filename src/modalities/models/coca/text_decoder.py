@@ -6,7 +6,7 @@ from torch import nn
 from modalities.models.coca.multi_modal_decoder import TransformerBlock
 from modalities.models.gpt2.gpt2_model import ActivationType
 from modalities.models.model import NNModel
-from modalities.nn.attention import AttentionConfig, AttentionType
+from modalities.nn.attention import AttentionCache, AttentionConfig, AttentionType
 
 
 class TextDecoder(NNModel):
@@ -30,6 +30,8 @@ class TextDecoder(NNModel):
         self.sample_key = sample_key
         self.prediction_key = prediction_key
         self.block_size = block_size
+        # the causal mask is computed once and shared by all blocks
+        self.attention_cache = AttentionCache()
 
         self.cls_token = nn.Parameter(torch.empty(1, 1, n_embd))
         self.transformer = nn.ModuleDict(
@@ -50,6 +52,7 @@ class TextDecoder(NNModel):
                             with_context=False,
                             attention_type=AttentionType.CAUSAL_SELF_ATTENTION,
                             attention_config=attention_config,
+                            attention_cache=self.attention_cache,
                         )
                         for _ in range(n_layer)
                     ]
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import torch
 
@@ -13,13 +13,24 @@ class CollateFnIF(ABC):
 
 
 class GPT2LLMCollateFn(CollateFnIF):
-    def __init__(self, sample_key: str, target_key: str):
+    def __init__(self, sample_key: str, target_key: str, document_id_key: Optional[str] = None):
+        """
+        :param sample_key: key of the token ids in the dataset samples and the resulting batch.
+        :param target_key: key of the target token ids in the resulting batch.
+        :param document_id_key: If set, the per-token document ids are read from the dataset samples
+                                and passed on to the model as part of the batch samples under this key.
+        """
         self.sample_key = sample_key
         self.target_key = target_key
+        self.document_id_key = document_id_key
 
     def __call__(self, batch: List[Dict[str, torch.Tensor]]) -> DatasetBatch:
         sample_tensor = torch.stack([torch.tensor(d[self.sample_key]) for d in batch])
         samples = {self.sample_key: sample_tensor[:, :-1]}
         targets = {self.target_key: sample_tensor[:, 1:]}
+        if self.document_id_key is not None:
+            # the document ids are aligned with the input tokens
+            document_id_tensor = torch.stack([torch.tensor(d[self.document_id_key]) for d in batch])
+            samples[self.document_id_key] = document_id_tensor[:, :-1]
 
         return DatasetBatch(targets=targets, samples=samples)
@@ -1,25 +1,40 @@
 import math
 from copy import deepcopy
+from dataclasses import dataclass
 from enum import Enum
-from typing import Annotated, Dict, List, Tuple
+from typing import Annotated, Dict, List, Optional, Tuple
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 
 try:
-    from flash_attn import flash_attn_func
+    from flash_attn import flash_attn_func, flash_attn_varlen_func
 except ModuleNotFoundError:
     flash_attn_func = None
+    flash_attn_varlen_func = None
 
+from packaging.version import Version
 from pydantic import BaseModel, Field, model_validator, validator
 
 from modalities.config.pydanctic_if_types import PydanticPytorchModuleType
 from modalities.config.utils import convert_base_model_config_to_dict
 from modalities.models.model import ActivationType, NNModel, SwiGLU
+from modalities.nn.attention import AttentionCache
+from modalities.running_env.context_parallel import (
+    get_context_parallel_group,
+    get_sequence_shard,
+    head_to_sequence_parallel,
+    sequence_to_head_parallel,
+)
+from modalities.running_env.pipeline_parallel import PIPELINE_HIDDEN_STATES_KEY, get_pipeline_stage_block_ids
 from modalities.util import parse_enum_by_name
 
 # GPT2 implementation taken from nanogpt https://github.com/karpathy/nanoGPT
 
+# `enable_gqa` was added to scaled_dot_product_attention in PyTorch 2.5
+_SDPA_SUPPORTS_GQA = Version(torch.__version__).release >= (2, 5)
+
 
 class PositionTypes(str, Enum):
     ABSOLUTE = "ABSOLUTE"
@@ -32,6 +47,7 @@ class QueryKeyValueTransform(nn.Module):
         q: torch.Tensor,
         k: torch.Tensor,
         v: torch.Tensor,
+        position_ids: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         pass
 
@@ -42,6 +58,7 @@ class IdentityTransform(QueryKeyValueTransform):
         q: torch.Tensor,
         k: torch.Tensor,
         v: torch.Tensor,
+        position_ids: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         return q, k, v
 
@@ -59,29 +76,20 @@ class RotaryTransform(QueryKeyValueTransform):
         self.seq_length_dim = seq_length_dim
         inv_freq = 1.0 / (10000 ** (torch.arange(0, dim_model, 2).float() / dim_model))
         self.register_buffer("inv_freq", inv_freq)
-
-        self._seq_len_cached = None
-        self._cos_cached = None
-        self._sin_cached = None
+        # the cos/sin tables are computed lazily and can be shared across layers, see CausalSelfAttention
+        self.attention_cache = AttentionCache()
 
     def rotate_half(self, x):
         x1, x2 = x.chunk(2, dim=-1)
         return torch.cat((-x2, x1), dim=-1)
 
-    def _update_cos_sin_tables(self, x):
-        seq_len = x.shape[self.seq_length_dim]
-
-        # Reset the tables if the sequence length has changed,
-        # or if we're on a new device (possibly due to tracing for instance)
-        if seq_len != self._seq_len_cached or self._cos_cached.device != x.device or self._cos_cached.dtype != x.dtype:
-            self._seq_len_cached = seq_len
-            t = torch.arange(x.shape[self.seq_length_dim], device=x.device, dtype=torch.float32)
-            freqs = torch.einsum("i,j->ij", t, self.inv_freq.to(x.dtype))
-            emb = torch.cat((freqs, freqs), dim=-1).to(x.device)
-            self._cos_cached = emb.cos()[None, None, :, :].to(x.dtype)
-            self._sin_cached = emb.sin()[None, None, :, :].to(x.dtype)
-
-        return self._cos_cached, self._sin_cached
+    def _get_cos_sin_tables(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # the tables are (re)computed by the cache if the sequence length exceeds the cached one,
+        # or if we're on a new device or dtype (possibly due to tracing for instance)
+        cos, sin = self.attention_cache.get_rotary_tables(
+            inv_freq=self.inv_freq.to(x.device), seq_len=x.shape[self.seq_length_dim], dtype=x.dtype
+        )
+        return cos, sin  # (T, hd)
 
     def apply_rotary_pos_emb(self, x, cos, sin):
         # NOTE: This could probably be moved to Triton
@@ -93,11 +101,17 @@ class RotaryTransform(QueryKeyValueTransform):
         return (x * cos) + (self.rotate_half(x) * sin)
 
     def forward(
-        self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor
+        self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, position_ids: Optional[torch.Tensor] = None
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        self._cos_cached, self._sin_cached = self._update_cos_sin_tables(k)
-        q = self.apply_rotary_pos_emb(q, self._cos_cached, self._sin_cached)
-        k = self.apply_rotary_pos_emb(k, self._cos_cached, self._sin_cached)
+        cos, sin = self._get_cos_sin_tables(k)  # (T, hd)
+        if position_ids is None:
+            cos, sin = cos[None, None, :, :], sin[None, None, :, :]  # (1, 1, T, hd)
+        else:
+            # position_ids: (B, T), e.g., restarting at every document boundary
+            cos = cos[position_ids].unsqueeze(1)  # (B, 1, T, hd)
+            sin = sin[position_ids].unsqueeze(1)  # (B, 1, T, hd)
+        q = self.apply_rotary_pos_emb(q, cos, sin)
+        k = self.apply_rotary_pos_emb(k, cos, sin)
 
         return q, k, v
 
@@ -154,11 +168,24 @@ class GPT2LLMConfig(BaseModel):
     attention_norm: PydanticPytorchModuleType
     ffn_norm: PydanticPytorchModuleType
     lm_head_norm: PydanticPytorchModuleType
+    # If set, the model skips the LM head and returns the final hidden states under prediction_key together with
+    # the LM head weight under lm_head_weight_key. This allows CLMChunkedCrossEntropyLoss to compute the loss
+    # without materializing the full (B, T, vocab_size) logits tensor.
+    lm_head_weight_key: Optional[str] = None
+    # If set, the model reads per-token document ids from the inputs under this key (see GPT2LLMCollateFn).
+    # Attention is then restricted to tokens of the same document and positions restart at every document.
+    document_id_key: Optional[str] = None
+    # If > 1, the sequences are sharded across groups of context_parallel_degree ranks (see CausalSelfAttention).
+    context_parallel_degree: Annotated[int, Field(strict=True, ge=1)] = 1
 
     @model_validator(mode="after")
     def check_divisibility(self) -> "GPT2LLMConfig":
         if self.n_head_q % self.n_head_kv != 0:
             raise ValueError("n_head_q must be divisible by n_head_kv")
+        if self.n_head_kv % self.context_parallel_degree != 0:
+            raise ValueError("n_head_kv must be divisible by context_parallel_degree")
+        if self.sequence_length % self.context_parallel_degree != 0:
+            raise ValueError("sequence_length must be divisible by context_parallel_degree")
         return self
 
     @model_validator(mode="after")
@@ -172,6 +199,26 @@ class GPT2LLMConfig(BaseModel):
         return self
 
 
+@dataclass
+class DocumentAttentionMask:
+    """Attention mask of packed documents, i.e., the block-diagonal causal mask or, for the variable length
+    kernels of flash attention, the cumulative sequence lengths of the documents. It only depends on the
+    document ids and is therefore computed once per forward pass and shared by all blocks."""
+
+    attn_mask: Optional[torch.Tensor] = None  # (B, 1, T, T)
+    cu_seqlens: Optional[torch.Tensor] = None  # (num_documents + 1,)
+    max_seqlen: Optional[int] = None
+
+    @staticmethod
+    def from_document_ids(
+        document_ids: torch.Tensor, attention_impl: AttentionImplementation
+    ) -> "DocumentAttentionMask":
+        if attention_impl == AttentionImplementation.DAO_FLASH:
+            cu_seqlens, max_seqlen = get_cu_seqlens(document_ids)
+            return DocumentAttentionMask(cu_seqlens=cu_seqlens, max_seqlen=max_seqlen)
+        return DocumentAttentionMask(attn_mask=get_document_causal_mask(document_ids))
+
+
 class CausalSelfAttention(nn.Module):
     def __init__(
         self,
@@ -182,30 +229,34 @@ class CausalSelfAttention(nn.Module):
         attention_impl: AttentionImplementation,
         bias: bool,
         dropout: float,
+        attention_cache: Optional[AttentionCache] = None,
+        context_parallel_group: Optional[dist.ProcessGroup] = None,
     ):
         super().__init__()
         assert n_embd % n_head_q == 0, "`n_embd needs` to be divisible by `n_head_q`."
         assert n_head_q % n_head_kv == 0, "`n_head_q needs` to be divisible by `n_head_kv`."
+        # context parallelism: each rank of the group holds a shard of the sequence, which is exchanged for a shard
+        # of the heads before the attention and back afterwards. Thereby, the position-wise transforms (e.g., RoPE)
+        # and the attention itself run on the full sequence, i.e., with the global positions, causal mask
+        # and document mask, and every attention implementation is supported.
+        self.context_parallel_group = context_parallel_group
+        self.context_parallel_degree = (
+            1 if context_parallel_group is None else dist.get_world_size(context_parallel_group)
+        )
+        assert n_head_kv % self.context_parallel_degree == 0, "`n_head_kv` needs to be divisible by the cp degree."
 
         self.n_rep = n_head_q // n_head_kv
         self.attention_impl = attention_impl
 
-        # query, key, value projections (separate)
-        self.q_attn = nn.Linear(
-            in_features=n_embd,
-            out_features=n_embd,
-            bias=bias,
-        )
-        self.k_attn = nn.Linear(
+        # fused query, key, value projection, i.e., a single GEMM whose output is split into q, k and v
+        self.kv_dim = n_embd // self.n_rep
+        self.qkv_attn = nn.Linear(
             in_features=n_embd,
-            out_features=n_embd // self.n_rep,
-            bias=bias,
-        )
-        self.v_attn = nn.Linear(
-            in_features=n_embd,
-            out_features=n_embd // self.n_rep,
+            out_features=n_embd + 2 * self.kv_dim,
             bias=bias,
         )
+        # checkpoints with separate q_attn, k_attn and v_attn projections are remapped when loading
+        self._register_load_state_dict_pre_hook(CausalSelfAttention._fuse_qkv_state_dict_keys)
 
         # output projection
         self.c_proj = nn.Linear(
@@ -231,13 +282,34 @@ class CausalSelfAttention(nn.Module):
             for transform_config in attention_config.qkv_transforms
         )
 
+        # causal mask and rotary tables are shared with the other layers of the model
+        self.attention_cache = AttentionCache() if attention_cache is None else attention_cache
+        for transform in self.qkv_transforms:
+            if isinstance(transform, RotaryTransform):
+                transform.attention_cache = self.attention_cache
+
     def projection(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
-        return self.q_attn(x), self.k_attn(x), self.v_attn(x)
+        q, k, v = self.qkv_attn(x).split([self.n_embd, self.kv_dim, self.kv_dim], dim=-1)
+        return q, k, v
+
+    @staticmethod
+    def _fuse_qkv_state_dict_keys(state_dict: Dict[str, torch.Tensor], prefix: str, *args, **kwargs):
+        # load_state_dict pre-hook: concatenates the weights (and biases) of the previously separate
+        # q_attn, k_attn and v_attn projections into the fused qkv_attn projection
+        for param_name in ["weight", "bias"]:
+            keys = [f"{prefix}{projection}.{param_name}" for projection in ["q_attn", "k_attn", "v_attn"]]
+            if all(key in state_dict for key in keys):
+                state_dict[f"{prefix}qkv_attn.{param_name}"] = torch.cat([state_dict.pop(key) for key in keys])
 
     @staticmethod
     def execute_qkv_transforms(
-        q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, qkv_transforms: nn.ModuleList, n_head_q: int
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        qkv_transforms: nn.ModuleList,
+        n_head_q: int,
+        position_ids: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         batch_size, sequence_length, embedding_dim = q.size()
         # hidden dimension of single head
@@ -250,7 +322,7 @@ class CausalSelfAttention(nn.Module):
         v = v.view(batch_size, sequence_length, -1, n_head_dim).transpose(1, 2).contiguous()  # (B, nh_kv, T, hd)
 
         for transform in qkv_transforms:
-            q, k, v = transform(q, k, v)
+            q, k, v = transform(q, k, v, position_ids=position_ids)
 
         return q, k, v
 
@@ -285,27 +357,40 @@ class CausalSelfAttention(nn.Module):
         v: torch.Tensor,
         dropout: float,
         attention_impl: AttentionImplementation,
+        document_mask: Optional[DocumentAttentionMask] = None,
+        attention_cache: Optional[AttentionCache] = None,
     ) -> torch.Tensor:
+        # with a document mask, the causal mask becomes block-diagonal, i.e., tokens only attend to
+        # preceding tokens of the same document
+        attn_mask = None if document_mask is None else document_mask.attn_mask  # (B, 1, T, T)
+        is_causal = attn_mask is None
         if attention_impl == AttentionImplementation.MANUAL:
-            k, v = cls.repeat_kv_heads(q, k, v)  # for GQA (group query attention)
+            # GQA (group query attention) is handled without repeating the key/value heads
             y = manual_scaled_dot_product_attention(
                 query=q,
                 key=k,
                 value=v,
-                attn_mask=None,
+                attn_mask=attn_mask,
                 dropout_p=dropout,
-                is_causal=True,
+                is_causal=is_causal,
+                attention_cache=attention_cache,
             )  # (B, nh_q, T, hd)
             y = y.transpose(1, 2).contiguous()  # (B, T, nh_q, hd)
         elif attention_impl == AttentionImplementation.PYTORCH_FLASH:
-            k, v = cls.repeat_kv_heads(q, k, v)  # for GQA (group query attention)
+            # for GQA (group query attention), newer PyTorch versions broadcast the key/value heads natively
+            sdpa_kwargs = {}
+            if _SDPA_SUPPORTS_GQA:
+                sdpa_kwargs["enable_gqa"] = True
+            else:
+                k, v = cls.repeat_kv_heads(q, k, v)
             y = torch.nn.functional.scaled_dot_product_attention(
                 query=q,
                 key=k,
                 value=v,
-                attn_mask=None,
+                attn_mask=attn_mask,
                 dropout_p=dropout,
-                is_causal=True,
+                is_causal=is_causal,
+                **sdpa_kwargs,
             )  # (B, nh_q, T, hd)
             y = y.transpose(1, 2).contiguous()  # (B, T, nh_q, hd)
         elif attention_impl == AttentionImplementation.DAO_FLASH:
@@ -318,20 +403,66 @@ class CausalSelfAttention(nn.Module):
             q = q.transpose(1, 2).contiguous()  # (B, T, nh_q, hd)
             k = k.transpose(1, 2).contiguous()  # (B, T, nh_kv, hd)
             v = v.transpose(1, 2).contiguous()  # (B, T, nh_kv, hd)
-            y = flash_attn_func(
-                q, k, v, dropout_p=dropout, causal=True, softmax_scale=None, window_size=(-1, -1)
-            )  # (B, T, nh_q, hd)
+            if document_mask is None:
+                y = flash_attn_func(
+                    q, k, v, dropout_p=dropout, causal=True, softmax_scale=None, window_size=(-1, -1)
+                )  # (B, T, nh_q, hd)
+            else:
+                # each document is treated as a separate sequence of variable length
+                B, T, nh_q, hd = q.shape
+                cu_seqlens, max_seqlen = document_mask.cu_seqlens, document_mask.max_seqlen
+                y = flash_attn_varlen_func(
+                    q.view(B * T, nh_q, hd),
+                    k.view(B * T, -1, hd),
+                    v.view(B * T, -1, hd),
+                    cu_seqlens_q=cu_seqlens,
+                    cu_seqlens_k=cu_seqlens,
+                    max_seqlen_q=max_seqlen,
+                    max_seqlen_k=max_seqlen,
+                    dropout_p=dropout,
+                    causal=True,
+                    softmax_scale=None,
+                    window_size=(-1, -1),
+                ).view(
+                    B, T, nh_q, hd
+                )  # (B, T, nh_q, hd)
         else:
             raise NotImplementedError(f"Attention implementation {attention_impl} not supported")
         return y  # (B, T, nh_q, hd)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(
+        self,
+        x: torch.Tensor,
+        document_ids: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.Tensor] = None,
+        document_mask: Optional[DocumentAttentionMask] = None,
+    ) -> torch.Tensor:
+        # the document mask is either passed precomputed (e.g., by GPT2LLM for all blocks) or built from document_ids
+        if document_mask is None and document_ids is not None:
+            document_mask = DocumentAttentionMask.from_document_ids(document_ids, self.attention_impl)
         B, T, _ = x.size()  # batch size (B), sequence length (T), embedding dimensionality (self.n_embd)
         q, k, v = self.projection(x)  # q: (B, T, n_embd), k: (B, T, n_embd // n_rep), v: (B, T, n_embd // n_rep)
+        if self.context_parallel_group is not None:
+            # with context parallelism, T is the length of the local shard
+            q = sequence_to_head_parallel(q, self.n_head_q, self.context_parallel_group)  # (B, cp * T, n_embd // cp)
+            k = sequence_to_head_parallel(k, self.n_head_kv, self.context_parallel_group)
+            v = sequence_to_head_parallel(v, self.n_head_kv, self.context_parallel_group)
 
         # q: (B, nh_q, T, hd), k: (B, nh_kv, T, hd), v: (B, nh_kv, T, hd)
-        q, k, v = CausalSelfAttention.execute_qkv_transforms(q, k, v, self.qkv_transforms, self.n_head_q)
-        y = CausalSelfAttention.execute_attention(q, k, v, self.dropout, self.attention_impl)  # (B, T, nh_q, hd)
+        q, k, v = CausalSelfAttention.execute_qkv_transforms(
+            q, k, v, self.qkv_transforms, self.n_head_q // self.context_parallel_degree, position_ids=position_ids
+        )
+        y = CausalSelfAttention.execute_attention(
+            q,
+            k,
+            v,
+            self.dropout,
+            self.attention_impl,
+            document_mask=document_mask,
+            attention_cache=self.attention_cache,
+        )  # (B, T, nh_q, hd)
+        if self.context_parallel_group is not None:
+            y = head_to_sequence_parallel(y, self.context_parallel_group)  # (B, T, nh_q, hd)
         y = y.reshape(B, T, self.n_embd)  # (B, T, n_embd), re-assemble all head outputs side by side
         return self.resid_dropout(self.c_proj(y))  # (B, T, n_embd), output projection
 
@@ -374,6 +505,8 @@ class GPT2Block(nn.Module):
         ffn_hidden: int,
         attention_norm: nn.Module,
         ffn_norm: nn.Module,
+        attention_cache: Optional[AttentionCache] = None,
+        context_parallel_group: Optional[dist.ProcessGroup] = None,
     ):
         super().__init__()
         self.attention_norm = attention_norm
@@ -386,6 +519,8 @@ class GPT2Block(nn.Module):
             attention_impl=attention_impl,
             bias=bias,
             dropout=dropout,
+            attention_cache=attention_cache,
+            context_parallel_group=context_parallel_group,
         )
         if activation_type == ActivationType.GELU:
             self.mlp = TransformerMLP(n_embd=n_embd, ffn_hidden=ffn_hidden, bias=bias, dropout=dropout)
@@ -394,8 +529,13 @@ class GPT2Block(nn.Module):
         else:
             raise NotImplementedError("unimplemented activation")
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = x + self.attn(self.attention_norm(x))
+    def forward(
+        self,
+        x: torch.Tensor,
+        document_mask: Optional[DocumentAttentionMask] = None,
+        position_ids: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        x = x + self.attn(self.attention_norm(x), document_mask=document_mask, position_ids=position_ids)
         x = x + self.mlp(self.ffn_norm(x))
         return x
 
@@ -421,6 +561,9 @@ class GPT2LLM(NNModel):
         attention_norm: nn.Module,
         ffn_norm: nn.Module,
         lm_head_norm: nn.Module,
+        lm_head_weight_key: Optional[str] = None,
+        document_id_key: Optional[str] = None,
+        context_parallel_degree: int = 1,
         seed: int = None,
     ):
         weight_decay_groups = {
@@ -433,6 +576,14 @@ class GPT2LLM(NNModel):
         self.prediction_key = prediction_key
         self.sequence_length = sequence_length
         self.poe_type = poe_type
+        self.lm_head_weight_key = lm_head_weight_key
+        self.document_id_key = document_id_key
+        self.attention_implementation = attention_implementation
+        # the ranks of a context parallel group get the same samples and process different shards of the sequence,
+        # the outputs are the shards of the predictions, see CLMCrossEntropyLoss for the loss
+        self.context_parallel_group = (
+            get_context_parallel_group(context_parallel_degree) if context_parallel_degree > 1 else None
+        )
 
         assert vocab_size is not None
         assert sequence_length is not None
@@ -453,6 +604,9 @@ class GPT2LLM(NNModel):
         ]:
             raise ValueError('It is expected to use "RotaryTransform" together with "NOPE".')
 
+        # causal masks and rotary tables are computed once and shared by all blocks
+        self.attention_cache = AttentionCache()
+
         self.transformer = nn.ModuleDict(
             dict(
                 wte=nn.Embedding(num_embeddings=vocab_size, embedding_dim=n_embd),
@@ -472,6 +626,8 @@ class GPT2LLM(NNModel):
                             ffn_hidden=ffn_hidden,
                             attention_norm=deepcopy(attention_norm),
                             ffn_norm=deepcopy(ffn_norm),
+                            attention_cache=self.attention_cache,
+                            context_parallel_group=self.context_parallel_group,
                         )
                         for _ in range(n_layer)
                     ]
@@ -484,8 +640,52 @@ class GPT2LLM(NNModel):
         # "UserWarning: functional_call was passed multiple values for tied weights.
         # This behavior is deprecated and will be an error in future versions"
         # not 100% sure what this is, so far seems to be harmless. TODO investigate
+        # The compiled model component compiles the blocks by default, which do not contain the tied weights.
         self.transformer.wte.weight = self.lm_head.weight  # https://paperswithcode.com/method/weight-tying
 
+        # the blocks of the pipeline stage, which are all blocks unless the model is split into pipeline stages
+        self.pipeline_block_ids = range(n_layer)
+        self.is_first_pipeline_stage = True
+        self.is_last_pipeline_stage = True
+
+    def split_into_pipeline_stage(self, stage_id: int, num_stages: int) -> None:
+        """Reduces the model in place to a stage of a pipeline of num_stages stages, which holds a contiguous
+        range of the blocks. The token and position embeddings are kept by the first stage and the LM head by the
+        last stage. The removed layers are replaced by nn.Identity, so that the parameter names of the stage are
+        the same as in the full model.
+
+        Except for the first stage, the stage gets the hidden states of the previous stage under
+        PIPELINE_HIDDEN_STATES_KEY in its inputs. Except for the last stage, the stage returns its hidden states
+        under PIPELINE_HIDDEN_STATES_KEY. All stages get the document ids, if used, from the inputs.
+
+        Args:
+            stage_id (int): Id of the stage, i.e., its rank within the pipeline.
+            num_stages (int): Number of stages of the pipeline.
+        """
+        self.pipeline_block_ids = get_pipeline_stage_block_ids(len(self.transformer.h), stage_id, num_stages)
+        self.is_first_pipeline_stage = stage_id == 0
+        self.is_last_pipeline_stage = stage_id == num_stages - 1
+        for block_id in range(len(self.transformer.h)):
+            if block_id not in self.pipeline_block_ids:
+                self.transformer.h[block_id] = nn.Identity()
+        if not self.is_first_pipeline_stage:
+            self.transformer.wte = nn.Identity()
+            self.transformer.wpe = nn.Identity()
+        if not self.is_last_pipeline_stage:
+            self.transformer.lm_head_norm = nn.Identity()
+            self.lm_head = nn.Identity()
+
+    def get_pipeline_tied_parameters(self) -> List[nn.Parameter]:
+        """Returns the parameters of the stage, which are tied to parameters of another stage, i.e., the token
+        embedding weight of the first stage and the LM head weight of the last stage."""
+        if self.is_first_pipeline_stage and self.is_last_pipeline_stage:
+            return []
+        elif self.is_first_pipeline_stage:
+            return [self.transformer.wte.weight]
+        elif self.is_last_pipeline_stage:
+            return [self.lm_head.weight]
+        return []
+
     def forward_impl(self, inputs: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         input_ids = inputs[self.sample_key]
         device = input_ids.device
@@ -493,20 +693,45 @@ class GPT2LLM(NNModel):
         assert t <= self.sequence_length, f"Cannot forward sequence of length {t}, the model's maximum "
         f"input sequence length is only {self.sequence_length}"
 
-        # forward the GPT model itself
-        tok_emb = self.transformer.wte(input_ids)  # token embeddings of shape (b, t, n_embd)
-
-        if self.poe_type is PositionTypes.ABSOLUTE:
-            pos = torch.arange(0, t, dtype=torch.long, device=device)  # shape (t)
-            pos_emb = self.transformer.wpe(pos)  # position embeddings of shape (t, n_embd)
-            tok_emb = tok_emb + pos_emb
-
-        # TODO: use drop out also without absolute position embedding?
-        x = self.transformer.drop(tok_emb)
+        if self.document_id_key is not None:
+            document_ids = inputs[self.document_id_key]  # shape (b, t)
+            position_ids = get_position_ids_from_document_ids(document_ids)  # shape (b, t)
+            # computed once instead of in each block, which also saves the device sync of the flash attention lengths
+            document_mask = DocumentAttentionMask.from_document_ids(document_ids, self.attention_implementation)
+        else:
+            document_mask, position_ids = None, None
+
+        if self.context_parallel_group is not None:
+            # the blocks get the document mask and position ids of the full sequence, see CausalSelfAttention
+            input_ids = get_sequence_shard(input_ids, self.context_parallel_group)  # shape (b, t / cp)
+
+        if self.is_first_pipeline_stage:
+            # forward the GPT model itself
+            tok_emb = self.transformer.wte(input_ids)  # token embeddings of shape (b, t, n_embd)
+
+            if self.poe_type is PositionTypes.ABSOLUTE:
+                if position_ids is None:
+                    pos = torch.arange(0, t, dtype=torch.long, device=device)  # shape (t)
+                else:
+                    pos = position_ids  # shape (b, t)
+                if self.context_parallel_group is not None:
+                    pos = get_sequence_shard(pos, self.context_parallel_group, dim=-1)  # offset by the shard
+                pos_emb = self.transformer.wpe(pos)  # position embeddings of shape (t, n_embd) or (b, t, n_embd)
+                tok_emb = tok_emb + pos_emb
+
+            # TODO: use drop out also without absolute position embedding?
+            x = self.transformer.drop(tok_emb)
+        else:
+            x = inputs[PIPELINE_HIDDEN_STATES_KEY]
 
-        for block in self.transformer.h:
-            x = block(x)
+        for block_id in self.pipeline_block_ids:
+            x = self.transformer.h[block_id](x, document_mask=document_mask, position_ids=position_ids)
+        if not self.is_last_pipeline_stage:
+            return {PIPELINE_HIDDEN_STATES_KEY: x}
         x = self.transformer.lm_head_norm(x)
+        if self.lm_head_weight_key is not None:
+            # the LM head is applied chunk-wise within the loss function
+            return {self.prediction_key: x, self.lm_head_weight_key: self.lm_head.weight}
         logits = self.lm_head(x)
         return {self.prediction_key: logits}
 
@@ -514,30 +739,129 @@ class GPT2LLM(NNModel):
         return self.forward_impl(inputs)
 
 
+def fuse_qkv_optimizer_state_dict_keys(optimizer_state_dict: Dict) -> Dict:
+    """Remaps the full optimizer state dict of a checkpoint with separate q_attn, k_attn and v_attn projections to
+    the fused qkv_attn projection, analogously to the model state dict (see CausalSelfAttention). The states
+    (e.g., the moments of Adam) of the projections are concatenated, scalar states (e.g., the step) are taken from
+    the query projection. State dicts of the fused layout are returned unchanged.
+
+    Args:
+        optimizer_state_dict (Dict): Full optimizer state dict, whose parameters are referenced by their names.
+
+    Returns:
+        Dict: The optimizer state dict in the fused layout.
+    """
+    state = optimizer_state_dict["state"]
+    for param_group in optimizer_state_dict["param_groups"]:
+        fused_params = []
+        for param in param_group["params"]:
+            if isinstance(param, str) and (".k_attn." in param or ".v_attn." in param):
+                # replaced by the fused projection at the position of the query projection
+                continue
+            if not isinstance(param, str) or ".q_attn." not in param:
+                fused_params.append(param)
+                continue
+            prefix, param_name = param.split(".q_attn.")
+            keys = [f"{prefix}.{projection}.{param_name}" for projection in ["q_attn", "k_attn", "v_attn"]]
+            fused_key = f"{prefix}.qkv_attn.{param_name}"
+            if all(key in state for key in keys):
+                states = [state.pop(key) for key in keys]
+                state[fused_key] = {
+                    name: torch.cat([s[name] for s in states]) if torch.is_tensor(value) and value.dim() > 0 else value
+                    for name, value in states[0].items()
+                }
+            fused_params.append(fused_key)
+        param_group["params"] = fused_params
+    return optimizer_state_dict
+
+
+def get_position_ids_from_document_ids(document_ids: torch.Tensor) -> torch.Tensor:
+    """Calculates the position of each token within its document.
+
+    Args:
+        document_ids (torch.Tensor): document id of each token of shape (B, T).
+
+    Returns:
+        torch.Tensor: position ids of shape (B, T), restarting at 0 for each document.
+    """
+    B, T = document_ids.shape
+    token_ids = torch.arange(T, device=document_ids.device).expand(B, T)
+    is_document_start = torch.ones_like(document_ids, dtype=torch.bool)
+    is_document_start[:, 1:] = document_ids[:, 1:] != document_ids[:, :-1]
+    document_start_token_ids = torch.where(is_document_start, token_ids, 0).cummax(dim=1).values
+    return token_ids - document_start_token_ids
+
+
+def get_document_causal_mask(document_ids: torch.Tensor) -> torch.Tensor:
+    """Calculates the block-diagonal causal attention mask for packed documents.
+
+    Args:
+        document_ids (torch.Tensor): document id of each token of shape (B, T).
+
+    Returns:
+        torch.Tensor: boolean mask of shape (B, 1, T, T), True where attention is allowed.
+    """
+    T = document_ids.shape[1]
+    causal_mask = torch.ones(T, T, dtype=torch.bool, device=document_ids.device).tril(diagonal=0)
+    same_document_mask = document_ids.unsqueeze(-1) == document_ids.unsqueeze(-2)  # (B, T, T)
+    return (causal_mask & same_document_mask).unsqueeze(1)
+
+
+def get_cu_seqlens(document_ids: torch.Tensor) -> Tuple[torch.Tensor, int]:
+    """Calculates the cumulative sequence lengths of the documents in the flattened batch,
+    as required by the variable length kernels of flash attention.
+
+    Args:
+        document_ids (torch.Tensor): document id of each token of shape (B, T).
+
+    Returns:
+        Tuple[torch.Tensor, int]: cumulative sequence lengths (int32) of shape (num_documents + 1,)
+            and the length of the longest document.
+    """
+    B, T = document_ids.shape
+    is_document_start = torch.ones_like(document_ids, dtype=torch.bool)
+    is_document_start[:, 1:] = document_ids[:, 1:] != document_ids[:, :-1]
+    document_start_token_ids = torch.nonzero(is_document_start.flatten()).flatten()
+    cu_seqlens = torch.cat([document_start_token_ids, torch.tensor([B * T], device=document_ids.device)]).to(
+        torch.int32
+    )
+    max_seqlen = int((cu_seqlens[1:] - cu_seqlens[:-1]).max().item())
+    return cu_seqlens, max_seqlen
+
+
 def manual_scaled_dot_product_attention(
-    query, key, value, attn_mask=None, dropout_p=0.0, is_causal=False, scale=None
+    query, key, value, attn_mask=None, dropout_p=0.0, is_causal=False, scale=None, attention_cache=None
 ) -> torch.Tensor:
     """
     taken from https://pytorch.org/docs/stable/generated/torch.nn.functional.scaled_dot_product_attention.html
+    The causal mask is taken from the (shared) attention_cache instead of being allocated on every call.
     """
     L, S = query.size(-2), key.size(-2)
+    # GQA (group query attention): instead of repeating the key/value heads, the query heads of each
+    # group are folded into the sequence dimension, i.e., (..., nh_q, L, E) -> (..., nh_kv, n_rep * L, E)
+    n_head_kv = key.size(-3)
+    n_rep = query.size(-3) // n_head_kv
     scale_factor = 1 / math.sqrt(query.size(-1)) if scale is None else scale
-    attn_bias = torch.zeros(
-        L, S, dtype=query.dtype, device=query.device
-    )  # device added (not part of the original code)
+    attn_bias = None
     if is_causal:
         assert attn_mask is None
-        temp_mask = torch.ones(L, S, dtype=torch.bool, device=query.device).tril(diagonal=0)  # device added
-        attn_bias.masked_fill_(temp_mask.logical_not(), float("-inf"))
-        attn_bias.to(query.dtype)
+        attention_cache = AttentionCache() if attention_cache is None else attention_cache
+        attn_bias = attention_cache.get_causal_bias(L, S, dtype=query.dtype, device=query.device)
 
     if attn_mask is not None:
+        # attn_mask can be broadcasted, e.g., with a shape of (B, 1, L, S)
         if attn_mask.dtype == torch.bool:
-            attn_bias.masked_fill_(attn_mask.logical_not(), float("-inf"))
+            attn_bias = torch.zeros_like(attn_mask, dtype=query.dtype).masked_fill(
+                attn_mask.logical_not(), float("-inf")
+            )
         else:
-            attn_bias += attn_mask
-    attn_weight = query @ key.transpose(-2, -1) * scale_factor
-    attn_weight += attn_bias
+            attn_bias = attn_mask
+    query = query.unflatten(-3, (n_head_kv, n_rep)).flatten(-3, -2)  # (..., nh_kv, n_rep * L, E)
+    attn_weight = query @ key.transpose(-2, -1) * scale_factor  # (..., nh_kv, n_rep * L, S)
+    attn_weight = attn_weight.unflatten(-2, (n_rep, L))  # (..., nh_kv, n_rep, L, S)
+    if attn_bias is not None:
+        attn_weight += attn_bias.unsqueeze(-3)
     attn_weight = torch.softmax(attn_weight, dim=-1)
     attn_weight = torch.dropout(attn_weight, dropout_p, train=True)
-    return attn_weight @ value
+    y = attn_weight.flatten(-3, -2) @ value  # (..., nh_kv, n_rep * L, E)
+    return y.unflatten(-2, (n_rep, L)).flatten(-4, -3)  # (..., nh_q, L, E)
@@ -9,7 +9,8 @@ import torch.nn as nn
 
 from modalities.models.mamba.mamba_block import Block, MambaBlock
 from modalities.models.mamba.mamba_config import MambaBlockConfig, MixerModelConfig
-from modalities.models.model import NNModel
+from modalities.models.mamba.utils.generation import InferenceParams
+from modalities.models.model import IncrementalDecodingMixin, NNModel
 
 try:
     from modalities.models.mamba.ops.triton.layernorm import RMSNorm, layer_norm_fn, rms_norm_fn
@@ -151,7 +152,7 @@ class MixerModel(nn.Module):
         return hidden_states
 
 
-class MambaLLM(NNModel):
+class MambaLLM(NNModel, IncrementalDecodingMixin):
     def __init__(
         self,
         d_model: int,
@@ -187,7 +188,7 @@ class MambaLLM(NNModel):
         self.initializer_cfg = initializer_cfg
         self.mixer_model_config = mixer_model_config
 
-        # todo: How to pass these variables in the forward method?
+        # inference_params of the forward pass, incremental decoding passes its state to decode_step instead
         self.inference_params = inference_params
         self.num_last_tokens = num_last_tokens
 
@@ -223,6 +224,22 @@ class MambaLLM(NNModel):
     def allocate_inference_cache(self, batch_size: int, max_seqlen: int, dtype: str = None, **kwargs) -> dict:
         return self.backbone.allocate_inference_cache(batch_size, max_seqlen, dtype=dtype, **kwargs)
 
+    def init_decoding_state(self, batch_size: int, max_seqlen: int) -> InferenceParams:
+        return InferenceParams(
+            max_seqlen=max_seqlen,
+            max_batch_size=batch_size,
+            key_value_memory_dict=self.allocate_inference_cache(batch_size, max_seqlen),
+        )
+
+    def decode_step(self, input_ids: torch.Tensor, decoding_state: InferenceParams) -> torch.Tensor:
+        """
+        The prompts are processed in parallel, which fills the conv and SSM states of each layer.
+        Afterwards, each token is processed by MambaBlock.step in O(1) from these recurrent states.
+        """
+        hidden_states = self.backbone(input_ids, inference_params=decoding_state)
+        decoding_state.seqlen_offset += input_ids.shape[1]
+        return self.lm_head(hidden_states[:, -1].to(self.lm_head.weight.dtype))
+
     def forward(self, inputs: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         """
         num_last_tokens: if > 0, only return the logits for the last n tokens
@@ -100,7 +100,10 @@ def selective_scan_fn(
     """if return_last_state is True, returns (out, last_state)
     last_state has shape (batch, dim, dstate). Note that the gradient of the last state is
     not considered in the backward pass.
+    Without the CUDA kernel (or for CPU tensors), the chunked scan `selective_scan_chunked` is used.
     """
+    if selective_scan_cuda is None or not u.is_cuda:
+        return selective_scan_chunked(u, delta, A, B, C, D, z, delta_bias, delta_softplus, return_last_state)
     return SelectiveScanFn.apply(u, delta, A, B, C, D, z, delta_bias, delta_softplus, return_last_state)
 
 
@@ -174,6 +177,159 @@ def selective_scan_ref(
     return out if not return_last_state else (out, last_state)
 
 
+def _get_chunk(t, start, end):
+    # slices the timesteps of u, delta and variable B and C, whereas A and constant B and C have the shape (D N)
+    return t[..., start:end] if t.dim() >= 3 else t
+
+
+def _selective_scan_chunk(u, delta, A, B, C, x):
+    """
+    Scans a chunk of timesteps, starting from the state x of the previous chunk.
+    Returns the outputs r(B D l) and the last state of the chunk.
+    """
+    dim = A.shape[0]
+    if B.dim() == 4:
+        B = repeat(B, "B G N L -> B (G H) N L", H=dim // B.shape[1])
+    if C.dim() == 4:
+        C = repeat(C, "B G N L -> B (G H) N L", H=dim // C.shape[1])
+    delta_u = delta * u
+    # log-space decays, (batch dim dstate l)
+    log_decay = torch.einsum("bdl,dn->bdnl", delta, A)
+    if B.dim() == 2:
+        states = torch.einsum("bdl,dn->bdnl", delta_u, B)
+    elif B.dim() == 3:
+        states = torch.einsum("bdl,bnl->bdnl", delta_u, B)
+    else:
+        states = torch.einsum("bdl,bdnl->bdnl", delta_u, B)
+    # before the step with the offset k, states[..., t] is the scan over the timesteps (t - k, t] and
+    # segment_decay[..., t] the product of the decays over the same timesteps
+    segment_decay = torch.exp(log_decay)
+    seqlen = u.shape[2]
+    offset = 1
+    while offset < seqlen:
+        states = states + F.pad(segment_decay[..., offset:] * states[..., :-offset], (offset, 0))
+        if 2 * offset < seqlen:
+            segment_decay = segment_decay * F.pad(segment_decay[..., :-offset], (offset, 0), value=1.0)
+        offset *= 2
+    # the state of the previous chunk decays with the cumulative products since the start of the chunk
+    states = states + torch.exp(torch.cumsum(log_decay, dim=-1)) * x[..., None]
+    if C.dim() == 2:
+        y = torch.einsum("bdnl,dn->bdl", states, C)
+    elif C.dim() == 3:
+        y = torch.einsum("bdnl,bnl->bdl", states, C)
+    else:
+        y = torch.einsum("bdnl,bdnl->bdl", states, C)
+    if y.is_complex():
+        y = y.real * 2
+    return y, states[..., -1]
+
+
+class ChunkedSelectiveScanFn(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, u, delta, A, B, C, chunk_size):
+        """
+        u: r(B D L)
+        delta: r(B D L), after adding the bias and applying the softplus
+        A: c(D N) or r(D N)
+        B: c(D N) or r(D N) or r(B N L) or c(B N L) or r(B G N L) or c(B G N L)
+        C: c(D N) or r(D N) or r(B N L) or c(B N L) or r(B G N L) or c(B G N L)
+
+        out: r(B D L), without D and z
+        last_state: r(B D dstate) or c(B D dstate)
+
+        Only the states at the chunk boundaries are saved, the chunks are recomputed in the backward pass.
+        """
+        batch, dim, dstate = u.shape[0], A.shape[0], A.shape[1]
+        x = A.new_zeros((batch, dim, dstate))
+        ys, chunk_states = [], []
+        for start in range(0, u.shape[2], chunk_size):
+            chunk_states.append(x)
+            y, x = _selective_scan_chunk(*[_get_chunk(t, start, start + chunk_size) for t in (u, delta, A, B, C)], x)
+            ys.append(y)
+        ctx.save_for_backward(u, delta, A, B, C, *chunk_states)
+        ctx.chunk_size = chunk_size
+        return torch.cat(ys, dim=2), x
+
+    @staticmethod
+    def backward(ctx, dout, dlast_state):
+        inputs, chunk_states = ctx.saved_tensors[:5], ctx.saved_tensors[5:]
+        needs_input_grad = ctx.needs_input_grad[:5]
+        grads = [torch.zeros_like(t) if needs_grad else None for t, needs_grad in zip(inputs, needs_input_grad)]
+        dx = dlast_state
+        # the chunks are recomputed from their first state in reverse order, passing back the gradient of the state
+        for chunk_id in reversed(range(len(chunk_states))):
+            start, end = chunk_id * ctx.chunk_size, (chunk_id + 1) * ctx.chunk_size
+            with torch.enable_grad():
+                chunk_inputs = [
+                    _get_chunk(t, start, end).detach().requires_grad_(needs_grad)
+                    for t, needs_grad in zip(inputs, needs_input_grad)
+                ]
+                x = chunk_states[chunk_id].detach().requires_grad_()
+                y, last_state = _selective_scan_chunk(*chunk_inputs, x)
+            differentiable_inputs = [t for t in chunk_inputs if t.requires_grad]
+            *chunk_grads, dx = torch.autograd.grad(
+                [y, last_state], differentiable_inputs + [x], [dout[..., start:end], dx]
+            )
+            chunk_grads = iter(chunk_grads)
+            for grad in grads:
+                if grad is not None:
+                    _get_chunk(grad, start, end).add_(next(chunk_grads))
+        return (*grads, None)
+
+
+def selective_scan_chunked(
+    u,
+    delta,
+    A,
+    B,
+    C,
+    D=None,
+    z=None,
+    delta_bias=None,
+    delta_softplus=False,
+    return_last_state=False,
+    chunk_size=16,
+):
+    """
+    Chunked parallel scan with the same inputs and outputs as `selective_scan_ref`.
+
+    The sequence is processed in chunks of chunk_size timesteps. Within a chunk, the recurrence
+    x_t = exp(delta_t * A) * x_{t-1} + deltaB_u_t is solved by a Hillis-Steele scan with log2(chunk_size)
+    vectorized steps instead of one step per timestep. The state of the previous chunk is carried over with the
+    cumulative products of the decays, which are computed in log-space (exp of the cumsum of delta * A).
+    All exponentiated decays are <= 1 for real A, so that strong decays underflow to zero instead of
+    overflowing. The intermediate tensors of a chunk take O(batch * dim * dstate * chunk_size) memory.
+    For the backward pass, only the inputs and the states at the chunk boundaries, i.e.,
+    O(batch * dim * dstate * seqlen / chunk_size), are saved and each chunk is recomputed
+    (see `ChunkedSelectiveScanFn`), whereas selective_scan_ref saves O(batch * dim * dstate * seqlen).
+
+    chunk_size: number of timesteps per chunk
+    """
+    dtype_in = u.dtype
+    u = u.float()
+    delta = delta.float()
+    if delta_bias is not None:
+        delta = delta + delta_bias[..., None].float()
+    if delta_softplus:
+        delta = F.softplus(delta)
+    is_variable_B = B.dim() >= 3
+    is_variable_C = C.dim() >= 3
+    if A.is_complex():
+        if is_variable_B:
+            B = torch.view_as_complex(rearrange(B.float(), "... (L two) -> ... L two", two=2))
+        if is_variable_C:
+            C = torch.view_as_complex(rearrange(C.float(), "... (L two) -> ... L two", two=2))
+    else:
+        B = B.float()
+        C = C.float()
+    y, last_state = ChunkedSelectiveScanFn.apply(u, delta, A, B, C, chunk_size)
+    out = y if D is None else y + u * rearrange(D, "d -> d 1")
+    if z is not None:
+        out = out * F.silu(z)
+    out = out.to(dtype=dtype_in)
+    return out if not return_last_state else (out, last_state)
+
+
 class MambaInnerFn(torch.autograd.Function):
     @staticmethod
     @custom_fwd
@@ -7,6 +7,9 @@ import torch
 from torch import Tensor
 from transformers.generation import GreedySearchDecoderOnlyOutput, SampleDecoderOnlyOutput, TextStreamer
 
+from modalities.inference.text.sampling import TokenSampler
+from modalities.models.model import IncrementalDecodingMixin
+
 
 @dataclass
 class InferenceParams:
@@ -28,87 +31,6 @@ class InferenceParams:
             self.lengths_per_sample.zero_()
 
 
-def modify_logits_for_min_p_filtering(logits, min_p):
-    """Set the logits for none min_p values to -inf. Done in-place."""
-    if min_p <= 0.0 or min_p >= 1.0:
-        return
-    indices_to_remove = logits < min_p
-    logits.masked_fill_(indices_to_remove, float("-Inf"))
-
-
-# https://github.com/NVIDIA/Megatron-LM/blob/0bb597b42c53355a567aba2a1357cc34b9d99ddd/megatron/text_generation/sampling.py
-# https://github.com/huggingface/transformers/blob/a44985b41cfa2de48a5e1de7f1f93b7483da25d1/src/transformers/generation/logits_process.py#L231
-def modify_logits_for_top_k_filtering(logits, top_k):
-    """Set the logits for none top-k values to -inf. Done in-place."""
-    indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-    logits.masked_fill_(indices_to_remove, float("-Inf"))
-
-
-# https://github.com/NVIDIA/Megatron-LM/blob/0bb597b42c53355a567aba2a1357cc34b9d99ddd/megatron/text_generation/sampling.py
-# https://github.com/huggingface/transformers/blob/a44985b41cfa2de48a5e1de7f1f93b7483da25d1/src/transformers/generation/logits_process.py#L170
-def modify_logits_for_top_p_filtering(logits, top_p):
-    """Set the logits for none top-p values to -inf. Done in-place."""
-    if top_p <= 0.0 or top_p >= 1.0:
-        return
-    # First sort and calculate cumulative sum of probabilities.
-    sorted_logits, sorted_indices = torch.sort(logits, descending=False)
-    cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
-    # Remove tokens with cumulative top_p above the threshold (token with 0 are kept)
-    sorted_indices_to_remove = cumulative_probs <= (1 - top_p)
-    # scatter sorted tensors to original indexing
-    indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
-    logits.masked_fill_(indices_to_remove, float("-inf"))
-
-
-def modify_logit_for_repetition_penalty(logits, prev_output_tokens, repetition_penalty=1.0):
-    """Apply repetition penalty. See https://arxiv.org/abs/1909.05858
-    logits: (batch_size, vocab_size)
-    prev_output_tokens: (batch_size, seq_len)
-    """
-    if repetition_penalty == 1.0:
-        return logits
-    score = torch.gather(logits, 1, prev_output_tokens)
-    # if score < 0 then repetition penalty has to be multiplied to reduce the previous token probability
-    score = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
-    logits.scatter_(1, prev_output_tokens, score)
-    return logits
-
-
-def sample(logits, top_k=1, top_p=0.0, min_p=0.0, temperature=1.0):
-    """Sample from top-k logits.
-    Arguments:
-        logits: Tensor of shape (batch_size, vocab_size)
-    """
-    if top_k == 1:  # Short-circuit for greedy decoding
-        return logits.argmax(dim=-1)
-    else:
-        if top_p > 0.0:
-            assert top_p <= 1.0, "top-p should be in (0, 1]."
-        if top_k > 0:
-            top_k = min(top_k, logits.size(-1))  # Safety check
-            logits_top, indices = torch.topk(logits, top_k, dim=-1)
-            if temperature != 1.0:
-                logits_top /= temperature
-            modify_logits_for_top_p_filtering(logits_top, top_p)
-            return indices[
-                torch.arange(indices.shape[0], device=indices.device),
-                torch.multinomial(torch.softmax(logits_top, dim=-1), num_samples=1).squeeze(dim=-1),
-            ]
-        else:
-            if min_p > 0.0:
-                logits_top = logits.clone()
-                max_prob = logits_top[..., 0].item()
-                max_prob * min_p
-                modify_logits_for_min_p_filtering(logits_top, min_p)
-                if temperature != 1.0:
-                    logits_top /= temperature
-                return torch.multinomial(torch.softmax(logits_top, dim=-1), num_samples=1).squeeze(dim=-1)
-            # Clone so that when we modify for top_p we don't change the original logits
-            logits_top = logits / temperature if temperature != 1.0 else logits.clone()
-            modify_logits_for_top_p_filtering(logits_top, top_p)
-            return torch.multinomial(torch.softmax(logits_top, dim=-1), num_samples=1).squeeze(dim=-1)
-
-
 @torch.inference_mode()
 def decode(
     input_ids,
@@ -131,6 +53,7 @@ def decode(
     Top-k and top-p can be used together. If top_k > 0 and top_p > 0, then top-k is applied first,
     then top-p.
     We assume that all sequences in the same batch have the same length.
+    The sampling parameters are either scalars or tensors with one value per sequence (see TokenSampler).
 
     Arguments:
         input_ids: (batch, seq_len)
@@ -158,10 +81,16 @@ def decode(
         )
         inference_params = model._decoding_cache.inference_params
         inference_params.reset(max_length, batch_size)
+    elif isinstance(model, IncrementalDecodingMixin):
+        inference_params = model.init_decoding_state(batch_size=batch_size, max_seqlen=max_length)
     else:
         inference_params = InferenceParams(max_seqlen=max_length, max_batch_size=batch_size)
 
     def get_logits(input_ids, inference_params):
+        if not cg and isinstance(model, IncrementalDecodingMixin):
+            # advances inference_params.seqlen_offset
+            logits = model.decode_step(input_ids, inference_params)
+            return logits[..., :vocab_size] if vocab_size is not None else logits
         decoding = inference_params.seqlen_offset > 0
         if decoding:
             position_ids = torch.full(
@@ -181,11 +110,16 @@ def decode(
             ).logits.squeeze(dim=1)
         else:
             logits = model._decoding_cache.run(input_ids, position_ids, inference_params.seqlen_offset).squeeze(dim=1)
+        inference_params.seqlen_offset += input_ids.shape[1]
         return logits[..., :vocab_size] if vocab_size is not None else logits
 
-    def sample_tokens(logits, inference_params):
+    sampler = TokenSampler(
+        temperature=temperature, top_k=top_k, top_p=top_p, min_p=min_p, repetition_penalty=repetition_penalty
+    )
+
+    def sample_tokens(logits, inference_params, prev_token_ids):
         if teacher_outputs is None or teacher_output_len <= inference_params.seqlen_offset:
-            token = sample(logits, top_k=top_k, top_p=top_p, min_p=min_p, temperature=temperature)
+            token = sampler(logits, prev_token_ids=prev_token_ids)
         else:
             token = teacher_outputs[:, inference_params.seqlen_offset]
         # return rearrange(token, "b -> b 1")
@@ -209,12 +143,10 @@ def decode(
     sequences_cat = input_ids
     while not should_stop(sequences[-1], inference_params):
         scores.append(get_logits(sequences[-1], inference_params))
-        inference_params.seqlen_offset += sequences[-1].shape[1]
         if repetition_penalty == 1.0:
-            sampled_tokens = sample_tokens(scores[-1], inference_params)
+            sampled_tokens = sample_tokens(scores[-1], inference_params, prev_token_ids=None)
         else:
-            logits = modify_logit_for_repetition_penalty(scores[-1].clone(), sequences_cat, repetition_penalty)
-            sampled_tokens = sample_tokens(logits, inference_params)
+            sampled_tokens = sample_tokens(scores[-1], inference_params, prev_token_ids=sequences_cat)
             sequences_cat = torch.cat([sequences_cat, sampled_tokens], dim=1)
         sequences.append(sampled_tokens)
         if streamer is not None:
@@ -225,7 +157,8 @@ def decode(
         end.record()
         torch.cuda.synchronize()
         print(f"Prompt processing + decoding time: {(start.elapsed_time(end)):.0f}ms")
-    output_cls = GreedySearchDecoderOnlyOutput if top_k == 1 else SampleDecoderOnlyOutput
+    is_greedy = not torch.is_tensor(top_k) and top_k == 1
+    output_cls = GreedySearchDecoderOnlyOutput if is_greedy else SampleDecoderOnlyOutput
     return output_cls(sequences=torch.cat(sequences, dim=1), scores=tuple(scores))
 
 
@@ -1,6 +1,6 @@
 from abc import abstractmethod
 from enum import Enum
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 
 import torch
 import torch.nn as nn
@@ -34,6 +34,25 @@ class NNModel(nn.Module):
         return {name: param for name, param in self.named_parameters()}
 
 
+class IncrementalDecodingMixin:
+    """Interface of models that generate autoregressively from a cached decoding state (e.g., the recurrent
+    conv and SSM states of Mamba), such that the cost per generated token is independent of the context length."""
+
+    @abstractmethod
+    def init_decoding_state(self, batch_size: int, max_seqlen: int) -> Any:
+        """Returns an empty decoding state for up to batch_size sequences of up to max_seqlen tokens."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def decode_step(self, input_ids: torch.Tensor, decoding_state: Any) -> torch.Tensor:
+        """Feeds input_ids of shape (batch_size, seqlen), i.e., the prompts in the first call and
+        the last generated token of each sequence in all subsequent calls, and updates the decoding state in-place.
+
+        :return: The logits of the last position of shape (batch_size, vocab_size).
+        """
+        raise NotImplementedError
+
+
 class SwiGLU(nn.Module):
     def __init__(self, n_embd: int, bias: bool):
         super().__init__()
@@ -1,5 +1,6 @@
+import os
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 import torch
 import torch.distributed as dist
@@ -8,10 +9,19 @@ from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
 from torch.distributed.fsdp import ShardingStrategy
 
 from modalities.checkpointing.checkpoint_loading import CheckpointLoadingIF
+from modalities.models.gpt2.gpt2_model import GPT2LLM, CausalSelfAttention, TransformerMLP
+from modalities.models.model import SwiGLU
 from modalities.nn.model_initialization.initialization_if import ModelInitializationIF
 from modalities.running_env.env_utils import MixedPrecisionSettings
 from modalities.running_env.fsdp.fsdp_auto_wrapper import FSDPTransformerAutoWrapPolicyFactory
-from modalities.util import get_local_number_of_trainable_parameters
+from modalities.running_env.pipeline_parallel import get_pipeline_parallel_group
+from modalities.running_env.tensor_parallel import (
+    ColumnParallelLinear,
+    RowParallelLinear,
+    get_data_parallel_group,
+    get_tensor_parallel_group,
+)
+from modalities.util import get_local_number_of_trainable_parameters, get_module_class_from_name, print_rank_0
 
 
 class ModelFactory:
@@ -32,6 +42,7 @@ class ModelFactory:
         block_names: List[str],
         mixed_precision_settings: MixedPrecisionSettings,
         sharding_strategy: ShardingStrategy,
+        tensor_parallel_degree: int = 1,
     ) -> FSDP:
         print(
             f"Unsharded number of parameters on rank {dist.get_rank()}: "
@@ -50,6 +61,8 @@ class ModelFactory:
             device_id=torch.cuda.current_device(),
             sync_module_states=sync_module_states,
             use_orig_params=True,
+            # 2D parallelism: the tensor parallel shards are sharded further across the data parallel ranks
+            process_group=get_data_parallel_group(tensor_parallel_degree) if tensor_parallel_degree > 1 else None,
         )
         print(
             f"Sharded number of parameters on rank {dist.get_rank()}:"
@@ -58,7 +71,145 @@ class ModelFactory:
 
         return fsdp_model
 
+    @staticmethod
+    def get_compiled_model(
+        model: nn.Module,
+        block_names: List[str],
+        mode: Optional[str] = None,
+        dynamic: Optional[bool] = None,
+        fullgraph: bool = False,
+        backend: str = "inductor",
+        cache_dir: Optional[Path] = None,
+    ) -> nn.Module:
+        """Compiles the blocks of the model in place with torch.compile, or the whole model if no block names are
+        given. Since the modules are compiled in place (nn.Module.compile), the module hierarchy, the block types
+        and the parameter names stay the same, so that the compiled model can be FSDP wrapped, checkpointed and
+        loaded like the original one.
+
+        Per-block compilation is meant to be applied before FSDP wrapping, such that the FSDP units
+        (i.e., the same blocks) call the compiled forward functions. Compiling the whole model is meant to be
+        applied after FSDP wrapping (with use_orig_params=True), as the FSDP communication of the root unit
+        would otherwise be part of the compiled graph.
+
+        Args:
+            model (nn.Module): The model, optionally already FSDP wrapped.
+            block_names (List[str]): Class names of the blocks to compile, e.g., ["GPT2Block"].
+            mode (Optional[str]): Compilation mode of torch.compile, e.g., "max-autotune".
+            dynamic (Optional[bool]): Whether to compile for dynamic shapes, None detects them automatically.
+            fullgraph (bool): Whether to raise an error on graph breaks.
+            backend (str): Compiler backend of torch.compile.
+            cache_dir (Optional[Path]): Directory of the inductor and FX graph caches, which is persisted
+                across restarts, so that unchanged graphs are not recompiled.
+
+        Returns:
+            nn.Module: The model with compiled blocks.
+        """
+        if cache_dir is not None:
+            _enable_persistent_compile_cache(cache_dir)
+        compile_kwargs = dict(mode=mode, dynamic=dynamic, fullgraph=fullgraph, backend=backend)
+        if len(block_names) == 0:
+            model.compile(**compile_kwargs)
+            return model
+
+        block_types = []
+        for block_name in block_names:
+            block_type = get_module_class_from_name(model, block_name)
+            if block_type is None:
+                raise ValueError(f"Could not find block with name {block_name} in model")
+            block_types.append(block_type)
+        blocks = [module for module in model.modules() if isinstance(module, tuple(block_types))]
+        for block in blocks:
+            block.compile(**compile_kwargs)
+        print_rank_0(f"Compiled {len(blocks)} blocks of the types {block_names} with torch.compile ({compile_kwargs})")
+        return model
+
+    @staticmethod
+    def get_tensor_parallel_model(model: nn.Module, tensor_parallel_degree: int) -> nn.Module:
+        """Shards the attention and MLP layers of the model in place across groups of tensor_parallel_degree
+        consecutive ranks (Megatron-style, https://arxiv.org/abs/1909.08053). The query, key and value projection
+        is column-parallel, i.e., each rank computes the attention of a shard of the heads, and the output
+        projection is row-parallel. Likewise, the first layers of TransformerMLP and SwiGLU are column-parallel
+        and their last layer is row-parallel. Thereby, the activations are all-reduced within the group after
+        the attention and the MLP in the forward pass and before them in the backward pass, while the weights,
+        compute and attention/MLP activations per rank shrink with the degree.
+
+        The full model has to be identical on all ranks (e.g., initialized with the same seed) and the ranks of a
+        tensor parallel group have to get the same samples. For 2D parallelism, the model is FSDP wrapped with the
+        same tensor_parallel_degree afterwards, which shards it across the data parallel ranks.
+
+        Args:
+            model (nn.Module): The model, which is not wrapped yet.
+            tensor_parallel_degree (int): Number of ranks that share the layers.
+
+        Returns:
+            nn.Module: The model with sharded layers.
+        """
+        if tensor_parallel_degree == 1:
+            return model
+        group = get_tensor_parallel_group(tensor_parallel_degree)
+        for module in list(model.modules()):
+            if isinstance(module, CausalSelfAttention):
+                if module.n_head_kv % tensor_parallel_degree != 0:
+                    raise ValueError(f"n_head_kv {module.n_head_kv} must be divisible by {tensor_parallel_degree}.")
+                module.qkv_attn = ColumnParallelLinear(
+                    module.qkv_attn, group, split_sizes=[module.n_embd, module.kv_dim, module.kv_dim]
+                )
+                module.c_proj = RowParallelLinear(module.c_proj, group)
+                # the attention is computed for the local heads
+                module.n_head_q //= tensor_parallel_degree
+                module.n_head_kv //= tensor_parallel_degree
+                module.n_embd //= tensor_parallel_degree
+                module.kv_dim //= tensor_parallel_degree
+            elif isinstance(module, TransformerMLP):
+                module.c_fc = ColumnParallelLinear(module.c_fc, group)
+                module.c_proj = RowParallelLinear(module.c_proj, group)
+            elif isinstance(module, SwiGLU):
+                module.W = ColumnParallelLinear(module.W, group)
+                module.V = ColumnParallelLinear(module.V, group)
+                module.W_2 = RowParallelLinear(module.W_2, group)
+        print_rank_0(f"Sharded the attention and MLP layers across {tensor_parallel_degree} tensor parallel ranks.")
+        return model
+
+    @staticmethod
+    def get_pipeline_stage_model(model: GPT2LLM, pipeline_parallel_degree: int) -> GPT2LLM:
+        """Reduces the model in place to the pipeline stage of the current rank, i.e., its rank within the group of
+        pipeline_parallel_degree consecutive ranks, which holds a contiguous range of the blocks (see
+        GPT2LLM.split_into_pipeline_stage). The stages are trained with the PipelineSchedule1F1B of the Trainer.
+
+        The full model has to be identical on all ranks (e.g., initialized with the same seed) and the ranks of a
+        pipeline group have to get the same samples.
+
+        Args:
+            model (GPT2LLM): The full model, which is not wrapped yet.
+            pipeline_parallel_degree (int): Number of pipeline stages.
+
+        Returns:
+            GPT2LLM: The model of the pipeline stage.
+        """
+        if pipeline_parallel_degree == 1:
+            return model
+        stage_id = dist.get_rank(get_pipeline_parallel_group(pipeline_parallel_degree))
+        model.split_into_pipeline_stage(stage_id=stage_id, num_stages=pipeline_parallel_degree)
+        print(
+            f"Pipeline stage {stage_id} on rank {dist.get_rank()} holds the blocks {list(model.pipeline_block_ids)} "
+            f"with {get_local_number_of_trainable_parameters(model)} parameters."
+        )
+        return model
+
     @staticmethod
     def get_weight_initalized_model(model: nn.Module, model_initializer: ModelInitializationIF) -> nn.Module:
         model_initializer.initialize_in_place(model)
         return model
+
+
+def _enable_persistent_compile_cache(cache_dir: Path) -> None:
+    # imported lazily, since inductor is only needed when compiling
+    import torch._inductor.config
+    import torch._inductor.utils
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = str(cache_dir)
+    os.environ.setdefault("TRITON_CACHE_DIR", str(cache_dir / "triton"))
+    torch._inductor.config.fx_graph_cache = True
+    # inductor memoizes its cache directory on first use
+    torch._inductor.utils.cache_dir.cache_clear()
@@ -1,6 +1,6 @@
 import math
 from enum import Enum
-from typing import Optional, Tuple
+from typing import Callable, Dict, Optional, Tuple
 
 import torch
 import torch.nn.functional as F
@@ -23,6 +23,59 @@ class AttentionConfig(BaseModel):
     attention_engine_type: AttentionEngineType
 
 
+class AttentionCache:
+    """Lazily sized cache for attention tensors that only depend on the sequence length, dtype and device,
+    i.e., causal masks and rotary cos/sin tables.
+
+    A single instance is meant to be shared by all attention layers of a model, so that these tensors are
+    computed once instead of per layer and forward pass. Per (dtype, device), the cached tensors grow to the
+    largest requested sequence length and smaller sequence lengths are served as views.
+    """
+
+    def __init__(self):
+        self._tensors: Dict[Tuple, Tensor] = {}
+
+    def _get_or_create(self, key: Tuple, size: int, create_fun: Callable[[int], Tensor]) -> Tensor:
+        # the sequence dimension of all cached tensors is the second to last one
+        tensor = self._tensors.get(key)
+        if tensor is None or tensor.shape[-2] < size:
+            # tensors created in inference mode could not be saved for backward in a later training step
+            with torch.inference_mode(False):
+                tensor = create_fun(size)
+            self._tensors[key] = tensor
+        return tensor
+
+    def get_causal_bias(self, query_length: int, key_length: int, dtype: torch.dtype, device: torch.device) -> Tensor:
+        """Returns the additive causal attention bias of shape (query_length, key_length), which is 0 for the
+        allowed and -inf for the masked positions."""
+
+        def create_causal_bias(size: int) -> Tensor:
+            is_masked = torch.ones(size, size, dtype=torch.bool, device=device).triu(diagonal=1)
+            return torch.zeros(size, size, dtype=dtype, device=device).masked_fill(is_masked, float("-inf"))
+
+        causal_bias = self._get_or_create(
+            key=("causal_bias", dtype, device), size=max(query_length, key_length), create_fun=create_causal_bias
+        )
+        return causal_bias[:query_length, :key_length]
+
+    def get_rotary_tables(self, inv_freq: Tensor, seq_len: int, dtype: torch.dtype) -> Tuple[Tensor, Tensor]:
+        """Returns the rotary cos and sin tables, each of shape (seq_len, 2 * len(inv_freq)).
+        Note, that the tables are cached per head dimension, i.e., inv_freq is assumed to be the same
+        for all layers."""
+        device = inv_freq.device
+
+        def create_rotary_tables(size: int) -> Tensor:
+            t = torch.arange(size, device=device, dtype=torch.float32)
+            freqs = torch.einsum("i,j->ij", t, inv_freq.to(dtype))
+            emb = torch.cat((freqs, freqs), dim=-1)
+            return torch.stack([emb.cos(), emb.sin()]).to(dtype)  # (2, size, dim)
+
+        rotary_tables = self._get_or_create(
+            key=("rotary_tables", inv_freq.numel(), dtype, device), size=seq_len, create_fun=create_rotary_tables
+        )
+        return rotary_tables[0, :seq_len], rotary_tables[1, :seq_len]
+
+
 class MultiHeadAttention(nn.Module):
     def __init__(
         self,
@@ -33,6 +86,7 @@ class MultiHeadAttention(nn.Module):
         bias: bool = True,
         dropout: float = 0.0,
         block_size: int = 1024,
+        attention_cache: Optional[AttentionCache] = None,
     ):
         super().__init__()
         if n_embd % n_head != 0:
@@ -53,10 +107,10 @@ class MultiHeadAttention(nn.Module):
 
         if not self.use_flash:
             self.attn_dropout = nn.Dropout(dropout) if dropout > 0.0 else nn.Identity()
-            self.register_buffer(
-                "bias",
-                torch.tril(torch.ones(block_size, block_size)).view(1, 1, block_size, block_size),
-            )
+        # the causal mask is sized lazily and can be shared with other attention layers of the model
+        self.attention_cache = AttentionCache() if attention_cache is None else attention_cache
+        # checkpoints might still contain the formerly registered (block_size x block_size) causal mask buffer
+        self._register_load_state_dict_pre_hook(MultiHeadAttention._remove_causal_mask_buffer)
         self.resid_dropout = nn.Dropout(dropout) if dropout > 0.0 else nn.Identity()
 
     def forward(self, x: Tensor, context: Optional[Tensor] = None) -> Tensor:
@@ -78,6 +132,10 @@ class MultiHeadAttention(nn.Module):
         y = self.resid_dropout(self.c_proj(y))
         return y
 
+    @staticmethod
+    def _remove_causal_mask_buffer(state_dict: Dict[str, Tensor], prefix: str, *args, **kwargs):
+        state_dict.pop(f"{prefix}bias", None)
+
     def _forward_input_projection(self, x: Tensor, context: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
         B, T, C = x.shape  # batch size, sequence length, embedding dimensionality (n_embd)
         _, Tc, Cc = context.shape  # batch size, context length, context embedding dimensionality
@@ -92,7 +150,7 @@ class MultiHeadAttention(nn.Module):
         att = (query @ key.transpose(-2, -1)) * (1.0 / math.sqrt(key.size(-1)))
         if self.is_causal:
             T = query.size(2)
-            att = att.masked_fill(self.bias[:, :, :T, :T] == 0, float("-inf"))
+            att = att + self.attention_cache.get_causal_bias(T, T, dtype=att.dtype, device=att.device)
         att = F.softmax(att, dim=-1)
         att = self.attn_dropout(att)
         return att @ value
@@ -29,7 +29,7 @@ NAMED_PARAMETER_INIT_GROUPS = {
         WeightInitTypes.PLAIN: RegexFilter(
             weights=[
                 # attention projection weights
-                r"transformer\.h\.\d+\.attn\.(q_attn|k_attn|v_attn|c_proj)\.weight",
+                r"transformer\.h\.\d+\.attn\.(qkv_attn|c_proj)\.weight",
                 # hidden feed forward in attention block
                 r"transformer\.h\.\w+\.mlp\.(W|V|W_2)\.weight",  # SwiGLU
                 r"transformer\.h\.\w+\.mlp\.(c_fc|c_proj)\.weight",  # gelu
@@ -41,7 +41,7 @@ NAMED_PARAMETER_INIT_GROUPS = {
             ],
             biases=[
                 # NOTE: some bias terms might not be present due to user configuration
-                r"transformer\.h\.\d+\.attn\.(q_attn|k_attn|v_attn|c_proj)\.bias",
+                r"transformer\.h\.\d+\.attn\.(qkv_attn|c_proj)\.bias",
                 r"transformer\.h\.\w+\.mlp\.(W|V|W_2)\.bias",  # SwiGLU
                 r"transformer\.h\.\w+\.mlp\.(c_fc|c_proj)\.bias",  # gelu
                 r"lm_head\.bias",
@@ -13,15 +13,19 @@ from modalities.checkpointing.checkpoint_saving_strategies import (
 )
 from modalities.checkpointing.fsdp.fsdp_checkpoint_loading import FSDPCheckpointLoading
 from modalities.checkpointing.fsdp.fsdp_checkpoint_saving import FSDPCheckpointSaving
+from modalities.checkpointing.pipeline.pipeline_checkpoint_saving import PipelineCheckpointSaving
 from modalities.checkpointing.torch.torch_checkpoint_loading import TorchCheckpointLoading
 from modalities.config.config import (
     AdamOptimizerConfig,
     AdamWOptimizerConfig,
     BatchSamplerConfig,
+    BlendedPackedDatasetConfig,
     CheckpointedModelConfig,
     CheckpointedOptimizerConfig,
     CheckpointSavingConfig,
+    CLMChunkedCrossEntropyLossConfig,
     CLMCrossEntropyLossConfig,
+    CompiledModelConfig,
     ConstantLRSchedulerConfig,
     CosineAnnealingLRSchedulerConfig,
     DistributedSamplerConfig,
@@ -38,6 +42,8 @@ from modalities.config.config import (
     OpenGPTXMMapDatasetConfig,
     PackedMemMapDatasetContinuousConfig,
     PackedMemMapDatasetMegatronConfig,
+    PipelineCheckpointSavingConfig,
+    PipelineStageModelConfig,
     PreTrainedHFTokenizerConfig,
     PreTrainedSPTokenizerConfig,
     RepeatingDataLoaderConfig,
@@ -46,6 +52,7 @@ from modalities.config.config import (
     SaveEveryKStepsCheckpointingStrategyConfig,
     SaveKMostRecentCheckpointsStrategyConfig,
     StepLRSchedulerConfig,
+    TensorParallelModelConfig,
     TorchCheckpointLoadingConfig,
     WandBEvaluationResultSubscriberConfig,
     WeightInitializedModelConfig,
@@ -57,7 +64,7 @@ from modalities.logging_broker.subscriber_impl.subscriber_factory import (
     ProgressSubscriberFactory,
     ResultsSubscriberFactory,
 )
-from modalities.loss_functions import CLMCrossEntropyLoss
+from modalities.loss_functions import CLMChunkedCrossEntropyLoss, CLMCrossEntropyLoss
 from modalities.models.coca.coca_model import CoCa, CoCaConfig
 from modalities.models.coca.collator import CoCaCollateFnConfig, CoCaCollatorFn
 from modalities.models.components.layer_norms import LayerNormConfig, RMSLayerNorm, RMSLayerNormConfig
@@ -78,19 +85,24 @@ from modalities.training.gradient_clipping.fsdp_gradient_clipper import (
     DummyGradientClipper,
     FSDPGradientClipper,
     FSDPLoggingOnlyGradientClipper,
+    PipelineGradientClipper,
 )
 from modalities.training.gradient_clipping.fsdp_gradient_clipper_config import (
     DummyGradientClipperConfig,
     FSDPDummyGradientClipperConfig,
     FSDPGradientClipperConfig,
+    PipelineGradientClipperConfig,
 )
 from modalities.utils.number_conversion import (
     LocalNumBatchesFromNumSamplesConfig,
     LocalNumBatchesFromNumTokensConfig,
     NumberConversion,
+    NumSamplesFromPackedMemMapDatasetContinuousConfig,
     NumStepsFromNumSamplesConfig,
     NumStepsFromNumTokensConfig,
+    NumStepsFromPackedMemMapDatasetContinuousConfig,
     NumTokensFromNumStepsConfig,
+    NumTokensFromPackedDataConfig,
 )
 
 
@@ -111,6 +123,9 @@ COMPONENTS = [
     ),
     ComponentEntity("model", "checkpointed", ModelFactory.get_checkpointed_model, CheckpointedModelConfig),
     ComponentEntity("model", "fsdp_wrapped", ModelFactory.get_fsdp_wrapped_model, FSDPWrappedModelConfig),
+    ComponentEntity("model", "compiled", ModelFactory.get_compiled_model, CompiledModelConfig),
+    ComponentEntity("model", "tensor_parallel", ModelFactory.get_tensor_parallel_model, TensorParallelModelConfig),
+    ComponentEntity("model", "pipeline_stage", ModelFactory.get_pipeline_stage_model, PipelineStageModelConfig),
     ComponentEntity(
         "model", "model_initialized", ModelFactory.get_weight_initalized_model, WeightInitializedModelConfig
     ),
@@ -124,6 +139,9 @@ COMPONENTS = [
     ),
     # losses
     ComponentEntity("loss", "clm_cross_entropy_loss", CLMCrossEntropyLoss, CLMCrossEntropyLossConfig),
+    ComponentEntity(
+        "loss", "clm_chunked_cross_entropy_loss", CLMChunkedCrossEntropyLoss, CLMChunkedCrossEntropyLossConfig
+    ),
     # optmizers
     ComponentEntity("optimizer", "adam", OptimizerFactory.get_adam, AdamOptimizerConfig),
     ComponentEntity("optimizer", "adam_w", OptimizerFactory.get_adam_w, AdamWOptimizerConfig),
@@ -160,6 +178,9 @@ COMPONENTS = [
         "dataset", "open_gptx_mmap_dataset", DatasetFactory.get_open_gptx_mmap_dataset, OpenGPTXMMapDatasetConfig
     ),
     ComponentEntity("dataset", "dummy_dataset", DatasetFactory.get_dummy_dataset, DummyDatasetConfig),
+    ComponentEntity(
+        "dataset", "blended_packed_dataset", DatasetFactory.get_blended_packed_dataset, BlendedPackedDatasetConfig
+    ),
     # samplers
     ComponentEntity("sampler", "distributed_sampler", DistributedSampler, DistributedSamplerConfig),
     # batch samplers
@@ -189,6 +210,9 @@ COMPONENTS = [
     ),
     # checkpoint saving execution
     ComponentEntity("checkpoint_saving_execution", "fsdp", FSDPCheckpointSaving, FSDPCheckpointSavingConfig),
+    ComponentEntity(
+        "checkpoint_saving_execution", "pipeline", PipelineCheckpointSaving, PipelineCheckpointSavingConfig
+    ),
     # checkpoint loading
     ComponentEntity("checkpoint_loading", "fsdp", FSDPCheckpointLoading, FSDPCheckpointLoadingConfig),
     ComponentEntity("checkpoint_loading", "torch", TorchCheckpointLoading, TorchCheckpointLoadingConfig),
@@ -226,6 +250,7 @@ COMPONENTS = [
     ComponentEntity(
         "gradient_clipper", "fsdp_logging_only", FSDPLoggingOnlyGradientClipper, FSDPDummyGradientClipperConfig
     ),
+    ComponentEntity("gradient_clipper", "pipeline", PipelineGradientClipper, PipelineGradientClipperConfig),
     ComponentEntity("gradient_clipper", "dummy", DummyGradientClipper, DummyGradientClipperConfig),
     # Number conversion
     ComponentEntity(
@@ -258,4 +283,22 @@ COMPONENTS = [
         NumberConversion.get_num_tokens_from_num_steps_callable,
         NumTokensFromNumStepsConfig,
     ),
+    ComponentEntity(
+        "number_conversion",
+        "num_tokens_from_packed_data",
+        NumberConversion.get_num_tokens_from_packed_data,
+        NumTokensFromPackedDataConfig,
+    ),
+    ComponentEntity(
+        "number_conversion",
+        "num_samples_from_packed_mem_map_dataset_continuous",
+        NumberConversion.get_num_samples_from_packed_mem_map_dataset_continuous,
+        NumSamplesFromPackedMemMapDatasetContinuousConfig,
+    ),
+    ComponentEntity(
+        "number_conversion",
+        "num_steps_from_packed_mem_map_dataset_continuous",
+        NumberConversion.get_num_steps_from_packed_mem_map_dataset_continuous,
+        NumStepsFromPackedMemMapDatasetContinuousConfig,
+    ),
 ]
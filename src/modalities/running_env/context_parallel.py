@@ -0,0 +1,76 @@
+from functools import lru_cache
+
+import torch
+import torch.distributed as dist
+
+
+@lru_cache(maxsize=None)
+def get_context_parallel_group(context_parallel_degree: int) -> dist.ProcessGroup:
+    """Splits the ranks into groups of context_parallel_degree consecutive ranks, which share the same samples
+    and process different shards of their sequences. Returns the group of the current rank.
+
+    Note, that the samplers of the ranks within a context parallel group have to return the same samples.
+    """
+    world_size = dist.get_world_size()
+    if world_size % context_parallel_degree != 0:
+        raise ValueError(
+            f"The world size {world_size} must be divisible by the context parallel degree {context_parallel_degree}."
+        )
+    rank = dist.get_rank()
+    context_parallel_group = None
+    # all ranks have to take part in the creation of each group
+    for first_rank in range(0, world_size, context_parallel_degree):
+        ranks = list(range(first_rank, first_rank + context_parallel_degree))
+        group = dist.new_group(ranks)
+        if rank in ranks:
+            context_parallel_group = group
+    return context_parallel_group
+
+
+def get_sequence_shard(x: torch.Tensor, group: dist.ProcessGroup, dim: int = 1) -> torch.Tensor:
+    """Returns the contiguous shard of the sequence dimension that is processed by the current rank."""
+    context_parallel_degree = dist.get_world_size(group)
+    if x.shape[dim] % context_parallel_degree != 0:
+        raise ValueError(
+            f"The sequence length {x.shape[dim]} must be divisible by the context parallel degree "
+            f"{context_parallel_degree}."
+        )
+    return x.chunk(context_parallel_degree, dim=dim)[dist.get_rank(group)]
+
+
+class _AllToAll(torch.autograd.Function):
+    # scatters the chunks of x along scatter_dim to the ranks of the group and concatenates the received
+    # chunks along gather_dim, the backward pass is the inverse exchange
+    @staticmethod
+    def forward(ctx, x: torch.Tensor, scatter_dim: int, gather_dim: int, group: dist.ProcessGroup) -> torch.Tensor:
+        ctx.scatter_dim, ctx.gather_dim, ctx.group = scatter_dim, gather_dim, group
+        chunks = torch.stack(x.chunk(dist.get_world_size(group), dim=scatter_dim))
+        received_chunks = torch.empty_like(chunks)
+        dist.all_to_all_single(received_chunks, chunks, group=group)
+        return torch.cat(received_chunks.unbind(0), dim=gather_dim)
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        return _AllToAll.apply(grad_output, ctx.gather_dim, ctx.scatter_dim, ctx.group), None, None, None
+
+
+def sequence_to_head_parallel(x: torch.Tensor, n_head: int, group: dist.ProcessGroup) -> torch.Tensor:
+    """Exchanges the sequence shards of all heads for all positions of a shard of the heads
+    (all-to-all as in DeepSpeed-Ulysses, https://arxiv.org/abs/2309.14509).
+
+    Args:
+        x (torch.Tensor): Tensor of shape (B, T / cp, n_head * hd).
+        n_head (int): Number of heads, which must be divisible by the context parallel degree cp.
+        group (dist.ProcessGroup): The context parallel group.
+
+    Returns:
+        torch.Tensor: Tensor of shape (B, T, n_head / cp * hd).
+    """
+    x = _AllToAll.apply(x.unflatten(-1, (n_head, -1)), 2, 1, group)  # (B, T, n_head / cp, hd)
+    return x.flatten(2)
+
+
+def head_to_sequence_parallel(x: torch.Tensor, group: dist.ProcessGroup) -> torch.Tensor:
+    """Inverse of sequence_to_head_parallel, i.e., exchanges a tensor of shape (B, T, n_head / cp, hd)
+    for a tensor of shape (B, T / cp, n_head, hd)."""
+    return _AllToAll.apply(x, 1, 2, group)
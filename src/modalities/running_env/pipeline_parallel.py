@@ -0,0 +1,244 @@
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+from modalities.batch import DatasetBatch, InferenceResultBatch
+from modalities.loss_functions import Loss
+
+# key of the hidden states, which are passed from one pipeline stage to the next within the inputs and predictions
+PIPELINE_HIDDEN_STATES_KEY = "pipeline_hidden_states"
+
+# dtypes of the hidden states that can be communicated between the stages, referenced by their index
+_HIDDEN_STATES_DTYPES = [torch.float32, torch.float16, torch.bfloat16]
+_MAX_HIDDEN_STATES_NDIM = 6
+
+
+@lru_cache(maxsize=None)
+def get_pipeline_parallel_group(pipeline_parallel_degree: int) -> dist.ProcessGroup:
+    """Splits the ranks into groups of pipeline_parallel_degree consecutive ranks, which share the same samples
+    and hold consecutive stages of the model. Returns the group of the current rank, whose rank within the group
+    is the id of its stage.
+    """
+    world_size = dist.get_world_size()
+    if world_size % pipeline_parallel_degree != 0:
+        raise ValueError(
+            f"The world size {world_size} must be divisible by the pipeline parallel degree {pipeline_parallel_degree}."
+        )
+    rank = dist.get_rank()
+    pipeline_parallel_group = None
+    # all ranks have to take part in the creation of each group
+    for first_rank in range(0, world_size, pipeline_parallel_degree):
+        ranks = list(range(first_rank, first_rank + pipeline_parallel_degree))
+        group = dist.new_group(ranks)
+        if rank in ranks:
+            pipeline_parallel_group = group
+    return pipeline_parallel_group
+
+
+@lru_cache(maxsize=None)
+def get_pipeline_embedding_group(pipeline_parallel_degree: int) -> dist.ProcessGroup:
+    """Returns the group of the first and the last stage of the pipeline of the current rank, which hold the tied
+    token embedding and LM head weights. The group is also created for the ranks of the other stages, which
+    are not part of it.
+    """
+    world_size = dist.get_world_size()
+    rank = dist.get_rank()
+    embedding_group = None
+    for first_rank in range(0, world_size, pipeline_parallel_degree):
+        ranks = [first_rank, first_rank + pipeline_parallel_degree - 1]
+        group = dist.new_group(ranks)
+        if rank in ranks:
+            embedding_group = group
+    return embedding_group
+
+
+def get_pipeline_stage_block_ids(num_blocks: int, stage_id: int, num_stages: int) -> range:
+    """Returns the ids of the contiguous blocks of a pipeline stage. The blocks are evenly distributed,
+    the first num_blocks % num_stages stages get one additional block.
+    """
+    if num_blocks < num_stages:
+        raise ValueError(f"The number of blocks {num_blocks} must be at least the number of stages {num_stages}.")
+    num_stage_blocks, num_remaining_blocks = divmod(num_blocks, num_stages)
+    first_block_id = stage_id * num_stage_blocks + min(stage_id, num_remaining_blocks)
+    return range(first_block_id, first_block_id + num_stage_blocks + int(stage_id < num_remaining_blocks))
+
+
+def split_dataset_batch(batch: DatasetBatch, num_micro_batches: int) -> List[DatasetBatch]:
+    """Splits a batch into num_micro_batches micro-batches of equal size along the batch dimension."""
+    if len(batch) % num_micro_batches != 0:
+        raise ValueError(f"The batch size {len(batch)} must be divisible by the number of micro-batches.")
+    samples = {k: v.chunk(num_micro_batches, dim=batch.batch_dim) for k, v in batch.samples.items()}
+    targets = {k: v.chunk(num_micro_batches, dim=batch.batch_dim) for k, v in batch.targets.items()}
+    return [
+        DatasetBatch(
+            samples={k: v[i] for k, v in samples.items()},
+            targets={k: v[i] for k, v in targets.items()},
+            batch_dim=batch.batch_dim,
+        )
+        for i in range(num_micro_batches)
+    ]
+
+
+class PipelineSchedule1F1B:
+    def __init__(self, pipeline_parallel_degree: int, num_micro_batches: int):
+        """Schedules the forward and backward passes of the micro-batches of a batch across the stages of a
+        pipeline (one-forward-one-backward schedule of PipeDream-Flush, https://arxiv.org/abs/2006.09503).
+        Each stage first runs the forward passes of the micro-batches that are needed to fill the pipeline and then
+        alternates between the forward pass of the next and the backward pass of the oldest micro-batch, such that
+        at most pipeline_parallel_degree - stage_id micro-batches are in flight and their activations stored.
+        The hidden states and their gradients are sent asynchronously to the neighboring stages.
+
+        The stage models are created by ModelFactory.get_pipeline_stage_model from identical full models.
+        The ranks of a pipeline group have to get the same samples.
+
+        Args:
+            pipeline_parallel_degree (int): Number of stages, i.e., of consecutive ranks per pipeline.
+            num_micro_batches (int): Number of micro-batches a batch is split into, which should be
+                at least pipeline_parallel_degree to keep the pipeline busy.
+        """
+        self.num_stages = pipeline_parallel_degree
+        self.num_micro_batches = num_micro_batches
+        self.group = get_pipeline_parallel_group(pipeline_parallel_degree)
+        self.embedding_group = get_pipeline_embedding_group(pipeline_parallel_degree)
+        self.stage_id = dist.get_rank(self.group)
+        self.is_first_stage = self.stage_id == 0
+        self.is_last_stage = self.stage_id == self.num_stages - 1
+        # the stages of a pipeline are consecutive ranks
+        self.previous_rank = dist.get_rank() - 1
+        self.next_rank = dist.get_rank() + 1
+
+    def step(
+        self,
+        model: nn.Module,
+        batch: DatasetBatch,
+        loss_fun: Loss,
+        loss_scale: float = 1.0,
+        synchronize_tied_gradients: bool = True,
+    ) -> torch.Tensor:
+        """Runs the forward and backward passes of the micro-batches of a batch and accumulates the gradients of
+        the mean loss over the micro-batches, scaled by loss_scale (e.g., 1 / gradient_acc_steps), in the
+        parameters of the stage.
+
+        Args:
+            model (nn.Module): The model of the pipeline stage of the current rank.
+            batch (DatasetBatch): The batch, which is the same for all stages.
+            loss_fun (Loss): The loss function, which is applied to the predictions of the last stage.
+            loss_scale (float): Factor of the loss for the backward pass.
+            synchronize_tied_gradients (bool): Whether to sum the gradients of the tied weights of the first and
+                last stage, which has to be done once before each optimizer step.
+
+        Returns:
+            torch.Tensor: The mean loss over the micro-batches, which is returned on all stages.
+        """
+        micro_batches = split_dataset_batch(batch, self.num_micro_batches)
+        self._send_works = []
+        inputs_queue, outputs_queue, losses = [], [], []
+
+        def forward(micro_batch_id: int):
+            hidden_states, output = self._forward_micro_batch(model, micro_batches[micro_batch_id], loss_fun)
+            if self.is_last_stage:
+                losses.append(output.detach())
+                output = output * loss_scale / self.num_micro_batches
+            inputs_queue.append(hidden_states)
+            outputs_queue.append(output)
+
+        def backward():
+            hidden_states, output = inputs_queue.pop(0), outputs_queue.pop(0)
+            if self.is_last_stage:
+                output.backward()
+            else:
+                torch.autograd.backward(output, self._recv(self.next_rank, batch.device))
+            if not self.is_first_stage:
+                self._send(hidden_states.grad, self.previous_rank)
+
+        num_warmup_micro_batches = min(self.num_stages - self.stage_id - 1, self.num_micro_batches)
+        for micro_batch_id in range(num_warmup_micro_batches):
+            forward(micro_batch_id)
+        for micro_batch_id in range(num_warmup_micro_batches, self.num_micro_batches):
+            forward(micro_batch_id)
+            backward()
+        for _ in range(num_warmup_micro_batches):
+            backward()
+        self._wait_for_sends()
+
+        if synchronize_tied_gradients:
+            self._all_reduce_tied_gradients(model)
+        return self._broadcast_mean_loss(losses, batch.device)
+
+    def forward_only(self, model: nn.Module, batch: DatasetBatch, loss_fun: Loss) -> torch.Tensor:
+        """Runs the forward passes of the micro-batches of a batch, e.g., for the evaluation under torch.no_grad.
+
+        Args:
+            model (nn.Module): The model of the pipeline stage of the current rank.
+            batch (DatasetBatch): The batch, which is the same for all stages.
+            loss_fun (Loss): The loss function, which is applied to the predictions of the last stage.
+
+        Returns:
+            torch.Tensor: The mean loss over the micro-batches, which is returned on all stages.
+        """
+        self._send_works = []
+        losses = []
+        for micro_batch in split_dataset_batch(batch, self.num_micro_batches):
+            _, output = self._forward_micro_batch(model, micro_batch, loss_fun)
+            if self.is_last_stage:
+                losses.append(output.detach())
+        self._wait_for_sends()
+        return self._broadcast_mean_loss(losses, batch.device)
+
+    def _forward_micro_batch(
+        self, model: nn.Module, micro_batch: DatasetBatch, loss_fun: Loss
+    ) -> Tuple[Optional[torch.Tensor], torch.Tensor]:
+        # returns the received hidden states and the loss on the last stage or the sent hidden states otherwise
+        inputs = dict(micro_batch.samples)
+        hidden_states = None
+        if not self.is_first_stage:
+            hidden_states = self._recv(self.previous_rank, micro_batch.device)
+            if torch.is_grad_enabled():
+                hidden_states.requires_grad_()
+            inputs[PIPELINE_HIDDEN_STATES_KEY] = hidden_states
+        predictions = model(inputs)
+        if self.is_last_stage:
+            return hidden_states, loss_fun(InferenceResultBatch(targets=micro_batch.targets, predictions=predictions))
+        output = predictions[PIPELINE_HIDDEN_STATES_KEY]
+        self._send(output.detach(), self.next_rank)
+        return hidden_states, output
+
+    def _broadcast_mean_loss(self, losses: List[torch.Tensor], device: torch.device) -> torch.Tensor:
+        loss = torch.stack(losses).mean() if self.is_last_stage else torch.zeros([], device=device)
+        # the global rank of the last stage
+        dist.broadcast(loss, src=dist.get_rank() + self.num_stages - 1 - self.stage_id, group=self.group)
+        return loss
+
+    def _wait_for_sends(self):
+        for work, _ in self._send_works:
+            work.wait()
+        self._send_works = []
+
+    def _send(self, tensor: torch.Tensor, dst: int):
+        # the shape and dtype are sent along, since they depend on the stage model (e.g., its mixed precision)
+        meta = torch.zeros(_MAX_HIDDEN_STATES_NDIM + 2, dtype=torch.long, device=tensor.device)
+        meta[0] = _HIDDEN_STATES_DTYPES.index(tensor.dtype)
+        meta[1] = tensor.dim()
+        meta[2 : 2 + tensor.dim()] = torch.tensor(tensor.shape)
+        tensor = tensor.contiguous()
+        # the tensors have to stay alive until they have been sent
+        self._send_works.extend([(dist.isend(meta, dst=dst), meta), (dist.isend(tensor, dst=dst), tensor)])
+
+    def _recv(self, src: int, device: torch.device) -> torch.Tensor:
+        meta = torch.zeros(_MAX_HIDDEN_STATES_NDIM + 2, dtype=torch.long, device=device)
+        dist.recv(meta, src=src)
+        shape = meta[2 : 2 + meta[1]].tolist()
+        tensor = torch.empty(shape, dtype=_HIDDEN_STATES_DTYPES[meta[0]], device=device)
+        dist.recv(tensor, src=src)
+        return tensor
+
+    def _all_reduce_tied_gradients(self, model: nn.Module):
+        if self.num_stages == 1 or not (self.is_first_stage or self.is_last_stage):
+            return
+        # e.g., the token embedding weight of the first and the LM head weight of the last stage of GPT2LLM
+        for parameter in model.get_pipeline_tied_parameters():
+            if parameter.grad is not None:
+                dist.all_reduce(parameter.grad, group=self.embedding_group)
@@ -0,0 +1,217 @@
+from functools import lru_cache
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+@lru_cache(maxsize=None)
+def get_tensor_parallel_group(tensor_parallel_degree: int) -> dist.ProcessGroup:
+    """Splits the ranks into groups of tensor_parallel_degree consecutive ranks (e.g., the GPUs of a node),
+    which share the same samples and hold different shards of the weights. Returns the group of the current rank.
+    """
+    world_size = dist.get_world_size()
+    if world_size % tensor_parallel_degree != 0:
+        raise ValueError(
+            f"The world size {world_size} must be divisible by the tensor parallel degree {tensor_parallel_degree}."
+        )
+    rank = dist.get_rank()
+    tensor_parallel_group = None
+    # all ranks have to take part in the creation of each group
+    for first_rank in range(0, world_size, tensor_parallel_degree):
+        ranks = list(range(first_rank, first_rank + tensor_parallel_degree))
+        group = dist.new_group(ranks)
+        if rank in ranks:
+            tensor_parallel_group = group
+    return tensor_parallel_group
+
+
+@lru_cache(maxsize=None)
+def get_data_parallel_group(tensor_parallel_degree: int) -> dist.ProcessGroup:
+    """Returns the group of the ranks with the same shards of the weights as the current rank, i.e., the ranks
+    at the same position within their tensor parallel groups, across which the data is parallelized (e.g., by FSDP).
+    """
+    world_size = dist.get_world_size()
+    rank = dist.get_rank()
+    data_parallel_group = None
+    for tensor_parallel_rank in range(tensor_parallel_degree):
+        ranks = list(range(tensor_parallel_rank, world_size, tensor_parallel_degree))
+        group = dist.new_group(ranks)
+        if rank in ranks:
+            data_parallel_group = group
+    return data_parallel_group
+
+
+class _CopyToTensorParallelRegion(torch.autograd.Function):
+    # identity in the forward pass, the partial input gradients of the ranks are summed in the backward pass
+    @staticmethod
+    def forward(ctx, x: torch.Tensor, group: dist.ProcessGroup) -> torch.Tensor:
+        ctx.group = group
+        return x
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        grad_output = grad_output.contiguous()
+        dist.all_reduce(grad_output, group=ctx.group)
+        return grad_output, None
+
+
+class _ReduceFromTensorParallelRegion(torch.autograd.Function):
+    # sums the partial outputs of the ranks in the forward pass, identity in the backward pass
+    @staticmethod
+    def forward(ctx, x: torch.Tensor, group: dist.ProcessGroup) -> torch.Tensor:
+        x = x.contiguous()
+        dist.all_reduce(x, group=group)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        return grad_output, None
+
+
+def get_column_shard(tensor: torch.Tensor, group: dist.ProcessGroup, split_sizes: Optional[List[int]] = None):
+    """Returns the shard of the rows (i.e., output features) of a weight or bias, which is held by the current rank.
+    For fused projections, each of the parts given by split_sizes (e.g., query, key and value) is sharded separately.
+    """
+    tensor_parallel_degree, rank = dist.get_world_size(group), dist.get_rank(group)
+    split_sizes = [tensor.shape[0]] if split_sizes is None else split_sizes
+    if any(split_size % tensor_parallel_degree != 0 for split_size in split_sizes):
+        raise ValueError(f"The output features {split_sizes} must be divisible by {tensor_parallel_degree}.")
+    parts = tensor.split(split_sizes, dim=0)
+    return torch.cat([part.chunk(tensor_parallel_degree, dim=0)[rank] for part in parts], dim=0)
+
+
+def get_row_shard(weight: torch.Tensor, group: dist.ProcessGroup) -> torch.Tensor:
+    """Returns the shard of the columns (i.e., input features) of a weight, which is held by the current rank."""
+    tensor_parallel_degree = dist.get_world_size(group)
+    if weight.shape[1] % tensor_parallel_degree != 0:
+        raise ValueError(f"The input features {weight.shape[1]} must be divisible by {tensor_parallel_degree}.")
+    return weight.chunk(tensor_parallel_degree, dim=1)[dist.get_rank(group)]
+
+
+class ColumnParallelLinear(nn.Module):
+    def __init__(self, linear: nn.Linear, group: dist.ProcessGroup, split_sizes: Optional[List[int]] = None):
+        """Linear layer, whose output features are sharded across the tensor parallel group
+        (https://arxiv.org/abs/1909.08053). The input is replicated and the output is the local shard.
+
+        Args:
+            linear (nn.Linear): The full linear layer, which is identical on all ranks of the group.
+            group (dist.ProcessGroup): The tensor parallel group.
+            split_sizes (Optional[List[int]]): Sizes of the parts of a fused projection, which are sharded separately.
+        """
+        super().__init__()
+        self.group = group
+        # sizes of the parts of the local shard, which are merged separately into the full weight
+        split_sizes = [linear.out_features] if split_sizes is None else split_sizes
+        self.shard_split_sizes = [split_size // dist.get_world_size(group) for split_size in split_sizes]
+        self.weight = nn.Parameter(get_column_shard(linear.weight.detach(), group, split_sizes).clone())
+        if linear.bias is None:
+            self.register_parameter("bias", None)
+        else:
+            self.bias = nn.Parameter(get_column_shard(linear.bias.detach(), group, split_sizes).clone())
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return F.linear(_CopyToTensorParallelRegion.apply(x, self.group), self.weight, self.bias)
+
+
+class RowParallelLinear(nn.Module):
+    def __init__(self, linear: nn.Linear, group: dist.ProcessGroup):
+        """Linear layer, whose input features are sharded across the tensor parallel group
+        (https://arxiv.org/abs/1909.08053). The input is the local shard and the output is replicated.
+
+        Args:
+            linear (nn.Linear): The full linear layer, which is identical on all ranks of the group.
+            group (dist.ProcessGroup): The tensor parallel group.
+        """
+        super().__init__()
+        self.group = group
+        self.weight = nn.Parameter(get_row_shard(linear.weight.detach(), group).clone())
+        # the bias is replicated and added after the partial outputs have been summed
+        if linear.bias is None:
+            self.register_parameter("bias", None)
+        else:
+            self.bias = nn.Parameter(linear.bias.detach().clone())
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        y = _ReduceFromTensorParallelRegion.apply(F.linear(x, self.weight), self.group)
+        return y if self.bias is None else y + self.bias
+
+
+# names of the modules, which wrap the original modules (FSDP and activation checkpointing), and are not part of the
+# parameter names in the full state dicts
+_WRAPPER_MODULE_NAMES = ["_fsdp_wrapped_module", "_checkpoint_wrapped_module"]
+
+
+class TensorParallelShard(NamedTuple):
+    parameter: nn.Parameter
+    group: dist.ProcessGroup
+    # dimension along which the full parameter is sharded
+    dim: int
+    # sizes of the parts of the shard (e.g., query, key and value), which are merged separately
+    split_sizes: List[int]
+
+
+def get_tensor_parallel_shards(model: nn.Module) -> Dict[str, TensorParallelShard]:
+    """Returns the parameters of the model, which are sharded across a tensor parallel group, by their names in the
+    full state dict. All other parameters (e.g., norms, embeddings and the biases of the row-parallel layers)
+    are replicated across the group. The model can be FSDP wrapped.
+    """
+    shards = {}
+    for module_name, module in model.named_modules():
+        module_name = ".".join(name for name in module_name.split(".") if name not in _WRAPPER_MODULE_NAMES)
+        if isinstance(module, ColumnParallelLinear):
+            layouts = {"weight": (0, module.shard_split_sizes), "bias": (0, module.shard_split_sizes)}
+        elif isinstance(module, RowParallelLinear):
+            layouts = {"weight": (1, [module.weight.shape[1]])}
+        else:
+            continue
+        for param_name, (dim, split_sizes) in layouts.items():
+            parameter = getattr(module, param_name)
+            if parameter is not None:
+                shards[f"{module_name}.{param_name}"] = TensorParallelShard(parameter, module.group, dim, split_sizes)
+    return shards
+
+
+def merge_tensor_parallel_shards(tensors: List[torch.Tensor], dim: int, split_sizes: List[int]) -> torch.Tensor:
+    """Merges the shards of the ranks of a tensor parallel group into the full tensor, i.e., inverts get_column_shard
+    (dim=0) and get_row_shard (dim=1). The parts of the shards given by split_sizes are merged separately."""
+    parts = [tensor.split(split_sizes, dim=dim) for tensor in tensors]
+    return torch.cat([torch.cat(rank_parts, dim=dim) for rank_parts in zip(*parts)], dim=dim)
+
+
+def gather_tensor_parallel_state_dict(
+    state_dict: Dict[str, Any], shards: Dict[str, TensorParallelShard], group: dist.ProcessGroup, dst: int = 0
+) -> Optional[Dict[str, Any]]:
+    """Gathers the state dicts of the ranks of a tensor parallel group on the global rank dst and merges the sharded
+    entries, i.e., the parameters of a model state dict or the states (e.g., the moments of Adam) of the "state"
+    of an optimizer state dict, whose parameters are referenced by their names. Non-sharded and scalar entries
+    are taken from the first rank of the group.
+
+    Args:
+        state_dict (Dict[str, Any]): The state dict of the shards of the current rank.
+        shards (Dict[str, TensorParallelShard]): The sharded parameters, see get_tensor_parallel_shards.
+        group (dist.ProcessGroup): The tensor parallel group.
+        dst (int): Global rank, which gets the full state dict.
+
+    Returns:
+        Optional[Dict[str, Any]]: The full state dict on rank dst and None on the other ranks.
+    """
+    state_dicts = [None] * dist.get_world_size(group) if dist.get_rank() == dst else None
+    dist.gather_object(state_dict, state_dicts, dst=dst, group=group)
+    if dist.get_rank() != dst:
+        return None
+
+    def merge(values: List[Any], shard: TensorParallelShard) -> Any:
+        if isinstance(values[0], dict):
+            return {key: merge([value[key] for value in values], shard) for key in values[0]}
+        if torch.is_tensor(values[0]) and values[0].dim() > 0:
+            return merge_tensor_parallel_shards(values, shard.dim, shard.split_sizes)
+        return values[0]
+
+    full_state_dict = dict(state_dicts[0])
+    for name, shard in shards.items():
+        if name in full_state_dict:
+            full_state_dict[name] = merge([state_dict[name] for state_dict in state_dicts], shard)
+    return full_state_dict
@@ -1,3 +1,4 @@
+from contextlib import nullcontext
 from enum import Enum
 from typing import Callable, Optional, Tuple
 
@@ -8,6 +9,7 @@ from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
 from torch.optim import Optimizer
 from torch.optim.lr_scheduler import LRScheduler
 
+from modalities.activation_offloading import ActivationOffloader
 from modalities.batch import DatasetBatch, EvaluationResultBatch
 from modalities.dataloader.dataloader import LLMDataLoader
 from modalities.logging_broker.messages import BatchProgressUpdate, ExperimentStatus, MessageTypes
@@ -15,6 +17,7 @@ from modalities.logging_broker.publisher import MessagePublisher
 from modalities.loss_functions import Loss
 from modalities.models.model import model_predict_batch
 from modalities.running_env.fsdp.reducer import Reducer
+from modalities.running_env.pipeline_parallel import PipelineSchedule1F1B
 from modalities.training.gradient_clipping.gradient_clipper import GradientClipperIF
 from modalities.util import Aggregator, TimeRecorder, print_rank_0
 
@@ -33,6 +36,9 @@ class Trainer:
         gradient_acc_steps: int,
         global_num_tokens_per_train_step: int,
         gradient_clipper: GradientClipperIF,
+        activation_offloader: Optional[ActivationOffloader] = None,
+        pipeline_schedule: Optional[PipelineSchedule1F1B] = None,
+        use_no_sync_for_gradient_accumulation: bool = False,
     ) -> None:
         self.global_rank = global_rank
         self.batch_progress_publisher = batch_progress_publisher
@@ -40,6 +46,12 @@ class Trainer:
         self.gradient_acc_steps = gradient_acc_steps
         self.global_num_tokens_per_train_step = global_num_tokens_per_train_step
         self.gradient_clipper = gradient_clipper
+        self.activation_offloader = activation_offloader
+        # if set, the model is a pipeline stage and each batch is split into micro-batches by the schedule
+        self.pipeline_schedule = pipeline_schedule
+        # if True, the gradients of the micro-batches before the last one of a train step are accumulated locally
+        # (FSDP no_sync), so that they are reduced only once per step at the cost of keeping unsharded gradients
+        self.use_no_sync_for_gradient_accumulation = use_no_sync_for_gradient_accumulation
 
     @staticmethod
     def _get_num_train_steps_done(micro_batch_id: int, gradient_acc_steps: int) -> int:
@@ -54,11 +66,22 @@ class Trainer:
         loss_fun: Loss,
         micro_batch_id: int,
     ) -> Tuple[bool, int, torch.Tensor, Optional[torch.Tensor], Optional[torch.Tensor]]:
-        result_batch = model_predict_batch(model=model, batch=batch)
-        loss = loss_fun(result_batch)
-        (loss / self.gradient_acc_steps).backward()
+        is_last_accumulation_step = (micro_batch_id + 1) % self.gradient_acc_steps == 0
+        if self.pipeline_schedule is not None:
+            loss = self.pipeline_schedule.step(
+                model=model,
+                batch=batch,
+                loss_fun=loss_fun,
+                loss_scale=1 / self.gradient_acc_steps,
+                synchronize_tied_gradients=is_last_accumulation_step,
+            )
+        else:
+            with self._get_gradient_sync_context(model=model, is_last_accumulation_step=is_last_accumulation_step):
+                result_batch = model_predict_batch(model=model, batch=batch)
+                loss = loss_fun(result_batch)
+                (loss / self.gradient_acc_steps).backward()
 
-        if (micro_batch_id + 1) % self.gradient_acc_steps == 0:
+        if is_last_accumulation_step:
             gradient_norm_score = self.gradient_clipper.clip_gradients()
             optimizer.step()
             scheduler.step()
@@ -73,6 +96,12 @@ class Trainer:
         )
         return step_performed, num_train_steps_done, loss, gradient_norm_score
 
+    def _get_gradient_sync_context(self, model: nn.Module, is_last_accumulation_step: bool):
+        # the forward and backward pass both have to run within FSDP's no_sync context
+        if self.use_no_sync_for_gradient_accumulation and not is_last_accumulation_step and hasattr(model, "no_sync"):
+            return model.no_sync()
+        return nullcontext()
+
     def train(
         self,
         model: nn.Module,
@@ -182,6 +211,10 @@ class Trainer:
                     "grad norm last": torch.tensor(gradient_norm_scores[-1]),
                 }
                 gradient_norm_scores = []
+                if self.activation_offloader is not None:
+                    metrics["activation offloaded bytes per step"] = torch.tensor(
+                        self.activation_offloader.pop_num_offloaded_bytes() / training_log_interval_in_steps
+                    )
 
                 training_metrics = EvaluationResultBatch(
                     losses=losses,
@@ -1,7 +1,15 @@
+import math
+from typing import List, Optional
+
 import torch
+import torch.distributed as dist
+import torch.nn as nn
 from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+from torch.distributed.fsdp import ShardingStrategy
 
 from modalities.config.lookup_enum import LookupEnum
+from modalities.running_env.pipeline_parallel import get_pipeline_parallel_group
+from modalities.running_env.tensor_parallel import get_tensor_parallel_shards
 from modalities.training.gradient_clipping.gradient_clipper import GradientClipperIF
 
 
@@ -11,25 +19,141 @@ class GradientClippingMode(LookupEnum):
     MAX_NORM = "inf"  # Maximum norm based clipping.
 
 
+def clip_grad_norm_across_ranks_(
+    parameters: List[nn.Parameter],
+    max_norm: float,
+    norm_type: float,
+    group: Optional[dist.ProcessGroup] = None,
+    num_replicas: Optional[List[int]] = None,
+) -> torch.Tensor:
+    """Clips the gradients of parameters, which are distributed across the ranks of the group (e.g., sharded by FSDP
+    or tensor parallelism), by their total norm, as nn.utils.clip_grad_norm_ does for the parameters of a single rank.
+
+    Args:
+        parameters (List[nn.Parameter]): The parameters of the current rank.
+        max_norm (float): Maximum norm of the gradients.
+        norm_type (float): Type of the p-norm, can be inf.
+        group (Optional[dist.ProcessGroup]): The ranks, which hold the parameters, all ranks by default.
+        num_replicas (Optional[List[int]]): Number of ranks of the group, which hold the same gradient as the
+            current rank, per parameter (e.g., the tensor parallel degree for replicated parameters), such that each
+            gradient is only counted once. By default, the gradients of the ranks are disjoint.
+
+    Returns:
+        torch.Tensor: The total norm of the gradients.
+    """
+    num_replicas = [1] * len(parameters) if num_replicas is None else num_replicas
+    grads = [(p.grad.detach(), n) for p, n in zip(parameters, num_replicas) if p.grad is not None and p.grad.numel()]
+    local_norm = torch.zeros([], dtype=torch.float32, device=parameters[0].device)
+    if norm_type == math.inf:
+        for grad, _ in grads:
+            local_norm = torch.maximum(local_norm, grad.abs().max().float())
+        dist.all_reduce(local_norm, op=dist.ReduceOp.MAX, group=group)
+        total_norm = local_norm
+    else:
+        for grad, n in grads:
+            local_norm += grad.float().norm(norm_type) ** norm_type / n
+        dist.all_reduce(local_norm, group=group)
+        total_norm = local_norm ** (1.0 / norm_type)
+    clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+    for grad, _ in grads:
+        grad.mul_(clip_coef.to(grad.dtype))
+    return total_norm
+
+
+def clip_tensor_parallel_grad_norm_(
+    model: nn.Module, max_norm: float, norm_type: float, data_parallel_replicas: int = 1
+) -> torch.Tensor:
+    """Clips the gradients of a model with tensor parallel layers (see ModelFactory.get_tensor_parallel_model) by
+    their total norm across all ranks, such that the replicated parameters get the same updates on the ranks of a
+    tensor parallel group. For 2D parallelism, the model is FSDP wrapped across the data parallel ranks, which either
+    hold disjoint shards of the gradients or, without sharding, data_parallel_replicas copies of them.
+    """
+    tensor_parallel_shards = get_tensor_parallel_shards(model)
+    tensor_parallel_degree = dist.get_world_size(next(iter(tensor_parallel_shards.values())).group)
+    sharded_parameters = {id(shard.parameter) for shard in tensor_parallel_shards.values()}
+    parameters = list(model.parameters())
+    num_replicas = [
+        data_parallel_replicas * (1 if id(parameter) in sharded_parameters else tensor_parallel_degree)
+        for parameter in parameters
+    ]
+    return clip_grad_norm_across_ranks_(parameters, max_norm, norm_type, num_replicas=num_replicas)
+
+
+def clip_fsdp_grad_norm_(wrapped_model: FSDP, max_norm: float, norm_type: GradientClippingMode) -> torch.Tensor:
+    # the norm computed by FSDP only covers its process group, i.e., the data parallel ranks for 2D parallelism
+    if len(get_tensor_parallel_shards(wrapped_model)) == 0:
+        return wrapped_model.clip_grad_norm_(max_norm=max_norm, norm_type=norm_type.value)
+    is_unsharded = wrapped_model.sharding_strategy == ShardingStrategy.NO_SHARD
+    return clip_tensor_parallel_grad_norm_(
+        wrapped_model,
+        max_norm=max_norm,
+        norm_type=float(norm_type.value),
+        data_parallel_replicas=dist.get_world_size(wrapped_model.process_group) if is_unsharded else 1,
+    )
+
+
+def _check_is_fsdp_wrapped(wrapped_model: nn.Module):
+    if not isinstance(wrapped_model, FSDP):
+        raise ValueError(
+            f"The FSDP gradient clippers require an FSDP wrapped model, but got {type(wrapped_model).__name__}. "
+            "Use the pipeline gradient clipper for the stages of a pipeline."
+        )
+
+
 class FSDPGradientClipper(GradientClipperIF):
     def __init__(self, wrapped_model: FSDP, max_norm: float, norm_type=GradientClippingMode) -> None:
+        _check_is_fsdp_wrapped(wrapped_model)
         self.wrapped_model = wrapped_model
         self.max_norm = max_norm
         self.norm_type = norm_type
 
     def clip_gradients(self) -> torch.Tensor:
-        gradient_norm_score = self.wrapped_model.clip_grad_norm_(max_norm=self.max_norm, norm_type=self.norm_type.value)
+        gradient_norm_score = clip_fsdp_grad_norm_(self.wrapped_model, max_norm=self.max_norm, norm_type=self.norm_type)
         return gradient_norm_score
 
 
 class FSDPLoggingOnlyGradientClipper(GradientClipperIF):
     def __init__(self, wrapped_model: FSDP, norm_type=GradientClippingMode) -> None:
+        _check_is_fsdp_wrapped(wrapped_model)
         self.wrapped_model = wrapped_model
         self.norm_type = norm_type
 
     def clip_gradients(self) -> torch.Tensor:
         # we only return the gradient norm score without actually clipping the gradients
-        gradient_norm_score = self.wrapped_model.clip_grad_norm_(max_norm=torch.inf, norm_type=self.norm_type.value)
+        gradient_norm_score = clip_fsdp_grad_norm_(self.wrapped_model, max_norm=torch.inf, norm_type=self.norm_type)
+        return gradient_norm_score
+
+
+class PipelineGradientClipper(GradientClipperIF):
+    def __init__(
+        self, wrapped_model: nn.Module, max_norm: float, norm_type: GradientClippingMode, pipeline_parallel_degree: int
+    ) -> None:
+        """Clips the gradients of the stage models of a pipeline (see ModelFactory.get_pipeline_stage_model) by their
+        total norm across the stages. The tied weights of the first and the last stage are counted once.
+
+        Args:
+            wrapped_model (nn.Module): The model of the pipeline stage of the current rank.
+            max_norm (float): Maximum norm of the gradients.
+            norm_type (GradientClippingMode): Type of the p-norm.
+            pipeline_parallel_degree (int): Number of pipeline stages.
+        """
+        self.wrapped_model = wrapped_model
+        self.max_norm = max_norm
+        self.norm_type = norm_type
+        self.group = get_pipeline_parallel_group(pipeline_parallel_degree)
+        # the tied weights hold the same gradients after the pipeline schedule synchronized them
+        tied_parameters = {id(parameter) for parameter in wrapped_model.get_pipeline_tied_parameters()}
+        self.parameters = list(wrapped_model.parameters())
+        self.num_replicas = [2 if id(parameter) in tied_parameters else 1 for parameter in self.parameters]
+
+    def clip_gradients(self) -> torch.Tensor:
+        gradient_norm_score = clip_grad_norm_across_ranks_(
+            self.parameters,
+            max_norm=self.max_norm,
+            norm_type=float(self.norm_type.value),
+            group=self.group,
+            num_replicas=self.num_replicas,
+        )
         return gradient_norm_score
 
 
@@ -12,6 +12,13 @@ class FSDPGradientClipperConfig(BaseModel):
     wrapped_model: PydanticPytorchModuleType
 
 
+class PipelineGradientClipperConfig(BaseModel):
+    max_norm: Annotated[float, Field(strict=True, gt=0)]
+    norm_type: GradientClippingMode
+    wrapped_model: PydanticPytorchModuleType
+    pipeline_parallel_degree: Annotated[int, Field(strict=True, ge=1)]
+
+
 class FSDPDummyGradientClipperConfig(BaseModel):
     wrapped_model: PydanticPytorchModuleType
     norm_type: GradientClippingMode
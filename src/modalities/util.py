@@ -1,12 +1,17 @@
+import fcntl
 import hashlib
+import os
+import tempfile
 import time
 import warnings
+from contextlib import contextmanager
 from datetime import datetime
 from enum import Enum
 from pathlib import Path
 from types import TracebackType
 from typing import Callable, Dict, Generic, Optional, Type, TypeVar
 
+import numpy as np
 import torch
 import torch.distributed as dist
 from pydantic import ValidationError
@@ -190,3 +195,29 @@ def get_module_class_from_name(module: torch.nn.Module, name: str) -> Type[torch
             module_class = get_module_class_from_name(child_module, name)
             if module_class is not None:
                 return module_class
+
+
+def save_array_atomically(filename: str, array: np.ndarray) -> None:
+    """Saves the array as .npy file such that readers never see a partially written file."""
+    # write to a temporary file in the same directory and rename it afterwards, e.g., to survive crashes
+    directory, basename = os.path.split(filename)
+    with tempfile.NamedTemporaryFile(dir=directory or ".", prefix=f".{basename}.", suffix=".tmp", delete=False) as f:
+        try:
+            np.save(f, array, allow_pickle=False)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            os.remove(f.name)
+            raise
+    os.replace(f.name, filename)
+
+
+@contextmanager
+def file_lock(lock_filename: str):
+    """Exclusive lock across all processes (i.e., ranks and dataloader workers) sharing the file system."""
+    with open(lock_filename, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -1,6 +1,11 @@
+import json
+from pathlib import Path
 from typing import Annotated, Callable
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, FilePath
+
+from modalities.dataloader.create_packed_data import VIRTUAL_PBIN_SUFFIX, EmbeddedStreamData
+from modalities.dataloader.packed_data_stats import load_packed_data_stats
 
 
 class LocalNumBatchesFromNumSamplesConfig(BaseModel):
@@ -35,6 +40,22 @@ class NumTokensFromNumStepsConfig(BaseModel):
     sequence_length: Annotated[int, Field(strict=True, gt=0)]
 
 
+class NumTokensFromPackedDataConfig(BaseModel):
+    dataset_path: FilePath
+
+
+class NumSamplesFromPackedMemMapDatasetContinuousConfig(BaseModel):
+    dataset_path: FilePath
+    block_size: Annotated[int, Field(strict=True, gt=1)]
+
+
+class NumStepsFromPackedMemMapDatasetContinuousConfig(BaseModel):
+    dataset_path: FilePath
+    block_size: Annotated[int, Field(strict=True, gt=1)]
+    num_ranks: Annotated[int, Field(strict=True, gt=0)]
+    local_micro_batch_size: Annotated[int, Field(strict=True, gt=0)]
+
+
 class NumberConversion:
     @staticmethod
     def get_local_num_batches_from_num_samples(
@@ -119,3 +140,70 @@ class NumberConversion:
         num_ranks: int, local_micro_batch_size: int, sequence_length: int
     ) -> Callable[[int], int]:
         return lambda num_steps_done: num_steps_done * num_ranks * local_micro_batch_size * sequence_length
+
+    @staticmethod
+    def get_num_tokens_from_packed_data(dataset_path: Path) -> int:
+        """Returns the number of tokens (including the eod tokens) of a packed data file in O(1).
+        The number is taken from the statistics sidecar written during packing. Without a sidecar, it is
+        derived from the header of the pbin file or from the manifest of a virtual pbin file.
+
+        Args:
+            dataset_path (Path): path to the pbin or virtual pbin file
+
+        Returns:
+            int: number of tokens
+        """
+        stats = load_packed_data_stats(dataset_path)
+        if stats is not None:
+            return stats["num_tokens"]
+        if dataset_path.suffix == VIRTUAL_PBIN_SUFFIX:
+            with dataset_path.open("r") as f:
+                manifest = json.load(f)
+            data_len = sum(member["data_len"] for member in manifest["members"])
+            return data_len // manifest["token_size_in_bytes"]
+        with dataset_path.open("rb") as f:
+            data_len = int.from_bytes(f.read(EmbeddedStreamData.DATA_SECTION_LENGTH_IN_BYTES), byteorder="little")
+            token_size_in_bytes = int.from_bytes(
+                f.read(EmbeddedStreamData.TOKEN_SIZE_DESCRIPTOR_LENGTH_IN_BYTES), byteorder="little"
+            )
+        return data_len // token_size_in_bytes
+
+    @staticmethod
+    def get_num_samples_from_packed_mem_map_dataset_continuous(dataset_path: Path, block_size: int) -> int:
+        """Calculates the number of samples of a PackedMemMapDatasetContinuous without instantiating
+        the dataset, whereby consecutive samples share one token.
+
+        Args:
+            dataset_path (Path): path to the pbin or virtual pbin file
+            block_size (int): number of tokens per sample
+
+        Returns:
+            int: number of samples
+        """
+        num_tokens = NumberConversion.get_num_tokens_from_packed_data(dataset_path)
+        if num_tokens < block_size:
+            return 0
+        return (num_tokens - block_size) // (block_size - 1) + 1
+
+    @staticmethod
+    def get_num_steps_from_packed_mem_map_dataset_continuous(
+        dataset_path: Path, block_size: int, num_ranks: int, local_micro_batch_size: int
+    ) -> int:
+        """Calculates the number of steps to iterate once over a PackedMemMapDatasetContinuous
+        without instantiating the dataset.
+
+        Args:
+            dataset_path (Path): path to the pbin or virtual pbin file
+            block_size (int): number of tokens per sample
+            num_ranks (int): number of ranks
+            local_micro_batch_size (int): micro batch size per rank
+
+        Returns:
+            int: number of steps
+        """
+        global_num_samples = NumberConversion.get_num_samples_from_packed_mem_map_dataset_continuous(
+            dataset_path=dataset_path, block_size=block_size
+        )
+        return NumberConversion.get_num_steps_from_num_samples(
+            num_ranks=num_ranks, local_micro_batch_size=local_micro_batch_size, global_num_samples=global_num_samples
+        )
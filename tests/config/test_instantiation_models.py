@@ -0,0 +1,88 @@
+from pathlib import Path
+
+import pytest
+from pydantic import ValidationError
+
+from modalities.config.config import load_app_config_dict
+from modalities.config.instantiation_models import TrainingComponentsInstantiationModel
+
+
+def _get_training_settings(
+    world_size: int, pipeline_parallel_degree: int, context_parallel_degree: int = 1, tensor_parallel_degree: int = 1
+) -> dict:
+    return dict(
+        experiment_id="0",
+        referencing_keys={"sample_key": "input_ids"},
+        training=dict(
+            training_log_interval_in_steps=1,
+            checkpointing_interval_in_steps=1,
+            evaluation_interval_in_steps=1,
+            gradient_acc_steps=1,
+            local_train_micro_batch_size=4,
+            sequence_length=16,
+            pipeline_parallelism=dict(pipeline_parallel_degree=pipeline_parallel_degree, num_micro_batches=2),
+            context_parallel_degree=context_parallel_degree,
+            tensor_parallel_degree=tensor_parallel_degree,
+        ),
+        cuda_env=dict(local_rank=0, world_size=world_size, global_rank=0),
+        paths=dict(checkpointing_path="checkpoints"),
+    )
+
+
+@pytest.mark.parametrize("world_size, pipeline_parallel_degree", [(4, 1), (4, 4)])
+def test_training_settings_with_pipeline_parallelism(world_size: int, pipeline_parallel_degree: int):
+    TrainingComponentsInstantiationModel.TrainingSettings(
+        **_get_training_settings(world_size, pipeline_parallel_degree)
+    )
+
+
+def test_training_settings_reject_data_parallel_pipelines():
+    with pytest.raises(ValidationError, match="must equal the pipeline parallel degree"):
+        TrainingComponentsInstantiationModel.TrainingSettings(**_get_training_settings(4, 2))
+
+
+def test_training_settings_num_ranks_per_data_parallel_replica():
+    settings = TrainingComponentsInstantiationModel.TrainingSettings(
+        **_get_training_settings(8, 1, context_parallel_degree=2, tensor_parallel_degree=2)
+    )
+    assert settings.training.num_ranks_per_data_parallel_replica == 4
+    with pytest.raises(ValidationError, match="must be divisible by the product"):
+        TrainingComponentsInstantiationModel.TrainingSettings(
+            **_get_training_settings(6, 1, context_parallel_degree=2, tensor_parallel_degree=2)
+        )
+
+
+@pytest.mark.parametrize(
+    "rank, parallelism_settings, expected_data_parallel_rank, expected_data_parallel_world_size",
+    [
+        (5, "", 5, 8),
+        (5, "context_parallel_degree: 2", 2, 4),
+        (5, "context_parallel_degree: 2\n    tensor_parallel_degree: 2", 1, 2),
+        (5, "pipeline_parallelism:\n      pipeline_parallel_degree: 8", 0, 1),
+    ],
+)
+def test_data_parallel_env_resolver(
+    monkeypatch,
+    tmp_path: Path,
+    rank: int,
+    parallelism_settings: str,
+    expected_data_parallel_rank: int,
+    expected_data_parallel_world_size: int,
+):
+    monkeypatch.setenv("RANK", str(rank))
+    monkeypatch.setenv("WORLD_SIZE", "8")
+    config_file_path = tmp_path / "config.yaml"
+    config_file_path.write_text(
+        f"""settings:
+  training:
+    {parallelism_settings}
+sampler:
+  rank: ${{data_parallel_env:rank}}
+  num_replicas: ${{data_parallel_env:world_size}}
+"""
+    )
+    config_dict = load_app_config_dict(config_file_path)
+    assert config_dict["sampler"] == {
+        "rank": expected_data_parallel_rank,
+        "num_replicas": expected_data_parallel_world_size,
+    }
@@ -1,12 +1,18 @@
 import dataclasses
 import os
 import pickle
+import socket
+import sys
+import traceback
+from datetime import timedelta
 from pathlib import Path
-from typing import Dict
+from typing import Callable, Dict
 from unittest.mock import MagicMock
 
 import pytest
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from torch.optim import Optimizer
 from torch.optim.lr_scheduler import LRScheduler
 from torch.utils.data.sampler import BatchSampler, SequentialSampler
@@ -20,7 +26,8 @@ from modalities.dataloader.samplers import ResumableBatchSampler
 from modalities.evaluator import Evaluator
 from modalities.logging_broker.publisher import MessagePublisher
 from modalities.loss_functions import Loss
-from modalities.models.model import NNModel
+from modalities.models.gpt2.gpt2_model import GPT2LLM, AttentionConfig, AttentionImplementation, PositionTypes
+from modalities.models.model import ActivationType, NNModel
 from modalities.tokenization.tokenizer_wrapper import PreTrainedHFTokenizer
 from modalities.trainer import Trainer
 from modalities.training.gradient_clipping.gradient_clipper import GradientClipperIF
@@ -28,6 +35,77 @@ from modalities.training.gradient_clipping.gradient_clipper import GradientClipp
 _ROOT_DIR = Path(__file__).parents[1]
 
 
+def _init_gloo_and_run(rank: int, world_size: int, port: int, fun: Callable, *args):
+    # a short timeout lets a hanging collective fail the test instead of stalling the test run
+    dist.init_process_group(
+        backend="gloo",
+        init_method=f"tcp://localhost:{port}",
+        rank=rank,
+        world_size=world_size,
+        timeout=timedelta(seconds=60),
+    )
+    try:
+        fun(*args)
+        # no rank may exit while another rank still communicates with it
+        dist.barrier()
+        exit_code = 0
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    # The process exits without destroying the process group: the destructor of ProcessGroupGloo joins its worker
+    # threads while holding the GIL, which deadlocks if a worker thread still releases the tensors of a finished
+    # collective (and thus waits for the GIL). The failing ranks are reported by mp.spawn via the exit code.
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(exit_code)
+
+
+def run_on_cpu_ranks(fun: Callable, world_size: int, *args):
+    """Runs fun(*args) in world_size processes, which form a gloo process group on the CPU.
+    fun has to be defined at module level, such that it can be pickled."""
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        port = s.getsockname()[1]
+    mp.spawn(_init_gloo_and_run, args=(world_size, port, fun, *args), nprocs=world_size)
+
+
+def get_small_gpt2_model(
+    poe_type: PositionTypes,
+    attention_impl: AttentionImplementation,
+    context_parallel_degree: int = 1,
+    activation_type: ActivationType = ActivationType.GELU,
+    n_layer: int = 2,
+) -> GPT2LLM:
+    """Small GPT2LLM, which is shared by the tests of the model parallelisms. It is a plain function instead of a
+    fixture, since it is called within the processes spawned by run_on_cpu_ranks."""
+    if poe_type is PositionTypes.NOPE:
+        qkv_transforms = [{"type_hint": "RotaryTransform", "config": {"n_embd": 32, "n_head": 4, "seq_length_dim": -2}}]
+    else:
+        qkv_transforms = []
+    return GPT2LLM(
+        sample_key="input_ids",
+        prediction_key="logits",
+        poe_type=poe_type,
+        sequence_length=16,
+        vocab_size=64,
+        n_layer=n_layer,
+        n_head_q=4,
+        n_head_kv=2,
+        n_embd=32,
+        ffn_hidden=64,
+        dropout=0.0,
+        bias=True,
+        activation_type=activation_type,
+        attention_implementation=attention_impl,
+        attention_config=AttentionConfig(qkv_transforms=qkv_transforms),
+        attention_norm=torch.nn.LayerNorm(32),
+        ffn_norm=torch.nn.LayerNorm(32),
+        lm_head_norm=torch.nn.LayerNorm(32),
+        document_id_key="document_ids",
+        context_parallel_degree=context_parallel_degree,
+    )
+
+
 @pytest.fixture
 def dummy_packed_data_path(tmpdir) -> Path:
     data = b""
@@ -0,0 +1,76 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from torch.utils.data import BatchSampler, SequentialSampler
+
+from modalities.dataloader.dataset import BlendedPackedDataset, PackedMemMapDatasetContinuous
+from modalities.dataloader.samplers import ResumableBatchSampler
+
+
+def _get_corpora():
+    return [[("a", i) for i in range(10)], [("b", i) for i in range(3)], [("c", i) for i in range(100)]]
+
+
+@pytest.mark.parametrize("weights", [[1, 1, 1], [0.7, 0.2, 0.1], [0, 1, 3]])
+def test_blended_dataset_matches_weights(weights):
+    dataset = BlendedPackedDataset(datasets=_get_corpora(), weights=weights, seed=1, num_samples=600)
+    assert len(dataset) == 600
+    samples = [dataset[i] for i in range(len(dataset))]
+
+    expected_counts = 600 * np.array(weights) / sum(weights)
+    for corpus_name, expected_count in zip(["a", "b", "c"], expected_counts):
+        corpus_samples = [sample for sample in samples if sample[0] == corpus_name]
+        assert abs(len(corpus_samples) - expected_count) <= 1
+        # samples of each corpus are taken in order and repeated once the corpus is exhausted
+        corpus_length = {"a": 10, "b": 3, "c": 100}[corpus_name]
+        assert [i for _, i in corpus_samples] == [k % corpus_length for k in range(len(corpus_samples))]
+
+    # every prefix of the blend follows the weights as well
+    prefix_count = sum(1 for sample in samples[:60] if sample[0] == "c")
+    assert abs(prefix_count - 60 * weights[2] / sum(weights)) <= 1
+
+
+def test_blended_dataset_is_deterministic_and_resumable():
+    dataset = BlendedPackedDataset(datasets=_get_corpora(), weights=[0.5, 0.25, 0.25], seed=3)
+    assert len(dataset) == 113
+    same_dataset = BlendedPackedDataset(datasets=_get_corpora(), weights=[0.5, 0.25, 0.25], seed=3)
+    other_dataset = BlendedPackedDataset(datasets=_get_corpora(), weights=[0.5, 0.25, 0.25], seed=4)
+    np.testing.assert_array_equal(dataset.blend_index, same_dataset.blend_index)
+    assert not np.array_equal(dataset.blend_index, other_dataset.blend_index)
+
+    def get_batch_sampler(start_index: int) -> ResumableBatchSampler:
+        batch_sampler = BatchSampler(SequentialSampler(dataset), batch_size=4, drop_last=True)
+        return ResumableBatchSampler(start_index=start_index, underlying_batch_sampler=batch_sampler)
+
+    all_batches = [[dataset[i] for i in batch] for batch in get_batch_sampler(start_index=0)]
+    resumed_batches = [[same_dataset[i] for i in batch] for batch in get_batch_sampler(start_index=5)]
+    assert resumed_batches == all_batches[5:]
+
+
+def test_blended_dataset_caches_memory_mapped_blend_index(tmp_path: Path, dummy_packed_data_path: Path):
+    datasets = [
+        PackedMemMapDatasetContinuous(dummy_packed_data_path, sample_key="input_ids", block_size=block_size)
+        for block_size in [3, 5]
+    ]
+    dataset = BlendedPackedDataset(datasets=datasets, weights=[2, 1], num_samples=12, blend_index_dir=tmp_path)
+    assert isinstance(dataset.blend_index, np.memmap)
+    assert len(list(tmp_path.glob("*.npy"))) == 1
+    assert [len(dataset[i]["input_ids"]) for i in range(len(dataset))].count(3) == 8
+
+    cached_dataset = BlendedPackedDataset(datasets=datasets, weights=[2, 1], num_samples=12, blend_index_dir=tmp_path)
+    np.testing.assert_array_equal(cached_dataset.blend_index, dataset.blend_index)
+    assert len(list(tmp_path.glob("*.npy"))) == 1
+
+    # re-weighting only creates a new blend index
+    reweighted_dataset = BlendedPackedDataset(
+        datasets=datasets, weights=[1, 1], num_samples=12, blend_index_dir=tmp_path
+    )
+    assert [len(reweighted_dataset[i]["input_ids"]) for i in range(12)].count(3) == 6
+    assert len(list(tmp_path.glob("*.npy"))) == 2
+
+
+@pytest.mark.parametrize("weights", [[1], [-1, 2, 1], [0, 0, 0]])
+def test_blended_dataset_rejects_invalid_weights(weights):
+    with pytest.raises(ValueError):
+        BlendedPackedDataset(datasets=_get_corpora(), weights=weights)
@@ -0,0 +1,110 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from modalities.dataloader.create_index import IndexGenerator
+from modalities.dataloader.create_packed_data import PackedDataGenerator
+from modalities.dataloader.dataset import PackedMemMapDatasetBase
+from modalities.dataloader.document_filter import DocumentFilter, DropReason
+
+
+def _random_document(rng: np.random.Generator, num_tokens: int = 200) -> list:
+    return rng.integers(0, 50_000, size=num_tokens).tolist()
+
+
+@pytest.mark.parametrize(
+    "num_tokens, expected_drop_reason",
+    [(2, DropReason.TOO_SHORT), (3, None), (10, None), (11, DropReason.TOO_LONG)],
+)
+def test_length_filter(num_tokens: int, expected_drop_reason: DropReason):
+    document_filter = DocumentFilter(min_num_tokens=3, max_num_tokens=10)
+    fingerprint = document_filter.compute_fingerprint(list(range(num_tokens)))
+    assert fingerprint.drop_reason == expected_drop_reason
+    assert document_filter.keep(fingerprint) == (expected_drop_reason is None)
+
+
+def test_exact_deduplication():
+    rng = np.random.default_rng(0)
+    document, other_document = _random_document(rng), _random_document(rng)
+    document_filter = DocumentFilter(exact_deduplication=True)
+    keep = [
+        document_filter.keep(document_filter.compute_fingerprint(d))
+        for d in [document, other_document, document, document[:-1]]
+    ]
+    assert keep == [True, True, False, True]
+    assert document_filter.get_stats()["num_dropped_documents"][DropReason.EXACT_DUPLICATE.value] == 1
+
+
+def test_near_deduplication():
+    rng = np.random.default_rng(0)
+    document, other_document = _random_document(rng), _random_document(rng)
+    near_duplicate = list(document)
+    near_duplicate[100] = 50_001
+    document_filter = DocumentFilter(near_deduplication=True, minhash_num_permutations=128, minhash_num_bands=32)
+    keep = [
+        document_filter.keep(document_filter.compute_fingerprint(d)) for d in [document, other_document, near_duplicate]
+    ]
+    assert keep == [True, True, False]
+    stats = document_filter.get_stats()
+    assert stats["num_kept_documents"] == 2
+    assert stats["num_dropped_documents"][DropReason.NEAR_DUPLICATE.value] == 1
+
+
+def test_minhash_signature_is_independent_of_chunking():
+    rng = np.random.default_rng(0)
+    document_filter = DocumentFilter(near_deduplication=True)
+    token_ids = np.asarray(_random_document(rng, num_tokens=1000))
+    signature = document_filter._compute_minhash_signature(token_ids)
+    assert np.array_equal(signature, document_filter._compute_minhash_signature(token_ids, chunk_size=7))
+
+
+def test_deduplication_index_is_bounded():
+    rng = np.random.default_rng(0)
+    documents = [_random_document(rng) for _ in range(5)]
+    document_filter = DocumentFilter(exact_deduplication=True, max_index_entries=2)
+    for document in documents:
+        assert document_filter.keep(document_filter.compute_fingerprint(document))
+    stats = document_filter.get_stats()
+    assert stats["num_index_entries"] == 2
+    assert stats["num_evicted_index_entries"] == 3
+    # the oldest documents were evicted and are not recognized as duplicates anymore
+    assert document_filter.keep(document_filter.compute_fingerprint(documents[0]))
+    assert not document_filter.keep(document_filter.compute_fingerprint(documents[-1]))
+
+
+def test_packed_data_generator_with_document_filter(tmpdir, wrapped_gpt2_tokenizer):
+    texts = ["hello world, this is a test", "short", "another document", "hello world, this is a test"]
+    raw_data_path = Path(tmpdir, "data.jsonl")
+    raw_data_path.write_text("".join(json.dumps({"text": text}) + "\n" for text in texts))
+    index_path = Path(tmpdir, "data.idx")
+    IndexGenerator(raw_data_path).create_index(index_path)
+
+    packed_generator = PackedDataGenerator(
+        src_path=raw_data_path,
+        tokenizer=wrapped_gpt2_tokenizer,
+        number_of_processes=2,
+        eod_token="<|endoftext|>",
+        index_path=index_path,
+        jq_pattern=".text",
+        processing_batch_size=1,
+        raw_samples_queue_size=2,
+        processed_samples_queue_size=2,
+        document_filter=DocumentFilter(min_num_tokens=2, exact_deduplication=True),
+    )
+    dst_path = Path(tmpdir, "data.pbin")
+    packed_generator.run(dst_path)
+
+    eod_token_id = wrapped_gpt2_tokenizer.get_token_id("<|endoftext|>")
+    packed_dataset = PackedMemMapDatasetBase(dst_path, sample_key="input_ids")
+    assert [sample["input_ids"].tolist() for sample in packed_dataset] == [
+        wrapped_gpt2_tokenizer.tokenize(text) + [eod_token_id] for text in [texts[0], texts[2]]
+    ]
+
+    with dst_path.with_suffix(".filter_stats.json").open() as f:
+        stats = json.load(f)
+    assert stats["num_documents"] == 4
+    assert stats["num_kept_documents"] == 2
+    assert stats["num_dropped_documents"][DropReason.TOO_SHORT.value] == 1
+    assert stats["num_dropped_documents"][DropReason.EXACT_DUPLICATE.value] == 1
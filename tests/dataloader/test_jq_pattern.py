@@ -0,0 +1,59 @@
+import json
+import pickle
+
+import jq
+import pytest
+
+from modalities.dataloader.jq_pattern import JqPattern, SimplePathPattern, compile_jq_pattern
+
+DOCUMENTS = [
+    {"text": "hello wörld", "meta": {"source": "web", "tags": ["a", "b"]}, "texts": ["first", "second"]},
+    {"text": "", "meta": None, "texts": []},
+    {"meta": {"source": None}},
+    {"text": 'with "quotes" and\nnewlines', "key with spaces": 3, "texts": [{"x": 1}]},
+]
+
+
+@pytest.mark.parametrize(
+    "jq_pattern, expected_type",
+    [
+        (".", SimplePathPattern),
+        (".text", SimplePathPattern),
+        (".meta.source", SimplePathPattern),
+        (".meta.tags[1]", SimplePathPattern),
+        (".texts[0]", SimplePathPattern),
+        (".texts[-1]", SimplePathPattern),
+        (".texts[5]", SimplePathPattern),
+        (".meta.tags.[0]", SimplePathPattern),
+        ('."key with spaces"', SimplePathPattern),
+        ('.["key with spaces"]', SimplePathPattern),
+        (".missing.field", SimplePathPattern),
+        (".text | length", JqPattern),
+        (".texts | length", JqPattern),
+        ('.meta.source // "unknown"', JqPattern),
+        ("[.text]", JqPattern),
+    ],
+)
+def test_compiled_pattern_matches_jq(jq_pattern: str, expected_type: type):
+    compiled_pattern = compile_jq_pattern(jq_pattern)
+    assert isinstance(compiled_pattern, expected_type)
+    jq_filter = jq.compile(jq_pattern)
+    for document in DOCUMENTS:
+        line = json.dumps(document)
+        assert compiled_pattern.first(line) == jq_filter.input_text(line).first()
+
+
+@pytest.mark.parametrize("jq_pattern", [".text.foo", ".text[0]", ".meta[0]"])
+def test_simple_path_pattern_raises_like_jq(jq_pattern: str):
+    line = json.dumps(DOCUMENTS[0])
+    with pytest.raises(ValueError):
+        jq.compile(jq_pattern).input_text(line).first()
+    with pytest.raises(ValueError):
+        compile_jq_pattern(jq_pattern).first(line)
+
+
+@pytest.mark.parametrize("jq_pattern", [".meta.source", ".text | length"])
+def test_compiled_pattern_can_be_pickled(jq_pattern: str):
+    line = json.dumps(DOCUMENTS[0])
+    unpickled_pattern = pickle.loads(pickle.dumps(compile_jq_pattern(jq_pattern)))
+    assert unpickled_pattern.first(line) == jq.compile(jq_pattern).input_text(line).first()
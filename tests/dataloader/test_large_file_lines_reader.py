@@ -1,3 +1,4 @@
+import gzip
 import json
 import pickle
 import tempfile
@@ -7,7 +8,7 @@ from pathlib import Path
 import pytest
 
 from modalities.dataloader.create_index import IndexGenerator
-from modalities.dataloader.large_file_lines_reader import LargeFileLinesReader
+from modalities.dataloader.large_file_lines_reader import LargeFileLinesReader, StreamingLinesReader
 
 
 def create_dummy_data(tmpdir_path: Path, content: str) -> Path:
@@ -67,3 +68,41 @@ def test_large_file_lines_reader_missing_source_data(tmpdir, dummy_data_path):
     assert not raw_data_path.exists()
     with pytest.raises(FileNotFoundError):
         LargeFileLinesReader(raw_data_path, dummy_data_path.index_path)
+
+
+def _write_shards(tmpdir_path: Path, lines: list, num_shards: int, suffix: str) -> list:
+    shard_paths = []
+    for shard_id in range(num_shards):
+        content = "".join(line + "\n" for line in lines[shard_id::num_shards]).encode("utf-8")
+        shard_path = Path(tmpdir_path, f"shard_{shard_id}.jsonl{suffix}")
+        if suffix == ".gz":
+            content = gzip.compress(content)
+        elif suffix == ".zst":
+            content = pytest.importorskip("zstandard").ZstdCompressor().compress(content)
+        shard_path.write_bytes(content)
+        shard_paths.append(shard_path)
+    return shard_paths
+
+
+@pytest.mark.parametrize("suffix", ["", ".gz", ".zst"])
+@pytest.mark.parametrize("num_decompression_threads, lines_per_chunk", [(1, 1), (2, 3), (8, 1024)])
+def test_streaming_lines_reader(tmpdir, suffix: str, num_decompression_threads: int, lines_per_chunk: int):
+    lines = [json.dumps({"text": f"line {i} with ünicode"}) for i in range(50)]
+    shard_paths = _write_shards(Path(tmpdir), lines, num_shards=5, suffix=suffix)
+    reader = StreamingLinesReader(
+        shard_paths,
+        num_decompression_threads=num_decompression_threads,
+        lines_per_chunk=lines_per_chunk,
+        max_buffered_chunks_per_file=2,
+    )
+    expected_lines = [line for shard_id in range(5) for line in lines[shard_id::5]]
+    assert list(reader) == expected_lines
+    # the reader can be iterated multiple times and stopped early
+    assert next(iter(reader)) == expected_lines[0]
+
+
+def test_streaming_lines_reader_raises_decompression_errors(tmpdir):
+    shard_paths = _write_shards(Path(tmpdir), ["{}"] * 10, num_shards=2, suffix=".gz")
+    shard_paths[1].write_bytes(b"not gzip compressed")
+    with pytest.raises(gzip.BadGzipFile):
+        list(StreamingLinesReader(shard_paths, num_decompression_threads=2))
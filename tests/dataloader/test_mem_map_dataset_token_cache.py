@@ -0,0 +1,89 @@
+import multiprocessing
+import pickle
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from modalities.dataloader.dataset import MemMapDataset
+from modalities.dataloader.token_cache import TokenCache
+
+
+def _get_dataset(indexed_dummy_data_path, tokenizer, token_cache_dir=None) -> MemMapDataset:
+    return MemMapDataset(
+        raw_data_path=indexed_dummy_data_path.raw_data_path,
+        tokenizer=tokenizer,
+        sample_key="input_ids",
+        index_path=indexed_dummy_data_path.index_path,
+        token_cache_dir=token_cache_dir,
+    )
+
+
+def test_token_cache_returns_tokenized_samples(indexed_dummy_data_path, wrapped_gpt2_tokenizer, tmpdir):
+    dataset = _get_dataset(indexed_dummy_data_path, wrapped_gpt2_tokenizer)
+    cached_dataset = _get_dataset(indexed_dummy_data_path, wrapped_gpt2_tokenizer, token_cache_dir=Path(tmpdir))
+    # the first access fills the cache, the second one reads from it
+    for _ in range(2):
+        for idx in [3, 0, len(dataset) - 1, 1]:
+            tokens, cached_tokens = dataset[idx], cached_dataset[idx]
+            # the samples are of the same type with and without the cache
+            assert tokens.dtype == cached_tokens.dtype == TokenCache.TOKEN_DTYPE
+            np.testing.assert_array_equal(cached_tokens, tokens)
+
+    # a new dataset instance reads the persisted cache without tokenizing
+    cached_dataset = _get_dataset(indexed_dummy_data_path, wrapped_gpt2_tokenizer, token_cache_dir=Path(tmpdir))
+    cached_dataset.tokenizer = None
+    np.testing.assert_array_equal(cached_dataset[3], dataset[3])
+    # the cache can be pickled without its memory maps
+    unpickled_token_cache = pickle.loads(pickle.dumps(cached_dataset.token_cache))
+    assert unpickled_token_cache._entries is None
+    np.testing.assert_array_equal(unpickled_token_cache.get(0), dataset[0])
+
+
+def test_token_cache_samples_can_be_embedded(indexed_dummy_data_path, wrapped_gpt2_tokenizer, tmpdir):
+    dataset = _get_dataset(indexed_dummy_data_path, wrapped_gpt2_tokenizer)
+    cached_dataset = _get_dataset(indexed_dummy_data_path, wrapped_gpt2_tokenizer, token_cache_dir=Path(tmpdir))
+    embedding = torch.nn.Embedding(wrapped_gpt2_tokenizer.vocab_size, 4)
+    # the first access is a cache miss, the second one a cache hit
+    for tokens in [dataset[0], cached_dataset[0], cached_dataset[0]]:
+        embeddings = embedding(torch.as_tensor(tokens))
+        assert embeddings.shape == (len(tokens), 4)
+
+
+def test_token_cache_dir_depends_on_jq_pattern(indexed_dummy_data_path, wrapped_gpt2_tokenizer, tmpdir):
+    cache_dirs = [
+        TokenCache.get_cache_dir(
+            Path(tmpdir),
+            raw_data_path=indexed_dummy_data_path.raw_data_path,
+            num_samples=10,
+            jq_pattern=jq_pattern,
+            tokenizer=wrapped_gpt2_tokenizer,
+        )
+        for jq_pattern in [".text", ".text", ".other"]
+    ]
+    assert cache_dirs[0] == cache_dirs[1] != cache_dirs[2]
+
+
+def _fill_cache(cache_dir: Path, num_samples: int, worker_id: int):
+    cache = TokenCache(cache_dir, num_samples=num_samples)
+    # all workers write all samples in different orders
+    for idx in np.random.default_rng(worker_id).permutation(num_samples):
+        cache.put(int(idx), list(range(idx)))
+
+
+def test_token_cache_concurrent_filling(tmpdir):
+    num_samples = 50
+    cache_dir = Path(tmpdir, "cache")
+    ctx = multiprocessing.get_context("fork")
+    processes = [ctx.Process(target=_fill_cache, args=(cache_dir, num_samples, i)) for i in range(4)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+        assert p.exitcode == 0
+
+    cache = TokenCache(cache_dir, num_samples=num_samples)
+    for idx in range(num_samples):
+        assert cache.get(idx).tolist() == list(range(idx))
+    # every sample was written exactly once
+    assert cache.tokens_path.stat().st_size == sum(range(num_samples)) * TokenCache.TOKEN_DTYPE.itemsize
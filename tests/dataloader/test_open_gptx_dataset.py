@@ -0,0 +1,127 @@
+import os
+import pickle
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+
+from modalities.dataloader.open_gptx_dataset.mmap_dataset import make_builder
+from modalities.dataloader.open_gptx_dataset.open_gptx_dataset import (
+    OpenGPTXMMapDataset,
+    _build_sample_idx_loop,
+    build_doc_idx,
+    build_sample_idx,
+    get_num_epochs,
+    get_num_tokens_per_epoch,
+    prebuild_index_mappings,
+)
+from tests.conftest import run_on_cpu_ranks
+
+
+@pytest.fixture
+def open_gptx_dataset_path(tmp_path: Path) -> Path:
+    builder = make_builder(out_file=str(tmp_path / "data.bin"), dtype=np.uint16)
+    for document_length in [7, 3, 12, 5, 9]:
+        builder.add_item(torch.arange(document_length))
+        builder.end_document()
+    builder.finalize(str(tmp_path / "data.idx"))
+    return tmp_path / "data.bin"
+
+
+def _load_dataset(path: Path) -> int:
+    dataset = OpenGPTXMMapDataset(sample_key="input_ids", path=path, sequence_len=4, num_samples=20)
+    return len(dataset)
+
+
+@pytest.mark.parametrize(
+    "num_documents, max_document_size, sequence_len, num_samples, separate_last_epoch",
+    [
+        (1, 100, 10, 5, False),
+        (50, 20, 8, 30, False),
+        (50, 20, 8, 300, True),
+        (100, 3, 16, 100, False),  # samples span many documents
+        (20, 500, 7, 1000, True),  # documents span many samples
+    ],
+)
+def test_build_sample_idx_matches_loop_implementation(
+    num_documents, max_document_size, sequence_len, num_samples, separate_last_epoch
+):
+    np_rng = np.random.RandomState(seed=0)
+    # documents of size 0 are skipped in both implementations
+    sizes = np_rng.randint(0, max_document_size + 1, size=num_documents).astype(np.int32)
+    sizes[0] = max_document_size
+    documents = np.arange(num_documents)
+    tokens_per_epoch = get_num_tokens_per_epoch(documents=documents, sizes=sizes)
+    num_epochs = get_num_epochs(
+        num_tokens_per_epoch=tokens_per_epoch, sequence_len=sequence_len, num_samples=num_samples
+    )
+    doc_idx = build_doc_idx(documents, num_epochs, np_rng, separate_last_epoch)
+
+    sample_idx_kwargs = dict(
+        sizes=sizes,
+        doc_idx=doc_idx,
+        seq_length=sequence_len,
+        num_epochs=num_epochs,
+        tokens_per_epoch=tokens_per_epoch,
+    )
+    sample_idx = build_sample_idx(**sample_idx_kwargs)
+    expected_sample_idx = _build_sample_idx_loop(**sample_idx_kwargs)
+
+    assert sample_idx.dtype == expected_sample_idx.dtype == np.int32
+    np.testing.assert_array_equal(sample_idx, expected_sample_idx)
+
+
+def test_build_doc_idx_is_shuffled_per_epoch_group():
+    documents = np.arange(10)
+    doc_idx = build_doc_idx(documents, num_epochs=3, np_rng=np.random.RandomState(seed=0), separate_last_epoch=True)
+    assert doc_idx.dtype == np.int32
+    assert len(doc_idx) == 30
+    # the last epoch is shuffled separately and therefore contains every document exactly once
+    np.testing.assert_array_equal(np.sort(doc_idx[20:]), documents)
+    np.testing.assert_array_equal(np.sort(doc_idx[:20]), np.repeat(documents, 2))
+
+
+def test_prebuilt_index_mappings_are_loaded_memory_mapped(open_gptx_dataset_path: Path):
+    index_mapping_filenames = prebuild_index_mappings(path=open_gptx_dataset_path, sequence_len=4, num_samples=20)
+    modification_times = [os.path.getmtime(filename) for filename in index_mapping_filenames]
+    # no temporary files are left behind
+    assert list(open_gptx_dataset_path.parent.glob("*.tmp")) == []
+
+    dataset = OpenGPTXMMapDataset(sample_key="input_ids", path=open_gptx_dataset_path, sequence_len=4, num_samples=20)
+    assert dataset.index_mapping_filenames == index_mapping_filenames
+    assert [os.path.getmtime(filename) for filename in index_mapping_filenames] == modification_times
+    for index_mapping in [dataset.doc_idx, dataset.sample_idx, dataset.shuffle_idx]:
+        assert isinstance(index_mapping, np.memmap)
+        assert not index_mapping.flags.writeable
+    assert all(len(dataset[i]["input_ids"]) == 5 for i in range(len(dataset)))
+
+    # dataloader workers memory-map the index mappings again instead of receiving copies
+    unpickled_dataset = pickle.loads(pickle.dumps(dataset))
+    assert isinstance(unpickled_dataset.sample_idx, np.memmap)
+    np.testing.assert_array_equal(unpickled_dataset[3]["input_ids"], dataset[3]["input_ids"])
+
+    # different parameters result in a different cache entry
+    other_dataset = OpenGPTXMMapDataset(
+        sample_key="input_ids", path=open_gptx_dataset_path, sequence_len=4, num_samples=20, seed=1
+    )
+    assert set(other_dataset.index_mapping_filenames).isdisjoint(index_mapping_filenames)
+
+
+def test_index_mappings_are_built_once_by_concurrent_processes(open_gptx_dataset_path: Path):
+    with get_context("spawn").Pool(processes=2) as pool:
+        dataset_lengths = pool.map(_load_dataset, [open_gptx_dataset_path] * 2)
+    assert len(set(dataset_lengths)) == 1
+    assert len(list(open_gptx_dataset_path.parent.glob("*_doc_idx.npy"))) == 1
+    assert len(list(open_gptx_dataset_path.parent.glob("*.tmp"))) == 0
+
+
+def _check_index_mappings_are_built_by_distributed_ranks(path: Path):
+    # all ranks build or wait for the index mappings and meet at the barrier afterwards
+    assert _load_dataset(path) > 0
+    assert len(list(path.parent.glob("*_doc_idx.npy"))) == 1
+
+
+def test_index_mappings_are_built_by_distributed_ranks(open_gptx_dataset_path: Path):
+    run_on_cpu_ranks(_check_index_mappings_are_built_by_distributed_ranks, 2, open_gptx_dataset_path)
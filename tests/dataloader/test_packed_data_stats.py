@@ -0,0 +1,59 @@
+from pathlib import Path
+
+import numpy as np
+
+from modalities.dataloader.create_packed_data import PackedDataGenerator
+from modalities.dataloader.dataset import PackedMemMapDatasetBase
+from modalities.dataloader.packed_data_stats import (
+    PackedDataStatsCollector,
+    load_packed_data_stats,
+    load_token_frequencies,
+)
+from modalities.utils.number_conversion import NumberConversion
+
+
+def test_stats_collector(tmpdir):
+    documents = [[1, 2, 3], [4], [5, 5, 5, 5, 5, 5, 5, 5], [1, 300]]
+    collector = PackedDataStatsCollector(token_size_in_bytes=2, vocab_size=10, token_buffer_size=4)
+    for document in documents:
+        collector.add_document(np.asarray(document, dtype="<u2").tobytes())
+    pbin_path = Path(tmpdir, "data.pbin")
+    collector.save(pbin_path)
+
+    stats = load_packed_data_stats(pbin_path)
+    assert stats["num_documents"] == 4
+    assert stats["num_tokens"] == 14
+    assert stats["min_document_length"] == 1
+    assert stats["max_document_length"] == 8
+    # bins [1, 2), [2, 4), [4, 8), [8, 16)
+    assert stats["document_length_histogram"]["counts"] == [1, 2, 0, 1]
+    token_frequencies = load_token_frequencies(pbin_path)
+    assert len(token_frequencies) == 301
+    assert token_frequencies.tolist() == np.bincount(np.concatenate(documents)).tolist()
+
+
+def test_packed_data_generator_writes_stats(indexed_dummy_data_path_long, wrapped_gpt2_tokenizer):
+    packed_generator = PackedDataGenerator(
+        src_path=indexed_dummy_data_path_long.raw_data_path,
+        tokenizer=wrapped_gpt2_tokenizer,
+        number_of_processes=2,
+        eod_token="<|endoftext|>",
+        index_path=indexed_dummy_data_path_long.index_path,
+        jq_pattern=".text",
+        processing_batch_size=5,
+        raw_samples_queue_size=3,
+        processed_samples_queue_size=3,
+    )
+    pbin_path = packed_generator._default_destination_path()
+    packed_generator.run()
+
+    packed_dataset = PackedMemMapDatasetBase(pbin_path, sample_key="input_ids")
+    all_tokens = np.concatenate([sample["input_ids"] for sample in packed_dataset])
+    stats = load_packed_data_stats(pbin_path)
+    assert stats["num_documents"] == len(packed_dataset)
+    assert stats["num_tokens"] == len(all_tokens)
+    assert stats["data_len"] == packed_dataset._embedded_stream_data.data_len
+    assert sum(stats["document_length_histogram"]["counts"]) == len(packed_dataset)
+    token_frequencies = load_token_frequencies(pbin_path)
+    assert token_frequencies.tolist() == np.bincount(all_tokens, minlength=len(token_frequencies)).tolist()
+    assert NumberConversion.get_num_tokens_from_packed_data(pbin_path) == len(all_tokens)
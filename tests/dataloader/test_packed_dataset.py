@@ -1,9 +1,15 @@
+import gzip
 import json
 from pathlib import Path
 
 import pytest
 
-from modalities.dataloader.create_packed_data import EmbeddedStreamData, PackedDataGenerator, join_embedded_stream_data
+from modalities.dataloader.create_packed_data import (
+    EmbeddedStreamData,
+    PackedDataGenerator,
+    create_virtual_pbin,
+    join_embedded_stream_data,
+)
 from modalities.dataloader.dataset import (
     PackedMemMapDatasetBase,
     PackedMemMapDatasetContinuous,
@@ -84,6 +90,20 @@ def test_packed_continuous_dataset_loading(dummy_packed_data_path, block_size, e
     assert retrieved_input_ids == expected_output
 
 
+def test_packed_continuous_dataset_document_ids(dummy_packed_data_path):
+    # the dummy data contains 4 documents with 6, 10, 3 and 1 tokens
+    ds = PackedMemMapDatasetContinuous(
+        raw_data_path=dummy_packed_data_path, block_size=6, sample_key="input_ids", document_id_key="document_ids"
+    )
+    retrieved_document_ids = [packed_samples["document_ids"].tolist() for packed_samples in ds]
+    assert retrieved_document_ids == [[0, 0, 0, 0, 0, 0], [0, 1, 1, 1, 1, 1], [0, 0, 0, 0, 0, 0]]
+
+    collator = GPT2LLMCollateFn(sample_key="input_ids", target_key="target_ids", document_id_key="document_ids")
+    batch = collator([ds[0], ds[1]])
+    assert batch.samples["document_ids"].tolist() == [[0, 0, 0, 0, 0], [0, 1, 1, 1, 1]]
+    assert batch.samples["document_ids"].shape == batch.samples["input_ids"].shape
+
+
 def test_packed_continuous_dataset_missing_file(dummy_packed_data_path):
     dummy_packed_data_path.unlink(missing_ok=True)
     with pytest.raises(FileNotFoundError):
@@ -194,6 +214,58 @@ def test_join_packed_datasets(dummy_packed_data_path, tmpdir):
     assert loaded_dataset_flattened == original_datasets_concatenated
 
 
+def test_join_packed_datasets_index_offsets(dummy_packed_data_path, tmpdir):
+    packed_data_clones = [Path(tmpdir, f"clone{i}.pbin") for i in range(3)]
+    for clone in packed_data_clones:
+        clone.write_bytes(dummy_packed_data_path.read_bytes())
+    joined_target_file = Path(tmpdir, "joined.pbin")
+    join_embedded_stream_data(list(map(EmbeddedStreamData, packed_data_clones)), joined_target_file, chunk_size=7)
+
+    original_dataset = PackedMemMapDatasetBase(dummy_packed_data_path, sample_key="input_ids")
+    joined_dataset = PackedMemMapDatasetBase(joined_target_file, sample_key="input_ids")
+    assert len(joined_dataset) == 3 * len(original_dataset)
+    for idx in range(len(joined_dataset)):
+        expected = original_dataset[idx % len(original_dataset)]["input_ids"]
+        assert joined_dataset[idx]["input_ids"].tolist() == expected.tolist()
+
+
+@pytest.mark.parametrize("block_size", [2, 3, 7, 20, 45])
+def test_virtual_pbin_equals_joined_pbin(dummy_packed_data_path, tmpdir, block_size: int):
+    member_dir = Path(tmpdir, "members")
+    member_dir.mkdir()
+    packed_data_clones = [Path(member_dir, f"clone{i}.pbin") for i in range(3)]
+    for clone in packed_data_clones:
+        clone.write_bytes(dummy_packed_data_path.read_bytes())
+
+    joined_target_file = Path(tmpdir, "joined.pbin")
+    join_embedded_stream_data(list(map(EmbeddedStreamData, packed_data_clones)), joined_target_file)
+    virtual_target_file = Path(tmpdir, "virtual.vpbin")
+    create_virtual_pbin(packed_data_clones, virtual_target_file)
+
+    for dataset_type in [PackedMemMapDatasetBase, PackedMemMapDatasetContinuous]:
+        kwargs = {}
+        if dataset_type is PackedMemMapDatasetContinuous:
+            kwargs = dict(block_size=block_size, document_id_key="document_ids")
+        joined_dataset = dataset_type(joined_target_file, sample_key="input_ids", **kwargs)
+        virtual_dataset = dataset_type(virtual_target_file, sample_key="input_ids", **kwargs)
+        assert len(virtual_dataset) == len(joined_dataset)
+        for joined_sample, virtual_sample in zip(joined_dataset, virtual_dataset):
+            assert virtual_sample.keys() == joined_sample.keys()
+            for key in joined_sample.keys():
+                assert virtual_sample[key].tolist() == joined_sample[key].tolist()
+
+
+def test_virtual_pbin_detects_modified_member(dummy_packed_data_path, tmpdir):
+    member = Path(tmpdir, "member.pbin")
+    member.write_bytes(dummy_packed_data_path.read_bytes())
+    virtual_target_file = Path(tmpdir, "virtual.vpbin")
+    create_virtual_pbin([member], virtual_target_file)
+    member.unlink()
+    join_embedded_stream_data([EmbeddedStreamData(dummy_packed_data_path)] * 2, member)
+    with pytest.raises(ValueError):
+        PackedMemMapDatasetBase(virtual_target_file, sample_key="input_ids")
+
+
 @pytest.mark.parametrize("token_size_in_bytes", [1, 2, 4])
 def test_conversion_tokens_represented_as_unsigned_ints(tmpdir, token_size_in_bytes: int):
     src_pbin_path = Path(__file__).parents[2] / "data/lorem_ipsum.pbin"
@@ -241,3 +313,35 @@ def test_original_samples_in_packed_dataset(indexed_dummy_data_path_long, wrappe
 
     for sample, original_sample in zip(packed_dataset, jsonl_tokenized):
         assert sample["input_ids"].tolist() == original_sample
+
+
+def test_packed_data_generator_streams_compressed_shards(indexed_dummy_data_path_long, wrapped_gpt2_tokenizer):
+    generator_kwargs = dict(
+        tokenizer=wrapped_gpt2_tokenizer,
+        number_of_processes=2,
+        eod_token="<|endoftext|>",
+        jq_pattern=".text",
+        processing_batch_size=5,
+        raw_samples_queue_size=3,
+        processed_samples_queue_size=3,
+    )
+    raw_data_path = indexed_dummy_data_path_long.raw_data_path
+    indexed_packed_path = raw_data_path.with_suffix(".indexed.pbin")
+    PackedDataGenerator(
+        src_path=raw_data_path, index_path=indexed_dummy_data_path_long.index_path, **generator_kwargs
+    ).run(indexed_packed_path)
+
+    lines = raw_data_path.read_text().splitlines(keepends=True)
+    shard_paths = []
+    for shard_id, start in enumerate(range(0, len(lines), 150)):
+        shard_path = raw_data_path.parent / f"shard_{shard_id}.jsonl.gz"
+        shard_path.write_bytes(gzip.compress("".join(lines[start : start + 150]).encode("utf-8")))
+        shard_paths.append(shard_path)
+    streamed_packed_path = raw_data_path.with_suffix(".streamed.pbin")
+    PackedDataGenerator(src_path=shard_paths, num_decompression_threads=2, **generator_kwargs).run(streamed_packed_path)
+
+    indexed_dataset = PackedMemMapDatasetBase(indexed_packed_path, sample_key="input_ids")
+    streamed_dataset = PackedMemMapDatasetBase(streamed_packed_path, sample_key="input_ids")
+    assert len(streamed_dataset) == len(indexed_dataset) == len(lines)
+    for indexed_sample, streamed_sample in zip(indexed_dataset, streamed_dataset):
+        assert streamed_sample["input_ids"].tolist() == indexed_sample["input_ids"].tolist()
@@ -0,0 +1,90 @@
+import gzip
+import json
+from pathlib import Path
+
+import pytest
+
+from modalities.dataloader.create_packed_data import PackedDataGenerator
+from modalities.dataloader.dataset import PackedMemMapDatasetBase
+from modalities.dataloader.sharded_packing import ShardedPackedDataGenerator, ShardMergeType
+
+GENERATOR_KWARGS = dict(
+    eod_token="<|endoftext|>",
+    jq_pattern=".text",
+    processing_batch_size=5,
+    raw_samples_queue_size=3,
+    processed_samples_queue_size=3,
+)
+
+
+def _write_shards(raw_data_path: Path, shard_dir: Path, num_lines_per_shard: int) -> list:
+    shard_dir.mkdir()
+    lines = raw_data_path.read_text().splitlines(keepends=True)
+    shard_paths = []
+    for shard_id, start in enumerate(range(0, len(lines), num_lines_per_shard)):
+        content = "".join(lines[start : start + num_lines_per_shard])
+        # mix compressed and uncompressed shards
+        if shard_id % 2 == 0:
+            shard_path = shard_dir / f"part_{shard_id}.jsonl.gz"
+            shard_path.write_bytes(gzip.compress(content.encode("utf-8")))
+        else:
+            shard_path = shard_dir / f"part_{shard_id}.jsonl"
+            shard_path.write_text(content)
+        shard_paths.append(shard_path)
+    return shard_paths
+
+
+@pytest.mark.parametrize("merge_type", [ShardMergeType.VIRTUAL, ShardMergeType.PHYSICAL])
+def test_sharded_packing(indexed_dummy_data_path_long, wrapped_gpt2_tokenizer, tmpdir, merge_type: ShardMergeType):
+    raw_data_path = indexed_dummy_data_path_long.raw_data_path
+    reference_path = Path(tmpdir, "reference.pbin")
+    PackedDataGenerator(
+        src_path=raw_data_path,
+        index_path=indexed_dummy_data_path_long.index_path,
+        tokenizer=wrapped_gpt2_tokenizer,
+        number_of_processes=2,
+        **GENERATOR_KWARGS,
+    ).run(reference_path)
+    reference_dataset = PackedMemMapDatasetBase(reference_path, sample_key="input_ids")
+
+    shard_paths = _write_shards(raw_data_path, Path(tmpdir, "shards"), num_lines_per_shard=120)
+    dst_dir = Path(tmpdir, "packed")
+    generator = ShardedPackedDataGenerator(
+        src_paths=shard_paths,
+        dst_dir=dst_dir,
+        tokenizer=wrapped_gpt2_tokenizer,
+        num_cpus=4,
+        num_parallel_shards=2,
+        **GENERATOR_KWARGS,
+    )
+    manifest_path = generator.run(merge_type=merge_type)
+
+    with manifest_path.open() as f:
+        manifest = json.load(f)
+    assert len(manifest["shards"]) == len(shard_paths)
+    assert manifest["num_documents"] == len(reference_dataset)
+    assert manifest["num_tokens"] == sum(len(sample["input_ids"]) for sample in reference_dataset)
+    num_lines = len(raw_data_path.read_text().splitlines())
+    for shard_id, (shard, shard_path) in enumerate(zip(manifest["shards"], shard_paths)):
+        assert shard["src_path"] == str(shard_path.absolute())
+        shard_dataset = PackedMemMapDatasetBase(dst_dir / shard["pbin_path"], sample_key="input_ids")
+        assert len(shard_dataset) == shard["num_documents"] == min(120, num_lines - 120 * shard_id)
+
+    merged_dataset = PackedMemMapDatasetBase(dst_dir / manifest["merged_path"], sample_key="input_ids")
+    assert len(merged_dataset) == len(reference_dataset)
+    for merged_sample, reference_sample in zip(merged_dataset, reference_dataset):
+        assert merged_sample["input_ids"].tolist() == reference_sample["input_ids"].tolist()
+
+
+def test_sharded_packing_raises_for_failed_shard(wrapped_gpt2_tokenizer, tmpdir):
+    broken_shard = Path(tmpdir, "broken.jsonl.gz")
+    broken_shard.write_bytes(b"not gzip compressed")
+    generator = ShardedPackedDataGenerator(
+        src_paths=[broken_shard],
+        dst_dir=Path(tmpdir, "packed"),
+        tokenizer=wrapped_gpt2_tokenizer,
+        num_cpus=1,
+        **GENERATOR_KWARGS,
+    )
+    with pytest.raises(RuntimeError):
+        generator.run()
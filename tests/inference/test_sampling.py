@@ -0,0 +1,76 @@
+import pytest
+import torch
+
+from modalities.inference.text.sampling import TokenSampler
+
+# probabilities 0.5, 0.3, 0.15, 0.05 followed by a long tail of tokens with a negligible probability
+PROBS = torch.tensor([0.5, 0.3, 0.15, 0.05])
+
+
+def _create_logits(batch_size: int, vocab_size: int = 1000) -> torch.Tensor:
+    logits = torch.full((vocab_size,), -1e4)
+    # the tokens are shuffled, such that the candidates are not the first token ids
+    logits[torch.tensor([17, 3, 512, 999])] = PROBS.log()
+    return logits.expand(batch_size, vocab_size).clone()
+
+
+def _sample_token_ids(sampler: TokenSampler, logits: torch.Tensor) -> torch.Tensor:
+    return sampler(logits, generator=torch.Generator().manual_seed(0))
+
+
+@pytest.mark.parametrize("sampler", [TokenSampler(temperature=0), TokenSampler(top_k=1)])
+def test_greedy_sampling(sampler: TokenSampler):
+    logits = torch.randn(8, 100)
+    assert torch.equal(_sample_token_ids(sampler, logits), logits.argmax(dim=-1))
+
+
+@pytest.mark.parametrize("num_initial_candidates", [1, 2, 256])
+@pytest.mark.parametrize(
+    "sampler_kwargs, expected_token_ids",
+    [
+        (dict(), {17, 3, 512, 999}),
+        (dict(top_k=2), {17, 3}),
+        (dict(top_p=0.7), {17, 3}),
+        (dict(top_p=0.9), {17, 3, 512}),
+        (dict(min_p=0.25), {17, 3, 512}),
+        # top-p is computed on the renormalized top-k probabilities 0.53, 0.32 and 0.16
+        (dict(top_k=3, top_p=0.83), {17, 3}),
+        (dict(top_k=3, min_p=0.5), {17, 3}),
+    ],
+)
+def test_sampled_tokens_are_filtered(sampler_kwargs: dict, expected_token_ids: set, num_initial_candidates: int):
+    sampler = TokenSampler(**sampler_kwargs, num_initial_candidates=num_initial_candidates)
+    token_ids = _sample_token_ids(sampler, _create_logits(batch_size=2000))
+    assert set(token_ids.tolist()) == expected_token_ids
+
+
+def test_sampling_matches_the_filtered_distribution():
+    token_ids = _sample_token_ids(TokenSampler(top_p=0.9), _create_logits(batch_size=20000))
+    frequencies = torch.tensor([(token_ids == token_id).float().mean() for token_id in [17, 3, 512]])
+    torch.testing.assert_close(frequencies, PROBS[:3] / PROBS[:3].sum(), rtol=0, atol=0.02)
+
+
+def test_per_sequence_parameters():
+    temperature, top_k, top_p = torch.tensor([0, 1, 1, 1]), torch.tensor([0, 1, 2, 0]), torch.tensor([1, 1, 1, 0.7])
+    sampler = TokenSampler(temperature=temperature.repeat(500), top_k=top_k.repeat(500), top_p=top_p.repeat(500))
+    logits = _create_logits(batch_size=2000)
+    token_ids = _sample_token_ids(sampler, logits).reshape(500, 4)
+    assert set(token_ids[:, 0].tolist()) == {17}
+    assert set(token_ids[:, 1].tolist()) == {17}
+    assert set(token_ids[:, 2].tolist()) == {17, 3}
+    assert set(token_ids[:, 3].tolist()) == {17, 3}
+
+
+def test_repetition_penalty():
+    logits = torch.tensor([[2.0, 1.9, -1.0, -1.1]])
+    prev_token_ids = torch.tensor([[0, 2]])
+    assert TokenSampler(temperature=0)(logits, prev_token_ids=prev_token_ids).item() == 0
+    # the penalized logits are 2.0 / 1.2 and -1.0 * 1.2
+    sampler = TokenSampler(temperature=0, repetition_penalty=1.2)
+    assert sampler(logits, prev_token_ids=prev_token_ids).item() == 1
+    assert sampler(-logits, prev_token_ids=prev_token_ids).item() == 3
+
+
+def test_sampler_raises_for_wrong_number_of_parameters():
+    with pytest.raises(ValueError):
+        TokenSampler(temperature=[1.0, 0.5])(torch.randn(3, 10))
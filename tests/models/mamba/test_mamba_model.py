@@ -2,8 +2,11 @@ import os
 
 import pytest
 import torch
+from torch import nn
 
+from modalities.inference.text.inference_component import TextInferenceComponent
 from modalities.models.mamba.mamba_model import _init_weights, create_block
+from modalities.models.mamba.utils.generation import decode
 
 
 @pytest.mark.skipif(
@@ -74,3 +77,64 @@ def test_tie_weights(mamba_llm):
     mamba_llm.tie_embeddings = True
     mamba_llm.tie_weights()
     assert (mamba_llm.lm_head.weight == mamba_llm.backbone.embedding.weight).all()
+
+
+@pytest.mark.parametrize("fused_add_norm", [False])
+def test_mamba_llm_decode_step_matches_forward(mamba_llm, batch_size, sequence_length, vocab_size, prediction_key):
+    mamba_llm.eval()
+    torch.manual_seed(0)
+    x = torch.randint(size=(batch_size, sequence_length), high=vocab_size)
+    with torch.no_grad():
+        expected_logits = mamba_llm({"input_ids": x})[prediction_key]
+        prompt_length = 5
+        decoding_state = mamba_llm.init_decoding_state(batch_size=batch_size, max_seqlen=sequence_length)
+        logits = [mamba_llm.decode_step(x[:, :prompt_length], decoding_state)]
+        for i in range(prompt_length, sequence_length):
+            logits.append(mamba_llm.decode_step(x[:, i : i + 1], decoding_state))
+    assert decoding_state.seqlen_offset == sequence_length
+    # the recurrent and the parallel scan only differ in the order of the float32 accumulation
+    torch.testing.assert_close(torch.stack(logits, dim=1), expected_logits[:, prompt_length - 1 :])
+
+
+@pytest.mark.parametrize("fused_add_norm", [False])
+def test_decode_with_mamba_llm_matches_greedy_recomputation(mamba_llm, batch_size, vocab_size, prediction_key):
+    mamba_llm.eval()
+    torch.manual_seed(0)
+    input_ids = torch.randint(size=(batch_size, 4), high=vocab_size)
+    sequences = decode(input_ids, mamba_llm, max_length=12)
+    expected_sequences = input_ids
+    with torch.no_grad():
+        while expected_sequences.shape[1] < 12:
+            logits = mamba_llm({"input_ids": expected_sequences})[prediction_key][:, -1]
+            expected_sequences = torch.cat([expected_sequences, logits.argmax(dim=-1, keepdim=True)], dim=1)
+    assert torch.equal(sequences.sequences, expected_sequences)
+
+
+class _FullRecomputationModel(nn.Module):
+    # hides the incremental decoding interface of the wrapped model
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, inputs):
+        return self.model(inputs)
+
+
+@pytest.mark.parametrize("fused_add_norm", [False])
+@pytest.mark.parametrize("vocab_size", [50304])
+def test_text_inference_component_decodes_mamba_llm_incrementally(mamba_llm, wrapped_gpt2_tokenizer, capsys):
+    generated_texts = []
+    for model in [mamba_llm, _FullRecomputationModel(mamba_llm)]:
+        component = TextInferenceComponent(
+            model=model,
+            tokenizer=wrapped_gpt2_tokenizer,
+            prompt_template="",
+            sequence_length=24,
+            temperature=0,
+            eod_token="<|endoftext|>",
+            device=torch.device("cpu"),
+        )
+        component.generate_tokens(context="The quick brown fox")
+        generated_texts.append(capsys.readouterr().out)
+    assert "OUTPUT" in generated_texts[0]
+    assert generated_texts[0] == generated_texts[1]
@@ -0,0 +1,112 @@
+from typing import Callable
+
+import pytest
+import torch
+
+from modalities.models.mamba.ops.selective_scan_interface import (
+    selective_scan_chunked,
+    selective_scan_fn,
+    selective_scan_ref,
+)
+
+
+def _create_inputs(batch: int, dim: int, dstate: int, seqlen: int, B_shape: str, is_complex: bool) -> dict:
+    torch.manual_seed(0)
+    A = -torch.rand(dim, dstate) * 8
+    if is_complex:
+        A = torch.complex(A, torch.randn(dim, dstate))
+    # variable B and C are real tensors, which hold the real and imaginary parts for a complex A
+    variable_seqlen = 2 * seqlen if is_complex else seqlen
+    if B_shape == "constant":
+        B = torch.randn(dim, dstate, dtype=A.dtype)
+    elif B_shape == "variable":
+        B = torch.randn(batch, dstate, variable_seqlen)
+    else:
+        B = torch.randn(batch, 2, dstate, variable_seqlen)
+    return dict(
+        u=torch.randn(batch, dim, seqlen),
+        delta=torch.randn(batch, dim, seqlen),
+        A=A,
+        B=B,
+        C=torch.randn(batch, dstate, variable_seqlen),
+        D=torch.randn(dim),
+        z=torch.randn(batch, dim, seqlen),
+        delta_bias=torch.rand(dim),
+        delta_softplus=True,
+    )
+
+
+@pytest.mark.parametrize("B_shape", ["constant", "variable", "grouped"])
+@pytest.mark.parametrize("is_complex", [False, True])
+@pytest.mark.parametrize("seqlen, chunk_size", [(1, 64), (37, 8), (100, 64), (128, 16), (50, 1)])
+def test_selective_scan_chunked_matches_reference(seqlen: int, chunk_size: int, B_shape: str, is_complex: bool):
+    inputs = _create_inputs(batch=2, dim=4, dstate=3, seqlen=seqlen, B_shape=B_shape, is_complex=is_complex)
+    out_ref, last_state_ref = selective_scan_ref(**inputs, return_last_state=True)
+    out, last_state = selective_scan_chunked(**inputs, return_last_state=True, chunk_size=chunk_size)
+    assert out.shape == out_ref.shape
+    torch.testing.assert_close(out, out_ref, rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(last_state, last_state_ref, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("B_shape", ["constant", "variable", "grouped"])
+@pytest.mark.parametrize("is_complex", [False, True])
+def test_selective_scan_chunked_gradients_match_reference(B_shape: str, is_complex: bool):
+    inputs = _create_inputs(batch=2, dim=4, dstate=3, seqlen=45, B_shape=B_shape, is_complex=is_complex)
+    grads = []
+    for scan_fun in [selective_scan_ref, lambda **kwargs: selective_scan_chunked(**kwargs, chunk_size=16)]:
+        leaves = {key: value.clone().requires_grad_() for key, value in inputs.items() if torch.is_tensor(value)}
+        out, last_state = scan_fun(**{**inputs, **leaves}, return_last_state=True)
+        (out.sum() + last_state.abs().sum()).backward()
+        grads.append({key: value.grad for key, value in leaves.items()})
+    for key in grads[0]:
+        torch.testing.assert_close(grads[1][key], grads[0][key], rtol=1e-4, atol=1e-4)
+
+
+def _get_num_saved_bytes(scan_fun: Callable, inputs: dict) -> int:
+    leaves = {key: value.clone().requires_grad_() for key, value in inputs.items() if torch.is_tensor(value)}
+    num_saved_bytes = 0
+
+    def pack_hook(tensor: torch.Tensor) -> torch.Tensor:
+        nonlocal num_saved_bytes
+        num_saved_bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda tensor: tensor):
+        scan_fun(**{**inputs, **leaves})
+    return num_saved_bytes
+
+
+def test_selective_scan_chunked_saves_less_for_backward_than_reference():
+    inputs = _create_inputs(batch=2, dim=32, dstate=16, seqlen=512, B_shape="variable", is_complex=False)
+    num_saved_bytes_ref = _get_num_saved_bytes(selective_scan_ref, inputs)
+    num_saved_bytes = _get_num_saved_bytes(lambda **kwargs: selective_scan_chunked(**kwargs, chunk_size=16), inputs)
+    # the reference saves several tensors of the size of the states of all timesteps (2 * 32 * 16 * 512 floats),
+    # whereas the chunked scan saves only the inputs and the states at the 32 chunk boundaries
+    assert num_saved_bytes < 2 * 32 * 16 * 512 * 4
+    assert num_saved_bytes < num_saved_bytes_ref / 5
+
+
+def test_selective_scan_chunked_is_stable_for_strong_decays():
+    # the decays within a chunk underflow to zero, which must not lead to inf or nan values
+    inputs = _create_inputs(batch=1, dim=2, dstate=2, seqlen=256, B_shape="variable", is_complex=False)
+    inputs["delta"] = inputs["delta"].abs() * 100
+    out_ref = selective_scan_ref(**inputs)
+    out = selective_scan_chunked(**inputs, chunk_size=256)
+    assert torch.isfinite(out).all()
+    torch.testing.assert_close(out, out_ref, rtol=1e-4, atol=1e-4)
+
+
+def test_selective_scan_fn_falls_back_to_chunked_scan_on_cpu():
+    inputs = _create_inputs(batch=2, dim=4, dstate=3, seqlen=20, B_shape="variable", is_complex=False)
+    out, last_state = selective_scan_fn(**inputs, return_last_state=True)
+    out_ref, last_state_ref = selective_scan_ref(**inputs, return_last_state=True)
+    torch.testing.assert_close(out, out_ref, rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(last_state, last_state_ref, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("use_fast_path", [False])
+def test_mamba_block_forward_on_cpu(batch_size, sequence_length, d_model, mamba_block):
+    x = torch.randn(batch_size, sequence_length, d_model)
+    y = mamba_block(x)
+    assert y.shape == x.shape
+    assert torch.isfinite(y).all()
@@ -3,11 +3,23 @@ Note: test_attention_types_approximate_equality can print the output of differen
       To do so, turn on verbose and run 'pytest tests/models/test_causal_self_attention.py -s'
 """
 from copy import deepcopy
+from unittest.mock import patch
 
 import pytest
 import torch
 
-from modalities.models.gpt2.gpt2_model import AttentionConfig, CausalSelfAttention
+from modalities.models.gpt2.gpt2_model import (
+    AttentionConfig,
+    AttentionImplementation,
+    CausalSelfAttention,
+    DocumentAttentionMask,
+    PositionTypes,
+    fuse_qkv_optimizer_state_dict_keys,
+    get_cu_seqlens,
+    get_document_causal_mask,
+    get_position_ids_from_document_ids,
+)
+from tests.conftest import get_small_gpt2_model
 
 torch.manual_seed(0)
 
@@ -27,9 +39,7 @@ def _get_random_attention_layer(n_head_q, n_head_kv, n_embd, attention_impl, att
         attention_config=attention_config,
         attention_impl=attention_impl,
     ).cuda()
-    self_attention_layer.q_attn = self_attention_layer.q_attn.bfloat16()
-    self_attention_layer.k_attn = self_attention_layer.k_attn.bfloat16()
-    self_attention_layer.v_attn = self_attention_layer.v_attn.bfloat16()
+    self_attention_layer.qkv_attn = self_attention_layer.qkv_attn.bfloat16()
     self_attention_layer.c_proj = self_attention_layer.c_proj.bfloat16()
     return self_attention_layer
 
@@ -222,3 +232,180 @@ def test_attention_implementation_approximate_equality(
         atol=2.5e-3,  # default for bfloat16: 1e-5
         rtol=0.016,  # default for bfloat16: 0.016
     )
+
+
+@pytest.mark.parametrize("attention_impl", ["manual", "pytorch_flash"])
+@pytest.mark.parametrize("n_head_q, n_head_kv", [(4, 4), (4, 2)])
+def test_document_aware_attention_matches_separate_documents(attention_impl, n_head_q, n_head_kv):
+    # packing two documents into one sequence must yield the same outputs as processing them separately
+    n_embd = 32
+    document_lengths = [5, 4]
+    attention_config = AttentionConfig(
+        qkv_transforms=[
+            AttentionConfig.QueryKeyValueTransformConfig(
+                type_hint="RotaryTransform",
+                config=AttentionConfig.QueryKeyValueTransformConfig.RotaryTransformConfig(
+                    n_embd=n_embd, n_head=n_head_q, seq_length_dim=-2
+                ),
+            )
+        ]
+    )
+    attention_layer = CausalSelfAttention(
+        n_head_q=n_head_q,
+        n_head_kv=n_head_kv,
+        n_embd=n_embd,
+        bias=False,
+        dropout=0.0,
+        attention_config=attention_config,
+        attention_impl=attention_impl,
+    )
+    packed_input = torch.rand(1, sum(document_lengths), n_embd)
+    document_ids = torch.tensor([[0] * document_lengths[0] + [1] * document_lengths[1]])
+    position_ids = get_position_ids_from_document_ids(document_ids)
+    assert position_ids.tolist() == [[0, 1, 2, 3, 4, 0, 1, 2, 3]]
+
+    packed_output = attention_layer(packed_input, document_ids=document_ids, position_ids=position_ids)
+    separate_outputs = torch.cat(
+        [attention_layer(document) for document in packed_input.split(document_lengths, dim=1)], dim=1
+    )
+    torch.testing.assert_close(packed_output, separate_outputs)
+
+    # without document ids, the second document attends to the first one
+    unmasked_output = attention_layer(packed_input)
+    assert not torch.allclose(unmasked_output[:, document_lengths[0] :], separate_outputs[:, document_lengths[0] :])
+
+
+def test_get_cu_seqlens():
+    document_ids = torch.tensor([[0, 0, 1, 1, 1], [0, 1, 1, 1, 1]])
+    cu_seqlens, max_seqlen = get_cu_seqlens(document_ids)
+    assert cu_seqlens.tolist() == [0, 2, 5, 6, 10]
+    assert cu_seqlens.dtype == torch.int32
+    assert max_seqlen == 4
+
+
+def test_document_attention_mask_from_document_ids():
+    document_ids = torch.tensor([[0, 0, 1, 1, 1], [0, 1, 1, 1, 1]])
+    document_mask = DocumentAttentionMask.from_document_ids(document_ids, AttentionImplementation.MANUAL)
+    assert torch.equal(document_mask.attn_mask, get_document_causal_mask(document_ids))
+    assert document_mask.cu_seqlens is None
+
+    document_mask = DocumentAttentionMask.from_document_ids(document_ids, AttentionImplementation.DAO_FLASH)
+    assert document_mask.attn_mask is None
+    assert document_mask.cu_seqlens.tolist() == [0, 2, 5, 6, 10]
+    assert document_mask.max_seqlen == 4
+
+
+def test_gpt2_computes_the_document_mask_once_per_forward_pass():
+    model = get_small_gpt2_model(PositionTypes.NOPE, AttentionImplementation.MANUAL, n_layer=3)
+    document_ids = torch.tensor([[0] * 5 + [1] * 3, [0] * 8])
+    inputs = {"input_ids": torch.randint(0, 64, (2, 8)), "document_ids": document_ids}
+    with patch(
+        "modalities.models.gpt2.gpt2_model.get_document_causal_mask", wraps=get_document_causal_mask
+    ) as get_mask_mock:
+        model(inputs)
+    get_mask_mock.assert_called_once()
+
+
+@pytest.mark.parametrize("attention_impl", ["manual", "pytorch_flash"])
+@pytest.mark.parametrize("n_head_q, n_head_kv", [(4, 4), (4, 2), (8, 2), (8, 1)])
+@pytest.mark.parametrize("use_document_ids", [False, True])
+def test_grouped_query_attention_matches_repeated_key_value_heads(
+    attention_impl, n_head_q, n_head_kv, use_document_ids
+):
+    batch_size, seq_length, head_dim = 2, 9, 8
+    q = torch.rand(batch_size, n_head_q, seq_length, head_dim)
+    k = torch.rand(batch_size, n_head_kv, seq_length, head_dim)
+    v = torch.rand(batch_size, n_head_kv, seq_length, head_dim)
+    document_ids = torch.tensor([[0] * 4 + [1] * 5, [0] * 9]) if use_document_ids else None
+    document_mask = (
+        None if document_ids is None else DocumentAttentionMask.from_document_ids(document_ids, attention_impl)
+    )
+
+    out = CausalSelfAttention.execute_attention(
+        q, k, v, dropout=0.0, attention_impl=attention_impl, document_mask=document_mask
+    )
+
+    k_repeated, v_repeated = CausalSelfAttention.repeat_kv_heads(q, k, v)
+    attn_mask = None if document_ids is None else get_document_causal_mask(document_ids)
+    expected_out = torch.nn.functional.scaled_dot_product_attention(
+        q, k_repeated, v_repeated, attn_mask=attn_mask, is_causal=attn_mask is None
+    ).transpose(1, 2)
+    assert out.shape == (batch_size, seq_length, n_head_q, head_dim)
+    torch.testing.assert_close(out, expected_out)
+
+
+@pytest.mark.parametrize("bias", [False, True])
+@pytest.mark.parametrize("n_head_q, n_head_kv", [(4, 4), (4, 2)])
+def test_loading_unfused_qkv_state_dict(bias, n_head_q, n_head_kv):
+    n_embd = 32
+    attention_layer_args = dict(
+        n_head_q=n_head_q,
+        n_head_kv=n_head_kv,
+        n_embd=n_embd,
+        bias=bias,
+        dropout=0.0,
+        attention_config=AttentionConfig(qkv_transforms=[]),
+        attention_impl="manual",
+    )
+    attention_layer = CausalSelfAttention(**attention_layer_args)
+
+    # state dict in the legacy layout with separate query, key and value projections
+    kv_dim = n_embd * n_head_kv // n_head_q
+    legacy_state_dict = {}
+    for name, param in attention_layer.state_dict(prefix="attn.").items():
+        if "qkv_attn" not in name:
+            legacy_state_dict[name] = param
+            continue
+        param_name = name.split(".")[-1]
+        for projection, projection_param in zip(["q_attn", "k_attn", "v_attn"], param.split([n_embd, kv_dim, kv_dim])):
+            legacy_state_dict[f"attn.{projection}.{param_name}"] = projection_param.clone()
+
+    loaded_attention_layer = CausalSelfAttention(**attention_layer_args)
+    loaded_attention_layer.load_state_dict(
+        {name.removeprefix("attn."): param for name, param in legacy_state_dict.items()}, strict=True
+    )
+
+    x = torch.rand(2, 5, n_embd)
+    torch.testing.assert_close(loaded_attention_layer(x), attention_layer(x))
+
+
+def test_fusing_unfused_qkv_optimizer_state_dict():
+    model = get_small_gpt2_model(PositionTypes.NOPE, AttentionImplementation.MANUAL)
+    optimizer = torch.optim.AdamW(model.parameters())
+    inputs = {"input_ids": torch.randint(0, 64, (2, 16)), "document_ids": torch.zeros(2, 16, dtype=torch.long)}
+    model(inputs)["logits"].sum().backward()
+    optimizer.step()
+
+    # full optimizer state dict, whose parameters are referenced by their names (as saved by FSDP)
+    names = {id(param): name for name, param in model.named_parameters()}
+    optimizer_state_dict = {
+        "state": {names[id(param)]: state for param, state in optimizer.state.items()},
+        "param_groups": [
+            {**param_group, "params": [names[id(param)] for param in param_group["params"]]}
+            for param_group in optimizer.param_groups
+        ],
+    }
+    # optimizer state dict in the legacy layout with separate query, key and value projections
+    legacy_state = {}
+    legacy_params = []
+    for name in optimizer_state_dict["param_groups"][0]["params"]:
+        if "qkv_attn" not in name:
+            legacy_state[name] = optimizer_state_dict["state"][name]
+            legacy_params.append(name)
+            continue
+        projection_states = {
+            state_name: value.split([32, 16, 16]) if value.dim() > 0 else [value] * 3
+            for state_name, value in optimizer_state_dict["state"][name].items()
+        }
+        for i, projection in enumerate(["q_attn", "k_attn", "v_attn"]):
+            legacy_name = name.replace("qkv_attn", projection)
+            legacy_state[legacy_name] = {state_name: value[i] for state_name, value in projection_states.items()}
+            legacy_params.append(legacy_name)
+    legacy_optimizer_state_dict = {
+        "state": legacy_state,
+        "param_groups": [{**optimizer_state_dict["param_groups"][0], "params": legacy_params}],
+    }
+
+    fused_optimizer_state_dict = fuse_qkv_optimizer_state_dict_keys(legacy_optimizer_state_dict)
+    assert fused_optimizer_state_dict["param_groups"] == optimizer_state_dict["param_groups"]
+    torch.testing.assert_close(fused_optimizer_state_dict["state"], optimizer_state_dict["state"])
@@ -0,0 +1,112 @@
+import subprocess
+import sys
+from copy import deepcopy
+from pathlib import Path
+
+import pytest
+import torch
+from pydantic import BaseModel
+
+from modalities.__main__ import load_app_config_dict
+from modalities.config.component_factory import ComponentFactory
+from modalities.config.config import PydanticPytorchModuleType
+from modalities.models.gpt2.gpt2_model import GPT2Block
+from modalities.models.model_factory import ModelFactory
+from modalities.registry.components import COMPONENTS
+from modalities.registry.registry import Registry
+from tests.conftest import _ROOT_DIR
+
+
+def _build_small_gpt2_model(compiled_model_config: dict = None) -> torch.nn.Module:
+    class ModelInstantiationModel(BaseModel):
+        model: PydanticPytorchModuleType
+
+    config_dict = load_app_config_dict(_ROOT_DIR / Path("tests/test_yaml_configs/gpt2_config_optimizer.yaml"))
+    model_raw_config = config_dict["model_raw"]["config"]
+    model_raw_config.update(n_layer=2, n_embd=128, ffn_hidden=128, n_head_q=4, n_head_kv=4, sequence_length=16)
+    for norm_key in ["attention_norm", "ffn_norm", "lm_head_norm"]:
+        model_raw_config[norm_key]["config"]["ndim"] = 128
+    config_dict["model"]["config"]["model_initializer"]["config"]["num_layers"] = 2
+    if compiled_model_config is not None:
+        config_dict["initialized_model"] = config_dict.pop("model")
+        config_dict["model"] = {
+            "component_key": "model",
+            "variant_key": "compiled",
+            "config": {"model": {"instance_key": "initialized_model", "pass_type": "BY_REFERENCE"}}
+            | compiled_model_config,
+        }
+    components = ComponentFactory(Registry(COMPONENTS)).build_components(
+        config_dict=config_dict, components_model_type=ModelInstantiationModel
+    )
+    return components.model
+
+
+def test_compiled_model_component_compiles_blocks_in_place():
+    model = _build_small_gpt2_model(compiled_model_config={"block_names": ["GPT2Block"], "backend": "aot_eager"})
+    blocks = [module for module in model.modules() if isinstance(module, GPT2Block)]
+    assert len(blocks) == 2
+    assert all(block._compiled_call_impl is not None for block in blocks)
+    assert model._compiled_call_impl is None
+
+    uncompiled_model = deepcopy(model)
+    for block in uncompiled_model.transformer.h:
+        block._compiled_call_impl = None
+    assert list(model.state_dict().keys()) == list(uncompiled_model.state_dict().keys())
+    inputs = {"input_ids": torch.randint(0, 50304, (2, 16))}
+    logits = model(inputs)["logits"]
+    logits.sum().backward()
+    torch.testing.assert_close(logits, uncompiled_model(inputs)["logits"])
+
+
+def test_compiled_model_without_block_names_compiles_whole_model():
+    model = ModelFactory.get_compiled_model(_build_small_gpt2_model(), block_names=[], backend="eager")
+    assert model._compiled_call_impl is not None
+    assert all(block._compiled_call_impl is None for block in model.transformer.h)
+
+
+def test_compiled_model_raises_for_unknown_block_name():
+    with pytest.raises(ValueError):
+        ModelFactory.get_compiled_model(_build_small_gpt2_model(), block_names=["UnknownBlock"], backend="eager")
+
+
+_COMPILE_SCRIPT = """
+import sys
+from pathlib import Path
+
+import torch
+from torch._dynamo.utils import counters
+
+from modalities.models.model_factory import ModelFactory
+
+
+class Block(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(8, 8)
+
+    def forward(self, x):
+        return torch.nn.functional.gelu(self.linear(x)) + x
+
+
+torch.manual_seed(0)
+model = ModelFactory.get_compiled_model(
+    torch.nn.Sequential(Block(), Block()), block_names=["Block"], dynamic=False, cache_dir=Path(sys.argv[1])
+)
+model(torch.randn(4, 8))
+print(counters["inductor"]["fxgraph_cache_hit"], counters["inductor"]["fxgraph_cache_miss"])
+"""
+
+
+def test_compile_cache_is_persisted_across_processes(tmp_path: Path):
+    cache_dir = tmp_path / "compile_cache"
+    num_cache_hits_and_misses = []
+    for _ in range(2):
+        result = subprocess.run(
+            [sys.executable, "-c", _COMPILE_SCRIPT, str(cache_dir)], capture_output=True, text=True, check=True
+        )
+        num_cache_hits_and_misses.append(tuple(map(int, result.stdout.split()[-2:])))
+    num_cache_misses = num_cache_hits_and_misses[0][1]
+    assert num_cache_hits_and_misses[0] == (0, num_cache_misses) and num_cache_misses > 0
+    # after the restart, all graphs are loaded from the cache instead of being recompiled
+    assert num_cache_hits_and_misses[1] == (num_cache_misses, 0)
+    assert (cache_dir / "fxgraph").is_dir()
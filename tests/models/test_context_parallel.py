@@ -0,0 +1,83 @@
+import torch
+import torch.distributed as dist
+
+from modalities.batch import InferenceResultBatch
+from modalities.loss_functions import CLMChunkedCrossEntropyLoss, CLMCrossEntropyLoss, Loss
+from modalities.models.gpt2.gpt2_model import GPT2LLM, AttentionImplementation, PositionTypes
+from tests.conftest import get_small_gpt2_model, run_on_cpu_ranks
+
+
+def _get_loss_and_grads(model: GPT2LLM, loss_fun: Loss, inputs: dict, targets: torch.Tensor):
+    predictions = model(inputs)
+    loss = loss_fun(InferenceResultBatch(targets={"target_ids": targets}, predictions=predictions))
+    loss.backward()
+    return loss.detach(), {name: p.grad for name, p in model.named_parameters()}
+
+
+def _check_context_parallel_matches_full_sequence():
+    world_size = dist.get_world_size()
+    for poe_type in [PositionTypes.NOPE, PositionTypes.ABSOLUTE]:
+        for attention_impl in [AttentionImplementation.MANUAL, AttentionImplementation.PYTORCH_FLASH]:
+            torch.manual_seed(0)
+            model = get_small_gpt2_model(poe_type, attention_impl, context_parallel_degree=1)
+            context_parallel_model = get_small_gpt2_model(poe_type, attention_impl, context_parallel_degree=world_size)
+            context_parallel_model.load_state_dict(model.state_dict())
+
+            input_ids = torch.randint(0, 64, (2, 16))
+            # the second document starts within the shard of the second rank
+            document_ids = torch.tensor([[0] * 11 + [1] * 5, [0] * 16])
+            targets = torch.randint(0, 64, (2, 16))
+            # the ignored targets make the shards contribute different numbers of targets to the loss
+            targets[0, 9:12] = -100
+            inputs = {"input_ids": input_ids, "document_ids": document_ids}
+
+            loss, grads = _get_loss_and_grads(model, CLMCrossEntropyLoss("target_ids", "logits"), inputs, targets)
+            context_parallel_loss, context_parallel_grads = _get_loss_and_grads(
+                context_parallel_model,
+                CLMCrossEntropyLoss("target_ids", "logits", context_parallel_degree=world_size),
+                inputs,
+                targets,
+            )
+            torch.testing.assert_close(context_parallel_loss, loss)
+            for name, grad in grads.items():
+                # the gradients are averaged over the ranks, as done by FSDP
+                dist.all_reduce(context_parallel_grads[name])
+                torch.testing.assert_close(context_parallel_grads[name] / world_size, grad, rtol=1e-4, atol=1e-5)
+
+
+def test_context_parallel_gpt2_matches_full_sequence():
+    run_on_cpu_ranks(_check_context_parallel_matches_full_sequence, 2)
+
+
+def _check_chunked_loss_with_context_parallelism_matches_full_sequence():
+    world_size = dist.get_world_size()
+    torch.manual_seed(0)
+    model = get_small_gpt2_model(PositionTypes.NOPE, AttentionImplementation.MANUAL, context_parallel_degree=1)
+    context_parallel_model = get_small_gpt2_model(
+        PositionTypes.NOPE, AttentionImplementation.MANUAL, context_parallel_degree=world_size
+    )
+    context_parallel_model.load_state_dict(model.state_dict())
+    # the models return the hidden states and the LM head weight instead of the logits
+    model.lm_head_weight_key = context_parallel_model.lm_head_weight_key = "lm_head_weight"
+
+    inputs = {"input_ids": torch.randint(0, 64, (2, 16)), "document_ids": torch.tensor([[0] * 11 + [1] * 5, [0] * 16])}
+    targets = torch.randint(0, 64, (2, 16))
+    targets[0, 9:12] = -100
+    loss_args = dict(
+        target_key="target_ids", prediction_key="logits", lm_head_weight_key="lm_head_weight", chunk_size=5
+    )
+    loss, grads = _get_loss_and_grads(model, CLMChunkedCrossEntropyLoss(**loss_args), inputs, targets)
+    context_parallel_loss, context_parallel_grads = _get_loss_and_grads(
+        context_parallel_model,
+        CLMChunkedCrossEntropyLoss(**loss_args, context_parallel_degree=world_size),
+        inputs,
+        targets,
+    )
+    torch.testing.assert_close(context_parallel_loss, loss)
+    for name, grad in grads.items():
+        dist.all_reduce(context_parallel_grads[name])
+        torch.testing.assert_close(context_parallel_grads[name] / world_size, grad, rtol=1e-4, atol=1e-5)
+
+
+def test_chunked_loss_with_context_parallelism_matches_full_sequence():
+    run_on_cpu_ranks(_check_chunked_loss_with_context_parallelism_matches_full_sequence, 2)
@@ -0,0 +1,200 @@
+from copy import deepcopy
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+import torch
+import torch.distributed as dist
+
+from modalities.batch import DatasetBatch, InferenceResultBatch
+from modalities.checkpointing.pipeline.pipeline_checkpoint_saving import PipelineCheckpointSaving
+from modalities.loss_functions import CLMCrossEntropyLoss
+from modalities.models.gpt2.gpt2_model import AttentionImplementation, PositionTypes
+from modalities.models.model_factory import ModelFactory
+from modalities.running_env.pipeline_parallel import (
+    PipelineSchedule1F1B,
+    get_pipeline_stage_block_ids,
+    split_dataset_batch,
+)
+from modalities.trainer import Trainer
+from modalities.training.gradient_clipping.fsdp_gradient_clipper import GradientClippingMode, PipelineGradientClipper
+from tests.conftest import get_small_gpt2_model, run_on_cpu_ranks
+
+
+@pytest.mark.parametrize(
+    "num_blocks, num_stages, expected_block_ids",
+    [
+        (4, 2, [range(0, 2), range(2, 4)]),
+        (4, 3, [range(0, 2), range(2, 3), range(3, 4)]),
+        (5, 3, [range(0, 2), range(2, 4), range(4, 5)]),
+        (3, 3, [range(0, 1), range(1, 2), range(2, 3)]),
+    ],
+)
+def test_get_pipeline_stage_block_ids(num_blocks: int, num_stages: int, expected_block_ids: list):
+    block_ids = [get_pipeline_stage_block_ids(num_blocks, stage_id, num_stages) for stage_id in range(num_stages)]
+    assert block_ids == expected_block_ids
+
+
+def test_get_pipeline_stage_block_ids_raises_for_too_few_blocks():
+    with pytest.raises(ValueError):
+        get_pipeline_stage_block_ids(num_blocks=2, stage_id=0, num_stages=3)
+
+
+def test_split_dataset_batch():
+    batch = DatasetBatch(samples={"input_ids": torch.arange(12).view(4, 3)}, targets={"target_ids": torch.arange(4)})
+    micro_batches = split_dataset_batch(batch, num_micro_batches=2)
+    assert [len(micro_batch) for micro_batch in micro_batches] == [2, 2]
+    assert torch.equal(micro_batches[1].samples["input_ids"], batch.samples["input_ids"][2:])
+    assert torch.equal(micro_batches[1].targets["target_ids"], batch.targets["target_ids"][2:])
+    with pytest.raises(ValueError):
+        split_dataset_batch(batch, num_micro_batches=3)
+
+
+def _get_batch() -> DatasetBatch:
+    # the second document of the first sample starts within the second micro-batch
+    document_ids = torch.zeros(4, 16, dtype=torch.long)
+    document_ids[2, 11:] = 1
+    return DatasetBatch(
+        samples={"input_ids": torch.randint(0, 64, (4, 16)), "document_ids": document_ids},
+        targets={"target_ids": torch.randint(0, 64, (4, 16))},
+    )
+
+
+def _get_loss(model: torch.nn.Module, loss_fun: CLMCrossEntropyLoss, batch: DatasetBatch) -> torch.Tensor:
+    return loss_fun(InferenceResultBatch(targets=batch.targets, predictions=model(batch.samples)))
+
+
+def _assert_stage_grads_match(stage_model: torch.nn.Module, model: torch.nn.Module):
+    # the tied LM head weight of the last stage gets the gradient of the token embedding and the LM head
+    parameters = dict(model.named_parameters(remove_duplicate=False))
+    for name, parameter in stage_model.named_parameters():
+        torch.testing.assert_close(parameter.grad, parameters[name].grad, rtol=1e-4, atol=1e-5)
+
+
+def _check_pipeline_matches_unpartitioned_model():
+    world_size = dist.get_world_size()
+    loss_fun = CLMCrossEntropyLoss("target_ids", "logits")
+    for poe_type in [PositionTypes.NOPE, PositionTypes.ABSOLUTE]:
+        torch.manual_seed(0)
+        model = get_small_gpt2_model(poe_type, AttentionImplementation.MANUAL, n_layer=4)
+        stage_model = ModelFactory.get_pipeline_stage_model(deepcopy(model), pipeline_parallel_degree=world_size)
+        batch = _get_batch()
+
+        loss = _get_loss(model, loss_fun, batch)
+        loss.backward()
+        schedule = PipelineSchedule1F1B(pipeline_parallel_degree=world_size, num_micro_batches=4)
+        pipeline_loss = schedule.step(model=stage_model, batch=batch, loss_fun=loss_fun)
+        torch.testing.assert_close(pipeline_loss, loss.detach())
+        _assert_stage_grads_match(stage_model, model)
+
+        with torch.no_grad():
+            torch.testing.assert_close(schedule.forward_only(stage_model, batch, loss_fun), loss.detach())
+
+
+def test_pipeline_parallel_gpt2_matches_unpartitioned_model():
+    # 4 blocks across 3 stages, such that the first stage holds 2 blocks and the middle stage sends and receives
+    run_on_cpu_ranks(_check_pipeline_matches_unpartitioned_model, 3)
+
+
+def _check_pipeline_trainer_accumulates_gradients():
+    world_size = dist.get_world_size()
+    loss_fun = CLMCrossEntropyLoss("target_ids", "logits")
+    torch.manual_seed(0)
+    model = get_small_gpt2_model(PositionTypes.ABSOLUTE, AttentionImplementation.PYTORCH_FLASH, n_layer=2)
+    stage_model = ModelFactory.get_pipeline_stage_model(deepcopy(model), pipeline_parallel_degree=world_size)
+    batches = [_get_batch(), _get_batch()]
+
+    trainer = Trainer(
+        global_rank=dist.get_rank(),
+        batch_progress_publisher=MagicMock(),
+        evaluation_result_publisher=MagicMock(),
+        gradient_acc_steps=2,
+        global_num_tokens_per_train_step=128,
+        gradient_clipper=MagicMock(),
+        pipeline_schedule=PipelineSchedule1F1B(pipeline_parallel_degree=world_size, num_micro_batches=2),
+    )
+    optimizer = MagicMock()
+    for micro_batch_id, batch in enumerate(batches):
+        step_performed, _, pipeline_loss, _ = trainer._train_batch(
+            batch=batch,
+            model=stage_model,
+            optimizer=optimizer,
+            scheduler=MagicMock(),
+            loss_fun=loss_fun,
+            micro_batch_id=micro_batch_id,
+        )
+        loss = _get_loss(model, loss_fun, batch)
+        (loss / 2).backward()
+        torch.testing.assert_close(pipeline_loss, loss.detach())
+        assert step_performed == (micro_batch_id == 1)
+    optimizer.step.assert_called_once()
+    _assert_stage_grads_match(stage_model, model)
+
+
+def test_pipeline_parallel_trainer_accumulates_gradients():
+    run_on_cpu_ranks(_check_pipeline_trainer_accumulates_gradients, 2)
+
+
+def _check_pipeline_gradient_clipping_matches_unpartitioned_model():
+    world_size = dist.get_world_size()
+    loss_fun = CLMCrossEntropyLoss("target_ids", "logits")
+    for norm_type in [GradientClippingMode.P2_NORM, GradientClippingMode.MAX_NORM]:
+        torch.manual_seed(0)
+        model = get_small_gpt2_model(PositionTypes.NOPE, AttentionImplementation.MANUAL, n_layer=4)
+        stage_model = ModelFactory.get_pipeline_stage_model(deepcopy(model), pipeline_parallel_degree=world_size)
+        batch = _get_batch()
+        _get_loss(model, loss_fun, batch).backward()
+        PipelineSchedule1F1B(pipeline_parallel_degree=world_size, num_micro_batches=2).step(
+            model=stage_model, batch=batch, loss_fun=loss_fun
+        )
+
+        norm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=0.1, norm_type=float(norm_type.value))
+        clipper = PipelineGradientClipper(
+            stage_model, max_norm=0.1, norm_type=norm_type, pipeline_parallel_degree=world_size
+        )
+        torch.testing.assert_close(clipper.clip_gradients(), norm)
+        _assert_stage_grads_match(stage_model, model)
+
+
+def test_pipeline_gradient_clipping_matches_unpartitioned_model():
+    run_on_cpu_ranks(_check_pipeline_gradient_clipping_matches_unpartitioned_model, 3)
+
+
+def _check_pipeline_checkpoint_saving_merges_stages(checkpoint_path: Path):
+    world_size = dist.get_world_size()
+    loss_fun = CLMCrossEntropyLoss("target_ids", "logits")
+    torch.manual_seed(0)
+    model = get_small_gpt2_model(PositionTypes.ABSOLUTE, AttentionImplementation.MANUAL, n_layer=2)
+    stage_model = ModelFactory.get_pipeline_stage_model(deepcopy(model), pipeline_parallel_degree=world_size)
+    optimizer = torch.optim.AdamW(model.parameters())
+    stage_optimizer = torch.optim.AdamW(stage_model.parameters())
+    batch = _get_batch()
+    _get_loss(model, loss_fun, batch).backward()
+    optimizer.step()
+    PipelineSchedule1F1B(pipeline_parallel_degree=world_size, num_micro_batches=2).step(
+        model=stage_model, batch=batch, loss_fun=loss_fun
+    )
+    stage_optimizer.step()
+
+    checkpoint_saving = PipelineCheckpointSaving(
+        checkpoint_path=checkpoint_path,
+        experiment_id="0",
+        global_rank=dist.get_rank(),
+        get_num_tokens_from_num_steps_callable=lambda num_steps: num_steps * 64,
+        pipeline_parallel_degree=world_size,
+    )
+    checkpoint_saving._save_checkpoint(stage_model, stage_optimizer, num_train_steps_done=1)
+    if dist.get_rank() != 0:
+        return
+    model_state = torch.load(checkpoint_path / "0" / "eid_0-model-num_steps_1-num_tokens_64.bin")
+    optim_state_dict = torch.load(checkpoint_path / "0" / "eid_0-optimizer-num_steps_1-num_tokens_64.bin")
+    torch.testing.assert_close(model_state, model.state_dict())
+    # the parameters are referenced by their names, as in the full optimizer state dicts of FSDP
+    named_parameters = list(model.named_parameters())
+    assert optim_state_dict["param_groups"][0]["params"] == [name for name, _ in named_parameters]
+    expected_state = {name: optimizer.state[parameter] for name, parameter in named_parameters}
+    torch.testing.assert_close(optim_state_dict["state"], expected_state, rtol=1e-4, atol=1e-6)
+
+
+def test_pipeline_checkpoint_saving_merges_stages(tmp_path: Path):
+    run_on_cpu_ranks(_check_pipeline_checkpoint_saving_merges_stages, 2, tmp_path)
@@ -0,0 +1,184 @@
+import math
+from copy import deepcopy
+
+import pytest
+import torch
+import torch.distributed as dist
+
+from modalities.batch import InferenceResultBatch
+from modalities.loss_functions import CLMCrossEntropyLoss
+from modalities.models.gpt2.gpt2_model import AttentionImplementation, PositionTypes
+from modalities.models.model import ActivationType
+from modalities.models.model_factory import ModelFactory
+from modalities.running_env.tensor_parallel import (
+    ColumnParallelLinear,
+    RowParallelLinear,
+    gather_tensor_parallel_state_dict,
+    get_column_shard,
+    get_data_parallel_group,
+    get_row_shard,
+    get_tensor_parallel_group,
+    get_tensor_parallel_shards,
+    merge_tensor_parallel_shards,
+)
+from modalities.training.gradient_clipping.fsdp_gradient_clipper import clip_tensor_parallel_grad_norm_
+from tests.conftest import get_small_gpt2_model, run_on_cpu_ranks
+
+
+def _get_loss(model: torch.nn.Module, inputs: dict, targets: torch.Tensor) -> torch.Tensor:
+    loss_fun = CLMCrossEntropyLoss("target_ids", "logits")
+    return loss_fun(InferenceResultBatch(targets={"target_ids": targets}, predictions=model(inputs)))
+
+
+def _check_tensor_parallel_matches_unsharded_model():
+    world_size = dist.get_world_size()
+    group = get_tensor_parallel_group(world_size)
+    for activation_type in [ActivationType.GELU, ActivationType.SWIGLU]:
+        for attention_impl in [AttentionImplementation.MANUAL, AttentionImplementation.PYTORCH_FLASH]:
+            torch.manual_seed(0)
+            model = get_small_gpt2_model(PositionTypes.NOPE, attention_impl, activation_type=activation_type)
+            tensor_parallel_model = ModelFactory.get_tensor_parallel_model(deepcopy(model), world_size)
+            assert list(tensor_parallel_model.state_dict().keys()) == list(model.state_dict().keys())
+
+            inputs = {
+                "input_ids": torch.randint(0, 64, (2, 16)),
+                "document_ids": torch.tensor([[0] * 11 + [1] * 5, [0] * 16]),
+            }
+            targets = torch.randint(0, 64, (2, 16))
+            loss = _get_loss(model, inputs, targets)
+            loss.backward()
+            tensor_parallel_loss = _get_loss(tensor_parallel_model, inputs, targets)
+            tensor_parallel_loss.backward()
+            torch.testing.assert_close(tensor_parallel_loss, loss)
+
+            modules = dict(model.named_modules())
+            for name, module in tensor_parallel_model.named_modules():
+                if isinstance(module, ColumnParallelLinear):
+                    split_sizes = [32, 16, 16] if name.endswith("qkv_attn") else None
+                    expected_weight_grad = get_column_shard(modules[name].weight.grad, group, split_sizes)
+                    expected_bias_grad = get_column_shard(modules[name].bias.grad, group, split_sizes)
+                elif isinstance(module, RowParallelLinear):
+                    expected_weight_grad = get_row_shard(modules[name].weight.grad, group)
+                    expected_bias_grad = modules[name].bias.grad
+                else:
+                    continue
+                torch.testing.assert_close(module.weight.grad, expected_weight_grad, rtol=1e-4, atol=1e-5)
+                torch.testing.assert_close(module.bias.grad, expected_bias_grad, rtol=1e-4, atol=1e-5)
+            # the replicated parameters (e.g., norms and embeddings) get the full gradients on all ranks
+            parameters = dict(model.named_parameters())
+            for name, parameter in tensor_parallel_model.named_parameters():
+                module = tensor_parallel_model.get_submodule(name.rsplit(".", 1)[0])
+                if not isinstance(module, (ColumnParallelLinear, RowParallelLinear)):
+                    torch.testing.assert_close(parameter.grad, parameters[name].grad, rtol=1e-4, atol=1e-5)
+
+
+def test_tensor_parallel_gpt2_matches_unsharded_model():
+    run_on_cpu_ranks(_check_tensor_parallel_matches_unsharded_model, 2)
+
+
+def _check_2d_parallel_groups():
+    # 2 tensor parallel groups of consecutive ranks and 2 data parallel groups across them
+    rank = torch.tensor([dist.get_rank()])
+    tensor_parallel_ranks = [torch.zeros_like(rank) for _ in range(2)]
+    dist.all_gather(tensor_parallel_ranks, rank, group=get_tensor_parallel_group(2))
+    data_parallel_ranks = [torch.zeros_like(rank) for _ in range(2)]
+    dist.all_gather(data_parallel_ranks, rank, group=get_data_parallel_group(2))
+    first_rank = dist.get_rank() - dist.get_rank() % 2
+    assert torch.cat(tensor_parallel_ranks).tolist() == [first_rank, first_rank + 1]
+    assert torch.cat(data_parallel_ranks).tolist() == [dist.get_rank() % 2, dist.get_rank() % 2 + 2]
+
+
+def test_tensor_and_data_parallel_groups():
+    run_on_cpu_ranks(_check_2d_parallel_groups, 4)
+
+
+@pytest.mark.parametrize(
+    "full_tensor, dim, split_sizes, num_shards",
+    [
+        (torch.arange(24).view(6, 4), 0, [3], 2),
+        (torch.arange(24).view(6, 4), 1, [2], 2),
+        (torch.arange(32).view(8, 4), 0, [2, 1, 1], 2),
+        (torch.arange(8), 0, [1, 1], 4),
+    ],
+)
+def test_merge_tensor_parallel_shards(full_tensor: torch.Tensor, dim: int, split_sizes: list, num_shards: int):
+    # the parts (e.g., query, key and value) of each shard are contiguous ranges of the parts of the full tensor
+    full_parts = full_tensor.split([split_size * num_shards for split_size in split_sizes], dim=dim)
+    shards = [
+        torch.cat([part.chunk(num_shards, dim=dim)[rank] for part in full_parts], dim=dim) for rank in range(num_shards)
+    ]
+    assert torch.equal(merge_tensor_parallel_shards(shards, dim, split_sizes), full_tensor)
+
+
+def _train_step(model: torch.nn.Module, optimizer: torch.optim.Optimizer):
+    torch.manual_seed(1)
+    inputs = {"input_ids": torch.randint(0, 64, (2, 16)), "document_ids": torch.zeros(2, 16, dtype=torch.long)}
+    _get_loss(model, inputs, torch.randint(0, 64, (2, 16))).backward()
+    optimizer.step()
+
+
+def _check_tensor_parallel_state_dicts_are_gathered():
+    world_size = dist.get_world_size()
+    group = get_tensor_parallel_group(world_size)
+    torch.manual_seed(0)
+    model = get_small_gpt2_model(
+        PositionTypes.NOPE, AttentionImplementation.MANUAL, activation_type=ActivationType.SWIGLU
+    )
+    tensor_parallel_model = ModelFactory.get_tensor_parallel_model(deepcopy(model), world_size)
+    optimizer = torch.optim.AdamW(model.parameters())
+    tensor_parallel_optimizer = torch.optim.AdamW(tensor_parallel_model.parameters())
+    _train_step(model, optimizer)
+    _train_step(tensor_parallel_model, tensor_parallel_optimizer)
+
+    shards = get_tensor_parallel_shards(tensor_parallel_model)
+    # per block, the weights and biases of qkv_attn, W and V and the weights of the row-parallel c_proj and W_2
+    assert len(shards) == 2 * 8
+    model_state = gather_tensor_parallel_state_dict(tensor_parallel_model.state_dict(), shards, group)
+    # the optimizer states are referenced by the parameter names, as in the full optimizer state dicts of FSDP
+    optimizer_state = gather_tensor_parallel_state_dict(
+        {name: tensor_parallel_optimizer.state[p] for name, p in tensor_parallel_model.named_parameters()},
+        shards,
+        group,
+    )
+    if dist.get_rank() != 0:
+        assert model_state is None and optimizer_state is None
+        return
+    torch.testing.assert_close(model_state, model.state_dict())
+    expected_optimizer_state = {name: optimizer.state[p] for name, p in model.named_parameters()}
+    torch.testing.assert_close(optimizer_state, expected_optimizer_state, rtol=1e-4, atol=1e-6)
+
+
+def test_tensor_parallel_state_dicts_are_gathered():
+    run_on_cpu_ranks(_check_tensor_parallel_state_dicts_are_gathered, 2)
+
+
+def _check_tensor_parallel_gradient_clipping_matches_unsharded_model():
+    world_size = dist.get_world_size()
+    for norm_type in [1.0, 2.0, math.inf]:
+        torch.manual_seed(0)
+        model = get_small_gpt2_model(PositionTypes.NOPE, AttentionImplementation.MANUAL)
+        tensor_parallel_model = ModelFactory.get_tensor_parallel_model(deepcopy(model), world_size)
+        inputs = {"input_ids": torch.arange(32).view(2, 16), "document_ids": torch.zeros(2, 16, dtype=torch.long)}
+        for m in [model, tensor_parallel_model]:
+            _get_loss(m, inputs, torch.arange(32).view(2, 16) % 64).backward()
+
+        norm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=0.1, norm_type=norm_type)
+        tensor_parallel_norm = clip_tensor_parallel_grad_norm_(tensor_parallel_model, max_norm=0.1, norm_type=norm_type)
+        torch.testing.assert_close(tensor_parallel_norm, norm)
+        # the replicated parameters are clipped by the same norm on all ranks
+        parameters = dict(model.named_parameters())
+        shards = get_tensor_parallel_shards(tensor_parallel_model)
+        for name, parameter in tensor_parallel_model.named_parameters():
+            expected_grad = parameters[name].grad
+            if name in shards:
+                full_grad = [torch.zeros_like(parameter.grad) for _ in range(world_size)]
+                dist.all_gather(full_grad, parameter.grad)
+                shard = shards[name]
+                parameter_grad = merge_tensor_parallel_shards(full_grad, shard.dim, shard.split_sizes)
+            else:
+                parameter_grad = parameter.grad
+            torch.testing.assert_close(parameter_grad, expected_grad, rtol=1e-4, atol=1e-6)
+
+
+def test_tensor_parallel_gradient_clipping_matches_unsharded_model():
+    run_on_cpu_ranks(_check_tensor_parallel_gradient_clipping_matches_unsharded_model, 2)
@@ -1,7 +1,7 @@
 import pytest
 import torch
 
-from modalities.nn.attention import AttentionType, MultiHeadAttention
+from modalities.nn.attention import AttentionCache, AttentionType, MultiHeadAttention
 
 
 @pytest.mark.parametrize(
@@ -20,3 +20,42 @@ def test_attention_with_cross_attention_forward():
     dummy_context = torch.randn(1, 16, 64)
     out = model(dummy_input, context=dummy_context)
     assert out.shape == (1, 256, 64)
+
+
+def test_attention_cache_causal_bias_is_sized_lazily():
+    attention_cache = AttentionCache()
+    causal_bias = attention_cache.get_causal_bias(4, 4, dtype=torch.float32, device=torch.device("cpu"))
+    expected_causal_bias = torch.zeros(4, 4).masked_fill(torch.ones(4, 4).tril() == 0, float("-inf"))
+    assert torch.equal(causal_bias, expected_causal_bias)
+
+    # smaller sequence lengths are served as views of the cached bias
+    smaller_causal_bias = attention_cache.get_causal_bias(3, 3, dtype=torch.float32, device=torch.device("cpu"))
+    assert smaller_causal_bias.untyped_storage().data_ptr() == causal_bias.untyped_storage().data_ptr()
+    assert torch.equal(smaller_causal_bias, expected_causal_bias[:3, :3])
+
+    # larger sequence lengths and other dtypes trigger a recomputation
+    larger_causal_bias = attention_cache.get_causal_bias(8, 8, dtype=torch.float32, device=torch.device("cpu"))
+    assert larger_causal_bias.shape == (8, 8)
+    assert torch.equal(larger_causal_bias[:4, :4], expected_causal_bias)
+    bf16_causal_bias = attention_cache.get_causal_bias(4, 4, dtype=torch.bfloat16, device=torch.device("cpu"))
+    assert bf16_causal_bias.dtype == torch.bfloat16
+
+
+def test_attention_cache_tensors_can_be_used_for_training_after_inference_mode():
+    attention_cache = AttentionCache()
+    inv_freq = torch.rand(4)
+    with torch.inference_mode():
+        attention_cache.get_rotary_tables(inv_freq, seq_len=8, dtype=torch.float32)
+    cos, _ = attention_cache.get_rotary_tables(inv_freq, seq_len=8, dtype=torch.float32)
+    x = torch.rand(8, 8, requires_grad=True)
+    (x * cos).sum().backward()
+    assert torch.equal(x.grad, cos)
+
+
+def test_attention_loads_state_dict_with_causal_mask_buffer():
+    model = MultiHeadAttention(n_embd=64, n_head=8, attention_type=AttentionType.CAUSAL_SELF_ATTENTION)
+    state_dict = model.state_dict()
+    assert "bias" not in state_dict
+    # the causal mask was formerly registered as a (block_size x block_size) buffer
+    state_dict["bias"] = torch.tril(torch.ones(1024, 1024)).view(1, 1, 1024, 1024)
+    model.load_state_dict(state_dict, strict=True)
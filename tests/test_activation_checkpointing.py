@@ -0,0 +1,170 @@
+from copy import deepcopy
+from typing import Dict, List
+
+import pytest
+import torch
+import torch.nn.functional as F
+from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import CheckpointWrapper
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from modalities.activation_checkpointing import (
+    ActivationCheckpointingVariants,
+    BlockActivationMemory,
+    apply_activation_checkpointing_inplace,
+    get_block_variants_for_memory_budget,
+)
+
+
+class ToyAttention(torch.nn.Module):
+    def __init__(self, n_embd: int, n_head: int):
+        super().__init__()
+        self.n_head = n_head
+        self.qkv = torch.nn.Linear(n_embd, 3 * n_embd)
+        self.proj = torch.nn.Linear(n_embd, n_embd)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        B, T, C = x.shape
+        q, k, v = self.qkv(x).view(B, T, 3, self.n_head, C // self.n_head).permute(2, 0, 3, 1, 4)
+        y = F.scaled_dot_product_attention(q, k, v, is_causal=True)
+        return self.proj(y.transpose(1, 2).reshape(B, T, C))
+
+
+class ToyBlock(torch.nn.Module):
+    def __init__(self, n_embd: int):
+        super().__init__()
+        self.norm = torch.nn.LayerNorm(n_embd)
+        self.attn = ToyAttention(n_embd, n_head=2)
+        self.mlp = torch.nn.Sequential(
+            torch.nn.Linear(n_embd, 4 * n_embd), torch.nn.GELU(), torch.nn.Linear(4 * n_embd, n_embd)
+        )
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = x + self.attn(self.norm(x))
+        return x + self.mlp(torch.tanh(x))
+
+
+class ToyModel(torch.nn.Module):
+    def __init__(self, n_layer: int = 4, n_embd: int = 16):
+        super().__init__()
+        self.wte = torch.nn.Embedding(32, n_embd)
+        self.h = torch.nn.ModuleList([ToyBlock(n_embd) for _ in range(n_layer)])
+
+    def forward(self, inputs: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        x = self.wte(inputs["input_ids"])
+        for block in self.h:
+            x = block(x)
+        return {"logits": x}
+
+
+class MatmulCounter(TorchDispatchMode):
+    def __init__(self):
+        super().__init__()
+        self.num_matmuls = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        if func.overloadpacket in (torch.ops.aten.mm, torch.ops.aten.addmm, torch.ops.aten.bmm):
+            self.num_matmuls += 1
+        return func(*args, **(kwargs or {}))
+
+
+def _get_wrapped_modules(model: torch.nn.Module) -> List[torch.nn.Module]:
+    return [module._checkpoint_wrapped_module for module in model.modules() if isinstance(module, CheckpointWrapper)]
+
+
+def _get_grads(model: torch.nn.Module, inputs: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    model(inputs)["logits"].pow(2).sum().backward()
+    # the checkpoint wrapper prefixes the parameter names
+    return {n.replace("_checkpoint_wrapped_module.", ""): p.grad for n, p in model.named_parameters()}
+
+
+@pytest.mark.parametrize(
+    "variant, kwargs, expected_wrapped_modules",
+    [
+        (ActivationCheckpointingVariants.FULL_BLOCK, {}, lambda m: list(m.h)),
+        (ActivationCheckpointingVariants.EVERY_KTH_BLOCK, {"every_k_blocks": 2}, lambda m: [m.h[0], m.h[2]]),
+        (ActivationCheckpointingVariants.SUBMODULES, {"submodule_names": ["attn"]}, lambda m: [b.attn for b in m.h]),
+        (ActivationCheckpointingVariants.SUBMODULES, {"submodule_names": ["mlp"]}, lambda m: [b.mlp for b in m.h]),
+        (ActivationCheckpointingVariants.SELECTIVE_OPS, {}, lambda m: list(m.h)),
+    ],
+)
+def test_activation_checkpointing_variants_match_uncheckpointed_model(variant, kwargs, expected_wrapped_modules):
+    torch.manual_seed(0)
+    model = ToyModel()
+    checkpointed_model = deepcopy(model)
+    expected_modules = expected_wrapped_modules(checkpointed_model)
+    apply_activation_checkpointing_inplace(checkpointed_model, ["ToyBlock"], variant=variant, **kwargs)
+    assert _get_wrapped_modules(checkpointed_model) == expected_modules
+
+    inputs = {"input_ids": torch.randint(0, 32, (2, 8))}
+    grads = _get_grads(model, inputs)
+    checkpointed_grads = _get_grads(checkpointed_model, inputs)
+    assert checkpointed_grads.keys() == grads.keys()
+    for name, grad in grads.items():
+        torch.testing.assert_close(checkpointed_grads[name], grad)
+
+
+@pytest.mark.parametrize(
+    "variant, expected_num_recomputed_matmuls",
+    # the recomputation stops early after the third of the four matmuls per block, since the output of the last
+    # one is not needed by the backward pass
+    [(ActivationCheckpointingVariants.FULL_BLOCK, 4 * 3), (ActivationCheckpointingVariants.SELECTIVE_OPS, 0)],
+)
+def test_selective_ops_checkpointing_does_not_recompute_matmuls(variant, expected_num_recomputed_matmuls: int):
+    inputs = {"input_ids": torch.randint(0, 32, (2, 8))}
+    model = ToyModel()
+    logits = model(inputs)["logits"]
+    with MatmulCounter() as counter:
+        logits.sum().backward()
+    num_backward_matmuls = counter.num_matmuls
+
+    apply_activation_checkpointing_inplace(model, ["ToyBlock"], variant=variant)
+    logits = model(inputs)["logits"]
+    with MatmulCounter() as counter:
+        logits.sum().backward()
+    assert counter.num_matmuls - num_backward_matmuls == expected_num_recomputed_matmuls
+
+
+def test_memory_budget_checkpoints_blocks_until_budget_is_met():
+    model = ToyModel()
+    inputs = {"input_ids": torch.randint(0, 32, (1, 8))}
+    apply_activation_checkpointing_inplace(
+        model,
+        ["ToyBlock"],
+        variant=ActivationCheckpointingVariants.MEMORY_BUDGET,
+        memory_budget_in_bytes=10**12,
+        sample_inputs=inputs,
+    )
+    assert _get_wrapped_modules(model) == []
+    assert all(p.grad is None for p in model.parameters())
+
+    blocks = list(model.h)
+    apply_activation_checkpointing_inplace(
+        model,
+        ["ToyBlock"],
+        variant=ActivationCheckpointingVariants.MEMORY_BUDGET,
+        memory_budget_in_bytes=0,
+        sample_inputs=inputs,
+    )
+    assert _get_wrapped_modules(model) == blocks
+
+
+def test_get_block_variants_for_memory_budget():
+    activation_memories = [
+        BlockActivationMemory(no_checkpointing=100, selective_ops=40, full_block=10),
+        BlockActivationMemory(no_checkpointing=100, selective_ops=70, full_block=10),
+        BlockActivationMemory(no_checkpointing=100, selective_ops=50, full_block=10),
+    ]
+    variants = get_block_variants_for_memory_budget(activation_memories, memory_budget_in_bytes=300)
+    assert variants == [None, None, None]
+    # selective checkpointing of the block with the largest saving is sufficient
+    variants = get_block_variants_for_memory_budget(activation_memories, memory_budget_in_bytes=250)
+    assert variants == [ActivationCheckpointingVariants.SELECTIVE_OPS, None, None]
+    # all blocks are checkpointed selectively (160 bytes), then the block with the largest saving fully
+    variants = get_block_variants_for_memory_budget(activation_memories, memory_budget_in_bytes=110)
+    assert variants == [
+        ActivationCheckpointingVariants.SELECTIVE_OPS,
+        ActivationCheckpointingVariants.FULL_BLOCK,
+        ActivationCheckpointingVariants.SELECTIVE_OPS,
+    ]
+    variants = get_block_variants_for_memory_budget(activation_memories, memory_budget_in_bytes=0)
+    assert variants == [ActivationCheckpointingVariants.FULL_BLOCK] * 3
@@ -0,0 +1,136 @@
+from copy import deepcopy
+
+import pytest
+import torch
+
+from modalities.activation_offloading import apply_activation_offloading_inplace
+from tests.test_activation_checkpointing import ToyModel
+
+
+def _get_loss_and_grads(model: torch.nn.Module, inputs: dict):
+    loss = model(inputs)["logits"].pow(2).sum()
+    loss.backward()
+    return loss, {name: p.grad for name, p in model.named_parameters()}
+
+
+@pytest.mark.parametrize(
+    "device",
+    [
+        "cpu",
+        pytest.param(
+            "cuda", marks=pytest.mark.skipif(not torch.cuda.is_available(), reason="Offloading requires a GPU.")
+        ),
+    ],
+)
+def test_activation_offloading_matches_model_without_offloading(device: str):
+    torch.manual_seed(0)
+    model = ToyModel(n_embd=64).to(device)
+    offloaded_model = deepcopy(model)
+    # tensors on the host are offloaded to separate host memory with synchronous copies
+    activation_offloader = apply_activation_offloading_inplace(
+        offloaded_model,
+        ["ToyBlock"],
+        min_offloaded_tensor_size_in_bytes=0,
+        pin_memory=device == "cuda",
+        offloaded_device_types=[device],
+    )
+    # the blocks are not wrapped
+    assert [name for name, _ in offloaded_model.named_parameters()] == [name for name, _ in model.named_parameters()]
+
+    inputs = {"input_ids": torch.randint(0, 32, (2, 16), device=device)}
+    for _ in range(2):
+        loss, grads = _get_loss_and_grads(model, inputs)
+        offloaded_loss, offloaded_grads = _get_loss_and_grads(offloaded_model, inputs)
+        torch.testing.assert_close(offloaded_loss, loss)
+        for name, grad in grads.items():
+            torch.testing.assert_close(offloaded_grads[name], grad)
+
+    # at least the inputs of the two linear layers of the MLP are offloaded
+    assert activation_offloader.pop_num_offloaded_bytes() >= 2 * 4 * 2 * 16 * (64 + 4 * 64)
+    assert activation_offloader.pop_num_offloaded_bytes() == 0
+    assert len(activation_offloader._groups) == 0
+
+
+def test_activation_offloading_ignores_tensors_on_other_devices():
+    model = ToyModel()
+    activation_offloader = apply_activation_offloading_inplace(
+        model, ["ToyBlock"], min_offloaded_tensor_size_in_bytes=0
+    )
+    _get_loss_and_grads(model, {"input_ids": torch.randint(0, 32, (2, 8))})
+    # by default, only tensors on CUDA devices are offloaded
+    assert activation_offloader.pop_num_offloaded_bytes() == 0
+
+
+class LinearTanhBlock(torch.nn.Module):
+    def __init__(self, n_embd: int):
+        super().__init__()
+        self.linear = torch.nn.Linear(n_embd, n_embd)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # saves the input of the linear layer and the output of tanh for the backward pass
+        return torch.tanh(self.linear(x))
+
+
+def test_activation_offloading_offloads_and_prefetches_the_block_tensors():
+    torch.manual_seed(0)
+    num_blocks, batch_size, sequence_length, n_embd = 3, 2, 5, 8
+    model = torch.nn.Sequential(*[LinearTanhBlock(n_embd) for _ in range(num_blocks)])
+    offloaded_model = deepcopy(model)
+    activation_offloader = apply_activation_offloading_inplace(
+        offloaded_model,
+        ["LinearTanhBlock"],
+        min_offloaded_tensor_size_in_bytes=0,
+        pin_memory=False,
+        offloaded_device_types=["cpu"],
+    )
+    prefetched_group_ids = []
+    prefetch = activation_offloader._prefetch
+
+    def record_prefetch(group_id: int):
+        # records whether the tensors of the group were prefetched already, e.g., by the backward pass of the next block
+        is_prefetched = [ref().device_tensor is not None for ref in activation_offloader._groups.get(group_id, [])]
+        prefetched_group_ids.append((group_id, is_prefetched))
+        prefetch(group_id)
+
+    activation_offloader._prefetch = record_prefetch
+
+    x = torch.randn(batch_size, sequence_length, n_embd, requires_grad=True)
+    offloaded_x = x.detach().clone().requires_grad_()
+    model(x).sum().backward()
+    offloaded_output = offloaded_model(offloaded_x)
+
+    # the two saved tensors of each block are copied to host memory and prefetched in the backward pass
+    assert activation_offloader.pop_num_offloaded_bytes() == num_blocks * 2 * batch_size * sequence_length * n_embd * 4
+    assert sorted(activation_offloader._groups) == list(range(num_blocks))
+    for group in activation_offloader._groups.values():
+        assert len(group) == 2
+        assert all(ref().device_tensor is None for ref in group)
+
+    offloaded_output.sum().backward()
+    # the backward pass of a block prefetches its own tensors and the ones of the preceding block
+    assert prefetched_group_ids == [
+        (2, [False, False]),
+        (1, [False, False]),
+        (1, [True, True]),
+        (0, [False, False]),
+        (0, [True, True]),
+        (-1, []),
+    ]
+    assert len(activation_offloader._groups) == 0
+    torch.testing.assert_close(offloaded_x.grad, x.grad)
+    for parameter, offloaded_parameter in zip(model.parameters(), offloaded_model.parameters()):
+        torch.testing.assert_close(offloaded_parameter.grad, parameter.grad)
+
+
+def test_activation_offloading_is_disabled_without_gradients():
+    model = ToyModel()
+    activation_offloader = apply_activation_offloading_inplace(model, ["ToyBlock"])
+    with torch.no_grad():
+        model({"input_ids": torch.randint(0, 32, (2, 8))})
+    assert len(activation_offloader._groups) == 0
+    assert len(activation_offloader._hooks_stack) == 0
+
+
+def test_apply_activation_offloading_raises_for_unknown_module():
+    with pytest.raises(ValueError):
+        apply_activation_offloading_inplace(ToyModel(), ["GPT2Block"])
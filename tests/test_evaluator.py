@@ -33,3 +33,48 @@ def test_evaluate_cpu(
         model=nn_model_mock, data_loaders=[llm_data_loader_mock], loss_fun=loss_mock, num_train_steps_done=1
     )
     nn_model_mock.forward.assert_has_calls([call(b.samples) for b in batches])
+
+
+def test_evaluate_cpu_with_batch_and_token_caps(
+    monkeypatch, nn_model_mock, loss_mock, llm_data_loader_mock, progress_publisher_mock, set_env_cpu
+):
+    batch_size = 4
+    seq_len = 9
+    num_batches = 6
+    sample_key = "input_ids"
+    target_key = "target_ids"
+
+    sample_tensor = torch.randint(size=(batch_size, seq_len), low=1, high=100)
+    samples = {sample_key: sample_tensor[:, :-1]}
+    targets = {target_key: sample_tensor[:, 1:]}
+
+    batches = [DatasetBatch(targets=targets, samples=samples) for _ in range(num_batches)]
+
+    llm_data_loader_mock.__iter__ = lambda _: iter(batches)
+    llm_data_loader_mock.batch_size = batch_size
+    llm_data_loader_mock.dataloader_tag = "val"
+
+    # batch cap
+    evaluator = Evaluator(
+        batch_progress_publisher=progress_publisher_mock,
+        evaluation_result_publisher=progress_publisher_mock,
+        max_num_eval_batches=2,
+    )
+    evaluator.evaluate(
+        model=nn_model_mock, data_loaders=[llm_data_loader_mock], loss_fun=loss_mock, num_train_steps_done=1
+    )
+    assert nn_model_mock.forward.call_count == 2
+
+    # token cap: each batch has batch_size * (seq_len - 1) = 32 tokens, i.e., the third batch exceeds 70 tokens
+    nn_model_mock.forward.reset_mock()
+    evaluator = Evaluator(
+        batch_progress_publisher=progress_publisher_mock,
+        evaluation_result_publisher=progress_publisher_mock,
+        max_num_eval_tokens=70,
+        use_inference_mode=True,
+    )
+    result_dict = evaluator.evaluate(
+        model=nn_model_mock, data_loaders=[llm_data_loader_mock], loss_fun=loss_mock, num_train_steps_done=1
+    )
+    assert nn_model_mock.forward.call_count == 3
+    assert torch.allclose(result_dict["val"].losses[loss_mock.tag], loss_mock.return_value)
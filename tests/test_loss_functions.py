@@ -2,7 +2,13 @@ import pytest
 import torch
 
 from modalities.batch import InferenceResultBatch
-from modalities.loss_functions import NCELoss, nce_loss
+from modalities.loss_functions import (
+    CLMChunkedCrossEntropyLoss,
+    CLMCrossEntropyLoss,
+    NCELoss,
+    chunked_linear_cross_entropy,
+    nce_loss,
+)
 
 
 @pytest.fixture
@@ -36,3 +42,44 @@ def test_nce_loss_correctness(embedding1, embedding2):
     bidirectional_loss = nce_loss(embedding1, embedding2, device="cpu", is_asymmetric=False, temperature=1.0)
     assert unidirectional_loss == pytest.approx(1.1300, 0.0001)
     assert bidirectional_loss == pytest.approx(2.2577, 0.0001)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 32, 1000])
+def test_chunked_linear_cross_entropy_matches_reference(chunk_size):
+    torch.manual_seed(0)
+    batch_size, sequence_length, n_embd, vocab_size = 2, 16, 8, 50
+    hidden_states = torch.randn(batch_size, sequence_length, n_embd, dtype=torch.float64, requires_grad=True)
+    weight = torch.randn(vocab_size, n_embd, dtype=torch.float64, requires_grad=True)
+    labels = torch.randint(0, vocab_size, (batch_size, sequence_length))
+    labels[0, :3] = -100  # ignored targets
+
+    reference_loss = torch.nn.functional.cross_entropy(
+        (hidden_states @ weight.t()).view(-1, vocab_size), labels.view(-1)
+    )
+    reference_grads = torch.autograd.grad(2.0 * reference_loss, (hidden_states, weight))
+
+    loss = chunked_linear_cross_entropy(hidden_states, weight, labels, chunk_size=chunk_size)
+    grads = torch.autograd.grad(2.0 * loss, (hidden_states, weight))
+
+    assert torch.allclose(loss.double(), reference_loss, atol=1e-6)
+    for grad, reference_grad in zip(grads, reference_grads):
+        assert torch.allclose(grad, reference_grad, atol=1e-6)
+
+
+def test_clm_chunked_cross_entropy_loss_without_grad():
+    hidden_states = torch.randn(2, 4, 8)
+    weight = torch.randn(16, 8)
+    labels = torch.randint(0, 16, (2, 4))
+    result_batch = InferenceResultBatch(
+        targets={"target_ids": labels}, predictions={"hidden_states": hidden_states, "lm_head_weight": weight}
+    )
+    loss_fun = CLMChunkedCrossEntropyLoss(
+        target_key="target_ids", prediction_key="hidden_states", lm_head_weight_key="lm_head_weight", chunk_size=3
+    )
+    reference_loss_fun = CLMCrossEntropyLoss(target_key="target_ids", prediction_key="logits")
+    reference_batch = InferenceResultBatch(
+        targets={"target_ids": labels}, predictions={"logits": hidden_states @ weight.t()}
+    )
+
+    with torch.no_grad():
+        assert torch.allclose(loss_fun(result_batch), reference_loss_fun(reference_batch), atol=1e-5)
@@ -41,3 +41,24 @@ def test_rotary_transform():
         comp_rot_h = torch.cat([-comp_h_2, comp_h_1], dim=-1)
         comp_rot_expected = comp * cos_m_theta + comp_rot_h * sin_m_theta
         assert torch.equal(comp_rot_expected, comp_rot)
+
+
+def test_rotary_transform_shares_cos_sin_tables_across_sequence_lengths():
+    bs, n_heads, embedding_dim = 2, 2, 8
+    head_dim = embedding_dim // n_heads
+    q, k, v = torch.rand(3, bs, n_heads, 6, head_dim)
+
+    rotary_transform = RotaryTransform(n_embd=embedding_dim, n_head=n_heads)
+    other_rotary_transform = RotaryTransform(n_embd=embedding_dim, n_head=n_heads)
+    other_rotary_transform.attention_cache = rotary_transform.attention_cache
+
+    # after processing a longer sequence, a shorter one is served from the cached tables
+    rotary_transform(q=q, k=k, v=v)
+    q_rot, k_rot, _ = other_rotary_transform(q=q[:, :, :4], k=k[:, :, :4], v=v[:, :, :4])
+
+    q_rot_expected, k_rot_expected, _ = RotaryTransform(n_embd=embedding_dim, n_head=n_heads)(
+        q=q[:, :, :4], k=k[:, :, :4], v=v[:, :, :4]
+    )
+    assert torch.equal(q_rot, q_rot_expected)
+    assert torch.equal(k_rot, k_rot_expected)
+    assert len(rotary_transform.attention_cache._tensors) == 1
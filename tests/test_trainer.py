@@ -0,0 +1,182 @@
+from contextlib import contextmanager
+from copy import deepcopy
+from typing import Callable, Dict, List, Tuple
+from unittest.mock import MagicMock
+
+import pytest
+import torch
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+from modalities.batch import DatasetBatch, InferenceResultBatch
+from modalities.loss_functions import CLMCrossEntropyLoss
+from modalities.trainer import Trainer
+from tests.conftest import run_on_cpu_ranks
+
+
+class LinearModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = nn.Linear(4, 8)
+
+    def forward(self, inputs: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        return {"logits": self.linear(inputs["input_ids"])}
+
+
+class NoSyncRecordingModel(LinearModel):
+    """Model with the no_sync context of FSDP, which records for each forward pass whether it ran within it."""
+
+    def __init__(self):
+        super().__init__()
+        self.is_synchronized = True
+        self.forward_synchronization: List[bool] = []
+
+    @contextmanager
+    def no_sync(self):
+        self.is_synchronized = False
+        try:
+            yield
+        finally:
+            self.is_synchronized = True
+
+    def forward(self, inputs: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        self.forward_synchronization.append(self.is_synchronized)
+        return super().forward(inputs)
+
+
+def _train_batches(use_no_sync_for_gradient_accumulation: bool, model: nn.Module, num_batches: int) -> MagicMock:
+    trainer = Trainer(
+        global_rank=0,
+        batch_progress_publisher=MagicMock(),
+        evaluation_result_publisher=MagicMock(),
+        gradient_acc_steps=2,
+        global_num_tokens_per_train_step=1,
+        gradient_clipper=MagicMock(),
+        use_no_sync_for_gradient_accumulation=use_no_sync_for_gradient_accumulation,
+    )
+    optimizer = MagicMock()
+    loss_fun = CLMCrossEntropyLoss("target_ids", "logits")
+    for micro_batch_id in range(num_batches):
+        batch = DatasetBatch(
+            samples={"input_ids": torch.randn(2, 3, 4)}, targets={"target_ids": torch.randint(0, 8, (2, 3))}
+        )
+        trainer._train_batch(
+            batch=batch,
+            model=model,
+            optimizer=optimizer,
+            scheduler=MagicMock(),
+            loss_fun=loss_fun,
+            micro_batch_id=micro_batch_id,
+        )
+    return optimizer
+
+
+@pytest.mark.parametrize(
+    "use_no_sync_for_gradient_accumulation, expected_forward_synchronization",
+    [(True, [False, True, False, True]), (False, [True, True, True, True])],
+)
+def test_train_batch_synchronizes_gradients_only_for_last_micro_batch(
+    use_no_sync_for_gradient_accumulation: bool, expected_forward_synchronization: List[bool]
+):
+    model = NoSyncRecordingModel()
+    optimizer = _train_batches(use_no_sync_for_gradient_accumulation, model, num_batches=4)
+    assert model.forward_synchronization == expected_forward_synchronization
+    assert optimizer.step.call_count == 2
+
+
+def test_train_batch_without_no_sync_context():
+    # models without a no_sync context (i.e., not FSDP wrapped) synchronize their gradients on every micro-batch
+    model = nn.Sequential()
+    model.forward = lambda inputs: {"logits": torch.randn(2, 3, 8, requires_grad=True)}
+    optimizer = _train_batches(use_no_sync_for_gradient_accumulation=True, model=model, num_batches=2)
+    assert optimizer.step.call_count == 1
+
+
+def _get_batches(num_batches: int, seed: int) -> List[DatasetBatch]:
+    generator = torch.Generator().manual_seed(seed)
+    return [
+        DatasetBatch(
+            samples={"input_ids": torch.randn(2, 3, 4, generator=generator)},
+            targets={"target_ids": torch.randint(0, 8, (2, 3), generator=generator)},
+        )
+        for _ in range(num_batches)
+    ]
+
+
+def _train_batches_with_sgd(
+    use_no_sync_for_gradient_accumulation: bool, model: nn.Module, batches: List[DatasetBatch]
+) -> Tuple[List[Dict[str, torch.Tensor]], Dict[str, torch.Tensor]]:
+    # returns the gradients before each optimizer step and the parameters after the last one
+    trainer = Trainer(
+        global_rank=0,
+        batch_progress_publisher=MagicMock(),
+        evaluation_result_publisher=MagicMock(),
+        gradient_acc_steps=2,
+        global_num_tokens_per_train_step=1,
+        gradient_clipper=MagicMock(),
+        use_no_sync_for_gradient_accumulation=use_no_sync_for_gradient_accumulation,
+    )
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    step_grads = []
+    optimizer.register_step_pre_hook(
+        lambda *_: step_grads.append({name: p.grad.clone() for name, p in model.named_parameters()})
+    )
+    loss_fun = CLMCrossEntropyLoss("target_ids", "logits")
+    for micro_batch_id, batch in enumerate(batches):
+        trainer._train_batch(
+            batch=batch,
+            model=model,
+            optimizer=optimizer,
+            scheduler=MagicMock(),
+            loss_fun=loss_fun,
+            micro_batch_id=micro_batch_id,
+        )
+    return step_grads, {name: p.detach().clone() for name, p in model.named_parameters()}
+
+
+def _assert_gradient_accumulation_with_no_sync_matches_per_micro_batch_sync(
+    get_model: Callable[[], nn.Module], batches: List[DatasetBatch]
+):
+    step_grads, parameters = _train_batches_with_sgd(True, get_model(), batches)
+    expected_step_grads, expected_parameters = _train_batches_with_sgd(False, get_model(), batches)
+    assert len(step_grads) == len(expected_step_grads) == len(batches) // 2
+    for grads, expected_grads in zip(step_grads, expected_step_grads):
+        torch.testing.assert_close(grads, expected_grads)
+    torch.testing.assert_close(parameters, expected_parameters)
+
+
+def test_train_batch_gradients_with_no_sync_match_per_micro_batch_sync():
+    torch.manual_seed(0)
+    model = NoSyncRecordingModel()
+    batches = _get_batches(num_batches=4, seed=0)
+    _assert_gradient_accumulation_with_no_sync_matches_per_micro_batch_sync(lambda: deepcopy(model), batches)
+
+    # the accumulated gradients of a step are the mean of the gradients of its micro-batches
+    step_grads, _ = _train_batches_with_sgd(True, deepcopy(model), batches[:2])
+    loss_fun = CLMCrossEntropyLoss("target_ids", "logits")
+    for batch in batches[:2]:
+        result_batch = InferenceResultBatch(targets=batch.targets, predictions=model(batch.samples))
+        (loss_fun(result_batch) / 2).backward()
+    torch.testing.assert_close(step_grads[0], {name: p.grad for name, p in model.named_parameters()})
+
+
+def _get_ddp_model() -> DDP:
+    # the gradients are only all-reduced outside of no_sync
+    torch.manual_seed(0)
+    return DDP(LinearModel())
+
+
+def _check_ddp_gradients_with_no_sync_match_per_micro_batch_sync():
+    # the ranks get different batches
+    batches = _get_batches(num_batches=4, seed=torch.distributed.get_rank())
+    _assert_gradient_accumulation_with_no_sync_matches_per_micro_batch_sync(_get_ddp_model, batches)
+    # the gradients accumulated within no_sync are all-reduced with the last micro-batch
+    step_grads, _ = _train_batches_with_sgd(True, _get_ddp_model(), batches[:2])
+    for grad in step_grads[0].values():
+        all_grads = [torch.zeros_like(grad) for _ in range(torch.distributed.get_world_size())]
+        torch.distributed.all_gather(all_grads, grad)
+        torch.testing.assert_close(all_grads[0], all_grads[1])
+
+
+def test_train_batch_ddp_gradients_with_no_sync_match_per_micro_batch_sync():
+    run_on_cpu_ranks(_check_ddp_gradients_with_no_sync_match_per_micro_batch_sync, 2)
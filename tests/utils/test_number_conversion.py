@@ -1,5 +1,10 @@
+import json
+from pathlib import Path
+
 import pytest
 
+from modalities.dataloader.dataset import PackedMemMapDatasetContinuous
+from modalities.dataloader.packed_data_stats import STATS_FORMAT_VERSION, get_stats_paths
 from modalities.utils.number_conversion import NumberConversion
 
 
@@ -75,3 +80,26 @@ def test_get_num_tokens_from_num_steps_callable(
         )
         == expected
     )
+
+
+@pytest.mark.parametrize("block_size,expected_num_samples", [(2, 19), (3, 9), (20, 1), (21, 0)])
+def test_get_num_samples_from_packed_mem_map_dataset_continuous(
+    dummy_packed_data_path: Path, block_size: int, expected_num_samples: int
+):
+    assert NumberConversion.get_num_tokens_from_packed_data(dummy_packed_data_path) == 20
+    num_samples = NumberConversion.get_num_samples_from_packed_mem_map_dataset_continuous(
+        dummy_packed_data_path, block_size=block_size
+    )
+    assert num_samples == expected_num_samples
+    if expected_num_samples > 0:
+        dataset = PackedMemMapDatasetContinuous(dummy_packed_data_path, sample_key="input_ids", block_size=block_size)
+        assert num_samples == len(dataset)
+    assert NumberConversion.get_num_steps_from_packed_mem_map_dataset_continuous(
+        dummy_packed_data_path, block_size=block_size, num_ranks=2, local_micro_batch_size=2
+    ) == (expected_num_samples // 4)
+
+
+def test_get_num_tokens_from_packed_data_prefers_stats_sidecar(dummy_packed_data_path: Path):
+    stats_path, _ = get_stats_paths(dummy_packed_data_path)
+    stats_path.write_text(json.dumps({"version": STATS_FORMAT_VERSION, "num_tokens": 1234}))
+    assert NumberConversion.get_num_tokens_from_packed_data(dummy_packed_data_path) == 1234